@@ -0,0 +1,445 @@
+"""Downloads files, hashing them as they're downloaded.
+
+If an HTTP(S) server says how big a file is and supports range
+requests, the file is downloaded over DOWNLOAD_SEGMENTS connections at
+once, each fetching its own part of the file. A segment whose
+connection fails picks up from where it stopped instead of starting
+the whole file over, and how far each segment got is kept in a
+progress file next to the download, so that downloading to the same
+path again resumes it. Everything else, including FTP, is streamed
+over a single connection.
+
+Either way the SHA1 and MD5 of the file are computed while it's being
+downloaded and checked against the expected MD5 and size if they're
+known, so the file doesn't need to be read again afterwards.
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Iterator, List, Optional
+
+import requests
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.utils import get_env_variable
+
+logger = get_and_configure_logger(__name__)
+
+
+DOWNLOAD_SEGMENTS = int(get_env_variable("DOWNLOAD_SEGMENTS", "4"))
+# Files are split into fewer segments rather than segments smaller than this.
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+# chunk_size is in bytes
+CHUNK_SIZE = 4 * 1024 * 1024
+# How often each segment records its progress, in bytes.
+PROGRESS_INTERVAL = 64 * 1024 * 1024
+TIMEOUT = 60
+
+
+class DownloadError(Exception):
+    pass
+
+
+class ChecksumMismatchError(DownloadError):
+    pass
+
+
+class DownloadResult:
+    """What was downloaded and how quickly."""
+
+    def __init__(
+        self,
+        url: str,
+        file_path: str,
+        size_in_bytes: int,
+        sha1: str,
+        md5: str,
+        bytes_downloaded: int,
+        seconds: float,
+        num_segments: int,
+        num_retries: int,
+    ):
+        self.url = url
+        self.file_path = file_path
+        self.size_in_bytes = size_in_bytes
+        self.sha1 = sha1
+        self.md5 = md5
+        # Less than size_in_bytes if the download was resumed.
+        self.bytes_downloaded = bytes_downloaded
+        self.seconds = seconds
+        self.num_segments = num_segments
+        self.num_retries = num_retries
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes_downloaded / self.seconds if self.seconds else 0.0
+
+    def get_metrics(self) -> dict:
+        """Returns the throughput of the download, for logging."""
+        return {
+            "size_in_bytes": self.size_in_bytes,
+            "bytes_downloaded": self.bytes_downloaded,
+            "seconds": round(self.seconds, 3),
+            "bytes_per_second": round(self.bytes_per_second),
+            "num_segments": self.num_segments,
+            "num_retries": self.num_retries,
+        }
+
+
+class Segment:
+    """The bytes of a file from `start` up to but not including `end`."""
+
+    def __init__(self, start: int, end: int, written: int = 0):
+        self.start = start
+        self.end = end
+        self.written = written
+
+    @property
+    def position(self) -> int:
+        return self.start + self.written
+
+    @property
+    def is_done(self) -> bool:
+        return self.position >= self.end
+
+
+def plan_segments(size_in_bytes: int, num_segments: int) -> List[Segment]:
+    """Splits a file into `num_segments` segments, or fewer if they'd be
+    smaller than MIN_SEGMENT_SIZE."""
+    num_segments = max(1, min(num_segments, size_in_bytes // MIN_SEGMENT_SIZE))
+    segment_size = -(-size_in_bytes // num_segments)
+    return [
+        Segment(start, min(start + segment_size, size_in_bytes))
+        for start in range(0, size_in_bytes, segment_size)
+    ]
+
+
+class Backoff:
+    """Sleeps before retries using exponential backoff
+    (https://en.wikipedia.org/wiki/Exponential_backoff), and counts them."""
+
+    def __init__(self, backoff_factor: int, max_retries: int, max_sleep_timeout: int):
+        self.backoff_factor = backoff_factor
+        self.max_retries = max_retries
+        self.max_sleep_timeout = max_sleep_timeout
+        self.num_retries = 0
+        self.lock = threading.Lock()
+
+    def retry(self, attempt: int) -> bool:
+        """Returns False if `attempt` was the last one, otherwise sleeps
+        before the next. `attempt` starts at 1."""
+        if attempt >= self.max_retries:
+            return False
+
+        with self.lock:
+            self.num_retries += 1
+
+        # After the attempt-th failed attempt, retry after k*backoff_factor,
+        # where k is a random integer between 0 and 2^attempt − 1.
+        k = random.randint(0, 2 ** attempt - 1)
+        time.sleep(min(k * self.backoff_factor, self.max_sleep_timeout))
+        return True
+
+
+class SequentialHasher:
+    """Computes the SHA1 and MD5 of a file whose segments are being written at the same time.
+
+    Hashes have to be computed in order, so this follows along behind
+    the writers, reading each segment back as far as it's been written.
+    What it reads was just written, so it comes from the page cache
+    rather than the disk.
+    """
+
+    def __init__(self, fd: int, segments: List[Segment]):
+        self.fd = fd
+        self.segments = segments
+        self.sha1 = hashlib.sha1()
+        self.md5 = hashlib.md5()
+        self.position = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def notify(self):
+        """Lets the hasher know a segment has been written further."""
+        with self.condition:
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        for segment in self.segments:
+            while self.position < segment.end:
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: self.stopped or segment.position > self.position
+                    )
+                if self.stopped:
+                    return
+
+                written_to = segment.position
+                while self.position < written_to:
+                    data = os.pread(
+                        self.fd, min(CHUNK_SIZE, written_to - self.position), self.position
+                    )
+                    self.sha1.update(data)
+                    self.md5.update(data)
+                    self.position += len(data)
+
+
+def _get_progress_path(target_file_path: str) -> str:
+    return target_file_path + ".progress"
+
+
+def _load_progress(target_file_path: str, url: str, size_in_bytes: int) -> Optional[List[Segment]]:
+    """Returns the segments of an earlier download of `url` to `target_file_path`, if any."""
+    if not os.path.exists(target_file_path):
+        return None
+
+    try:
+        with open(_get_progress_path(target_file_path)) as progress_file:
+            progress = json.load(progress_file)
+    except (OSError, ValueError):
+        return None
+
+    if progress["url"] != url or progress["size_in_bytes"] != size_in_bytes:
+        return None
+
+    return [Segment(*segment) for segment in progress["segments"]]
+
+
+def _save_progress(target_file_path: str, url: str, size_in_bytes: int, segments: List[Segment]):
+    progress_path = _get_progress_path(target_file_path)
+    with open(progress_path + ".tmp", "w") as progress_file:
+        json.dump(
+            {
+                "url": url,
+                "size_in_bytes": size_in_bytes,
+                "segments": [[segment.start, segment.end, segment.written] for segment in segments],
+            },
+            progress_file,
+        )
+    os.replace(progress_path + ".tmp", progress_path)
+
+
+def _get_range_support(url: str) -> (Optional[int], bool):
+    """Returns the size of the file at `url` if the server says, and
+    whether it supports range requests."""
+    if not url.startswith("http://") and not url.startswith("https://"):
+        return None, False
+
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException:
+        return None, False
+
+    if response.status_code != 200 or "Content-Length" not in response.headers:
+        return None, False
+
+    accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return int(response.headers["Content-Length"]), accepts_ranges
+
+
+def _download_segment(url: str, fd: int, segment: Segment, on_progress, backoff: Backoff):
+    attempt = 1
+    while not segment.is_done:
+        try:
+            headers = {"Range": "bytes={}-{}".format(segment.position, segment.end - 1)}
+            with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                if response.status_code != 206:
+                    raise DownloadError(
+                        "Expected a partial response but got {}".format(response.status_code)
+                    )
+
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    # Never write past the segment, in case the server does.
+                    chunk = chunk[: segment.end - segment.position]
+                    while chunk:
+                        num_written = os.pwrite(fd, chunk, segment.position)
+                        segment.written += num_written
+                        chunk = chunk[num_written:]
+                        on_progress(num_written)
+
+            if not segment.is_done:
+                raise DownloadError("The connection closed before the segment was downloaded.")
+        except Exception:
+            if not backoff.retry(attempt):
+                raise
+            attempt += 1
+
+
+def _download_segments(
+    url: str, target_file_path: str, size_in_bytes: int, num_segments: int, backoff: Backoff
+) -> (str, str, int, int):
+    """Downloads `url` in segments, resuming an earlier download if there was one.
+
+    Returns the SHA1 and MD5 of the file, how many bytes were
+    downloaded and how many segments were used.
+    """
+    segments = _load_progress(target_file_path, url, size_in_bytes)
+    if segments:
+        logger.info(
+            "Resuming download.",
+            url=url,
+            bytes_already_downloaded=sum(segment.written for segment in segments),
+        )
+    else:
+        segments = plan_segments(size_in_bytes, num_segments)
+
+    fd = os.open(target_file_path, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, size_in_bytes)
+        _save_progress(target_file_path, url, size_in_bytes, segments)
+
+        progress_lock = threading.Lock()
+        bytes_downloaded = 0
+        bytes_since_save = 0
+
+        def on_progress(num_bytes):
+            nonlocal bytes_downloaded, bytes_since_save
+            hasher.notify()
+            with progress_lock:
+                bytes_downloaded += num_bytes
+                bytes_since_save += num_bytes
+                if bytes_since_save >= PROGRESS_INTERVAL:
+                    bytes_since_save = 0
+                    _save_progress(target_file_path, url, size_in_bytes, segments)
+
+        hasher = SequentialHasher(fd, segments)
+        hasher_thread = threading.Thread(target=hasher.run, daemon=True)
+        hasher_thread.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                futures = [
+                    executor.submit(_download_segment, url, fd, segment, on_progress, backoff)
+                    for segment in segments
+                ]
+                for future in futures:
+                    future.result()
+        except Exception:
+            hasher.stop()
+            with progress_lock:
+                _save_progress(target_file_path, url, size_in_bytes, segments)
+            raise
+
+        hasher_thread.join()
+    finally:
+        os.close(fd)
+
+    os.remove(_get_progress_path(target_file_path))
+    return hasher.sha1.hexdigest(), hasher.md5.hexdigest(), bytes_downloaded, len(segments)
+
+
+def _stream(url: str) -> Iterator[bytes]:
+    if url.startswith("http://") or url.startswith("https://"):
+        with requests.get(url, stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    yield chunk
+    else:
+        # Ancient unresolved bug. WTF python: https://bugs.python.org/issue27973
+        urllib.request.urlcleanup()
+        with closing(urllib.request.urlopen(url, timeout=TIMEOUT)) as response:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                yield chunk
+        urllib.request.urlcleanup()
+
+
+def _download_stream(url: str, target_file_path: str, backoff: Backoff) -> (str, str, int, int):
+    """Downloads `url` over a single connection, starting over if it fails."""
+    attempt = 1
+    bytes_downloaded = 0
+    while True:
+        sha1 = hashlib.sha1()
+        md5 = hashlib.md5()
+        try:
+            with open(target_file_path, "wb") as target_file:
+                for chunk in _stream(url):
+                    target_file.write(chunk)
+                    sha1.update(chunk)
+                    md5.update(chunk)
+                    bytes_downloaded += len(chunk)
+
+            return sha1.hexdigest(), md5.hexdigest(), bytes_downloaded, 1
+        except Exception:
+            if not backoff.retry(attempt):
+                raise
+            attempt += 1
+
+
+def download_file(
+    download_url: str,
+    target_file_path: str,
+    *,
+    expected_md5: str = None,
+    expected_size_in_bytes: int = None,
+    num_segments: int = DOWNLOAD_SEGMENTS,
+    backoff_factor: int = 8,
+    max_retries: int = 10,
+    max_sleep_timeout: int = 120  # 2 mins
+) -> DownloadResult:
+    """Downloads the given url into `target_file_path`.
+
+    The download will be retried `max_retries` times if it fails for
+    any reason, using exponential backoff. If the file's size or MD5
+    don't match what's expected, the file is removed and a
+    ChecksumMismatchError is raised.
+    """
+    start_time = time.monotonic()
+    backoff = Backoff(backoff_factor, max_retries, max_sleep_timeout)
+
+    size_in_bytes, accepts_ranges = _get_range_support(download_url)
+    if expected_size_in_bytes and size_in_bytes and size_in_bytes != int(expected_size_in_bytes):
+        raise ChecksumMismatchError(
+            "{} is {} bytes but {} were expected.".format(
+                download_url, size_in_bytes, expected_size_in_bytes
+            )
+        )
+
+    if size_in_bytes and accepts_ranges:
+        sha1, md5, bytes_downloaded, num_segments = _download_segments(
+            download_url, target_file_path, size_in_bytes, num_segments, backoff
+        )
+    else:
+        sha1, md5, bytes_downloaded, num_segments = _download_stream(
+            download_url, target_file_path, backoff
+        )
+
+    result = DownloadResult(
+        download_url,
+        target_file_path,
+        os.path.getsize(target_file_path),
+        sha1,
+        md5,
+        bytes_downloaded,
+        time.monotonic() - start_time,
+        num_segments,
+        backoff.num_retries,
+    )
+
+    size_mismatch = expected_size_in_bytes and result.size_in_bytes != int(expected_size_in_bytes)
+    if (expected_md5 and result.md5 != expected_md5) or size_mismatch:
+        os.remove(target_file_path)
+        raise ChecksumMismatchError(
+            "{} didn't match: expected md5 {} and {} bytes, got {} and {} bytes.".format(
+                download_url,
+                expected_md5,
+                expected_size_in_bytes,
+                result.md5,
+                result.size_in_bytes,
+            )
+        )
+
+    logger.info("Downloaded file.", url=download_url, **result.get_metrics())
+    return result
@@ -1,20 +1,21 @@
-from typing import List
+from typing import List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
 
 from data_refinery_common.enums import Downloaders, ProcessorPipeline
-from data_refinery_common.job_lookup import (
-    determine_downloader_task,
-    determine_processor_pipeline,
-    determine_ram_amount,
-)
+from data_refinery_common.job_lookup import determine_downloader_task, determine_processor_pipeline
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.message_queue import send_job
+from data_refinery_common.message_queue import send_job, send_jobs
 from data_refinery_common.models import (
     DownloaderJob,
     DownloaderJobOriginalFileAssociation,
     OriginalFile,
     ProcessorJob,
     ProcessorJobOriginalFileAssociation,
+    Sample,
 )
+from data_refinery_common.ram_estimation import estimate_ram_amount
 
 logger = get_and_configure_logger(__name__)
 
@@ -128,6 +129,22 @@ def create_downloader_job(
         accession_code = original_downloader_job.accession_code
         original_files = original_downloader_job.original_files.all()
 
+    with transaction.atomic():
+        _create_recreated_downloader_job(
+            downloader_task, accession_code, original_files, archive_file, processor_job_id
+        )
+
+    return True
+
+
+def _create_recreated_downloader_job(
+    downloader_task: str,
+    accession_code: str,
+    original_files: List[OriginalFile],
+    archive_file: Optional[OriginalFile],
+    processor_job_id=None,
+) -> DownloaderJob:
+    """Creates the DownloaderJob for create_downloader_job and associates its files with it."""
     new_job = DownloaderJob()
     new_job.downloader_task = downloader_task
     new_job.accession_code = accession_code
@@ -152,41 +169,43 @@ def create_downloader_job(
                 archive_file.is_downloaded = False
                 archive_file.save()
 
-            DownloaderJobOriginalFileAssociation.objects.get_or_create(
+            DownloaderJobOriginalFileAssociation.objects.create(
                 downloader_job=new_job, original_file=archive_file
             )
     else:
         # We can't just associate the undownloaded files, because
         # there's a chance that there is a file which actually is
         # downloaded that also needs to be associated with the job.
-        for original_file in original_files:
-            DownloaderJobOriginalFileAssociation.objects.get_or_create(
-                downloader_job=new_job, original_file=original_file
-            )
+        DownloaderJobOriginalFileAssociation.objects.bulk_create(
+            [
+                DownloaderJobOriginalFileAssociation(
+                    downloader_job=new_job, original_file=original_file
+                )
+                for original_file in original_files
+            ]
+        )
 
-    return True
+    return new_job
 
 
-def create_processor_jobs_for_original_files(
-    original_files: List[OriginalFile], downloader_job: DownloaderJob = None,
-):
-    """
-    Creates one processor job for each original file given.
-    """
-    for original_file in original_files:
-        create_processor_job_for_original_files([original_file], downloader_job)
+def _prefetch_samples(original_files: List[OriginalFile]) -> None:
+    """Looks up the samples of all of `original_files` in one query."""
+    # Ordered so the first sample is the same one `samples.first()` would be.
+    prefetch_related_objects(
+        original_files, Prefetch("samples", queryset=Sample.objects.order_by("id"))
+    )
 
 
-def create_processor_job_for_original_files(
-    original_files: List[OriginalFile], downloader_job: DownloaderJob = None,
-):
-    """
-    Create a processor job and queue a processor task for sample related to an experiment.
-    """
-    # If there's no acceptable original files then we've created all the jobs we need to!
-    if len(original_files) == 0:
-        return
+def _prepare_processor_job(
+    original_files: List[OriginalFile], downloader_job: DownloaderJob = None
+) -> Tuple[Optional[ProcessorJob], ProcessorPipeline]:
+    """Works out which pipeline `original_files` need and builds an
+    unsaved processor job for them.
 
+    Returns None instead of a job if there's no pipeline for them.
+    The samples of `original_files` need to have been prefetched by
+    _prefetch_samples.
+    """
     # If there's more than one original file we should prefer one with raw data.
     original_file_to_use = original_files[0]
     for original_file in original_files:
@@ -203,7 +222,7 @@ def create_processor_job_for_original_files(
             original_file_to_use = original_file
 
     # For anything that has raw data there should only be one Sample per OriginalFile
-    sample_object = original_file_to_use.samples.first()
+    sample_object = next(iter(original_file_to_use.samples.all()), None)
     pipeline_to_apply = determine_processor_pipeline(sample_object, original_file_to_use)
 
     if pipeline_to_apply == ProcessorPipeline.NONE:
@@ -214,29 +233,111 @@ def create_processor_job_for_original_files(
         )
         for original_file in original_files:
             original_file.delete_local_file()
-    else:
-        processor_job = ProcessorJob()
-        processor_job.downloader_job = downloader_job
-        processor_job.pipeline_applied = pipeline_to_apply.value
-        processor_job.ram_amount = determine_ram_amount(processor_job, sample_object)
 
-        processor_job.save()
+        return None, pipeline_to_apply
 
-        for original_file in original_files:
-            assoc = ProcessorJobOriginalFileAssociation()
-            assoc.original_file = original_file
-            assoc.processor_job = processor_job
-            assoc.save()
-
-        logger.debug(
-            "Queuing processor job.",
-            processor_job=processor_job.id,
-            downloader_job=downloader_job.id if downloader_job else None,
+    processor_job = ProcessorJob()
+    processor_job.downloader_job = downloader_job
+    processor_job.pipeline_applied = pipeline_to_apply.value
+    processor_job.ram_amount = estimate_ram_amount(processor_job, sample_object, original_files)
+
+    return processor_job, pipeline_to_apply
+
+
+def create_processor_jobs_for_original_files(
+    original_files: List[OriginalFile], downloader_job: DownloaderJob = None,
+):
+    """
+    Creates one processor job for each original file given.
+
+    This does the same thing as calling
+    create_processor_job_for_original_files for each file, but the
+    samples for all of the files are looked up at once, the jobs and
+    their associations are created with bulk inserts in one
+    transaction, and the jobs are queued with send_jobs.
+    """
+    original_files = list(original_files)
+    if not original_files:
+        return
+
+    _prefetch_samples(original_files)
+
+    jobs_to_create = []
+    for original_file in original_files:
+        processor_job, pipeline_to_apply = _prepare_processor_job([original_file], downloader_job)
+        if processor_job:
+            jobs_to_create.append((processor_job, pipeline_to_apply, original_file))
+
+    if not jobs_to_create:
+        return
+
+    with transaction.atomic():
+        processor_jobs = ProcessorJob.objects.bulk_create([job for job, _, _ in jobs_to_create])
+        ProcessorJobOriginalFileAssociation.objects.bulk_create(
+            [
+                ProcessorJobOriginalFileAssociation(
+                    processor_job=processor_job, original_file=original_file
+                )
+                for processor_job, (_, _, original_file) in zip(processor_jobs, jobs_to_create)
+            ]
         )
 
-        try:
-            send_job(pipeline_to_apply, processor_job)
-        except Exception:
-            # If we cannot queue the job now the Foreman will do
-            # it later.
-            pass
+    logger.debug(
+        "Queuing %d processor jobs.",
+        len(processor_jobs),
+        downloader_job=downloader_job.id if downloader_job else None,
+    )
+
+    try:
+        send_jobs(
+            [
+                (pipeline_to_apply, processor_job)
+                for processor_job, (_, pipeline_to_apply, _) in zip(processor_jobs, jobs_to_create)
+            ]
+        )
+    except Exception:
+        # If we cannot queue the jobs now the Foreman will do
+        # it later.
+        pass
+
+
+def create_processor_job_for_original_files(
+    original_files: List[OriginalFile], downloader_job: DownloaderJob = None,
+):
+    """
+    Create a processor job and queue a processor task for sample related to an experiment.
+    """
+    # If there's no acceptable original files then we've created all the jobs we need to!
+    if len(original_files) == 0:
+        return
+
+    original_files = list(original_files)
+    _prefetch_samples(original_files)
+
+    processor_job, pipeline_to_apply = _prepare_processor_job(original_files, downloader_job)
+    if not processor_job:
+        return
+
+    processor_job.save()
+
+    ProcessorJobOriginalFileAssociation.objects.bulk_create(
+        [
+            ProcessorJobOriginalFileAssociation(
+                processor_job=processor_job, original_file=original_file
+            )
+            for original_file in original_files
+        ]
+    )
+
+    logger.debug(
+        "Queuing processor job.",
+        processor_job=processor_job.id,
+        downloader_job=downloader_job.id if downloader_job else None,
+    )
+
+    try:
+        send_job(pipeline_to_apply, processor_job)
+    except Exception:
+        # If we cannot queue the job now the Foreman will do
+        # it later.
+        pass
@@ -2,17 +2,23 @@
 
 from __future__ import absolute_import, unicode_literals
 
-import datetime
-import sys
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
 
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.utils import timezone
 
 import boto3
 
 from data_refinery_common.enums import Downloaders, ProcessorPipeline, SurveyJobTypes
 from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.models import DownloaderJob, JobQueueDepth, SurveyJob
 from data_refinery_common.utils import get_env_variable
 
 logger = get_and_configure_logger(__name__)
@@ -30,76 +36,239 @@ JOB_DEFINITION_PREFIX = get_env_variable("JOB_DEFINITION_PREFIX", "")
 BATCH_TRANSCRIPTOME_JOB = "TRANSCRIPTOME_INDEX"
 BATCH_DOWNLOADER_JOB = "DOWNLOADER"
 NONE_JOB_ERROR_TEMPLATE = "send_job was called with NONE job_type: {} for {} job {}"
-TIME_OF_LAST_JOB_CHECK = timezone.now() - datetime.timedelta(minutes=10)
+# How many jobs send_jobs submits to Batch at once.
+SEND_JOBS_MAX_THREADS = int(get_env_variable("SEND_JOBS_MAX_THREADS", "8"))
+# Smasher, tximport, and janitor jobs don't have RAM tiers, their job
+# definitions in workers/batch-job-templates always give them this
+# much RAM in MB.
+UNTIERED_JOB_RAM_AMOUNTS = {
+    ProcessorPipeline.SMASHER.value: 28000,
+    ProcessorPipeline.TXIMPORT.value: 32768,
+    ProcessorPipeline.JANITOR.value: 256,
+}
 
 
 batch = boto3.client("batch", region_name=AWS_REGION)
 
-# Initialize the queue depths to zero to be used as a global.
-JOB_QUEUE_DEPTHS = {}
-for queue_name in settings.AWS_BATCH_QUEUE_ALL_NAMES:
-    JOB_QUEUE_DEPTHS[queue_name] = 0
+# Batch job statuses of jobs that are waiting to run and that are running.
+QUEUED_JOB_STATUSES = ["SUBMITTED", "PENDING", "RUNNABLE"]
+RUNNING_JOB_STATUSES = ["STARTING", "RUNNING"]
 
-DOWNLOADER_JOB_QUEUE_DEPTHS = {}
-for queue_name in settings.AWS_BATCH_QUEUE_WORKERS_NAMES:
-    DOWNLOADER_JOB_QUEUE_DEPTHS[queue_name] = 0
+
+def get_job_type_from_batch_job_name(batch_job_name: str) -> str:
+    """Returns the job type get_job_name would have given the Batch job
+    named `batch_job_name`, which is it with the RAM amount and job id
+    stripped off."""
+    if batch_job_name.startswith(JOB_DEFINITION_PREFIX):
+        batch_job_name = batch_job_name[len(JOB_DEFINITION_PREFIX) :]
+
+    return re.sub(r"(_\d+)+$", "", batch_job_name)
+
+
+def get_ram_amount_from_batch_job_name(batch_job_name: str) -> int:
+    """Returns the RAM amount in MB that send_job put into the name of
+    the Batch job named `batch_job_name`.
+
+    Jobs without RAM tiers get what their job definition gives them,
+    the same amount the ledger counts for them."""
+    match = re.search(r"_(\d+)_\d+$", batch_job_name)
+    if not match:
+        return UNTIERED_JOB_RAM_AMOUNTS.get(get_job_type_from_batch_job_name(batch_job_name), 0)
+
+    return int(match.group(1))
 
 
 def count_jobs_in_queue(batch_job_queue) -> dict:
-    """Counts how many jobs are in the job queue that aren't finished.
+    """Counts how many jobs of each type are in the job queue that aren't finished.
 
-    Also returns how many of those are downloader jobs."""
-    try:
-        num_jobs = 0
-        num_downloader_jobs = 0
+    Returns a dict from job type to a (num_queued, num_running, ram_amount) tuple."""
+    counts = defaultdict(lambda: [0, 0, 0])
 
-        # AWS Batch only returns one status at a time and doesn't provide a `count` or `total`.
-        for status in ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"]:
-            list_jobs_dict = batch.list_jobs(jobQueue=batch_job_queue, jobStatus=status)
+    # AWS Batch only returns one status at a time and doesn't provide a `count` or `total`.
+    for status in QUEUED_JOB_STATUSES + RUNNING_JOB_STATUSES:
+        is_running = status in RUNNING_JOB_STATUSES
+        list_jobs_dict = batch.list_jobs(jobQueue=batch_job_queue, jobStatus=status)
 
-            def is_downloader(job_json):
-                return job_json["jobName"].startswith("Downloader")
+        while True:
+            for job_summary in list_jobs_dict["jobSummaryList"]:
+                job_type = get_job_type_from_batch_job_name(job_summary["jobName"])
+                counts[job_type][is_running] += 1
+                counts[job_type][2] += get_ram_amount_from_batch_job_name(job_summary["jobName"])
 
-            num_jobs += len(list_jobs_dict["jobSummaryList"])
-            num_downloader_jobs += len(
-                list(filter(is_downloader, list_jobs_dict["jobSummaryList"]))
+            if not list_jobs_dict.get("nextToken"):
+                break
+
+            list_jobs_dict = batch.list_jobs(
+                jobQueue=batch_job_queue, jobStatus=status, nextToken=list_jobs_dict["nextToken"],
             )
-            while "nextToken" in list_jobs_dict and list_jobs_dict["nextToken"]:
-                list_jobs_dict = batch.list_jobs(
-                    jobQueue=batch_job_queue,
-                    jobStatus=status,
-                    nextToken=list_jobs_dict["nextToken"],
-                )
-                num_jobs += len(list_jobs_dict["jobSummaryList"])
-                num_downloader_jobs += len(
-                    list(filter(is_downloader, list_jobs_dict["jobSummaryList"]))
+
+    return {job_type: tuple(count) for job_type, count in counts.items()}
+
+
+def reconcile_job_queue_depths():
+    """Replaces the counts in the JobQueueDepth ledger with what Batch reports.
+
+    The ledger drifts when jobs die without finishing, so this should
+    be called periodically. This is the only thing that still pages
+    through Batch's list_jobs."""
+    for batch_job_queue in settings.AWS_BATCH_QUEUE_ALL_NAMES:
+        try:
+            counts = count_jobs_in_queue(batch_job_queue)
+        except Exception:
+            logger.exception(
+                "Unable to reconcile job queue depths with Batch.", batch_job_queue=batch_job_queue
+            )
+            continue
+
+        now = timezone.now()
+        with transaction.atomic():
+            JobQueueDepth.objects.filter(batch_job_queue=batch_job_queue).exclude(
+                job_type__in=counts.keys()
+            ).update(
+                num_queued=0, num_running=0, ram_amount=0, last_reconciled_at=now, last_modified=now
+            )
+
+            for job_type, (num_queued, num_running, ram_amount) in counts.items():
+                JobQueueDepth.objects.update_or_create(
+                    batch_job_queue=batch_job_queue,
+                    job_type=job_type,
+                    defaults={
+                        "num_queued": num_queued,
+                        "num_running": num_running,
+                        "ram_amount": ram_amount,
+                        "last_reconciled_at": now,
+                        "last_modified": now,
+                    },
                 )
-    except Exception:
-        logger.exception("Unable to determine number of Batch jobs.")
-        # Can't query Batch, return an impossibly high number to prevent
-        # additonal queuing from happening:
-        num_jobs = sys.maxsize
-        num_downloader_jobs = sys.maxsize
 
-    return {"all_jobs": num_jobs, "downloader_jobs": num_downloader_jobs}
 
+def _adjust_job_queue_depth(
+    batch_job_queue: str, job_type: str, queued: int, running: int, ram_amount: int = 0
+):
+    """Adds `queued`, `running` and `ram_amount` to the ledger's counts
+    for `job_type` in `batch_job_queue`."""
+    now = timezone.now()
+    updates = {
+        "num_queued": Greatest(F("num_queued") + queued, 0),
+        "num_running": Greatest(F("num_running") + running, 0),
+        "ram_amount": Greatest(F("ram_amount") + ram_amount, 0),
+        "last_modified": now,
+    }
+
+    if JobQueueDepth.objects.filter(batch_job_queue=batch_job_queue, job_type=job_type).update(
+        **updates
+    ):
+        return
 
-def get_job_queue_depths(window=datetime.timedelta(minutes=2)):
-    global TIME_OF_LAST_JOB_CHECK
-    global JOB_QUEUE_DEPTHS
-    global DOWNLOADER_JOB_QUEUE_DEPTHS
+    try:
+        with transaction.atomic():
+            JobQueueDepth.objects.create(
+                batch_job_queue=batch_job_queue,
+                job_type=job_type,
+                num_queued=max(queued, 0),
+                num_running=max(running, 0),
+                ram_amount=max(ram_amount, 0),
+                last_modified=now,
+            )
+    except IntegrityError:
+        # Another process created it first.
+        JobQueueDepth.objects.filter(batch_job_queue=batch_job_queue, job_type=job_type).update(
+            **updates
+        )
 
-    if timezone.now() - TIME_OF_LAST_JOB_CHECK > window:
-        for job_queue in settings.AWS_BATCH_QUEUE_ALL_NAMES:
-            job_count_dict = count_jobs_in_queue(job_queue)
-            JOB_QUEUE_DEPTHS[job_queue] = job_count_dict["all_jobs"]
 
-            if job_queue in settings.AWS_BATCH_QUEUE_WORKERS_NAMES:
-                DOWNLOADER_JOB_QUEUE_DEPTHS[job_queue] = job_count_dict["downloader_jobs"]
+def _get_ledger_job_type(job) -> str:
+    """Returns the job type the ledger counts `job` under, or None if it isn't a Batch job."""
+    if isinstance(job, DownloaderJob):
+        return BATCH_DOWNLOADER_JOB
+    elif isinstance(job, SurveyJob):
+        return SurveyJobTypes.SURVEYOR.value
 
-        TIME_OF_LAST_JOB_CHECK = timezone.now()
+    try:
+        return get_job_name(ProcessorPipeline[job.pipeline_applied], job.id)
+    except (KeyError, ValueError):
+        return None
 
-    return {"all_jobs": JOB_QUEUE_DEPTHS, "downloader_jobs": DOWNLOADER_JOB_QUEUE_DEPTHS}
+
+def get_job_ram_amount(job) -> int:
+    """Returns how much RAM in MB `job` takes up on its node.
+
+    That's its ram_amount, unless it's a job without RAM tiers."""
+    if not job:
+        return 0
+
+    ledger_job_type = _get_ledger_job_type(job)
+    if ledger_job_type in UNTIERED_JOB_RAM_AMOUNTS:
+        return UNTIERED_JOB_RAM_AMOUNTS[ledger_job_type]
+
+    return job.ram_amount or 0
+
+
+def record_job_queued(job):
+    """Records in the ledger that `job` was just sent to its Batch job queue."""
+    ledger_job_type = _get_ledger_job_type(job)
+    if job.batch_job_queue and ledger_job_type:
+        _adjust_job_queue_depth(
+            job.batch_job_queue,
+            ledger_job_type,
+            queued=1,
+            running=0,
+            ram_amount=get_job_ram_amount(job),
+        )
+
+
+def record_job_started(job):
+    """Records in the ledger that `job` has started running.
+
+    Jobs that weren't sent to Batch, such as ones run by hand, aren't counted."""
+    ledger_job_type = _get_ledger_job_type(job)
+    if job.batch_job_id and job.batch_job_queue and ledger_job_type:
+        _adjust_job_queue_depth(job.batch_job_queue, ledger_job_type, queued=-1, running=1)
+
+
+def record_job_finished(job):
+    """Records in the ledger that `job` has left its Batch job queue, whether
+    it finished running or was terminated before it started."""
+    ledger_job_type = _get_ledger_job_type(job)
+    if job.batch_job_id and job.batch_job_queue and ledger_job_type:
+        queued, running = (0, -1) if job.start_time else (-1, 0)
+        _adjust_job_queue_depth(
+            job.batch_job_queue,
+            ledger_job_type,
+            queued=queued,
+            running=running,
+            ram_amount=-get_job_ram_amount(job),
+        )
+
+
+def get_job_queue_depths():
+    """Returns how many unfinished jobs are in each job queue, how
+    many of those are downloader jobs, and how much RAM in MB they were
+    given, according to the ledger."""
+    job_queue_depths = {queue_name: 0 for queue_name in settings.AWS_BATCH_QUEUE_ALL_NAMES}
+    job_queue_ram_amounts = {queue_name: 0 for queue_name in settings.AWS_BATCH_QUEUE_ALL_NAMES}
+    downloader_job_queue_depths = {
+        queue_name: 0 for queue_name in settings.AWS_BATCH_QUEUE_WORKERS_NAMES
+    }
+
+    for depth in JobQueueDepth.objects.filter(
+        batch_job_queue__in=settings.AWS_BATCH_QUEUE_ALL_NAMES
+    ).values("batch_job_queue", "job_type", "num_queued", "num_running", "ram_amount"):
+        num_jobs = depth["num_queued"] + depth["num_running"]
+        job_queue_depths[depth["batch_job_queue"]] += num_jobs
+        job_queue_ram_amounts[depth["batch_job_queue"]] += depth["ram_amount"]
+
+        if (
+            depth["job_type"] == BATCH_DOWNLOADER_JOB
+            and depth["batch_job_queue"] in downloader_job_queue_depths
+        ):
+            downloader_job_queue_depths[depth["batch_job_queue"]] += num_jobs
+
+    return {
+        "all_jobs": job_queue_depths,
+        "downloader_jobs": downloader_job_queue_depths,
+        "ram_amounts": job_queue_ram_amounts,
+    }
 
 
 def get_job_queue_depth(job_queue_name):
@@ -152,42 +321,102 @@ def get_capacity_for_downloader_jobs() -> int:
     return min(downloader_capacity, overall_capacity)
 
 
-def increment_job_queue_depth(job_queue_name):
-    global DOWNLOADER_JOB_QUEUE_DEPTHS
-    JOB_QUEUE_DEPTHS[job_queue_name] += 1
+def choose_job_queue(
+    ram_amount: int,
+    job_queues: List[str],
+    job_queue_depths: Dict[str, int],
+    job_queue_ram_amounts: Dict[str, int],
+    max_jobs_per_node: int,
+    max_ram_per_node: int,
+) -> Optional[str]:
+    """Picks which of `job_queues` a job that needs `ram_amount` MB should go to.
+
+    Each worker queue has its own node, so a job can only go to a queue
+    that has no more than `max_jobs_per_node` jobs and enough of
+    `max_ram_per_node` left for it. Of those, the queue the job fits
+    best, the one that will have the least RAM left over, is picked.
+    That keeps the big gaps free for big jobs rather than spreading
+    small jobs across every node.
+
+    Returns None if no queue has room for the job.
+    """
+    best_job_queue = None
+    best_ram_left = None
+    for job_queue in job_queues:
+        if job_queue_depths[job_queue] > max_jobs_per_node:
+            continue
+
+        ram_left = max_ram_per_node - job_queue_ram_amounts[job_queue] - ram_amount
+        if ram_left < 0:
+            continue
+
+        if best_ram_left is None or ram_left < best_ram_left:
+            best_job_queue = job_queue
+            best_ram_left = ram_left
+
+    return best_job_queue
 
 
-def increment_downloader_job_queue_depth(job_queue_name):
-    global DOWNLOADER_JOB_QUEUE_DEPTHS
-    DOWNLOADER_JOB_QUEUE_DEPTHS[job_queue_name] += 1
+def _log_no_room(job, ram_amount: int, **kwargs):
+    if ram_amount > settings.MAX_RAM_PER_NODE:
+        logger.warn(
+            "Job needs more RAM than any node has, so it can't be queued.",
+            job_id=job.id if job else None,
+            ram_amount=ram_amount,
+            max_ram_per_node=settings.MAX_RAM_PER_NODE,
+            **kwargs,
+        )
 
 
-def get_batch_queue_for_downloader_job():
+def get_batch_queue_for_downloader_job(job=None):
     """Logic for distributing downloader jobs across queues.
     """
-    job_queue_depths = get_job_queue_depths()["downloader_jobs"]
-    for job_queue in settings.AWS_BATCH_QUEUE_WORKERS_NAMES:
-        if job_queue_depths[job_queue] <= settings.MAX_DOWNLOADER_JOBS_PER_NODE:
-            return job_queue
-
+    ram_amount = get_job_ram_amount(job)
+    job_queue_depths = get_job_queue_depths()
     # If none of the job queues have capacity for downloader
     # jobs do not queue the job. This ensures we actually
     # process data we download rather than overloading the
     # instance with downloader jobs until its disk is full.
-    return None
+    job_queues = [
+        job_queue
+        for job_queue in settings.AWS_BATCH_QUEUE_WORKERS_NAMES
+        if job_queue_depths["downloader_jobs"][job_queue] <= settings.MAX_DOWNLOADER_JOBS_PER_NODE
+    ]
+
+    job_queue = choose_job_queue(
+        ram_amount,
+        job_queues,
+        job_queue_depths["all_jobs"],
+        job_queue_depths["ram_amounts"],
+        settings.MAX_JOBS_PER_NODE,
+        settings.MAX_RAM_PER_NODE,
+    )
+    if not job_queue:
+        _log_no_room(job, ram_amount)
 
+    return job_queue
 
-def get_first_job_queue_with_capacity():
-    """Returns the first job queue that has capacity for more jobs.
+
+def get_first_job_queue_with_capacity(job=None):
+    """Returns the job queue `job` fits best, see choose_job_queue.
 
     If there are no job queues with capacity, returns None.
     """
-    job_queue_depths = get_job_queue_depths()["all_jobs"]
-    for job_queue in settings.AWS_BATCH_QUEUE_WORKERS_NAMES:
-        if job_queue_depths[job_queue] <= settings.MAX_JOBS_PER_NODE:
-            return job_queue
+    ram_amount = get_job_ram_amount(job)
+    job_queue_depths = get_job_queue_depths()
 
-    return None
+    job_queue = choose_job_queue(
+        ram_amount,
+        settings.AWS_BATCH_QUEUE_WORKERS_NAMES,
+        job_queue_depths["all_jobs"],
+        job_queue_depths["ram_amounts"],
+        settings.MAX_JOBS_PER_NODE,
+        settings.MAX_RAM_PER_NODE,
+    )
+    if not job_queue:
+        _log_no_room(job, ram_amount)
+
+    return job_queue
 
 
 def get_batch_queue_for_job(job_type, job):
@@ -205,9 +434,9 @@ def get_batch_queue_for_job(job_type, job):
         if organism in ["HOMO_SAPIENS", "MUS_MUSCULUS"]:
             return settings.AWS_BATCH_QUEUE_COMPENDIA_NAME
         else:
-            return get_first_job_queue_with_capacity()
+            return get_first_job_queue_with_capacity(job)
     elif job_type in list(Downloaders):
-        return get_batch_queue_for_downloader_job()
+        return get_batch_queue_for_downloader_job(job)
     elif job_type in list(ProcessorPipeline):
         # Queue it in the same queue as the downloader job as long as
         # that is set and still available.
@@ -216,15 +445,24 @@ def get_batch_queue_for_job(job_type, job):
             or not job.downloader_job.batch_job_queue
             or job.downloader_job.batch_job_queue not in settings.AWS_BATCH_QUEUE_WORKERS_NAMES
         ):
-            return get_first_job_queue_with_capacity()
-        else:
-            return job.downloader_job.batch_job_queue
+            return get_first_job_queue_with_capacity(job)
+
+        # The downloaded files are on that node, so if it doesn't have
+        # enough RAM left for the job it has to wait until it does.
+        job_queue = job.downloader_job.batch_job_queue
+        ram_amount = get_job_ram_amount(job)
+        job_queue_ram_amount = get_job_queue_depths()["ram_amounts"][job_queue]
+        if job_queue_ram_amount + ram_amount <= settings.MAX_RAM_PER_NODE:
+            return job_queue
+
+        _log_no_room(job, ram_amount, batch_job_queue=job_queue)
+        return None
 
     elif job_type in list(SurveyJobTypes):
         # We always want to queue a survey job, so just look for the queue
         # with the smallest number of jobs in it. The only time we return
         # None is if there's no job queues for some reason.
-        return get_first_job_queue_with_capacity()
+        return get_first_job_queue_with_capacity(job)
     else:
         # Handle the case where it's none of the above. Shouldn't happen.
         raise ValueError(f"Job id {job.id} had an invalid job_type: {job_type.value}")
@@ -277,11 +515,12 @@ def is_job_processor(job_type):
     return job_type not in list(Downloaders) and job_type not in list(SurveyJobTypes)
 
 
-def send_job(job_type: Enum, job, is_dispatch=False) -> bool:
-    # There's no Batch to dispatch jobs to locally, so don't even try.
-    if not settings.RUNNING_IN_CLOUD:
-        return False
+def _prepare_job_submission(job_type: Enum, job, is_dispatch: bool) -> Tuple[bool, Dict]:
+    """Works out how `job` should be submitted to Batch.
 
+    Returns what send_job should return and None if the job shouldn't
+    be submitted, otherwise None and the arguments for batch.submit_job.
+    """
     job_name = get_job_name(job_type, job.id)
     is_processor = is_job_processor(job_type)
 
@@ -292,40 +531,107 @@ def send_job(job_type: Enum, job, is_dispatch=False) -> bool:
     else:
         should_dispatch = is_dispatch  # only dispatch when specifically requested to
 
-    if should_dispatch:
-        job_name = JOB_DEFINITION_PREFIX + job_name
+    if not should_dispatch:
+        return True, None
 
-        # Smasher, tximport, and janitor jobs  don't have RAM tiers.
-        if job_type not in [
-            ProcessorPipeline.SMASHER,
-            ProcessorPipeline.TXIMPORT,
-            ProcessorPipeline.JANITOR,
-        ]:
-            job_name = job_name + "_" + str(job.ram_amount)
+    job_name = JOB_DEFINITION_PREFIX + job_name
 
-        job_queue = get_batch_queue_for_job(job_type, job)
+    # Smasher, tximport, and janitor jobs  don't have RAM tiers.
+    if job_type not in [
+        ProcessorPipeline.SMASHER,
+        ProcessorPipeline.TXIMPORT,
+        ProcessorPipeline.JANITOR,
+    ]:
+        job_name = job_name + "_" + str(job.ram_amount)
 
-        if not job_queue:
-            # There's no capacity for the job. That's okay. The
-            # Foreman will requeue when there is.
-            return False
+    job_queue = get_batch_queue_for_job(job_type, job)
+
+    if not job_queue:
+        # There's no capacity for the job. That's okay. The
+        # Foreman will requeue when there is.
+        return False, None
+
+    return (
+        None,
+        {
+            "jobName": job_name + f"_{job.id}",
+            "jobQueue": job_queue,
+            "jobDefinition": job_name,
+            "parameters": {"job_name": job_type.value, "job_id": str(job.id)},
+        },
+    )
 
-        try:
-            batch_response = batch.submit_job(
-                jobName=job_name + f"_{job.id}",
-                jobQueue=job_queue,
-                jobDefinition=job_name,
-                parameters={"job_name": job_type.value, "job_id": str(job.id)},
-            )
-            job.batch_job_queue = job_queue
-            job.batch_job_id = batch_response["jobId"]
-            job.save()
 
-            increment_job_queue_depth(job_queue)
-            if job_type in list(Downloaders):
-                increment_downloader_job_queue_depth(job_queue)
+def send_job(job_type: Enum, job, is_dispatch=False) -> bool:
+    # There's no Batch to dispatch jobs to locally, so don't even try.
+    if not settings.RUNNING_IN_CLOUD:
+        return False
 
-            return True
+    result, submission = _prepare_job_submission(job_type, job, is_dispatch)
+    if not submission:
+        return result
+
+    try:
+        batch_response = batch.submit_job(**submission)
+        job.batch_job_queue = submission["jobQueue"]
+        job.batch_job_id = batch_response["jobId"]
+        job.save()
+
+        record_job_queued(job)
+
+        return True
+    except Exception as e:
+        logger.warn(
+            "Unable to Dispatch Batch Job.",
+            job_name=job_type.value,
+            job_id=str(job.id),
+            reason=str(e),
+        )
+        raise
+
+
+def send_jobs(jobs: List[Tuple[Enum, Any]], is_dispatch=False) -> List[bool]:
+    """Sends each (job_type, job) in `jobs` the same way send_job would.
+
+    Rather than waiting on Batch for one job at a time, the jobs are
+    submitted by a pool of up to SEND_JOBS_MAX_THREADS threads. Only
+    the calls to Batch are made from the pool, the database is only
+    touched from the calling thread.
+
+    Returns whether each job was sent. Unlike send_job this doesn't
+    raise if Batch can't be reached, those jobs just aren't sent.
+    """
+    # There's no Batch to dispatch jobs to locally, so don't even try.
+    if not settings.RUNNING_IN_CLOUD:
+        return [False] * len(jobs)
+
+    results = [None] * len(jobs)
+    submissions = []
+    for index, (job_type, job) in enumerate(jobs):
+        result, submission = _prepare_job_submission(job_type, job, is_dispatch)
+        if not submission:
+            results[index] = result
+            continue
+
+        # Count the job right away so the queues for the jobs after it
+        # are picked knowing it's there.
+        previous_job_queue = job.batch_job_queue
+        job.batch_job_queue = submission["jobQueue"]
+        record_job_queued(job)
+        submissions.append((index, job_type, job, submission, previous_job_queue))
+
+    with ThreadPoolExecutor(max_workers=SEND_JOBS_MAX_THREADS) as pool:
+        futures = [
+            pool.submit(batch.submit_job, **submission) for _, _, _, submission, _ in submissions
+        ]
+
+    sent_jobs = []
+    for (index, job_type, job, submission, previous_job_queue), future in zip(submissions, futures):
+        try:
+            job.batch_job_id = future.result()["jobId"]
+            job.last_modified = timezone.now()
+            sent_jobs.append(job)
+            results[index] = True
         except Exception as e:
             logger.warn(
                 "Unable to Dispatch Batch Job.",
@@ -333,9 +639,23 @@ def send_job(job_type: Enum, job, is_dispatch=False) -> bool:
                 job_id=str(job.id),
                 reason=str(e),
             )
-            raise
+            _adjust_job_queue_depth(
+                job.batch_job_queue,
+                _get_ledger_job_type(job),
+                queued=-1,
+                running=0,
+                ram_amount=-get_job_ram_amount(job),
+            )
+            job.batch_job_queue = previous_job_queue
+            results[index] = False
+
+    for job_class in {type(job) for job in sent_jobs}:
+        job_class.objects.bulk_update(
+            [job for job in sent_jobs if type(job) is job_class],
+            ["batch_job_queue", "batch_job_id", "last_modified"],
+        )
 
-    return True
+    return results
 
 
 def terminate_job(job, reason=None):
@@ -343,3 +663,4 @@ def terminate_job(job, reason=None):
         reason = "The job was terminated by data_refinery_common.message_queue.terminate_job()."
 
     batch.terminate_job(jobId=job.batch_job_id, reason=reason)
+    record_job_finished(job)
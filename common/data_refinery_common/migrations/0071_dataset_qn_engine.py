@@ -0,0 +1,23 @@
+# Generated by Django 3.2.7 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_refinery_common", "0070_auto_20211208_2118"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dataset",
+            name="qn_engine",
+            field=models.CharField(
+                choices=[("PREPROCESSCORE", "preprocessCore"), ("NUMPY", "numpy")],
+                default="PREPROCESSCORE",
+                help_text="Specifies which implementation of quantile normalization to use",
+                max_length=255,
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.7 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_refinery_common", "0071_dataset_qn_engine"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dataset",
+            name="output_format",
+            field=models.CharField(
+                choices=[("TSV", "TSV"), ("NPY", "NumPy")],
+                default="TSV",
+                help_text=(
+                    "Specifies the file format of the gene expression matrices. NPY matrices are"
+                    " float32 NumPy arrays which can be loaded memory-mapped."
+                ),
+                max_length=255,
+            ),
+        ),
+    ]
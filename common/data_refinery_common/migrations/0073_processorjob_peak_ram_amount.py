@@ -0,0 +1,16 @@
+# Generated by Django 3.2.7 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_refinery_common", "0072_dataset_output_format"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="processorjob", name="peak_ram_amount", field=models.IntegerField(null=True),
+        ),
+    ]
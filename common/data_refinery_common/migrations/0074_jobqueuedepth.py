@@ -0,0 +1,35 @@
+# Generated by Django 3.2.7 on 2026-10-18 15:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_refinery_common", "0073_processorjob_peak_ram_amount"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="JobQueueDepth",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("batch_job_queue", models.CharField(max_length=100)),
+                ("job_type", models.CharField(max_length=256)),
+                ("num_queued", models.IntegerField(default=0)),
+                ("num_running", models.IntegerField(default=0)),
+                ("last_reconciled_at", models.DateTimeField(null=True)),
+                ("last_modified", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                "db_table": "job_queue_depths",
+                "unique_together": {("batch_job_queue", "job_type")},
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 3.2.7 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_refinery_common", "0074_jobqueuedepth"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="jobqueuedepth", name="ram_amount", field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.7 on 2026-10-18 19:42
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_refinery_common", "0075_jobqueuedepth_ram_amount"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RamEstimatorFit",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("estimates", models.JSONField(default=dict)),
+                ("created_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={"db_table": "ram_estimator_fits",},
+        ),
+    ]
@@ -46,7 +46,9 @@ from data_refinery_common.models.dataset_annotation import DatasetAnnotation  #
 from data_refinery_common.models.experiment import Experiment  # noqa
 from data_refinery_common.models.experiment_annotation import ExperimentAnnotation  # noqa
 from data_refinery_common.models.jobs.downloader_job import DownloaderJob  # noqa
+from data_refinery_common.models.jobs.job_queue_depth import JobQueueDepth  # noqa
 from data_refinery_common.models.jobs.processor_job import ProcessorJob  # noqa
+from data_refinery_common.models.jobs.ram_estimator_fit import RamEstimatorFit  # noqa
 from data_refinery_common.models.jobs.survey_job import SurveyJob  # noqa
 from data_refinery_common.models.jobs.survey_job_key_value import SurveyJobKeyValue  # noqa
 from data_refinery_common.models.keywords import SampleKeyword  # noqa
@@ -48,6 +48,24 @@ class AbstractAttribute(models.Model):
 
         return rendered
 
+    @staticmethod
+    def prefetch_values(attributes):
+        """Loads the ontology terms of all of `attributes` in one query so
+        that `get_value` doesn't have to look them up one at a time."""
+        ontology_terms = {
+            attribute.value for attribute in attributes if attribute.value_type == ONTOLOGY_TERM
+        }
+        if not ontology_terms:
+            return
+
+        terms = {
+            term.ontology_term: term
+            for term in OntologyTerm.objects.filter(ontology_term__in=ontology_terms)
+        }
+        for attribute in attributes:
+            if attribute.value_type == ONTOLOGY_TERM and attribute.value in terms:
+                attribute._prefetched_ontology_term = terms[attribute.value]
+
     def set_value(self, value):
         """This method sets the attribute value and assigns the correct
         value_type. NOTE: we assume that all provided strings are ontology terms."""
@@ -74,6 +92,10 @@ class AbstractAttribute(models.Model):
         to convert to the same type"""
 
         if self.value_type == ONTOLOGY_TERM:
+            prefetched_term = getattr(self, "_prefetched_ontology_term", None)
+            if prefetched_term is not None:
+                return prefetched_term
+
             return OntologyTerm.get_or_create_from_api(self.value)
         elif self.value_type == BOOL:
             return bool(self.value)
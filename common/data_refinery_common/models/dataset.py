@@ -79,6 +79,16 @@ class Dataset(models.Model):
         ("ARPACK", "arpack"),
     )
 
+    OUTPUT_FORMAT_CHOICES = (
+        ("TSV", "TSV"),
+        ("NPY", "NumPy"),
+    )
+
+    QN_ENGINE_CHOICES = (
+        ("PREPROCESSCORE", "preprocessCore"),
+        ("NUMPY", "numpy"),
+    )
+
     # ID
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
@@ -129,6 +139,21 @@ class Dataset(models.Model):
         default="NONE",
         help_text="Specifies choice of SVD algorithm",
     )
+    output_format = models.CharField(
+        max_length=255,
+        choices=OUTPUT_FORMAT_CHOICES,
+        default="TSV",
+        help_text=(
+            "Specifies the file format of the gene expression matrices. NPY matrices are"
+            " float32 NumPy arrays which can be loaded memory-mapped."
+        ),
+    )
+    qn_engine = models.CharField(
+        max_length=255,
+        choices=QN_ENGINE_CHOICES,
+        default="PREPROCESSCORE",
+        help_text="Specifies which implementation of quantile normalization to use",
+    )
 
     # State properties
     is_processing = models.BooleanField(default=False)  # Data is still editable when False
@@ -100,10 +100,12 @@ class Experiment(models.Model):
         metadata = {}
         metadata["title"] = self.title
         metadata["accession_code"] = self.accession_code
-        metadata["organisms"] = list(self.organisms.all().values_list("name", flat=True))
-        metadata["sample_accession_codes"] = list(
-            self.samples.all().values_list("accession_code", flat=True)
-        )
+        # Iterate over the relations rather than using values_list so
+        # that they can be loaded with prefetch_related.
+        metadata["organisms"] = [organism.name for organism in self.organisms.all()]
+        metadata["sample_accession_codes"] = [
+            sample.accession_code for sample in self.samples.all()
+        ]
         metadata["description"] = self.description
         metadata["protocol_description"] = self.protocol_description
         metadata["technology"] = self.technology
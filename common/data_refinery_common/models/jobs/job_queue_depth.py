@@ -0,0 +1,39 @@
+from django.db import models
+from django.utils import timezone
+
+
+class JobQueueDepth(models.Model):
+    """Keeps count of the jobs of one type that are waiting or running in a Batch job queue.
+
+    The counts are kept up to date as jobs are sent, started, finished
+    and terminated, so that how full the queues are can be looked up
+    without asking Batch. Jobs that die without finishing would throw
+    the counts off, so the Foreman periodically reconciles them with
+    what Batch reports.
+    """
+
+    class Meta:
+        db_table = "job_queue_depths"
+        unique_together = ("batch_job_queue", "job_type")
+
+    batch_job_queue = models.CharField(max_length=100)
+
+    # The name of the job's type in Batch, without the RAM amount, as
+    # returned by message_queue.get_job_name. All downloader jobs have
+    # the same type.
+    job_type = models.CharField(max_length=256)
+
+    num_queued = models.IntegerField(default=0)
+    num_running = models.IntegerField(default=0)
+
+    # The total RAM in MB that the queued and running jobs were given,
+    # so jobs can be placed on the queue with the most room for them.
+    ram_amount = models.IntegerField(default=0)
+
+    last_reconciled_at = models.DateTimeField(null=True)
+    last_modified = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "JobQueueDepth {}/{}: {} queued, {} running, {}MB".format(
+            self.batch_job_queue, self.job_type, self.num_queued, self.num_running, self.ram_amount
+        )
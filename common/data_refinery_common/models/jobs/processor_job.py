@@ -51,6 +51,10 @@ class ProcessorJob(models.Model):
     # Resources
     ram_amount = models.IntegerField(default=2048)
 
+    # The most RAM in MB the job was observed using, which is what
+    # ram_estimation learns from. Jobs that don't finish never record it.
+    peak_ram_amount = models.IntegerField(null=True)
+
     # The volume index is the instance id of an AWS EC2 machine. It looks like
     # these are 19 characters, but just to be safe we'll make the max length a
     # bit higher
@@ -0,0 +1,23 @@
+from django.db import models
+from django.utils import timezone
+
+
+class RamEstimatorFit(models.Model):
+    """The RAM amounts ram_estimation would give new processor jobs, by group.
+
+    Fitting a RamEstimator reads a lot of job history, so the Foreman
+    does it periodically and saves the result here. Everything else
+    that creates processor jobs just reads the latest one.
+    """
+
+    class Meta:
+        db_table = "ram_estimator_fits"
+
+    # From the name of each group with enough history, as returned by
+    # ram_estimation.get_group_name, to how much RAM in MB to give its jobs.
+    estimates = models.JSONField(default=dict)
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "RamEstimatorFit {}: {} groups".format(self.created_at, len(self.estimates))
@@ -83,15 +83,19 @@ class OriginalFile(models.Model):
         self.last_modified = current_time
         return super(OriginalFile, self).save(*args, **kwargs)
 
-    def set_downloaded(self, absolute_file_path, filename=None):
+    def set_downloaded(self, absolute_file_path, filename=None, sha1=None, md5=None):
         """ Marks the file as downloaded, if `filename` is not provided it will
-        be parsed from the `absolute_file_path` """
+        be parsed from the `absolute_file_path`. If the file was hashed while
+        it was downloaded, pass `sha1` and `md5` to avoid reading it again. """
         self.is_downloaded = True
         self.is_archive = FileUtils.is_archive(absolute_file_path)
         self.absolute_file_path = absolute_file_path
         self.filename = filename if filename else os.path.basename(absolute_file_path)
         self.calculate_size()
-        self.calculate_sha1_and_md5()
+        if sha1 and md5:
+            self.sha1, self.md5 = sha1, md5
+        else:
+            self.calculate_sha1_and_md5()
         self.save()
 
     def calculate_sha1(self) -> None:
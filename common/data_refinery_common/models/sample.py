@@ -123,8 +123,10 @@ class Sample(models.Model):
         metadata["refinebio_time"] = self.time
         metadata["refinebio_platform"] = self.pretty_platform
         metadata["refinebio_processed"] = self.has_raw
+        # Iterate over the annotations rather than using values_list so
+        # that prefetch_related("sampleannotation_set") can be used.
         metadata["refinebio_annotations"] = [
-            data for data in self.sampleannotation_set.all().values_list("data", flat=True)
+            annotation.data for annotation in self.sampleannotation_set.all()
         ]
 
         if computed_file and computed_file.result and computed_file.result.processor:
@@ -0,0 +1,360 @@
+"""Estimates how much RAM processor jobs need from the jobs that came before them.
+
+`job_lookup.determine_ram_amount` gives every job of a pipeline the
+same amount of RAM, and `job_requeuing` climbs a fixed ladder of
+amounts when a job runs out. Instead, every processor job records the
+most RAM it used as `peak_ram_amount`, and a RamEstimator groups those
+observations by pipeline, platform and how big the job's original
+files were. A job is then given a high quantile of what jobs like it
+used, plus some headroom.
+
+When a group doesn't have enough observations the next more general
+group is used instead, and if there still isn't enough history
+`determine_ram_amount` and the requeue ladder are used just like before.
+
+Fitting a RamEstimator reads a lot of history, so only the Foreman
+does it. It saves what the estimator gives each group as a
+RamEstimatorFit every RAM_ESTIMATOR_REFIT_SECONDS, and
+`estimate_ram_amount` looks new jobs up in the latest one.
+"""
+
+import bisect
+import json
+import math
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import OuterRef, Subquery, Sum
+from django.utils import timezone
+
+from data_refinery_common.enums import ProcessorPipeline
+from data_refinery_common.job_lookup import determine_ram_amount
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.models import (
+    OriginalFile,
+    ProcessorJob,
+    ProcessorJobOriginalFileAssociation,
+    RamEstimatorFit,
+    Sample,
+)
+from data_refinery_common.utils import get_env_variable
+
+logger = get_and_configure_logger(__name__)
+
+BYTES_IN_MB = 1024 * 1024
+# Jobs are given at least this quantile of what jobs like them used...
+RAM_ESTIMATE_QUANTILE = float(get_env_variable("RAM_ESTIMATE_QUANTILE", "0.99"))
+# ...plus this fraction of it on top...
+RAM_ESTIMATE_HEADROOM = float(get_env_variable("RAM_ESTIMATE_HEADROOM", "0.1"))
+# ...rounded up to a multiple of this many MB.
+RAM_ESTIMATE_STEP_MB = 512
+MIN_RAM_ESTIMATE_MB = 1024
+# A group needs this many observations before it's trusted.
+RAM_ESTIMATE_MIN_OBSERVATIONS = int(get_env_variable("RAM_ESTIMATE_MIN_OBSERVATIONS", "50"))
+# Only jobs that needed more than a requeued job had are relevant to
+# it, so fewer of them are needed.
+RAM_ESTIMATE_MIN_RETRY_OBSERVATIONS = 10
+RAM_ESTIMATE_HISTORY_DAYS = int(get_env_variable("RAM_ESTIMATE_HISTORY_DAYS", "180"))
+RAM_ESTIMATE_MAX_HISTORY = 200000
+RAM_ESTIMATOR_REFIT_SECONDS = 60 * 60
+# How often the saved estimates are looked up again.
+RAM_ESTIMATES_RELOAD_SECONDS = 10 * 60
+# How much RAM these pipelines' jobs need depends on their organism,
+# which their history doesn't record, so determine_ram_amount sizes them.
+UNESTIMATED_PIPELINES = [
+    ProcessorPipeline.CREATE_COMPENDIA.value,
+    ProcessorPipeline.CREATE_QUANTPENDIA.value,
+]
+
+
+def get_size_bucket(size_in_bytes: Optional[int]) -> Optional[int]:
+    """Buckets sizes by powers of two so that jobs of similar sizes are grouped together."""
+    if not size_in_bytes:
+        return None
+
+    return int(math.log2(max(1, size_in_bytes // BYTES_IN_MB)))
+
+
+def _get_group_keys(pipeline: str, platform: Optional[str], size_in_bytes: Optional[int]):
+    """Returns the keys of the groups a job belongs to, most specific first."""
+    return [
+        (pipeline, platform, get_size_bucket(size_in_bytes)),
+        (pipeline, platform),
+        (pipeline,),
+    ]
+
+
+def get_group_name(key: Tuple) -> str:
+    """Returns the name a group's estimate is saved under in a RamEstimatorFit."""
+    return json.dumps(key)
+
+
+class RamEstimator:
+    """Estimates how much RAM a job needs from the peak RAM of similar jobs."""
+
+    def __init__(
+        self,
+        quantile: float = RAM_ESTIMATE_QUANTILE,
+        headroom: float = RAM_ESTIMATE_HEADROOM,
+        min_observations: int = RAM_ESTIMATE_MIN_OBSERVATIONS,
+        min_retry_observations: int = RAM_ESTIMATE_MIN_RETRY_OBSERVATIONS,
+        max_ram_amount: int = None,
+    ):
+        self.quantile = quantile
+        self.headroom = headroom
+        self.min_observations = min_observations
+        self.min_retry_observations = min_retry_observations
+        # No node has more RAM than this to give a job.
+        self.max_ram_amount = max_ram_amount or settings.MAX_RAM_PER_NODE
+        self._observations = defaultdict(list)
+
+    def fit(self, history: Iterable[Dict]) -> "RamEstimator":
+        """Learns from `history`, which should be rows like the ones
+        `get_job_history` returns."""
+        for row in history:
+            for key in _get_group_keys(
+                row["pipeline_applied"], row["platform"], row["size_in_bytes"]
+            ):
+                self._observations[key].append(row["peak_ram_amount"])
+
+        for observations in self._observations.values():
+            observations.sort()
+
+        return self
+
+    def _get_observations(
+        self,
+        pipeline: str,
+        platform: Optional[str],
+        size_in_bytes: Optional[int],
+        min_observations: int,
+        more_than: int = 0,
+    ) -> Optional[List[int]]:
+        """Returns the sorted observations of the most specific group the
+        job belongs to that has enough observations above `more_than`."""
+        for key in _get_group_keys(pipeline, platform, size_in_bytes):
+            observations = self._observations.get(key, [])
+            observations = observations[bisect.bisect_right(observations, more_than) :]
+            if len(observations) >= min_observations:
+                return observations
+
+        return None
+
+    def _to_ram_amount(self, observations: List[int]) -> int:
+        index = min(len(observations) - 1, max(0, math.ceil(self.quantile * len(observations)) - 1))
+        ram_amount = observations[index] * (1 + self.headroom)
+        steps = math.ceil(ram_amount / RAM_ESTIMATE_STEP_MB)
+        return min(self.max_ram_amount, max(MIN_RAM_ESTIMATE_MB, steps * RAM_ESTIMATE_STEP_MB))
+
+    def estimate(
+        self, pipeline: str, platform: Optional[str], size_in_bytes: Optional[int]
+    ) -> Optional[int]:
+        """Returns how much RAM in MB a new job should have, or None if
+        there isn't enough history to say."""
+        observations = self._get_observations(
+            pipeline, platform, size_in_bytes, self.min_observations
+        )
+        if not observations:
+            return None
+
+        return self._to_ram_amount(observations)
+
+    def get_estimates(self) -> Dict[str, int]:
+        """Returns how much RAM in MB to give new jobs in each group that
+        has enough observations, by the group's `get_group_name`."""
+        estimates = {}
+        for key, observations in self._observations.items():
+            observations = observations[bisect.bisect_right(observations, 0) :]
+            if len(observations) >= self.min_observations:
+                estimates[get_group_name(key)] = self._to_ram_amount(observations)
+
+        return estimates
+
+    def estimate_retry(
+        self,
+        pipeline: str,
+        platform: Optional[str],
+        size_in_bytes: Optional[int],
+        last_ram_amount: int,
+    ) -> Optional[int]:
+        """Returns how much RAM in MB to retry a job that ran out of
+        `last_ram_amount` with, or None if there isn't enough history to say.
+
+        Only jobs that used more than `last_ram_amount` are considered,
+        so a job can skip straight past the amounts that wouldn't have
+        been enough rather than failing at each of them."""
+        observations = self._get_observations(
+            pipeline, platform, size_in_bytes, self.min_retry_observations, last_ram_amount
+        )
+        if not observations:
+            return None
+
+        return self._to_ram_amount(observations)
+
+
+def get_job_history(start_time=None, end_time=None, max_jobs: int = None) -> List[Dict]:
+    """Returns the most recent successful processor jobs that recorded
+    their peak RAM, along with the features RamEstimator groups them by."""
+    jobs = ProcessorJob.objects.filter(success=True, peak_ram_amount__isnull=False).exclude(
+        pipeline_applied__in=UNESTIMATED_PIPELINES
+    )
+    if start_time:
+        jobs = jobs.filter(end_time__gte=start_time)
+    if end_time:
+        jobs = jobs.filter(end_time__lt=end_time)
+
+    sizes = (
+        ProcessorJobOriginalFileAssociation.objects.filter(processor_job=OuterRef("pk"))
+        .values("processor_job")
+        .annotate(total=Sum("original_file__size_in_bytes"))
+        .values("total")
+    )
+    platforms = Sample.objects.filter(original_files__processor_jobs=OuterRef("pk")).values(
+        "platform_accession_code"
+    )[:1]
+
+    jobs = jobs.annotate(size_in_bytes=Subquery(sizes), platform=Subquery(platforms)).order_by(
+        "-end_time"
+    )
+    if max_jobs:
+        jobs = jobs[:max_jobs]
+
+    return list(
+        jobs.values(
+            "id",
+            "pipeline_applied",
+            "platform",
+            "size_in_bytes",
+            "ram_amount",
+            "peak_ram_amount",
+            "start_time",
+            "end_time",
+        )
+    )
+
+
+def get_job_features(
+    job: ProcessorJob, sample: Sample = None, original_files: List[OriginalFile] = None
+) -> Tuple[str, Optional[str], Optional[int]]:
+    """Returns the (pipeline, platform, size_in_bytes) of `job`.
+
+    `original_files` can be passed in for jobs that haven't been
+    associated with their files yet."""
+    if original_files is None:
+        original_files = list(job.original_files.all()) if job.id else []
+
+    if not sample and original_files:
+        sample = Sample.objects.filter(original_files__in=original_files).first()
+
+    size_in_bytes = sum(original_file.size_in_bytes or 0 for original_file in original_files)
+    platform = sample.platform_accession_code if sample else None
+
+    return job.pipeline_applied, platform, size_in_bytes
+
+
+_estimator = None
+_estimator_fitted_at = 0
+_estimates = None
+_estimates_loaded_at = 0
+
+
+def fit_ram_estimator() -> RamEstimator:
+    """Fits a new RamEstimator to recent history.
+
+    This reads up to RAM_ESTIMATE_MAX_HISTORY jobs, so only the Foreman
+    should call it."""
+    global _estimator, _estimator_fitted_at
+
+    estimator = RamEstimator().fit(
+        get_job_history(
+            start_time=timezone.now() - timedelta(days=RAM_ESTIMATE_HISTORY_DAYS),
+            max_jobs=RAM_ESTIMATE_MAX_HISTORY,
+        )
+    )
+
+    _estimator = estimator
+    _estimator_fitted_at = time.time()
+    return _estimator
+
+
+def get_ram_estimator() -> RamEstimator:
+    """Returns the RamEstimator this process last fit, refitting it once
+    it's more than RAM_ESTIMATOR_REFIT_SECONDS old."""
+    global _estimator, _estimator_fitted_at
+
+    if _estimator and time.time() - _estimator_fitted_at < RAM_ESTIMATOR_REFIT_SECONDS:
+        return _estimator
+
+    try:
+        return fit_ram_estimator()
+    except Exception:
+        logger.exception("Unable to fit RAM estimator, falling back to default RAM amounts.")
+
+    # An estimator with no history falls back to the defaults.
+    _estimator = RamEstimator()
+    _estimator_fitted_at = time.time()
+    return _estimator
+
+
+def save_ram_estimates() -> RamEstimatorFit:
+    """Refits the RamEstimator and saves its estimates for `estimate_ram_amount`,
+    replacing the ones saved before."""
+    fit = RamEstimatorFit.objects.create(estimates=fit_ram_estimator().get_estimates())
+    RamEstimatorFit.objects.exclude(id=fit.id).delete()
+
+    logger.info("Saved RAM estimates.", num_groups=len(fit.estimates))
+    return fit
+
+
+def get_ram_estimates() -> Dict[str, int]:
+    """Returns the estimates the Foreman last saved, looking them up
+    again once they're more than RAM_ESTIMATES_RELOAD_SECONDS old."""
+    global _estimates, _estimates_loaded_at
+
+    if _estimates is not None and time.time() - _estimates_loaded_at < RAM_ESTIMATES_RELOAD_SECONDS:
+        return _estimates
+
+    try:
+        fit = RamEstimatorFit.objects.order_by("-created_at").first()
+        _estimates = fit.estimates if fit else {}
+    except Exception:
+        logger.exception("Unable to load RAM estimates, falling back to default RAM amounts.")
+        _estimates = {}
+
+    _estimates_loaded_at = time.time()
+    return _estimates
+
+
+def reset_ram_estimator():
+    """Throws away the fitted RamEstimator and the loaded estimates so
+    that the next ones come from the latest jobs."""
+    global _estimator, _estimates
+    _estimator = None
+    _estimates = None
+
+
+def estimate_ram_amount(
+    job: ProcessorJob, sample: Sample = None, original_files: List[OriginalFile] = None
+) -> int:
+    """Determines the amount of RAM in MB to give a new ProcessorJob from
+    the saved estimates, falling back to `determine_ram_amount`."""
+    estimates = get_ram_estimates()
+    if estimates and job.pipeline_applied not in UNESTIMATED_PIPELINES:
+        for key in _get_group_keys(*get_job_features(job, sample, original_files)):
+            if get_group_name(key) in estimates:
+                return estimates[get_group_name(key)]
+
+    return determine_ram_amount(job, sample)
+
+
+def estimate_retry_ram_amount(last_job: ProcessorJob, sample: Sample = None) -> Optional[int]:
+    """Returns the amount of RAM in MB to retry `last_job` with now that
+    it's run out, or None if there isn't enough history to say.
+
+    Only the Foreman retries jobs, so this uses the estimator it fit."""
+    return get_ram_estimator().estimate_retry(
+        *get_job_features(last_job, sample), last_job.ram_amount
+    )
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from data_refinery_common import downloads
+from data_refinery_common.downloads import ChecksumMismatchError, Segment, download_file
+
+FILE_CONTENTS = os.urandom(1024 * 1024 + 123)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves FILE_CONTENTS, with range requests unless the path is /no-ranges.
+
+    The first `server.num_failures` GET requests stop after sending half
+    of what they were asked for.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_file_headers(self, status, length):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if self.path != "/no-ranges":
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.send_file_headers(200, len(FILE_CONTENTS))
+
+    def do_GET(self):
+        self.server.num_gets += 1
+        start, end = 0, len(FILE_CONTENTS) - 1
+        status = 200
+        if "Range" in self.headers and self.path != "/no-ranges":
+            start, end = [int(n) for n in self.headers["Range"].split("=")[1].split("-")]
+            status = 206
+
+        body = FILE_CONTENTS[start : end + 1]
+        self.send_file_headers(status, len(body))
+
+        with self.server.lock:
+            fail = self.server.num_failures > 0
+            self.server.num_failures -= 1
+        if fail:
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+
+class DownloadFileTestCase(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        self.server.num_gets = 0
+        self.server.num_failures = 0
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "http://127.0.0.1:{}/file".format(self.server.server_address[1])
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.target_file_path = os.path.join(temp_dir, "file")
+
+        # Small enough that the test file is split into segments.
+        patcher = patch.object(downloads, "MIN_SEGMENT_SIZE", 64 * 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_downloaded(self, result):
+        with open(self.target_file_path, "rb") as downloaded_file:
+            self.assertEqual(downloaded_file.read(), FILE_CONTENTS)
+        self.assertEqual(result.sha1, hashlib.sha1(FILE_CONTENTS).hexdigest())
+        self.assertEqual(result.md5, hashlib.md5(FILE_CONTENTS).hexdigest())
+        self.assertEqual(result.size_in_bytes, len(FILE_CONTENTS))
+        self.assertFalse(os.path.exists(self.target_file_path + ".progress"))
+
+    def test_segmented_download(self):
+        result = download_file(self.url, self.target_file_path, num_segments=4)
+
+        self.assert_downloaded(result)
+        self.assertEqual(result.num_segments, 4)
+        self.assertEqual(self.server.num_gets, 4)
+        self.assertEqual(result.bytes_downloaded, len(FILE_CONTENTS))
+        self.assertGreater(result.bytes_per_second, 0)
+
+    def test_download_without_ranges(self):
+        self.url = self.url.replace("/file", "/no-ranges")
+
+        result = download_file(self.url, self.target_file_path, num_segments=4)
+
+        self.assert_downloaded(result)
+        self.assertEqual(result.num_segments, 1)
+
+    def test_failed_segments_resume(self):
+        self.server.num_failures = 2
+
+        result = download_file(self.url, self.target_file_path, num_segments=4, backoff_factor=0)
+
+        self.assert_downloaded(result)
+        self.assertEqual(result.num_retries, 2)
+        # The segments picked up where they stopped.
+        self.assertEqual(result.bytes_downloaded, len(FILE_CONTENTS))
+
+    def test_resume_earlier_download(self):
+        half = len(FILE_CONTENTS) // 2
+        with open(self.target_file_path, "wb") as target_file:
+            target_file.write(FILE_CONTENTS[:half])
+        downloads._save_progress(
+            self.target_file_path,
+            self.url,
+            len(FILE_CONTENTS),
+            [Segment(0, len(FILE_CONTENTS), half)],
+        )
+
+        result = download_file(self.url, self.target_file_path)
+
+        self.assert_downloaded(result)
+        self.assertEqual(result.bytes_downloaded, len(FILE_CONTENTS) - half)
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(ChecksumMismatchError):
+            download_file(self.url, self.target_file_path, expected_md5="0" * 32)
+        self.assertFalse(os.path.exists(self.target_file_path))
+
+        with self.assertRaises(ChecksumMismatchError):
+            download_file(self.url, self.target_file_path, expected_size_in_bytes=1)
+        # The size was wrong, so nothing was downloaded.
+        self.assertEqual(self.server.num_gets, 4)
@@ -1,6 +1,39 @@
+from unittest.mock import patch
+
 from django.test import TestCase
 
-from data_refinery_common.job_management import create_processor_job_for_original_files
+from data_refinery_common.enums import ProcessorPipeline
+from data_refinery_common.job_management import (
+    create_downloader_job,
+    create_processor_job_for_original_files,
+    create_processor_jobs_for_original_files,
+)
+from data_refinery_common.models import (
+    DownloaderJob,
+    DownloaderJobOriginalFileAssociation,
+    OriginalFile,
+    OriginalFileSampleAssociation,
+    ProcessorJob,
+    Sample,
+)
+
+
+def create_sample_with_files(accession_code, num_files):
+    sample = Sample.objects.create(
+        accession_code=accession_code, technology="RNA-SEQ", has_raw=True
+    )
+    original_files = []
+    for i in range(num_files):
+        original_file = OriginalFile.objects.create(
+            filename="{}_{}.fastq.gz".format(accession_code, i),
+            source_filename="{}_{}.fastq.gz".format(accession_code, i),
+            source_url="ftp://example.com/{}_{}.fastq.gz".format(accession_code, i),
+            has_raw=True,
+        )
+        OriginalFileSampleAssociation.objects.create(original_file=original_file, sample=sample)
+        original_files.append(original_file)
+
+    return sample, original_files
 
 
 class UtilsTestCase(TestCase):
@@ -9,3 +42,38 @@ class UtilsTestCase(TestCase):
         create_processor_job_for_original_files([])
 
         self.assertTrue(True)
+
+    @patch("data_refinery_common.job_management.send_jobs")
+    def test_create_processor_jobs_for_original_files(self, mock_send_jobs):
+        _, original_files = create_sample_with_files("SRR1234567", 3)
+
+        create_processor_jobs_for_original_files(original_files)
+
+        self.assertEqual(ProcessorJob.objects.count(), 3)
+        for original_file in original_files:
+            processor_jobs = list(original_file.processor_jobs.all())
+            self.assertEqual(len(processor_jobs), 1)
+            self.assertEqual(processor_jobs[0].pipeline_applied, "SALMON")
+            self.assertEqual(list(processor_jobs[0].original_files.all()), [original_file])
+
+        # All of the jobs are sent at once.
+        mock_send_jobs.assert_called_once()
+        sent_jobs = mock_send_jobs.call_args[0][0]
+        self.assertEqual([job_type for job_type, _ in sent_jobs], [ProcessorPipeline.SALMON] * 3)
+
+    def test_create_downloader_job(self):
+        _, original_files = create_sample_with_files("SRR7654321", 3)
+        downloader_job = DownloaderJob.objects.create(
+            downloader_task="SRA", accession_code="SRR7654321"
+        )
+        for original_file in original_files:
+            DownloaderJobOriginalFileAssociation.objects.create(
+                downloader_job=downloader_job, original_file=original_file
+            )
+
+        self.assertTrue(create_downloader_job(original_files[:1]))
+
+        new_job = DownloaderJob.objects.latest("id")
+        self.assertTrue(new_job.was_recreated)
+        self.assertEqual(new_job.accession_code, "SRR7654321")
+        self.assertEqual(set(new_job.original_files.all()), set(original_files))
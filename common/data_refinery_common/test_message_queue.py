@@ -0,0 +1,231 @@
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from data_refinery_common.enums import Downloaders, ProcessorPipeline
+from data_refinery_common.message_queue import (
+    choose_job_queue,
+    get_capacity_for_jobs,
+    get_job_queue_depths,
+    get_job_type_from_batch_job_name,
+    get_ram_amount_from_batch_job_name,
+    reconcile_job_queue_depths,
+    record_job_finished,
+    record_job_started,
+    send_job,
+    send_jobs,
+    terminate_job,
+)
+from data_refinery_common.models import DownloaderJob, JobQueueDepth, ProcessorJob
+
+WORKER_QUEUES = ["queue_1", "queue_2"]
+ALL_QUEUES = WORKER_QUEUES + ["smasher_queue"]
+
+
+class FakeBatchClient:
+    """Just enough of boto3's Batch client to submit, terminate and list jobs."""
+
+    def __init__(self, page_size=2):
+        self.jobs = {}
+        self.page_size = page_size
+        self.num_list_jobs_calls = 0
+
+    def submit_job(self, jobName, jobQueue, jobDefinition=None, parameters=None, status="RUNNABLE"):
+        job_id = "fake-job-{}".format(len(self.jobs))
+        self.jobs[job_id] = {"jobId": job_id, "jobName": jobName, "jobQueue": jobQueue}
+        self.set_status(job_id, status)
+        return {"jobId": job_id, "jobName": jobName}
+
+    def set_status(self, job_id, status):
+        self.jobs[job_id]["status"] = status
+
+    def terminate_job(self, jobId, reason):
+        self.set_status(jobId, "FAILED")
+
+    def list_jobs(self, jobQueue, jobStatus, nextToken=None):
+        self.num_list_jobs_calls += 1
+        matching = [
+            {"jobId": job["jobId"], "jobName": job["jobName"], "status": job["status"]}
+            for job in self.jobs.values()
+            if job["jobQueue"] == jobQueue and job["status"] == jobStatus
+        ]
+
+        start = int(nextToken or 0)
+        response = {"jobSummaryList": matching[start : start + self.page_size]}
+        if start + self.page_size < len(matching):
+            response["nextToken"] = str(start + self.page_size)
+
+        return response
+
+
+@override_settings(
+    RUNNING_IN_CLOUD=True,
+    AWS_BATCH_QUEUE_WORKERS_NAMES=WORKER_QUEUES,
+    AWS_BATCH_QUEUE_ALL_NAMES=ALL_QUEUES,
+)
+class JobQueueDepthLedgerTestCase(TestCase):
+    def setUp(self):
+        self.batch = FakeBatchClient()
+        patcher = patch("data_refinery_common.message_queue.batch", self.batch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_job_type_from_batch_job_name(self):
+        self.assertEqual(get_job_type_from_batch_job_name("SALMON_12288_45"), "SALMON")
+        self.assertEqual(get_job_type_from_batch_job_name("AFFY_TO_PCL_2048_3"), "AFFY_TO_PCL")
+        self.assertEqual(get_job_type_from_batch_job_name("DOWNLOADER_1024_9"), "DOWNLOADER")
+        self.assertEqual(get_job_type_from_batch_job_name("SMASHER_7"), "SMASHER")
+
+    def test_get_ram_amount_from_batch_job_name(self):
+        self.assertEqual(get_ram_amount_from_batch_job_name("SALMON_12288_45"), 12288)
+        self.assertEqual(get_ram_amount_from_batch_job_name("DOWNLOADER_1024_9"), 1024)
+        # Jobs without RAM tiers get what their job definition gives them.
+        self.assertEqual(get_ram_amount_from_batch_job_name("SMASHER_7"), 28000)
+        self.assertEqual(get_ram_amount_from_batch_job_name("JANITOR_8"), 256)
+
+    def test_choose_job_queue(self):
+        depths = {"queue_1": 0, "queue_2": 0, "queue_3": 0}
+        ram_amounts = {"queue_1": 20000, "queue_2": 60000, "queue_3": 0}
+
+        def choose(ram_amount, max_jobs=25):
+            return choose_job_queue(
+                ram_amount, list(depths), depths, ram_amounts, max_jobs, max_ram_per_node=65536
+            )
+
+        # The job goes where it leaves the least RAM unused.
+        self.assertEqual(choose(4096), "queue_2")
+        self.assertEqual(choose(32768), "queue_1")
+        self.assertEqual(choose(65536), "queue_3")
+        # No node has room for it.
+        self.assertIsNone(choose(65537))
+
+        # Queues with too many jobs are skipped no matter how much RAM they have.
+        depths["queue_2"] = 26
+        self.assertEqual(choose(4096), "queue_1")
+
+    def test_jobs_are_placed_by_ram(self):
+        with override_settings(MAX_RAM_PER_NODE=24576):
+            for _ in range(4):
+                job = ProcessorJob.objects.create(pipeline_applied="SALMON", ram_amount=12288)
+                self.assertTrue(send_job(ProcessorPipeline.SALMON, job))
+
+            # Neither queue has room for a fifth.
+            job = ProcessorJob.objects.create(pipeline_applied="SALMON", ram_amount=12288)
+            self.assertFalse(send_job(ProcessorPipeline.SALMON, job))
+
+        # The second job fit best on the same node as the first.
+        depths = get_job_queue_depths()
+        self.assertEqual(depths["all_jobs"], {"queue_1": 2, "queue_2": 2, "smasher_queue": 0})
+        self.assertEqual(
+            depths["ram_amounts"], {"queue_1": 24576, "queue_2": 24576, "smasher_queue": 0}
+        )
+
+    def test_send_job_updates_ledger(self):
+        processor_job = ProcessorJob.objects.create(pipeline_applied="SALMON", ram_amount=12288)
+        downloader_job = DownloaderJob.objects.create(downloader_task="SRA", accession_code="SRR1")
+
+        self.assertTrue(send_job(ProcessorPipeline.SALMON, processor_job))
+        self.assertTrue(send_job(Downloaders.SRA, downloader_job, is_dispatch=True))
+
+        depths = get_job_queue_depths()
+        self.assertEqual(depths["all_jobs"], {"queue_1": 2, "queue_2": 0, "smasher_queue": 0})
+        self.assertEqual(depths["downloader_jobs"], {"queue_1": 1, "queue_2": 0})
+        self.assertEqual(get_capacity_for_jobs(), 2 * 25 - 2)
+
+        # None of that should have needed to ask Batch.
+        self.assertEqual(self.batch.num_list_jobs_calls, 0)
+
+    def test_send_jobs(self):
+        jobs = [
+            ProcessorJob.objects.create(pipeline_applied="SALMON", ram_amount=12288)
+            for _ in range(3)
+        ]
+
+        submit_job = self.batch.submit_job
+
+        def flaky_submit_job(jobName, **kwargs):
+            if jobName.endswith("_{}".format(jobs[1].id)):
+                raise Exception("Batch is having a bad day.")
+            return submit_job(jobName, **kwargs)
+
+        self.batch.submit_job = flaky_submit_job
+
+        sent = send_jobs([(ProcessorPipeline.SALMON, job) for job in jobs])
+
+        self.assertEqual(sent, [True, False, True])
+        for job, was_sent in zip(jobs, sent):
+            job.refresh_from_db()
+            self.assertEqual(job.batch_job_id is not None, was_sent)
+            self.assertEqual(job.batch_job_queue, "queue_1" if was_sent else None)
+
+        # Only the jobs that made it to Batch are counted.
+        self.assertEqual(get_job_queue_depths()["all_jobs"]["queue_1"], 2)
+
+    def test_job_lifecycle(self):
+        job = ProcessorJob.objects.create(pipeline_applied="SALMON", ram_amount=12288)
+        send_job(ProcessorPipeline.SALMON, job)
+
+        record_job_started(job)
+        depth = JobQueueDepth.objects.get(batch_job_queue="queue_1", job_type="SALMON")
+        self.assertEqual((depth.num_queued, depth.num_running, depth.ram_amount), (0, 1, 12288))
+
+        job.start_time = timezone.now()
+        record_job_finished(job)
+        depth.refresh_from_db()
+        self.assertEqual((depth.num_queued, depth.num_running, depth.ram_amount), (0, 0, 0))
+
+    def test_untiered_jobs_count_the_same_ram_as_reconciling(self):
+        job = ProcessorJob.objects.create(pipeline_applied="TXIMPORT")
+        self.assertTrue(send_job(ProcessorPipeline.TXIMPORT, job))
+
+        depth = JobQueueDepth.objects.get(batch_job_queue="queue_1", job_type="TXIMPORT")
+        self.assertEqual(depth.ram_amount, 32768)
+
+        reconcile_job_queue_depths()
+        depth.refresh_from_db()
+        self.assertEqual(depth.ram_amount, 32768)
+
+    def test_terminate_job_before_it_starts(self):
+        job = ProcessorJob.objects.create(pipeline_applied="SALMON", ram_amount=12288)
+        send_job(ProcessorPipeline.SALMON, job)
+
+        terminate_job(job)
+
+        self.assertEqual(self.batch.jobs[job.batch_job_id]["status"], "FAILED")
+        self.assertEqual(get_job_queue_depths()["all_jobs"]["queue_1"], 0)
+
+    def test_jobs_not_sent_to_batch_arent_counted(self):
+        job = ProcessorJob.objects.create(pipeline_applied="SALMON", ram_amount=12288)
+
+        record_job_started(job)
+        record_job_finished(job)
+
+        self.assertEqual(JobQueueDepth.objects.count(), 0)
+
+    def test_reconcile(self):
+        for i in range(5):
+            self.batch.submit_job(
+                "SALMON_12288_{}".format(i), "queue_1", status="RUNNING" if i < 2 else "RUNNABLE"
+            )
+        self.batch.submit_job("DOWNLOADER_1024_9", "queue_2", status="STARTING")
+        self.batch.submit_job("SALMON_12288_10", "queue_1", status="SUCCEEDED")
+
+        # A job that died without finishing.
+        JobQueueDepth.objects.create(
+            batch_job_queue="queue_1", job_type="AFFY_TO_PCL", num_queued=3
+        )
+
+        reconcile_job_queue_depths()
+
+        salmon_depth = JobQueueDepth.objects.get(batch_job_queue="queue_1", job_type="SALMON")
+        self.assertEqual((salmon_depth.num_queued, salmon_depth.num_running), (3, 2))
+        self.assertEqual(salmon_depth.ram_amount, 5 * 12288)
+        self.assertIsNotNone(salmon_depth.last_reconciled_at)
+
+        affy_depth = JobQueueDepth.objects.get(batch_job_queue="queue_1", job_type="AFFY_TO_PCL")
+        self.assertEqual((affy_depth.num_queued, affy_depth.num_running), (0, 0))
+
+        depths = get_job_queue_depths()
+        self.assertEqual(depths["all_jobs"], {"queue_1": 5, "queue_2": 1, "smasher_queue": 0})
+        self.assertEqual(depths["downloader_jobs"], {"queue_1": 0, "queue_2": 1})
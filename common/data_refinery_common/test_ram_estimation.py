@@ -0,0 +1,165 @@
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from data_refinery_common.models import (
+    OriginalFile,
+    OriginalFileSampleAssociation,
+    ProcessorJob,
+    ProcessorJobOriginalFileAssociation,
+    Sample,
+)
+from data_refinery_common.ram_estimation import (
+    RamEstimator,
+    estimate_ram_amount,
+    get_job_history,
+    reset_ram_estimator,
+    save_ram_estimates,
+)
+
+BYTES_IN_MB = 1024 * 1024
+
+
+def make_history(pipeline, platform, size_in_bytes, peaks):
+    return [
+        {
+            "pipeline_applied": pipeline,
+            "platform": platform,
+            "size_in_bytes": size_in_bytes,
+            "peak_ram_amount": peak,
+        }
+        for peak in peaks
+    ]
+
+
+class RamEstimatorTestCase(TestCase):
+    def test_not_enough_history(self):
+        estimator = RamEstimator(min_observations=5).fit(
+            make_history("SALMON", "Illumina HiSeq 2500", 1000 * BYTES_IN_MB, [3000] * 4)
+        )
+
+        self.assertIsNone(estimator.estimate("SALMON", "Illumina HiSeq 2500", 1000 * BYTES_IN_MB))
+
+    def test_quantile_and_headroom(self):
+        estimator = RamEstimator(quantile=0.9, headroom=0.1, min_observations=10).fit(
+            make_history(
+                "SALMON", "Illumina HiSeq 2500", 1000 * BYTES_IN_MB, range(1000, 11000, 1000)
+            )
+        )
+
+        # The 90th percentile is 9000MB, which is 9900MB with headroom.
+        self.assertEqual(
+            estimator.estimate("SALMON", "Illumina HiSeq 2500", 1000 * BYTES_IN_MB), 10240
+        )
+
+    def test_falls_back_to_more_general_groups(self):
+        estimator = RamEstimator(quantile=1, headroom=0, min_observations=10).fit(
+            make_history("SALMON", "Illumina HiSeq 2500", 1000 * BYTES_IN_MB, [4096] * 10)
+            + make_history("SALMON", "Illumina HiSeq 2500", 100 * BYTES_IN_MB, [2048] * 10)
+            + make_history("SALMON", "Illumina HiSeq 4000", 100 * BYTES_IN_MB, [8192] * 5)
+        )
+
+        # Files of about the same size.
+        self.assertEqual(
+            estimator.estimate("SALMON", "Illumina HiSeq 2500", 900 * BYTES_IN_MB), 4096
+        )
+        self.assertEqual(
+            estimator.estimate("SALMON", "Illumina HiSeq 2500", 120 * BYTES_IN_MB), 2048
+        )
+        # Files of an unseen size use the rest of the platform.
+        self.assertEqual(
+            estimator.estimate("SALMON", "Illumina HiSeq 2500", 10 * BYTES_IN_MB), 4096
+        )
+        # Not enough history for this platform, so use the whole pipeline.
+        self.assertEqual(
+            estimator.estimate("SALMON", "Illumina HiSeq 4000", 100 * BYTES_IN_MB), 8192
+        )
+        self.assertIsNone(estimator.estimate("AFFY_TO_PCL", "hugene10st", 100 * BYTES_IN_MB))
+
+    @override_settings(MAX_RAM_PER_NODE=16384)
+    def test_capped_at_node_ram(self):
+        estimator = RamEstimator(quantile=1, headroom=0, min_observations=10).fit(
+            make_history("SALMON", None, None, [20000] * 10)
+        )
+
+        self.assertEqual(estimator.estimate("SALMON", None, None), 16384)
+        self.assertEqual(estimator.get_estimates()['["SALMON"]'], 16384)
+
+    def test_estimate_retry(self):
+        estimator = RamEstimator(
+            quantile=1, headroom=0, min_observations=10, min_retry_observations=3
+        ).fit(make_history("SALMON", None, None, [4096] * 20 + [16384, 20000, 24000]))
+
+        # Only the jobs that needed more than the job ran out of are considered.
+        self.assertEqual(estimator.estimate_retry("SALMON", None, None, 12288), 24064)
+        # There aren't enough jobs that needed more than this.
+        self.assertIsNone(estimator.estimate_retry("SALMON", None, None, 16384))
+
+
+class EstimateRamAmountTestCase(TestCase):
+    def setUp(self):
+        reset_ram_estimator()
+        self.addCleanup(reset_ram_estimator)
+
+    def make_job(self, size_in_bytes, peak_ram_amount=None):
+        sample = Sample.objects.create(
+            accession_code="SRR" + str(Sample.objects.count()),
+            platform_accession_code="Illumina HiSeq 2500",
+        )
+        original_file = OriginalFile.objects.create(
+            filename="reads.fastq.gz", source_filename="reads.fastq.gz", size_in_bytes=size_in_bytes
+        )
+        OriginalFileSampleAssociation.objects.create(original_file=original_file, sample=sample)
+
+        job = ProcessorJob.objects.create(
+            pipeline_applied="SALMON",
+            ram_amount=12288,
+            peak_ram_amount=peak_ram_amount,
+            success=True if peak_ram_amount else None,
+            start_time=timezone.now(),
+            end_time=timezone.now(),
+        )
+        ProcessorJobOriginalFileAssociation.objects.create(
+            processor_job=job, original_file=original_file
+        )
+
+        return job, sample, original_file
+
+    def test_get_job_history(self):
+        job, _, _ = self.make_job(100 * BYTES_IN_MB, peak_ram_amount=3000)
+        self.make_job(100 * BYTES_IN_MB)
+        # Compendia jobs are sized by organism instead.
+        ProcessorJob.objects.create(
+            pipeline_applied="CREATE_COMPENDIA",
+            peak_ram_amount=100000,
+            success=True,
+            end_time=timezone.now(),
+        )
+
+        history = get_job_history()
+
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0]["id"], job.id)
+        self.assertEqual(history[0]["platform"], "Illumina HiSeq 2500")
+        self.assertEqual(history[0]["size_in_bytes"], 100 * BYTES_IN_MB)
+
+    def test_falls_back_to_determine_ram_amount(self):
+        job = ProcessorJob(pipeline_applied="SALMON")
+
+        self.assertEqual(estimate_ram_amount(job), 12288)
+
+    def test_estimates_from_history(self):
+        for _ in range(50):
+            self.make_job(100 * BYTES_IN_MB, peak_ram_amount=3000)
+        _, sample, original_file = self.make_job(110 * BYTES_IN_MB)
+
+        job = ProcessorJob(pipeline_applied="SALMON")
+
+        # Only the Foreman fits the estimator, until it saves the
+        # estimates everything else uses the defaults.
+        self.assertEqual(estimate_ram_amount(job, sample, [original_file]), 12288)
+
+        save_ram_estimates()
+        reset_ram_estimator()
+
+        # 3000MB plus 10% headroom, rounded up to the next 512MB.
+        self.assertEqual(estimate_ram_amount(job, sample, [original_file]), 3584)
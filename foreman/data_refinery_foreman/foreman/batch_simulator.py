@@ -0,0 +1,262 @@
+"""An in-process stand-in for the boto3 Batch client, for exercising the Foreman without AWS.
+
+A BatchSimulator can be patched in wherever a module uses
+`batch = boto3.client("batch", ...)`, such as message_queue and the
+Foreman's utils. It implements the calls the Foreman makes:
+submit_job, list_jobs, describe_jobs and terminate_job.
+
+Time only passes when `advance` is called. Each queue has a node with
+`node_ram_amount` MB of RAM, and runnable jobs start in the order they
+were submitted while their node has room for them. While they run, the
+simulator does to the database what the workers would have: jobs are
+marked as started when they start, and marked as succeeded or failed
+when they end. Jobs can also be killed for running out of memory, in
+which case the worker wouldn't have gotten to record anything and the
+job is left looking hung, just like in Batch.
+
+The Foreman calls the client from thread pools, so the calls that
+read or change the simulated jobs take a lock.
+"""
+
+import itertools
+import random
+import threading
+from collections import Counter, deque
+from typing import Callable, Dict, List, Union
+
+from django.utils import timezone
+
+from data_refinery_common.enums import Downloaders, SurveyJobTypes
+from data_refinery_common.message_queue import (
+    get_ram_amount_from_batch_job_name,
+    record_job_finished,
+    record_job_started,
+)
+from data_refinery_common.models import DownloaderJob, ProcessorJob, SurveyJob
+
+# The most jobs list_jobs and describe_jobs return at once, same as Batch.
+LIST_JOBS_PAGE_SIZE = 100
+DESCRIBE_JOBS_PAGE_SIZE = 100
+# Jobs without a RAM tier in their name, like smasher jobs, are assumed to need this much.
+DEFAULT_RAM_AMOUNT = 1024
+SIMULATED_FAILURE_REASON = "Simulated failure."
+
+
+def get_job_model(job_type_name: str):
+    """Returns the model of the job that the Batch job with `job_name`
+    parameter `job_type_name` is for."""
+    if job_type_name in [downloader.value for downloader in Downloaders]:
+        return DownloaderJob
+    elif job_type_name in [survey_job_type.value for survey_job_type in SurveyJobTypes]:
+        return SurveyJob
+
+    return ProcessorJob
+
+
+class SimulatedBatchJob:
+    def __init__(self, job_id: str, job_name: str, job_queue: str, parameters: Dict):
+        self.job_id = job_id
+        self.job_name = job_name
+        self.job_queue = job_queue
+        self.parameters = parameters or {}
+        self.status = "RUNNABLE"
+        self.status_reason = None
+        self.ram_amount = get_ram_amount_from_batch_job_name(job_name) or DEFAULT_RAM_AMOUNT
+        self.started_at = None
+        self.ends_at = None
+        # What will happen when it ends: "SUCCEEDED", "FAILED" or "OOM".
+        self.outcome = None
+
+    def to_summary(self) -> Dict:
+        return {"jobId": self.job_id, "jobName": self.job_name, "status": self.status}
+
+    def to_description(self) -> Dict:
+        description = self.to_summary()
+        description["jobQueue"] = self.job_queue
+        description["parameters"] = self.parameters
+        if self.status_reason:
+            description["statusReason"] = self.status_reason
+
+        return description
+
+
+class BatchSimulator:
+    """Just enough of boto3's Batch client for the Foreman, backed by simulated nodes.
+
+    `job_duration` is how many simulated seconds a job runs for. It can
+    be a callable that's passed the SimulatedBatchJob. Each job that
+    ends fails with probability `failure_rate` and runs out of memory
+    with probability `oom_rate`.
+    """
+
+    def __init__(
+        self,
+        job_duration: Union[float, Callable[[SimulatedBatchJob], float]] = 600,
+        failure_rate: float = 0,
+        oom_rate: float = 0,
+        node_ram_amount: int = 184320,
+        update_database: bool = True,
+        seed: int = None,
+    ):
+        self.job_duration = job_duration
+        self.failure_rate = failure_rate
+        self.oom_rate = oom_rate
+        self.node_ram_amount = node_ram_amount
+        self.update_database = update_database
+        self.random = random.Random(seed)
+
+        self.now = 0.0
+        self.jobs = {}
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._runnable = {}
+        self._running = []
+        self.num_calls = Counter()
+        # How many times each database job was submitted.
+        self.submissions = Counter()
+
+    def _get_job_duration(self, job: SimulatedBatchJob) -> float:
+        if callable(self.job_duration):
+            return self.job_duration(job)
+
+        return self.job_duration
+
+    def _get_database_job(self, job: SimulatedBatchJob):
+        model = get_job_model(job.parameters.get("job_name"))
+        return model.objects.filter(id=job.parameters.get("job_id")).first()
+
+    def submit_job(self, jobName, jobQueue, jobDefinition=None, parameters=None, **kwargs):
+        job_id = "simulated-{}".format(next(self._job_ids))
+        job = SimulatedBatchJob(job_id, jobName, jobQueue, parameters)
+        with self._lock:
+            self.num_calls["submit_job"] += 1
+            self.jobs[job_id] = job
+            self._runnable.setdefault(jobQueue, deque()).append(job)
+            self.submissions[(job.parameters.get("job_name"), job.parameters.get("job_id"))] += 1
+
+        return {"jobId": job_id, "jobName": jobName}
+
+    def list_jobs(self, jobQueue, jobStatus, nextToken=None, **kwargs):
+        with self._lock:
+            self.num_calls["list_jobs"] += 1
+            matching = [
+                job.to_summary()
+                for job in self.jobs.values()
+                if job.job_queue == jobQueue and job.status == jobStatus
+            ]
+
+        start = int(nextToken or 0)
+        response = {"jobSummaryList": matching[start : start + LIST_JOBS_PAGE_SIZE]}
+        if start + LIST_JOBS_PAGE_SIZE < len(matching):
+            response["nextToken"] = str(start + LIST_JOBS_PAGE_SIZE)
+
+        return response
+
+    def describe_jobs(self, jobs: List[str]):
+        if len(jobs) > DESCRIBE_JOBS_PAGE_SIZE:
+            raise ValueError("describe_jobs can only describe 100 jobs at a time.")
+
+        with self._lock:
+            self.num_calls["describe_jobs"] += 1
+            return {
+                "jobs": [
+                    self.jobs[job_id].to_description() for job_id in jobs if job_id in self.jobs
+                ]
+            }
+
+    def terminate_job(self, jobId, reason):
+        with self._lock:
+            self.num_calls["terminate_job"] += 1
+            job = self.jobs[jobId]
+            if job.status in ["SUCCEEDED", "FAILED"]:
+                return {}
+
+            if job.status == "RUNNABLE":
+                self._runnable[job.job_queue].remove(job)
+            else:
+                self._running.remove(job)
+
+            job.status = "FAILED"
+            job.status_reason = reason
+            return {}
+
+    def get_queue_ram_amount(self, job_queue: str) -> int:
+        """Returns how much RAM the jobs running in `job_queue` have."""
+        return sum(job.ram_amount for job in self._running if job.job_queue == job_queue)
+
+    def _start_jobs(self):
+        for job_queue, runnable in self._runnable.items():
+            ram_amount = self.get_queue_ram_amount(job_queue)
+            while runnable and ram_amount + runnable[0].ram_amount <= self.node_ram_amount:
+                job = runnable.popleft()
+                job.status = "RUNNING"
+                job.started_at = self.now
+                job.ends_at = self.now + self._get_job_duration(job)
+
+                roll = self.random.random()
+                if roll < self.oom_rate:
+                    job.outcome = "OOM"
+                elif roll < self.oom_rate + self.failure_rate:
+                    job.outcome = "FAILED"
+                else:
+                    job.outcome = "SUCCEEDED"
+
+                self._running.append(job)
+                ram_amount += job.ram_amount
+
+                if self.update_database:
+                    self._record_start(job)
+
+    def _record_start(self, job: SimulatedBatchJob):
+        database_job = self._get_database_job(job)
+        if not database_job:
+            return
+
+        database_job.start_time = timezone.now()
+        database_job.save()
+        record_job_started(database_job)
+
+    def _end_job(self, job: SimulatedBatchJob):
+        self._running.remove(job)
+
+        if job.outcome == "OOM":
+            # The container was killed before the worker could record anything.
+            job.status = "FAILED"
+            job.status_reason = "OutOfMemoryError: Container killed due to memory usage"
+            return
+
+        job.status = job.outcome
+        if not self.update_database:
+            return
+
+        database_job = self._get_database_job(job)
+        if not database_job:
+            return
+
+        database_job.success = job.outcome == "SUCCEEDED"
+        if not database_job.success:
+            database_job.failure_reason = SIMULATED_FAILURE_REASON
+        database_job.end_time = timezone.now()
+        database_job.save()
+        record_job_finished(database_job)
+
+    def advance(self, seconds: float):
+        """Lets `seconds` of simulated time pass, starting and ending jobs along the way."""
+        end = self.now + seconds
+        self._start_jobs()
+
+        while True:
+            ending = [job for job in self._running if job.ends_at <= end]
+            if not ending:
+                break
+
+            job = min(ending, key=lambda job: job.ends_at)
+            self.now = max(self.now, job.ends_at)
+            self._end_job(job)
+            self._start_jobs()
+
+        self.now = end
+
+    def count_jobs(self) -> Dict[str, int]:
+        """Returns how many jobs have each status."""
+        return Counter(job.status for job in self.jobs.values())
@@ -1,13 +1,17 @@
 import datetime
+import threading
 import time
+from typing import Dict
 
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 
 from data_refinery_common.enums import ProcessorPipeline
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.message_queue import send_job
+from data_refinery_common.message_queue import reconcile_job_queue_depths, send_job
 from data_refinery_common.models import ComputedFile, ProcessorJob
+from data_refinery_common.ram_estimation import RAM_ESTIMATOR_REFIT_SECONDS, save_ram_estimates
 from data_refinery_foreman.foreman.downloader_job_manager import (
     retry_failed_downloader_jobs,
     retry_hung_downloader_jobs,
@@ -41,6 +45,15 @@ JANITOR_DISPATCH_TIME = datetime.timedelta(minutes=30)
 # How frequently we clean up the database.
 DBCLEAN_TIME = datetime.timedelta(hours=6)
 
+# How frequently the job queue depth ledger is corrected with what
+# Batch reports. Between reconciliations it's kept up to date as jobs
+# are sent, started, and finished.
+JOB_QUEUE_RECONCILE_TIME = datetime.timedelta(minutes=10)
+
+# How frequently the RAM estimates that new processor jobs are given
+# are refit to the latest jobs.
+RAM_ESTIMATES_TIME = datetime.timedelta(seconds=RAM_ESTIMATOR_REFIT_SECONDS)
+
 
 def send_janitor_jobs():
     """Dispatch a Janitor job for each job queue.
@@ -75,6 +88,70 @@ def clean_database():
     logger.info("Cleaned files!")
 
 
+def reconcile_job_queue_depths_forever():
+    """Reconciles the job queue depth ledger every JOB_QUEUE_RECONCILE_TIME."""
+    while True:
+        time.sleep(JOB_QUEUE_RECONCILE_TIME.total_seconds())
+
+        try:
+            reconcile_job_queue_depths()
+        except Exception:
+            logger.exception("Caught exception while reconciling job queue depths.")
+        finally:
+            # This thread has its own database connection, don't let it go stale.
+            connection.close()
+
+
+def start_job_queue_reconciler() -> threading.Thread:
+    """Reconciles the job queue depth ledger now and then keeps doing
+    so in a background thread so the main loop never waits on Batch."""
+    reconcile_job_queue_depths()
+
+    reconciler = threading.Thread(
+        target=reconcile_job_queue_depths_forever, name="job_queue_reconciler", daemon=True
+    )
+    reconciler.start()
+    return reconciler
+
+
+def run_requeuing_functions() -> Dict[str, float]:
+    """Runs each of the functions that requeue jobs once.
+
+    Returns how many seconds each function took, so slow parts of the
+    loop stand out.
+    """
+    # Requeue jobs of each failure class for each job type.
+    # The order of processor -> downloader -> surveyor is intentional.
+    # Processors go first so we process data sitting on disk.
+    # Downloaders go first so we actually queue up the jobs in the database.
+    # Surveyors go last so we don't end up with tons and tons of unqueued jobs.
+    requeuing_functions_in_order = [
+        retry_failed_processor_jobs,
+        retry_hung_processor_jobs,
+        retry_lost_processor_jobs,
+        retry_unqueued_processor_jobs,
+        retry_failed_downloader_jobs,
+        retry_hung_downloader_jobs,
+        retry_lost_downloader_jobs,
+        retry_unqueued_downloader_jobs,
+        retry_failed_survey_jobs,
+        retry_hung_survey_jobs,
+        retry_lost_survey_jobs,
+        retry_unqueued_survey_jobs,
+    ]
+
+    function_seconds = {}
+    for function in requeuing_functions_in_order:
+        function_start_time = time.monotonic()
+        try:
+            function()
+        except Exception:
+            logger.exception("Caught exception in %s: ", function.__name__)
+        function_seconds[function.__name__] = round(time.monotonic() - function_start_time, 3)
+
+    return function_seconds
+
+
 def monitor_jobs():
     """Main Foreman thread that helps manage the Batch job queue.
 
@@ -88,6 +165,10 @@ def monitor_jobs():
     """
     # last_janitorial_time = timezone.now()
     last_dbclean_time = timezone.now()
+    last_ram_estimates_time = None
+
+    if settings.RUNNING_IN_CLOUD:
+        start_job_queue_reconciler()
 
     while True:
         # Perform two heartbeats, one for the logs and one for Monit:
@@ -100,31 +181,14 @@ def monitor_jobs():
 
         start_time = timezone.now()
 
-        # Requeue jobs of each failure class for each job type.
-        # The order of processor -> downloader -> surveyor is intentional.
-        # Processors go first so we process data sitting on disk.
-        # Downloaders go first so we actually queue up the jobs in the database.
-        # Surveyors go last so we don't end up with tons and tons of unqueued jobs.
-        requeuing_functions_in_order = [
-            retry_failed_processor_jobs,
-            retry_hung_processor_jobs,
-            retry_lost_processor_jobs,
-            retry_unqueued_processor_jobs,
-            retry_failed_downloader_jobs,
-            retry_hung_downloader_jobs,
-            retry_lost_downloader_jobs,
-            retry_unqueued_downloader_jobs,
-            retry_failed_survey_jobs,
-            retry_hung_survey_jobs,
-            retry_lost_survey_jobs,
-            retry_unqueued_survey_jobs,
-        ]
-
-        for function in requeuing_functions_in_order:
+        if not last_ram_estimates_time or start_time - last_ram_estimates_time > RAM_ESTIMATES_TIME:
             try:
-                function()
+                save_ram_estimates()
             except Exception:
-                logger.exception("Caught exception in %s: ", function.__name__)
+                logger.exception("Caught exception while saving RAM estimates.")
+            last_ram_estimates_time = start_time
+
+        function_seconds = run_requeuing_functions()
 
         if settings.RUNNING_IN_CLOUD:
             # Disable this for now because this will trigger regardless of
@@ -139,6 +203,11 @@ def monitor_jobs():
                 last_dbclean_time = timezone.now()
 
         loop_time = timezone.now() - start_time
+        logger.info(
+            "Finished Foreman loop.",
+            loop_seconds=round(loop_time.total_seconds(), 3),
+            **function_seconds,
+        )
         if loop_time < MIN_LOOP_TIME:
             remaining_time = MIN_LOOP_TIME - loop_time
             if remaining_time.seconds > 0:
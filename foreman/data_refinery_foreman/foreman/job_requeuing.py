@@ -1,15 +1,23 @@
+from typing import List, Optional
+
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+
 from data_refinery_common.enums import Downloaders, ProcessorPipeline, SurveyJobTypes
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.message_queue import send_job
+from data_refinery_common.message_queue import send_job, send_jobs
 from data_refinery_common.models import (
     DownloaderJob,
     DownloaderJobOriginalFileAssociation,
     ProcessorJob,
     ProcessorJobDatasetAssociation,
     ProcessorJobOriginalFileAssociation,
+    Sample,
     SurveyJob,
     SurveyJobKeyValue,
 )
+from data_refinery_common.ram_estimation import estimate_retry_ram_amount
 
 logger = get_and_configure_logger(__name__)
 
@@ -117,14 +125,24 @@ def requeue_downloader_job(last_job: DownloaderJob) -> (bool, str):
     return True
 
 
-def requeue_processor_job(last_job: ProcessorJob) -> None:
-    """Queues a new processor job.
+def _get_next_ram_amount(ram_amount: int, ladder: List[int]) -> int:
+    """Returns the smallest amount in `ladder` that's more than
+    `ram_amount`, or `ram_amount` if it's already at the top.
+
+    Jobs sized by ram_estimation can have amounts in between the rungs,
+    so this can't just look up the next rung."""
+    for rung in ladder:
+        if rung > ram_amount:
+            return rung
+
+    return ram_amount
 
-    The new processor job will have num_retries one greater than
-    last_job.num_retries.
-    """
-    num_retries = last_job.num_retries + 1
 
+def _get_retry_ram_amount(last_job: ProcessorJob, sample: Sample = None) -> int:
+    """Determines how much RAM in MB to give the job that replaces last_job.
+
+    `sample` can be passed in if last_job's sample has already been
+    looked up, so that estimating the amount doesn't look it up again."""
     # The Salmon pipeline is quite RAM-sensitive.
     # Try it again with an increased RAM amount, if possible.
     new_ram_amount = last_job.ram_amount
@@ -137,22 +155,16 @@ def requeue_processor_job(last_job: ProcessorJob) -> None:
         if last_job.pipeline_applied == ProcessorPipeline.TXIMPORT.value:
             new_ram_amount = 32768
         # These initial values are set in common/job_lookup.py:determine_ram_amount
+        # unless ram_estimation had enough history to estimate them.
         elif last_job.pipeline_applied in [
             ProcessorPipeline.SALMON.value,
             ProcessorPipeline.TRANSCRIPTOME_INDEX_LONG.value,
             ProcessorPipeline.TRANSCRIPTOME_INDEX_SHORT.value,
             ProcessorPipeline.QN_REFERENCE.value,
         ]:
-            if last_job.ram_amount == 4096:
-                new_ram_amount = 8192
-            if last_job.ram_amount == 8192:
-                new_ram_amount = 12288
-            elif last_job.ram_amount == 12288:
-                new_ram_amount = 16384
-            elif last_job.ram_amount == 16384:
-                new_ram_amount = 32768
-            elif last_job.ram_amount == 32768:
-                new_ram_amount = 65536
+            new_ram_amount = _get_next_ram_amount(
+                last_job.ram_amount, [4096, 8192, 12288, 16384, 32768, 65536]
+            )
         # The AFFY pipeline is somewhat RAM-sensitive.
         # Also NO_OP can fail and be retried, so we want to attempt ramping up ram.
         # Try it again with an increased RAM amount, if possible.
@@ -160,26 +172,40 @@ def requeue_processor_job(last_job: ProcessorJob) -> None:
             last_job.pipeline_applied == ProcessorPipeline.AFFY_TO_PCL.value
             or last_job.pipeline_applied == ProcessorPipeline.NO_OP.value
         ):
-            if last_job.ram_amount == 2048:
-                new_ram_amount = 4096
-            elif last_job.ram_amount == 4096:
-                new_ram_amount = 8192
-            elif last_job.ram_amount == 8192:
-                new_ram_amount = 32768
+            new_ram_amount = _get_next_ram_amount(last_job.ram_amount, [2048, 4096, 8192, 32768])
         elif (
             last_job.pipeline_applied == ProcessorPipeline.ILLUMINA_TO_PCL.value
             and "non-zero exit status -9" in last_job.failure_reason
         ):
-            if last_job.ram_amount == 2048:
-                new_ram_amount = 4096
-            elif last_job.ram_amount == 4096:
-                new_ram_amount = 8192
+            new_ram_amount = _get_next_ram_amount(last_job.ram_amount, [2048, 4096, 8192])
+
+        # If the job looks like it ran out of RAM, skip straight to
+        # what jobs like it that needed more RAM ended up using rather
+        # than climbing the ladder one failure at a time.
+        if new_ram_amount > last_job.ram_amount:
+            estimated_ram_amount = estimate_retry_ram_amount(last_job, sample)
+            if estimated_ram_amount:
+                new_ram_amount = estimated_ram_amount
+
+            # No node has more RAM than this to give it.
+            new_ram_amount = max(
+                last_job.ram_amount, min(new_ram_amount, settings.MAX_RAM_PER_NODE)
+            )
 
+    return new_ram_amount
+
+
+def requeue_processor_job(last_job: ProcessorJob) -> None:
+    """Queues a new processor job.
+
+    The new processor job will have num_retries one greater than
+    last_job.num_retries.
+    """
     new_job = ProcessorJob(
         downloader_job=last_job.downloader_job,
-        num_retries=num_retries,
+        num_retries=last_job.num_retries + 1,
         pipeline_applied=last_job.pipeline_applied,
-        ram_amount=new_ram_amount,
+        ram_amount=_get_retry_ram_amount(last_job),
         batch_job_queue=last_job.batch_job_queue,
     )
     new_job.save()
@@ -221,6 +247,105 @@ def requeue_processor_job(last_job: ProcessorJob) -> None:
     return True
 
 
+def _get_prefetched_sample(last_job: ProcessorJob) -> Optional[Sample]:
+    """Returns the first sample of last_job's original files, the same
+    one `ram_estimation.get_job_features` would look up, from the ones
+    that were prefetched."""
+    samples = [
+        sample
+        for original_file in last_job.original_files.all()
+        for sample in original_file.samples.all()
+    ]
+    return min(samples, key=lambda sample: sample.id, default=None)
+
+
+def requeue_processor_jobs(last_jobs: List[ProcessorJob]) -> int:
+    """Queues a new processor job for each of last_jobs.
+
+    This does the same thing as calling requeue_processor_job on each
+    of them, but the new jobs and their associations are created with
+    bulk inserts and they're sent to Batch with send_jobs, so requeuing
+    a page of jobs doesn't take a round trip per job.
+
+    Returns how many of the new jobs were sent.
+    """
+    if not last_jobs:
+        return 0
+
+    prefetch_related_objects(last_jobs, "original_files__samples", "datasets")
+
+    new_jobs = ProcessorJob.objects.bulk_create(
+        [
+            ProcessorJob(
+                downloader_job_id=last_job.downloader_job_id,
+                num_retries=last_job.num_retries + 1,
+                pipeline_applied=last_job.pipeline_applied,
+                ram_amount=_get_retry_ram_amount(last_job, _get_prefetched_sample(last_job)),
+                batch_job_queue=last_job.batch_job_queue,
+            )
+            for last_job in last_jobs
+        ]
+    )
+
+    try:
+        ProcessorJobOriginalFileAssociation.objects.bulk_create(
+            [
+                ProcessorJobOriginalFileAssociation(
+                    processor_job=new_job, original_file=original_file
+                )
+                for last_job, new_job in zip(last_jobs, new_jobs)
+                for original_file in last_job.original_files.all()
+            ]
+        )
+        ProcessorJobDatasetAssociation.objects.bulk_create(
+            [
+                ProcessorJobDatasetAssociation(processor_job=new_job, dataset=dataset)
+                for last_job, new_job in zip(last_jobs, new_jobs)
+                for dataset in last_job.datasets.all()
+            ]
+        )
+
+        logger.debug(
+            "Requeuing %d Processor Jobs.", len(last_jobs), last_job_ids=[j.id for j in last_jobs]
+        )
+        sent = send_jobs(
+            [(ProcessorPipeline[new_job.pipeline_applied], new_job) for new_job in new_jobs],
+            is_dispatch=True,
+        )
+    except Exception:
+        logger.warn(
+            "Failed to requeue %d Processor Jobs.",
+            len(last_jobs),
+            last_job_ids=[j.id for j in last_jobs],
+            exc_info=1,
+        )
+        # Can't communicate with Batch just now, leave the jobs for a later loop.
+        ProcessorJob.objects.filter(id__in=[new_job.id for new_job in new_jobs]).delete()
+        return 0
+
+    retried_jobs = []
+    unsent_job_ids = []
+    now = timezone.now()
+    for last_job, new_job, was_sent in zip(last_jobs, new_jobs, sent):
+        if was_sent:
+            last_job.retried = True
+            last_job.success = False
+            last_job.retried_job = new_job
+            last_job.last_modified = now
+            retried_jobs.append(last_job)
+        else:
+            unsent_job_ids.append(new_job.id)
+
+    ProcessorJob.objects.bulk_update(
+        retried_jobs, ["retried", "success", "retried_job", "last_modified"]
+    )
+    if unsent_job_ids:
+        # Can't communicate with Batch just now, leave the jobs for a later loop.
+        ProcessorJob.objects.filter(id__in=unsent_job_ids).delete()
+
+    return len(retried_jobs)
+
+
 def requeue_survey_job(last_job: SurveyJob) -> None:
     """Queues a new survey job.
 
@@ -0,0 +1,215 @@
+"""Measures how quickly the Foreman can dispatch and requeue jobs as the backlog grows.
+
+For each backlog size this seeds the database with that many
+processor jobs that were never queued, then runs iterations of the
+Foreman's main loop against a BatchSimulator instead of AWS Batch.
+Between iterations the simulator runs the jobs for as long as the
+loop would have slept, failing some and killing some for running out
+of memory so that the Foreman has jobs to requeue.
+
+It reports how many jobs were dispatched per second of time spent in
+the loop, how long the loops took, how many database queries they
+made, and checks that:
+  - no job was submitted to Batch more than once,
+  - no job was retried more than once,
+  - every job that failed was either retried or given up on,
+  - the job queue depth ledger kept as jobs are queued and finished
+    matches the simulator before it's reconciled.
+
+Everything is done in a transaction that's rolled back at the end, but
+it should still only be run against a development database.
+"""
+
+import os
+import statistics
+import time
+from collections import Counter
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from data_refinery_common.message_queue import get_job_queue_depths, reconcile_job_queue_depths
+from data_refinery_common.models import ProcessorJob
+from data_refinery_foreman.foreman import utils
+from data_refinery_foreman.foreman.batch_simulator import BatchSimulator
+from data_refinery_foreman.foreman.job_control import (
+    JOB_QUEUE_RECONCILE_TIME,
+    MIN_LOOP_TIME,
+    run_requeuing_functions,
+)
+
+SEED_BATCH_SIZE = 5000
+# The mix of pipelines and RAM amounts the seeded jobs are given.
+SEED_JOB_TYPES = [("SALMON", 12288), ("AFFY_TO_PCL", 2048), ("NO_OP", 2048)]
+
+
+class Rollback(Exception):
+    """Raised to roll back everything a benchmark run did."""
+
+
+def seed_jobs(num_jobs: int):
+    """Creates `num_jobs` processor jobs that haven't been queued yet."""
+    for start in range(0, num_jobs, SEED_BATCH_SIZE):
+        ProcessorJob.objects.bulk_create(
+            [
+                ProcessorJob(
+                    pipeline_applied=SEED_JOB_TYPES[i % len(SEED_JOB_TYPES)][0],
+                    ram_amount=SEED_JOB_TYPES[i % len(SEED_JOB_TYPES)][1],
+                )
+                for i in range(start, min(num_jobs, start + SEED_BATCH_SIZE))
+            ]
+        )
+
+
+def get_ledger_drift(simulator: BatchSimulator) -> int:
+    """Returns how many jobs the job queue depth ledger is off from the simulator by.
+
+    This has to be called before the ledger is reconciled, which
+    would hide any drift.
+    """
+    ledger = get_job_queue_depths()["all_jobs"]
+    simulated = Counter(
+        job.job_queue for job in simulator.jobs.values() if job.status in ["RUNNABLE", "RUNNING"]
+    )
+
+    return sum(
+        abs(ledger.get(queue, 0) - simulated[queue]) for queue in set(ledger) | set(simulated)
+    )
+
+
+def check_requeues(simulator: BatchSimulator) -> dict:
+    """Counts the ways the Foreman could have gotten requeuing wrong."""
+    duplicate_submissions = sum(1 for count in simulator.submissions.values() if count > 1)
+    duplicate_retries = (
+        ProcessorJob.objects.filter(retried_job__isnull=False)
+        .values("retried_job")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+        .count()
+    )
+    # Failed jobs the Foreman hasn't gotten to yet are fine, but a
+    # failed job that's marked as retried needs a job that replaced it
+    # unless it was given up on.
+    lost_retries = ProcessorJob.objects.filter(
+        success=False,
+        retried=True,
+        retried_job__isnull=True,
+        num_retries__lt=utils.MAX_NUM_RETRIES,
+    ).count()
+
+    return {
+        "duplicate_submissions": duplicate_submissions,
+        "duplicate_retries": duplicate_retries,
+        "lost_retries": lost_retries,
+    }
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--num-jobs",
+            type=lambda s: [int(n) for n in s.split(",")],
+            default=[1000, 10000, 100000],
+            help="A comma separated list of backlog sizes to benchmark.",
+        )
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--num-queues", type=int, default=2)
+        parser.add_argument("--max-jobs-per-node", type=int, default=settings.MAX_JOBS_PER_NODE)
+        parser.add_argument("--node-ram-amount", type=int, default=settings.MAX_RAM_PER_NODE)
+        parser.add_argument(
+            "--job-minutes", type=float, default=10, help="How long each job runs on average."
+        )
+        parser.add_argument("--failure-rate", type=float, default=0.05)
+        parser.add_argument("--oom-rate", type=float, default=0.02)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        if settings.RUNNING_IN_CLOUD:
+            raise CommandError("Refusing to seed benchmark jobs into a database in the cloud.")
+
+        print(
+            "num_jobs, iterations, jobs_dispatched, dispatched_per_second, mean_loop_seconds,"
+            " max_loop_seconds, mean_queries, duplicate_submissions, duplicate_retries,"
+            " lost_retries, ledger_drift"
+        )
+        for num_jobs in options["num_jobs"]:
+            print(", ".join(str(value) for value in self.benchmark(num_jobs, options)))
+
+    def benchmark(self, num_jobs: int, options: dict) -> list:
+        job_queues = ["benchmark_queue_{}".format(i) for i in range(options["num_queues"])]
+        simulator = BatchSimulator(
+            job_duration=lambda job: simulator.random.expovariate(
+                1 / (options["job_minutes"] * 60)
+            ),
+            failure_rate=options["failure_rate"],
+            oom_rate=options["oom_rate"],
+            node_ram_amount=options["node_ram_amount"],
+            seed=options["seed"],
+        )
+
+        result = None
+        try:
+            with transaction.atomic(), override_settings(
+                RUNNING_IN_CLOUD=True,
+                AWS_BATCH_QUEUE_WORKERS_NAMES=job_queues,
+                AWS_BATCH_QUEUE_ALL_NAMES=job_queues,
+                MAX_JOBS_PER_NODE=options["max_jobs_per_node"],
+                MAX_RAM_PER_NODE=options["node_ram_amount"],
+            ), patch.dict(
+                os.environ, {"MAX_JOBS_PER_NODE": str(options["max_jobs_per_node"])}
+            ), patch(
+                "data_refinery_common.message_queue.batch", simulator
+            ), patch(
+                "data_refinery_foreman.foreman.utils.batch", simulator
+            ):
+                seed_jobs(num_jobs)
+
+                loop_seconds = []
+                query_counts = []
+                since_reconcile = 0
+                # The most the ledger drifted from the simulator
+                # between reconciliations.
+                ledger_drift = 0
+                for _ in range(options["iterations"]):
+                    with CaptureQueriesContext(connection) as queries:
+                        start = time.monotonic()
+                        run_requeuing_functions()
+                        loop_seconds.append(time.monotonic() - start)
+                    query_counts.append(len(queries))
+
+                    # The loop sleeps until MIN_LOOP_TIME has passed.
+                    elapsed = max(MIN_LOOP_TIME.total_seconds(), loop_seconds[-1])
+                    simulator.advance(elapsed)
+
+                    since_reconcile += elapsed
+                    if since_reconcile >= JOB_QUEUE_RECONCILE_TIME.total_seconds():
+                        ledger_drift = max(ledger_drift, get_ledger_drift(simulator))
+                        reconcile_job_queue_depths()
+                        since_reconcile = 0
+
+                ledger_drift = max(ledger_drift, get_ledger_drift(simulator))
+                checks = check_requeues(simulator)
+                dispatched = simulator.num_calls["submit_job"]
+                result = [
+                    num_jobs,
+                    options["iterations"],
+                    dispatched,
+                    round(dispatched / sum(loop_seconds), 1) if sum(loop_seconds) else 0,
+                    round(statistics.mean(loop_seconds), 3),
+                    round(max(loop_seconds), 3),
+                    round(statistics.mean(query_counts), 1),
+                    checks["duplicate_submissions"],
+                    checks["duplicate_retries"],
+                    checks["lost_retries"],
+                    ledger_drift,
+                ]
+
+                raise Rollback()
+        except Rollback:
+            pass
+
+        return result
@@ -5,7 +5,6 @@ from django.db.models.aggregates import Count
 from django.db.models.expressions import Q
 
 from data_refinery_common.enums import ProcessorPipeline
-from data_refinery_common.job_lookup import determine_ram_amount
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.message_queue import send_job
 from data_refinery_common.models import (
@@ -15,6 +14,7 @@ from data_refinery_common.models import (
     ProcessorJob,
     ProcessorJobDatasetAssociation,
 )
+from data_refinery_common.ram_estimation import estimate_ram_amount
 from data_refinery_common.utils import queryset_iterator
 
 logger = get_and_configure_logger(__name__)
@@ -35,11 +35,20 @@ class Command(BaseCommand):
             ),
         )
 
+        parser.add_argument(
+            "--qn-engine",
+            type=str,
+            help=(
+                "Specify the implementation of quantile normalization to use, "
+                "PREPROCESSCORE or NUMPY."
+            ),
+        )
+
     def handle(self, *args, **options):
-        create_compendia(options["svd_algorithm"], options["organisms"])
+        create_compendia(options["svd_algorithm"], options["organisms"], options["qn_engine"])
 
 
-def create_compendia(svd_algorithm, organisms):
+def create_compendia(svd_algorithm, organisms, qn_engine=None):
     """Create a compendium for one or more organisms."""
 
     svd_algorithm_choices = ["ARPACK", "RANDOMIZED", "NONE"]
@@ -51,6 +60,14 @@ def create_compendia(svd_algorithm, organisms):
 
     svd_algorithm = svd_algorithm or "ARPACK"
 
+    qn_engine_choices = ["PREPROCESSCORE", "NUMPY"]
+    if qn_engine and qn_engine not in qn_engine_choices:
+        raise Exception(
+            "Invalid qn_engine option provided. Possible values are " + str(qn_engine_choices)
+        )
+
+    qn_engine = qn_engine or "PREPROCESSCORE"
+
     target_organisms = get_target_organisms(organisms)
     grouped_organisms = group_organisms_by_biggest_platform(target_organisms)
 
@@ -58,7 +75,7 @@ def create_compendia(svd_algorithm, organisms):
 
     created_jobs = []
     for organism in grouped_organisms:
-        job = create_job_for_organism(organism, svd_algorithm)
+        job = create_job_for_organism(organism, svd_algorithm, qn_engine)
         logger.info(
             "Sending compendia job for Organism", job_id=str(job.pk), organism=str(organism)
         )
@@ -133,7 +150,9 @@ def get_organism_microarray_platforms(organism):
     )
 
 
-def create_job_for_organism(organisms: List[Organism], svd_algorithm="ARPACK"):
+def create_job_for_organism(
+    organisms: List[Organism], svd_algorithm="ARPACK", qn_engine="PREPROCESSCORE"
+):
     """Returns a compendia job for the provided organism.
 
     Fetch all of the experiments and compile large but normally formated Dataset.
@@ -149,6 +168,7 @@ def create_job_for_organism(organisms: List[Organism], svd_algorithm="ARPACK"):
     dataset.quantile_normalize = True
     dataset.quant_sf_only = False
     dataset.svd_algorithm = svd_algorithm
+    dataset.qn_engine = qn_engine
     dataset.save()
 
     pjda = ProcessorJobDatasetAssociation()
@@ -158,7 +178,7 @@ def create_job_for_organism(organisms: List[Organism], svd_algorithm="ARPACK"):
 
     # Have to call this after setting the dataset since it's used in
     # the caclulation.
-    job.ram_amount = determine_ram_amount(job)
+    job.ram_amount = estimate_ram_amount(job)
     job.save()
 
     return job
@@ -4,7 +4,6 @@ import time
 from django.core.management.base import BaseCommand
 
 from data_refinery_common.enums import ProcessorPipeline
-from data_refinery_common.job_lookup import determine_ram_amount
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.message_queue import send_job
 from data_refinery_common.models import (
@@ -14,6 +13,7 @@ from data_refinery_common.models import (
     ProcessorJob,
     ProcessorJobDatasetAssociation,
 )
+from data_refinery_common.ram_estimation import estimate_ram_amount
 from data_refinery_common.utils import queryset_page_iterator
 
 logger = get_and_configure_logger(__name__)
@@ -41,7 +41,7 @@ def create_job_for_organism(organism: Organism):
 
     # Have to call this after setting the dataset since it's used in
     # the caclulation.
-    job.ram_amount = determine_ram_amount(job)
+    job.ram_amount = estimate_ram_amount(job)
     job.save()
 
     return job
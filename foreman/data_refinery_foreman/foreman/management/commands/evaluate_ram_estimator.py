@@ -0,0 +1,183 @@
+"""Replays recent processor jobs to see how ram_estimation would have sized them.
+
+The estimator is fit to the jobs that finished before --split-date and
+then asked to size every successful job that finished after it. This
+reports how many RAM-hours were reserved but never used, both as the
+jobs were actually run and as the estimator would have run them, along
+with how many out-of-memory retries the estimator would have avoided.
+
+A RAM-hour is using 1GB of RAM for 1 hour, the same as in
+scripts/calculate_ram_hours.py.
+"""
+
+import datetime
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+import pytz
+
+from data_refinery_common.models import ProcessorJob
+from data_refinery_common.ram_estimation import (
+    RAM_ESTIMATE_HEADROOM,
+    RAM_ESTIMATE_HISTORY_DAYS,
+    RAM_ESTIMATE_MIN_OBSERVATIONS,
+    RAM_ESTIMATE_QUANTILE,
+    RamEstimator,
+    get_job_history,
+)
+
+PAGE_SIZE = 1000
+
+
+def get_hours(job) -> float:
+    if not (job["start_time"] and job["end_time"]):
+        return 0
+
+    return (job["end_time"] - job["start_time"]).total_seconds() / 60 / 60
+
+
+def get_failed_attempts(job_ids):
+    """Returns a dict from job id to the earlier attempts that were retried into it, oldest first."""
+    attempts = defaultdict(list)
+    # Maps the id of each job to the final job it was retried into.
+    final_job_ids = {job_id: job_id for job_id in job_ids}
+
+    to_look_up = list(job_ids)
+    while to_look_up:
+        earlier_attempts = []
+        for start in range(0, len(to_look_up), PAGE_SIZE):
+            earlier_attempts.extend(
+                ProcessorJob.objects.filter(
+                    retried_job_id__in=to_look_up[start : start + PAGE_SIZE]
+                ).values("id", "retried_job_id", "ram_amount", "start_time", "end_time")
+            )
+
+        to_look_up = []
+        for attempt in earlier_attempts:
+            if attempt["id"] in final_job_ids:
+                # Shouldn't be possible, but don't loop forever.
+                continue
+
+            final_job_id = final_job_ids[attempt["retried_job_id"]]
+            final_job_ids[attempt["id"]] = final_job_id
+            attempts[final_job_id].insert(0, attempt)
+            to_look_up.append(attempt["id"])
+
+    return attempts
+
+
+class Stats:
+    def __init__(self):
+        self.jobs = 0
+        self.estimated_jobs = 0
+        self.wasted_ram_hours = 0
+        self.estimated_wasted_ram_hours = 0
+        self.oom_retries = 0
+        self.oom_retries_avoided = 0
+        self.new_ooms = 0
+
+    def row(self, name):
+        return [
+            name,
+            self.jobs,
+            self.estimated_jobs,
+            "{:.1f}".format(self.wasted_ram_hours),
+            "{:.1f}".format(self.estimated_wasted_ram_hours),
+            self.oom_retries,
+            self.oom_retries_avoided,
+            self.new_ooms,
+        ]
+
+
+HEADERS = [
+    "pipeline",
+    "jobs",
+    "estimated_jobs",
+    "wasted_ram_hours",
+    "estimated_wasted_ram_hours",
+    "oom_retries",
+    "oom_retries_avoided",
+    "new_ooms",
+]
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--split-date",
+            type=lambda s: pytz.utc.localize(datetime.datetime.strptime(s, "%Y-%m-%d")),
+            default=None,
+            help=(
+                "Fit to jobs that finished before this date and evaluate the jobs that finished"
+                " after it. The format is expected to be YYYY-MM-DD. Defaults to 30 days ago."
+            ),
+        )
+        parser.add_argument("--history-days", type=int, default=RAM_ESTIMATE_HISTORY_DAYS)
+        parser.add_argument("--quantile", type=float, default=RAM_ESTIMATE_QUANTILE)
+        parser.add_argument("--headroom", type=float, default=RAM_ESTIMATE_HEADROOM)
+        parser.add_argument("--min-observations", type=int, default=RAM_ESTIMATE_MIN_OBSERVATIONS)
+
+    def handle(self, *args, **options):
+        split_date = options["split_date"] or timezone.now() - datetime.timedelta(days=30)
+
+        estimator = RamEstimator(
+            quantile=options["quantile"],
+            headroom=options["headroom"],
+            min_observations=options["min_observations"],
+        )
+        estimator.fit(
+            get_job_history(
+                start_time=split_date - datetime.timedelta(days=options["history_days"]),
+                end_time=split_date,
+            )
+        )
+
+        jobs = get_job_history(start_time=split_date)
+        failed_attempts = get_failed_attempts([job["id"] for job in jobs])
+
+        stats = defaultdict(Stats)
+        for job in jobs:
+            pipeline_stats = stats[job["pipeline_applied"]]
+            pipeline_stats.jobs += 1
+            hours = get_hours(job)
+            attempts = failed_attempts.get(job["id"], [])
+
+            # Attempts that were given less RAM than the one that worked ran out of it.
+            ooms = [attempt for attempt in attempts if attempt["ram_amount"] < job["ram_amount"]]
+            pipeline_stats.oom_retries += len(ooms)
+            pipeline_stats.wasted_ram_hours += (
+                (job["ram_amount"] - job["peak_ram_amount"]) * hours
+                + sum(attempt["ram_amount"] * get_hours(attempt) for attempt in ooms)
+            ) / 1024
+
+            estimated_ram_amount = estimator.estimate(
+                job["pipeline_applied"], job["platform"], job["size_in_bytes"]
+            )
+            if estimated_ram_amount:
+                pipeline_stats.estimated_jobs += 1
+            else:
+                # Without an estimate it would have been sized the same
+                # way the first attempt was.
+                estimated_ram_amount = attempts[0]["ram_amount"] if attempts else job["ram_amount"]
+
+            if estimated_ram_amount >= job["peak_ram_amount"]:
+                pipeline_stats.oom_retries_avoided += len(ooms)
+                pipeline_stats.estimated_wasted_ram_hours += (
+                    (estimated_ram_amount - job["peak_ram_amount"]) * hours / 1024
+                )
+            else:
+                # It would have run out of RAM, so all of that was wasted.
+                pipeline_stats.new_ooms += 1
+                pipeline_stats.estimated_wasted_ram_hours += estimated_ram_amount * hours / 1024
+
+        total = Stats()
+        for pipeline_stats in stats.values():
+            for field, value in vars(pipeline_stats).items():
+                setattr(total, field, getattr(total, field) + value)
+
+        print(", ".join(HEADERS))
+        for pipeline in sorted(stats):
+            print(", ".join(map(str, stats[pipeline].row(pipeline))))
+        print(", ".join(map(str, total.row("TOTAL"))))
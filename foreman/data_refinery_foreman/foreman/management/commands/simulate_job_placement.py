@@ -0,0 +1,297 @@
+"""Replays a historical mix of jobs to compare how they'd be placed on the worker queues.
+
+Every worker queue has its own node. The old placement sent each job
+to the first queue with no more than MAX_JOBS_PER_NODE jobs in it,
+regardless of how much RAM the job needed. message_queue.choose_job_queue
+also keeps track of how much RAM is committed to each queue and picks
+the queue the job fits best, refusing to place it if no node has room.
+
+This replays the downloader and processor jobs that started in a time
+window through both policies. Jobs arrive in the order they started,
+run for as long as they actually ran, and a node runs the jobs queued
+on it in order as long as it has enough RAM free. Jobs that can't be
+placed wait for the Foreman to try again once a job finishes. It
+reports how long the jobs waited to start, how long the whole mix took
+and what fraction of the nodes' RAM was in use while it ran.
+"""
+
+import datetime
+import heapq
+from collections import deque
+from typing import Callable, Dict, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+import pytz
+
+from data_refinery_common.message_queue import choose_job_queue
+from data_refinery_common.models import DownloaderJob, ProcessorJob
+
+PAGE_SIZE = 2000
+
+
+class SimulatedJob:
+    def __init__(self, key, arrival, duration, ram_amount, is_downloader, downloader_key=None):
+        self.key = key
+        self.arrival = arrival
+        self.duration = duration
+        self.ram_amount = ram_amount
+        self.is_downloader = is_downloader
+        self.downloader_key = downloader_key
+        self.job_queue = None
+        self.start = None
+
+
+class SimulatedQueue:
+    """A worker queue and the node that runs its jobs."""
+
+    def __init__(self, name: str, max_ram: int):
+        self.name = name
+        self.max_ram = max_ram
+        self.waiting = deque()
+        self.num_running = 0
+        self.num_downloaders = 0
+        self.running_ram = 0
+        self.committed_ram = 0
+
+    @property
+    def num_jobs(self):
+        return len(self.waiting) + self.num_running
+
+
+def first_fit_by_count(job: SimulatedJob, queues: List[SimulatedQueue], max_jobs: int, **kwargs):
+    """How jobs were placed before choose_job_queue."""
+    for queue in queues:
+        if queue.num_jobs <= max_jobs:
+            return queue.name
+
+    return None
+
+
+def best_fit_by_ram(job: SimulatedJob, queues: List[SimulatedQueue], max_jobs: int, max_ram: int):
+    return choose_job_queue(
+        job.ram_amount,
+        [queue.name for queue in queues],
+        {queue.name: queue.num_jobs for queue in queues},
+        {queue.name: queue.committed_ram for queue in queues},
+        max_jobs,
+        max_ram,
+    )
+
+
+POLICIES = {"first_fit_by_count": first_fit_by_count, "best_fit_by_ram": best_fit_by_ram}
+
+
+def simulate(
+    jobs: List[SimulatedJob],
+    policy: Callable,
+    num_queues: int,
+    max_jobs_per_node: int,
+    max_downloader_jobs_per_node: int,
+    max_ram_per_node: int,
+) -> Dict:
+    """Runs `jobs` through `num_queues` simulated queues, placing them with `policy`."""
+    queues = [SimulatedQueue("queue_{}".format(i), max_ram_per_node) for i in range(num_queues)]
+    queues_by_name = {queue.name: queue for queue in queues}
+    arrivals = deque(sorted(jobs, key=lambda job: job.arrival))
+    # Jobs that couldn't be placed, which the Foreman will retry.
+    unplaced = deque()
+    # (end time, sequence number, job) of the jobs that are running.
+    running = []
+    downloader_queues = {}
+    sequence = 0
+    now = 0.0
+    ram_seconds = 0.0
+    num_refusals = 0
+
+    def place(job: SimulatedJob) -> bool:
+        nonlocal num_refusals
+
+        job_queue = None
+        if job.downloader_key in downloader_queues:
+            # Processor jobs are queued on the same node as the data they need.
+            job_queue = downloader_queues[job.downloader_key]
+            queue = queues_by_name[job_queue]
+            if policy is best_fit_by_ram and queue.committed_ram + job.ram_amount > queue.max_ram:
+                job_queue = None
+        else:
+            eligible = queues
+            if job.is_downloader:
+                eligible = [
+                    queue
+                    for queue in queues
+                    if queue.num_downloaders <= max_downloader_jobs_per_node
+                ]
+            job_queue = policy(job, eligible, max_jobs=max_jobs_per_node, max_ram=max_ram_per_node)
+
+        if not job_queue:
+            num_refusals += 1
+            return False
+
+        job.job_queue = job_queue
+        queue = queues_by_name[job_queue]
+        queue.waiting.append(job)
+        queue.committed_ram += job.ram_amount
+        if job.is_downloader:
+            queue.num_downloaders += 1
+            downloader_queues[job.key] = job_queue
+
+        return True
+
+    def start_jobs():
+        nonlocal sequence
+        for queue in queues:
+            while (
+                queue.waiting and queue.running_ram + queue.waiting[0].ram_amount <= queue.max_ram
+            ):
+                job = queue.waiting.popleft()
+                job.start = now
+                queue.num_running += 1
+                queue.running_ram += job.ram_amount
+                heapq.heappush(running, (now + job.duration, sequence, job))
+                sequence += 1
+
+    while arrivals or unplaced or running or any(queue.waiting for queue in queues):
+        next_arrival = arrivals[0].arrival if arrivals else None
+        next_end = running[0][0] if running else None
+        if next_arrival is None and next_end is None:
+            # Whatever is left can never be placed or started.
+            break
+
+        if next_end is None or (next_arrival is not None and next_arrival <= next_end):
+            next_time = next_arrival
+        else:
+            next_time = next_end
+
+        ram_seconds += sum(queue.running_ram for queue in queues) * (next_time - now)
+        now = next_time
+
+        if next_end is not None and next_end == now:
+            _, _, job = heapq.heappop(running)
+            queue = queues_by_name[job.job_queue]
+            queue.num_running -= 1
+            queue.running_ram -= job.ram_amount
+            queue.committed_ram -= job.ram_amount
+            if job.is_downloader:
+                queue.num_downloaders -= 1
+
+            # The Foreman gets another chance at the jobs it couldn't place.
+            for _ in range(len(unplaced)):
+                job = unplaced.popleft()
+                if not place(job):
+                    unplaced.append(job)
+        else:
+            job = arrivals.popleft()
+            if not place(job):
+                unplaced.append(job)
+
+        start_jobs()
+
+    started = [job for job in jobs if job.start is not None]
+    waits = sorted(job.start - job.arrival for job in started)
+    makespan = now - min((job.arrival for job in jobs), default=0)
+
+    return {
+        "jobs": len(jobs),
+        "jobs_started": len(started),
+        "refused_placements": num_refusals,
+        "mean_wait_hours": sum(waits) / len(waits) / 3600 if waits else 0,
+        "p95_wait_hours": waits[int(0.95 * (len(waits) - 1))] / 3600 if waits else 0,
+        "makespan_hours": makespan / 3600,
+        "ram_utilization": (
+            ram_seconds / (num_queues * max_ram_per_node * makespan) if makespan else 0
+        ),
+    }
+
+
+def get_jobs(start_time, end_time, max_ram: int) -> List[SimulatedJob]:
+    """Returns the downloader and processor jobs that started between
+    `start_time` and `end_time` as SimulatedJobs, leaving out jobs too
+    big for any node."""
+    jobs = []
+    for model, fields in [
+        (DownloaderJob, ["id", "start_time", "end_time", "ram_amount"]),
+        (ProcessorJob, ["id", "start_time", "end_time", "ram_amount", "downloader_job_id"]),
+    ]:
+        rows = (
+            model.objects.filter(
+                start_time__gte=start_time,
+                start_time__lt=end_time,
+                end_time__isnull=False,
+                ram_amount__lte=max_ram,
+            )
+            .exclude(batch_job_queue=settings.AWS_BATCH_QUEUE_SMASHER_NAME)
+            .values(*fields)
+            .iterator(chunk_size=PAGE_SIZE)
+        )
+        for row in rows:
+            is_downloader = model is DownloaderJob
+            downloader_job_id = row.get("downloader_job_id")
+            jobs.append(
+                SimulatedJob(
+                    ("DownloaderJob" if is_downloader else "ProcessorJob", row["id"]),
+                    (row["start_time"] - start_time).total_seconds(),
+                    max(0, (row["end_time"] - row["start_time"]).total_seconds()),
+                    row["ram_amount"],
+                    is_downloader,
+                    ("DownloaderJob", downloader_job_id) if downloader_job_id else None,
+                )
+            )
+
+    return jobs
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start-date",
+            type=lambda s: pytz.utc.localize(datetime.datetime.strptime(s, "%Y-%m-%d")),
+            default=None,
+            help="Replay jobs that started on or after this date, formatted YYYY-MM-DD."
+            " Defaults to a week ago.",
+        )
+        parser.add_argument("--days", type=int, default=1)
+        parser.add_argument(
+            "--num-queues", type=int, default=len(settings.AWS_BATCH_QUEUE_WORKERS_NAMES) or 1,
+        )
+        parser.add_argument("--max-jobs-per-node", type=int, default=settings.MAX_JOBS_PER_NODE)
+        parser.add_argument(
+            "--max-downloader-jobs-per-node",
+            type=int,
+            default=settings.MAX_DOWNLOADER_JOBS_PER_NODE,
+        )
+        parser.add_argument("--max-ram-per-node", type=int, default=settings.MAX_RAM_PER_NODE)
+
+    def handle(self, *args, **options):
+        start_time = options["start_date"] or timezone.now() - datetime.timedelta(days=7)
+        end_time = start_time + datetime.timedelta(days=options["days"])
+
+        headers = None
+        for name, policy in POLICIES.items():
+            # Each policy needs its own copies since they're mutated.
+            jobs = get_jobs(start_time, end_time, options["max_ram_per_node"])
+            stats = simulate(
+                jobs,
+                policy,
+                options["num_queues"],
+                options["max_jobs_per_node"],
+                options["max_downloader_jobs_per_node"],
+                options["max_ram_per_node"],
+            )
+
+            if not headers:
+                headers = list(stats.keys())
+                print(", ".join(["policy"] + headers))
+            print(
+                ", ".join(
+                    [name]
+                    + [
+                        "{:.3f}".format(stats[header])
+                        if isinstance(stats[header], float)
+                        else str(stats[header])
+                        for header in headers
+                    ]
+                )
+            )
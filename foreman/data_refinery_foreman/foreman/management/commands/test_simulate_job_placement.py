@@ -0,0 +1,54 @@
+from django.test import TestCase
+
+from data_refinery_foreman.foreman.management.commands.simulate_job_placement import (
+    SimulatedJob,
+    best_fit_by_ram,
+    first_fit_by_count,
+    simulate,
+)
+
+
+def make_jobs():
+    # Three big jobs arrive a second apart, and then a downloader job
+    # and the processor job for what it downloaded.
+    jobs = [SimulatedJob(i, float(i), 100.0, 32768, False) for i in range(3)]
+    jobs.append(SimulatedJob("downloader", 3.0, 10.0, 1024, True))
+    jobs.append(SimulatedJob("processor", 5.0, 10.0, 32768, False, "downloader"))
+    return jobs
+
+
+class SimulateJobPlacementTestCase(TestCase):
+    def run_policy(self, policy):
+        jobs = make_jobs()
+        stats = simulate(
+            jobs,
+            policy,
+            num_queues=2,
+            max_jobs_per_node=25,
+            max_downloader_jobs_per_node=20,
+            max_ram_per_node=65536,
+        )
+        return {job.key: job for job in jobs}, stats
+
+    def test_first_fit_by_count(self):
+        jobs, stats = self.run_policy(first_fit_by_count)
+
+        # Everything piles onto the first node, so the third big job
+        # has to wait for one of the others to finish.
+        self.assertEqual({job.job_queue for job in jobs.values()}, {"queue_0"})
+        self.assertEqual(jobs[2].start, 100.0)
+        self.assertEqual(stats["jobs_started"], 5)
+
+    def test_best_fit_by_ram(self):
+        jobs, stats = self.run_policy(best_fit_by_ram)
+
+        self.assertEqual(jobs[0].job_queue, "queue_0")
+        self.assertEqual(jobs[1].job_queue, "queue_0")
+        self.assertEqual(jobs[2].job_queue, "queue_1")
+        self.assertEqual(jobs[2].start, 2.0)
+
+        # The processor job stays with its data even though it has to
+        # wait for room there.
+        self.assertEqual(jobs["processor"].job_queue, jobs["downloader"].job_queue)
+        self.assertGreater(stats["refused_placements"], 0)
+        self.assertEqual(stats["jobs_started"], 5)
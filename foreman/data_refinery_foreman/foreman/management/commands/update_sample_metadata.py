@@ -50,6 +50,15 @@ class Command(BaseCommand):
         page = paginator.page()
 
         while True:
+            # Fetch the metadata for the page's SRA samples all at once.
+            SraSurveyor.prefetch_metadata(
+                [
+                    sample.accession_code
+                    for sample in page.object_list
+                    if sample.source_database == "SRA"
+                ]
+            )
+
             for sample in page.object_list:
                 logger.debug("Refreshing metadata for a sample.", sample=sample.accession_code)
                 try:
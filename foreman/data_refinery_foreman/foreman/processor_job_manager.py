@@ -3,10 +3,10 @@ from typing import List
 import data_refinery_foreman.foreman.utils as utils
 from data_refinery_common.enums import ProcessorPipeline
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.message_queue import get_capacity_for_jobs, send_job
+from data_refinery_common.message_queue import get_capacity_for_jobs, send_jobs
 from data_refinery_common.models import ProcessorJob
 from data_refinery_common.performant_pagination.pagination import PerformantPaginator as Paginator
-from data_refinery_foreman.foreman.job_requeuing import requeue_processor_job
+from data_refinery_foreman.foreman.job_requeuing import requeue_processor_jobs
 
 logger = get_and_configure_logger(__name__)
 
@@ -21,22 +21,22 @@ def handle_processor_jobs(
     if queue_capacity is None:
         queue_capacity = get_capacity_for_jobs()
 
-    jobs_dispatched = 0
-    for count, job in enumerate(jobs):
-
-        if not ignore_ceiling and jobs_dispatched >= queue_capacity:
-            logger.info(
-                "We hit the maximum total jobs ceiling, "
-                "so we're not handling any more processor jobs now."
-            )
-            return
-
+    jobs_to_requeue = []
+    for job in jobs:
         if job.num_retries < utils.MAX_NUM_RETRIES:
-            if requeue_processor_job(job):
-                jobs_dispatched = jobs_dispatched + 1
+            if not ignore_ceiling and len(jobs_to_requeue) >= queue_capacity:
+                logger.info(
+                    "We hit the maximum total jobs ceiling, "
+                    "so we're not handling any more processor jobs now."
+                )
+                break
+
+            jobs_to_requeue.append(job)
         else:
             utils.handle_repeated_failure(job)
 
+    requeue_processor_jobs(jobs_to_requeue)
+
 
 def retry_failed_processor_jobs() -> None:
     """Handle processor jobs that were marked as a failure.
@@ -187,15 +187,13 @@ def retry_unqueued_processor_jobs() -> None:
         )
 
     while queue_capacity > 0:
-        for processor_job in database_page.object_list:
-            if send_job(
-                ProcessorPipeline[processor_job.pipeline_applied],
-                job=processor_job,
-                is_dispatch=True,
-            ):
-                queue_capacity -= 1
-        else:
-            # Can't communicate with Batch just now, leave the job for a later loop.
+        processor_jobs = list(database_page.object_list)[:queue_capacity]
+        sent = send_jobs(
+            [(ProcessorPipeline[job.pipeline_applied], job) for job in processor_jobs],
+            is_dispatch=True,
+        )
+        if not any(sent):
+            # Can't communicate with Batch just now, leave the jobs for a later loop.
             break
 
         if database_page.has_next():
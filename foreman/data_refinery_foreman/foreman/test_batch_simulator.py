@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from data_refinery_common.enums import ProcessorPipeline
+from data_refinery_common.message_queue import get_job_queue_depths, send_jobs
+from data_refinery_common.models import ProcessorJob
+from data_refinery_foreman.foreman.batch_simulator import SIMULATED_FAILURE_REASON, BatchSimulator
+
+WORKER_QUEUES = ["queue_1", "queue_2"]
+
+
+@override_settings(
+    RUNNING_IN_CLOUD=True,
+    AWS_BATCH_QUEUE_WORKERS_NAMES=WORKER_QUEUES,
+    AWS_BATCH_QUEUE_ALL_NAMES=WORKER_QUEUES,
+)
+class BatchSimulatorTestCase(TestCase):
+    def start_simulator(self, **kwargs):
+        simulator = BatchSimulator(job_duration=100, node_ram_amount=24576, seed=1, **kwargs)
+        patcher = patch("data_refinery_common.message_queue.batch", simulator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return simulator
+
+    def send_salmon_jobs(self, num_jobs):
+        jobs = [
+            ProcessorJob.objects.create(pipeline_applied="SALMON", ram_amount=12288)
+            for _ in range(num_jobs)
+        ]
+        self.assertTrue(all(send_jobs([(ProcessorPipeline.SALMON, job) for job in jobs])))
+        return jobs
+
+    def test_jobs_run_as_ram_allows(self):
+        simulator = self.start_simulator()
+        jobs = self.send_salmon_jobs(3)
+
+        # Only two jobs fit on a node at once.
+        simulator.advance(50)
+        self.assertEqual(simulator.count_jobs(), {"RUNNING": 2, "RUNNABLE": 1})
+        for job in jobs:
+            job.refresh_from_db()
+        self.assertEqual([job.start_time is not None for job in jobs], [True, True, False])
+
+        simulator.advance(100)
+        self.assertEqual(simulator.count_jobs(), {"SUCCEEDED": 2, "RUNNING": 1})
+        jobs[0].refresh_from_db()
+        self.assertTrue(jobs[0].success)
+        self.assertIsNotNone(jobs[0].end_time)
+
+        simulator.advance(100)
+        self.assertEqual(simulator.count_jobs(), {"SUCCEEDED": 3})
+        self.assertEqual(get_job_queue_depths()["all_jobs"], {"queue_1": 0, "queue_2": 0})
+        self.assertEqual(max(simulator.submissions.values()), 1)
+
+    def test_failures(self):
+        simulator = self.start_simulator(failure_rate=1)
+        job = self.send_salmon_jobs(1)[0]
+
+        simulator.advance(200)
+
+        job.refresh_from_db()
+        self.assertFalse(job.success)
+        self.assertEqual(job.failure_reason, SIMULATED_FAILURE_REASON)
+
+    def test_oom_leaves_job_hung(self):
+        simulator = self.start_simulator(oom_rate=1)
+        job = self.send_salmon_jobs(1)[0]
+
+        simulator.advance(200)
+
+        self.assertEqual(simulator.count_jobs(), {"FAILED": 1})
+        job.refresh_from_db()
+        self.assertIsNotNone(job.start_time)
+        self.assertIsNone(job.end_time)
+        self.assertIsNone(job.success)
+
+    def test_list_jobs_pages(self):
+        simulator = self.start_simulator()
+        for i in range(150):
+            simulator.submit_job(
+                jobName="SALMON_12288_{}".format(i), jobQueue="queue_1", parameters={}
+            )
+
+        first_page = simulator.list_jobs(jobQueue="queue_1", jobStatus="RUNNABLE")
+        self.assertEqual(len(first_page["jobSummaryList"]), 100)
+        second_page = simulator.list_jobs(
+            jobQueue="queue_1", jobStatus="RUNNABLE", nextToken=first_page["nextToken"]
+        )
+        self.assertEqual(len(second_page["jobSummaryList"]), 50)
+        self.assertNotIn("nextToken", second_page)
+
+    def test_concurrent_submissions(self):
+        simulator = self.start_simulator()
+
+        def submit(i):
+            return simulator.submit_job(
+                jobName="SALMON_12288_{}".format(i), jobQueue="queue_1", parameters={}
+            )["jobId"]
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            job_ids = list(pool.map(submit, range(500)))
+
+        self.assertEqual(len(set(job_ids)), 500)
+        self.assertEqual(len(simulator.jobs), 500)
+        self.assertEqual(simulator.num_calls["submit_job"], 500)
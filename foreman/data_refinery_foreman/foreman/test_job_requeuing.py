@@ -2,10 +2,19 @@ from test.support import EnvironmentVarGuard
 from unittest.mock import patch
 
 from django.conf import settings
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from data_refinery_common.models import DownloaderJob, ProcessorJob, SurveyJob
+from data_refinery_common.models import (
+    DownloaderJob,
+    OriginalFileSampleAssociation,
+    ProcessorJob,
+    Sample,
+    SurveyJob,
+)
+from data_refinery_common.ram_estimation import get_ram_estimator, reset_ram_estimator
 from data_refinery_foreman.foreman import job_requeuing
 from data_refinery_foreman.foreman.test_utils import (
     create_downloader_job,
@@ -132,6 +141,92 @@ class JobRequeuingTestCase(TestCase):
         self.assertEqual(original_job.ram_amount, 16384)
         self.assertEqual(retried_job.ram_amount, 32768)
 
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    def test_requeuing_processor_job_w_estimated_ram(self, mock_send_job):
+        """Jobs that ran out of RAM should skip past amounts that similar jobs needed more than."""
+        mock_send_job.side_effect = fake_send_job
+
+        for _ in range(20):
+            ProcessorJob.objects.create(
+                pipeline_applied="SALMON",
+                ram_amount=32768,
+                peak_ram_amount=20000,
+                success=True,
+                start_time=timezone.now(),
+                end_time=timezone.now(),
+            )
+        reset_ram_estimator()
+        self.addCleanup(reset_ram_estimator)
+
+        job = create_processor_job(pipeline="SALMON", ram_amount=16384, start_time=timezone.now())
+
+        job_requeuing.requeue_processor_job(job)
+        self.assertEqual(len(mock_send_job.mock_calls), 1)
+
+        retried_job = ProcessorJob.objects.get(num_retries=1)
+        # 20000MB plus 10% headroom, rounded up to the next 512MB.
+        self.assertEqual(retried_job.ram_amount, 22016)
+
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    def test_requeuing_estimator_sized_processor_job(self, mock_send_job):
+        """Jobs sized by ram_estimation have amounts between the rungs of the ladder."""
+        mock_send_job.side_effect = fake_send_job
+        reset_ram_estimator()
+        self.addCleanup(reset_ram_estimator)
+
+        job = create_processor_job(pipeline="SALMON", ram_amount=13824, start_time=timezone.now())
+
+        job_requeuing.requeue_processor_job(job)
+        retried_job = ProcessorJob.objects.get(num_retries=1)
+        self.assertEqual(retried_job.ram_amount, 16384)
+
+        # The next rung is more than a node has.
+        retried_job.start_time = timezone.now()
+        retried_job.save()
+        with override_settings(MAX_RAM_PER_NODE=24576):
+            job_requeuing.requeue_processor_job(retried_job)
+
+        self.assertEqual(ProcessorJob.objects.get(num_retries=2).ram_amount, 24576)
+
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
+    def test_requeuing_processor_jobs_queries(self, mock_send_jobs):
+        """Requeuing a bigger page of jobs shouldn't take any more queries."""
+        mock_send_jobs.side_effect = lambda jobs, is_dispatch=False: [True] * len(jobs)
+        reset_ram_estimator()
+        self.addCleanup(reset_ram_estimator)
+        # Fitting the estimator happens once, not once per page.
+        get_ram_estimator()
+
+        def create_jobs(num_jobs):
+            jobs = []
+            for _ in range(num_jobs):
+                job = create_processor_job(
+                    pipeline="SALMON", ram_amount=16384, start_time=timezone.now()
+                )
+                sample = Sample.objects.create(
+                    accession_code="SRR" + str(Sample.objects.count()),
+                    platform_accession_code="IlluminaHiSeq2500",
+                )
+                OriginalFileSampleAssociation.objects.create(
+                    original_file=job.original_files.first(), sample=sample
+                )
+                jobs.append(ProcessorJob.objects.get(id=job.id))
+
+            return jobs
+
+        small_page = create_jobs(2)
+        with CaptureQueriesContext(connection) as small_page_queries:
+            self.assertEqual(job_requeuing.requeue_processor_jobs(small_page), 2)
+
+        big_page = create_jobs(6)
+        with self.assertNumQueries(len(small_page_queries)):
+            self.assertEqual(job_requeuing.requeue_processor_jobs(big_page), 6)
+
+        for job in big_page:
+            job.refresh_from_db()
+            self.assertTrue(job.retried)
+            self.assertEqual(job.retried_job.ram_amount, 32768)
+
     @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
     def test_requeuing_survey_job(self, mock_send_job):
         mock_send_job.side_effect = fake_send_job
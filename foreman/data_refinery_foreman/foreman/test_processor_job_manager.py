@@ -5,7 +5,7 @@ from django.conf import settings
 from django.test import TestCase
 from django.utils import timezone
 
-from data_refinery_common.models import ProcessorJob
+from data_refinery_common.models import Dataset, ProcessorJob, ProcessorJobDatasetAssociation
 from data_refinery_foreman.foreman import processor_job_manager, utils
 from data_refinery_foreman.foreman.test_utils import create_processor_job
 
@@ -23,19 +23,27 @@ def fake_send_job(job_type, job, is_dispatch=False):
     return True
 
 
+def fake_send_jobs(jobs, is_dispatch=False):
+    return [fake_send_job(job_type, job, is_dispatch) for job_type, job in jobs]
+
+
+def count_sent_jobs(mock_send_jobs):
+    return sum(len(call[1][0]) for call in mock_send_jobs.mock_calls)
+
+
 class ProcessorJobManagerTestCase(TestCase):
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
-    def test_repeated_processor_failures(self, mock_list_jobs, mock_send_job):
+    def test_repeated_processor_failures(self, mock_list_jobs, mock_send_jobs):
         """Jobs will be repeatedly retried."""
-        mock_send_job.side_effect = fake_send_job
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
 
         job = create_processor_job()
 
         for i in range(utils.MAX_NUM_RETRIES):
             processor_job_manager.handle_processor_jobs([job])
-            self.assertEqual(i + 1, len(mock_send_job.mock_calls))
+            self.assertEqual(i + 1, count_sent_jobs(mock_send_jobs))
 
             jobs = ProcessorJob.objects.all().order_by("-id")
             previous_job = jobs[1]
@@ -55,10 +63,39 @@ class ProcessorJobManagerTestCase(TestCase):
         self.assertEqual(last_job.num_retries, utils.MAX_NUM_RETRIES)
         self.assertFalse(last_job.success)
 
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
+    @patch("data_refinery_common.message_queue.batch.list_jobs")
+    def test_requeuing_processor_jobs_in_bulk(self, mock_list_jobs, mock_send_jobs):
+        """The new jobs keep their files and datasets, and jobs Batch
+        didn't take are left to be retried later."""
+        mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
+        mock_send_jobs.side_effect = lambda jobs, is_dispatch=False: [
+            fake_send_job(*job) for job in jobs[:-1]
+        ] + [False]
+
+        jobs = [create_processor_job() for _ in range(3)]
+        dataset = Dataset.objects.create()
+        ProcessorJobDatasetAssociation.objects.create(processor_job=jobs[0], dataset=dataset)
+
+        processor_job_manager.handle_processor_jobs(jobs)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 3)
+
+        for job in jobs:
+            job.refresh_from_db()
+        self.assertTrue(jobs[0].retried)
+        self.assertTrue(jobs[1].retried)
+        self.assertFalse(jobs[2].retried)
+        self.assertEqual(ProcessorJob.objects.count(), 5)
+
+        retried_job = jobs[0].retried_job
+        self.assertEqual(retried_job.num_retries, 1)
+        self.assertEqual(set(retried_job.original_files.all()), set(jobs[0].original_files.all()))
+        self.assertEqual(list(retried_job.datasets.all()), [dataset])
+
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
-    def test_retrying_failed_processor_jobs(self, mock_list_jobs, mock_send_job):
-        mock_send_job.side_effect = fake_send_job
+    def test_retrying_failed_processor_jobs(self, mock_list_jobs, mock_send_jobs):
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
 
         job = create_processor_job()
@@ -66,7 +103,7 @@ class ProcessorJobManagerTestCase(TestCase):
         job.save()
 
         processor_job_manager.retry_failed_processor_jobs()
-        self.assertEqual(len(mock_send_job.mock_calls), 1)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 1)
 
         jobs = ProcessorJob.objects.order_by("id")
         original_job = jobs[0]
@@ -77,11 +114,11 @@ class ProcessorJobManagerTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
     @patch("data_refinery_foreman.foreman.utils.batch.describe_jobs")
-    def test_retrying_hung_processor_jobs(self, mock_describe_jobs, mock_list_jobs, mock_send_job):
-        mock_send_job.side_effect = fake_send_job
+    def test_retrying_hung_processor_jobs(self, mock_describe_jobs, mock_list_jobs, mock_send_jobs):
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
         mock_describe_jobs.return_value = {"jobs": [{"jobId": "FINDME", "status": "FAILED"}]}
 
@@ -96,7 +133,7 @@ class ProcessorJobManagerTestCase(TestCase):
         job2.save()
 
         processor_job_manager.retry_hung_processor_jobs()
-        self.assertEqual(len(mock_send_job.mock_calls), 2)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 2)
 
         jobs = ProcessorJob.objects.order_by("id")
         original_job = jobs[0]
@@ -115,14 +152,14 @@ class ProcessorJobManagerTestCase(TestCase):
         retried_job2 = jobs[3]
         self.assertEqual(retried_job2.num_retries, 1)
 
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
     @patch("data_refinery_foreman.foreman.utils.batch.describe_jobs")
     def test_not_retrying_hung_processor_jobs(
-        self, mock_describe_jobs, mock_list_jobs, mock_send_job
+        self, mock_describe_jobs, mock_list_jobs, mock_send_jobs
     ):
         """Tests that we don't restart processor jobs that are still running."""
-        mock_send_job.side_effect = fake_send_job
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
         mock_describe_jobs.return_value = {"jobs": [{"jobId": "FINDME", "status": "RUNNING"}]}
 
@@ -132,7 +169,7 @@ class ProcessorJobManagerTestCase(TestCase):
         job.save()
 
         processor_job_manager.retry_hung_processor_jobs()
-        self.assertEqual(len(mock_send_job.mock_calls), 0)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 0)
 
         jobs = ProcessorJob.objects.order_by("id")
         original_job = jobs[0]
@@ -142,11 +179,11 @@ class ProcessorJobManagerTestCase(TestCase):
 
         self.assertEqual(jobs.count(), 1)
 
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
     @patch("data_refinery_foreman.foreman.utils.batch.describe_jobs")
-    def test_retrying_lost_processor_jobs(self, mock_describe_jobs, mock_list_jobs, mock_send_job):
-        mock_send_job.side_effect = fake_send_job
+    def test_retrying_lost_processor_jobs(self, mock_describe_jobs, mock_list_jobs, mock_send_jobs):
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
         mock_describe_jobs.return_value = EMPTY_DESCRIBE_JOBS_QUEUE_RESPONSE
 
@@ -158,7 +195,7 @@ class ProcessorJobManagerTestCase(TestCase):
         job2.save()
 
         processor_job_manager.retry_lost_processor_jobs()
-        self.assertEqual(len(mock_send_job.mock_calls), 2)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 2)
 
         jobs = ProcessorJob.objects.order_by("id")
         original_job = jobs[0]
@@ -177,10 +214,10 @@ class ProcessorJobManagerTestCase(TestCase):
         retried_job2 = jobs[3]
         self.assertEqual(retried_job2.num_retries, 1)
 
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
     @patch("data_refinery_foreman.foreman.utils.batch.describe_jobs")
-    def test_retrying_lost_smasher_jobs(self, mock_describe_jobs, mock_list_jobs, mock_send_job):
+    def test_retrying_lost_smasher_jobs(self, mock_describe_jobs, mock_list_jobs, mock_send_jobs):
         """Make sure that the smasher jobs will get retried even though they
         don't have a volume_index.
 
@@ -188,7 +225,7 @@ class ProcessorJobManagerTestCase(TestCase):
         need a separate smasher compute environment so this could test
         that once it's done.
         """
-        mock_send_job.side_effect = fake_send_job
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
         mock_describe_jobs.return_value = EMPTY_DESCRIBE_JOBS_QUEUE_RESPONSE
 
@@ -198,7 +235,7 @@ class ProcessorJobManagerTestCase(TestCase):
 
         processor_job_manager.retry_lost_processor_jobs()
 
-        self.assertEqual(len(mock_send_job.mock_calls), 1)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 1)
 
         jobs = ProcessorJob.objects.order_by("id")
         original_job = jobs[0]
@@ -209,14 +246,14 @@ class ProcessorJobManagerTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
     @patch("data_refinery_foreman.foreman.utils.batch.describe_jobs")
     def test_not_retrying_old_processor_jobs(
-        self, mock_describe_jobs, mock_list_jobs, mock_send_job
+        self, mock_describe_jobs, mock_list_jobs, mock_send_jobs
     ):
         """Makes sure temporary logic to limit the Foreman's scope works."""
-        mock_send_job.side_effect = fake_send_job
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
         mock_describe_jobs.return_value = EMPTY_DESCRIBE_JOBS_QUEUE_RESPONSE
 
@@ -225,18 +262,18 @@ class ProcessorJobManagerTestCase(TestCase):
         job.save()
 
         processor_job_manager.retry_lost_processor_jobs()
-        self.assertEqual(len(mock_send_job.mock_calls), 0)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 0)
 
         self.assertEqual(1, ProcessorJob.objects.all().count())
 
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
     @patch("data_refinery_foreman.foreman.utils.batch.describe_jobs")
     def test_not_retrying_lost_processor_jobs(
-        self, mock_describe_jobs, mock_list_jobs, mock_send_job
+        self, mock_describe_jobs, mock_list_jobs, mock_send_jobs
     ):
         """Make sure that we don't retry processor jobs we shouldn't."""
-        mock_send_job.side_effect = fake_send_job
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
         mock_describe_jobs.return_value = {"jobs": [{"jobId": "FINDME", "status": "RUNNABLE"}]}
 
@@ -245,7 +282,7 @@ class ProcessorJobManagerTestCase(TestCase):
         job.save()
 
         processor_job_manager.retry_lost_processor_jobs()
-        self.assertEqual(len(mock_send_job.mock_calls), 0)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 0)
 
         jobs = ProcessorJob.objects.order_by("id")
         original_job = jobs[0]
@@ -256,11 +293,11 @@ class ProcessorJobManagerTestCase(TestCase):
         # Make sure no additional job was created.
         self.assertEqual(jobs.count(), 1)
 
-    @patch("data_refinery_foreman.foreman.job_requeuing.send_job")
+    @patch("data_refinery_foreman.foreman.job_requeuing.send_jobs")
     @patch("data_refinery_common.message_queue.batch.list_jobs")
     @patch("data_refinery_foreman.foreman.utils.batch.describe_jobs")
-    def test_not_retrying_janitor_jobs(self, mock_describe_jobs, mock_list_jobs, mock_send_job):
-        mock_send_job.side_effect = fake_send_job
+    def test_not_retrying_janitor_jobs(self, mock_describe_jobs, mock_list_jobs, mock_send_jobs):
+        mock_send_jobs.side_effect = fake_send_jobs
         mock_list_jobs.return_value = EMPTY_LIST_JOBS_QUEUE_RESPONSE
         mock_describe_jobs.return_value = EMPTY_DESCRIBE_JOBS_QUEUE_RESPONSE
 
@@ -268,7 +305,7 @@ class ProcessorJobManagerTestCase(TestCase):
         job.save()
 
         processor_job_manager.retry_lost_processor_jobs()
-        self.assertEqual(len(mock_send_job.mock_calls), 0)
+        self.assertEqual(count_sent_jobs(mock_send_jobs), 0)
 
         jobs = ProcessorJob.objects.order_by("id")
         self.assertEqual(len(jobs), 1)
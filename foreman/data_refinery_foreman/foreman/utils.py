@@ -1,5 +1,7 @@
 import datetime
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 
 from django.utils import timezone
 
@@ -23,6 +25,8 @@ PAGE_SIZE = 2000
 # 100 is the maximum number of jobIds you can pass to a AWS Batch's
 # describe_jobs.
 DESCRIBE_JOBS_PAGE_SIZE = 100
+# How many pages of jobs are described at once.
+DESCRIBE_JOBS_MAX_THREADS = 8
 
 # Setting this to a recent date will prevent the Foreman from queuing/requeuing
 # jobs created before this cutoff.
@@ -53,47 +57,51 @@ def handle_repeated_failure(job) -> None:
     )
 
 
-def check_hung_jobs(object_list):
-    hung_jobs = []
-    # Batch will describe up to 100 jobs at a time.
-    for page_start in range(0, len(object_list), DESCRIBE_JOBS_PAGE_SIZE):
-        page_end = page_start + DESCRIBE_JOBS_PAGE_SIZE
-        page = object_list[page_start:page_end]
+def describe_batch_job_statuses(batch_job_ids: List[str]) -> Dict[str, str]:
+    """Returns the status Batch has for each of batch_job_ids.
+
+    Batch will describe up to 100 jobs at a time, so the pages are
+    described by a pool of up to DESCRIBE_JOBS_MAX_THREADS threads
+    rather than waiting on Batch for each one in turn. Jobs that Batch
+    doesn't know about are left out.
+    """
+    pages = [
+        batch_job_ids[page_start : page_start + DESCRIBE_JOBS_PAGE_SIZE]
+        for page_start in range(0, len(batch_job_ids), DESCRIBE_JOBS_PAGE_SIZE)
+    ]
+    if not pages:
+        return {}
 
-        batch_jobs = []
-        job_ids = [job.batch_job_id for job in page if job.batch_job_id]
-        if job_ids:
-            batch_jobs = batch.describe_jobs(jobs=job_ids)["jobs"]
+    with ThreadPoolExecutor(max_workers=min(DESCRIBE_JOBS_MAX_THREADS, len(pages))) as pool:
+        responses = pool.map(lambda page: batch.describe_jobs(jobs=page), pages)
 
-        running_job_batch_ids = {job["jobId"] for job in batch_jobs if job["status"] == "RUNNING"}
+        return {job["jobId"]: job["status"] for response in responses for job in response["jobs"]}
 
-        for job in page:
-            if job.batch_job_id and job.batch_job_id not in running_job_batch_ids:
-                hung_jobs.append(job)
 
-    return hung_jobs
+def check_hung_jobs(object_list):
+    statuses = describe_batch_job_statuses(
+        [job.batch_job_id for job in object_list if job.batch_job_id]
+    )
+
+    return [
+        job
+        for job in object_list
+        if job.batch_job_id and statuses.get(job.batch_job_id) != "RUNNING"
+    ]
 
 
 def check_lost_jobs(object_list):
-    lost_jobs = []
-    # Batch will describe up to 100 jobs at a time.
-    for page_start in range(0, len(object_list), DESCRIBE_JOBS_PAGE_SIZE):
-        page_end = page_start + DESCRIBE_JOBS_PAGE_SIZE
-        page = object_list[page_start:page_end]
-
-        batch_jobs = []
-        job_ids = [job.batch_job_id for job in page if job.batch_job_id]
-        if job_ids:
-            batch_jobs = batch.describe_jobs(jobs=job_ids)["jobs"]
-
-        # Need to ignore statuses where the job wouldn't have its
-        # start_time set. This includes RUNNING because it may not
-        # have yet gotten to that point.
-        ignore = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"]
-        ignore_job_batch_ids = {job["jobId"] for job in batch_jobs if job["status"] in ignore}
-
-        for job in page:
-            if not job.batch_job_id or job.batch_job_id not in ignore_job_batch_ids:
-                lost_jobs.append(job)
-
-    return lost_jobs
+    statuses = describe_batch_job_statuses(
+        [job.batch_job_id for job in object_list if job.batch_job_id]
+    )
+
+    # Need to ignore statuses where the job wouldn't have its
+    # start_time set. This includes RUNNING because it may not
+    # have yet gotten to that point.
+    ignore = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"]
+
+    return [
+        job
+        for job in object_list
+        if not job.batch_job_id or statuses.get(job.batch_job_id) not in ignore
+    ]
@@ -245,6 +245,7 @@ GEO:
 """
 
 import csv
+from functools import lru_cache
 from io import StringIO
 from typing import Dict, List
 
@@ -266,19 +267,12 @@ TITLE_FIELDS = [
 
 def extract_title(sample: Dict, priority_field: str = None) -> str:
     """ Given a flat sample dictionary, find the title """
-    if priority_field:
-        title_fields = [priority_field] + [tf for tf in TITLE_FIELDS if tf != priority_field]
-    else:
-        title_fields = TITLE_FIELDS
-
     # Specifically look up for imported, non-SDRF AE samples
     for comment in sample.get("source_comment", []):
         if "title" in comment.get("name", ""):
             return comment["value"]
 
-    expanded_title_fields = create_variants(title_fields)
-
-    for title_field in expanded_title_fields:
+    for title_field in get_title_variants(priority_field):
         if title_field in sample:
             return sample[title_field]
 
@@ -287,6 +281,18 @@ def extract_title(sample: Dict, priority_field: str = None) -> str:
     return None
 
 
+@lru_cache(maxsize=None)
+def get_title_variants(priority_field: str = None) -> tuple:
+    """Returns the variants of TITLE_FIELDS in the order to look for
+    them, with the variants of `priority_field` first."""
+    if priority_field:
+        title_fields = [priority_field] + [tf for tf in TITLE_FIELDS if tf != priority_field]
+    else:
+        title_fields = TITLE_FIELDS
+
+    return tuple(create_variants(title_fields))
+
+
 def create_variants(fields_list: List):
     """ Given a list of strings, create variations likely to give metadata hits.
 
@@ -336,8 +342,11 @@ def parse_sdrf(sdrf_url: str) -> List:
         logger.error("Unable to fetch URL: " + sdrf_url, response_code=sdrf_response.status_code)
         return []
 
-    sdrf_text = sdrf_response.text
+    return parse_sdrf_text(sdrf_response.text)
+
 
+def parse_sdrf_text(sdrf_text: str) -> List:
+    """ Parses the text of an SDRF file into a list of sample dictionaries. """
     samples = []
 
     reader = csv.reader(StringIO(sdrf_text), delimiter="\t")
@@ -387,183 +396,214 @@ def preprocess_geo_sample(sample) -> List:
     return new_sample
 
 
+SEX_FIELDS = [
+    "sex",
+    "gender",
+    "subject gender",
+    "subjext sex",
+    # This looks reduntant, but there are some samples which use
+    # Characteristic[Characteristic[sex]]
+    "characteristic [sex]",
+    "characteristics [sex]",
+]
+
+AGE_FIELDS = [
+    "age",
+    "patient age",
+    "age of patient",
+    "age (years)",
+    "age (yrs)",
+    "age (months)",
+    "age (days)",
+    "age (hours)",
+    "age at diagnosis",
+    "age at diagnosis years",
+    "age at diagnosis months",
+    "age at diagnosis days",
+    "age at diagnosis hours",
+    "characteristic [age]",
+    "characteristics [age]",
+]
+
+SPECIMEN_PART_FIELDS = [
+    # AE
+    "organism part",
+    "cell type",
+    "tissue",
+    "tissue type",
+    "tissue source",
+    "tissue origin",
+    "source tissue",
+    "tissue subtype",
+    "tissue/cell type",
+    "tissue region",
+    "tissue compartment",
+    "tissues",
+    "tissue of origin",
+    "tissue-type",
+    "tissue harvested",
+    "cell/tissue type",
+    "tissue subregion",
+    "organ",
+    "characteristic [organism part]",
+    "characteristics [organism part]",
+    # SRA
+    "cell_type",
+    "organismpart",
+    # GEO
+    "isolation source",
+    "tissue sampled",
+    "cell description",
+]
+
+GENETIC_INFORMATION_FIELDS = [
+    "strain/background",
+    "strain",
+    "strain or line",
+    "background strain",
+    "genotype",
+    "genetic background",
+    "genetic information",
+    "genotype/variation",
+    "ecotype",
+    "cultivar",
+    "strain/genotype",
+]
+
+DISEASE_FIELDS = [
+    "disease",
+    "disease state",
+    "disease status",
+    "diagnosis",
+    "infection with",
+    "sample type",
+]
+
+DISEASE_STAGE_FIELDS = [
+    "disease state",
+    "disease staging",
+    "disease stage",
+    "grade",
+    "tumor grade",
+    "who grade",
+    "histological grade",
+    "tumor grading",
+    "disease outcome",
+    "subject status",
+]
+
+CELL_LINE_FIELDS = [
+    "cell line",
+    "sample strain",
+]
+
+TREATMENT_FIELDS = [
+    "treatment",
+    "treatment group",
+    "treatment protocol",
+    "drug treatment",
+    "clinical treatment",
+]
+
+RACE_FIELDS = [
+    "race",
+    "ethnicity",
+    "race/ethnicity",
+]
+
+SUBJECT_FIELDS = [
+    # AE
+    "subject",
+    "subject id",
+    "subject/sample source id",
+    "subject identifier",
+    "human subject anonymized id",
+    "individual",
+    "individual identifier",
+    "individual id",
+    "patient",
+    "patient id",
+    "patient identifier",
+    "patient number",
+    "patient no",
+    "donor id",
+    "donor",
+    # SRA
+    "sample_source_name",
+]
+
+DEVELOPMENTAL_STAGE_FIELDS = [
+    "developmental stage",
+    "development stage",
+    "development stages",
+]
+
+COMPOUND_FIELDS = [
+    "compound",
+    "compound1",
+    "compound2",
+    "compound name",
+    "drug",
+    "drugs",
+    "immunosuppressive drugs",
+]
+
+TIME_FIELDS = [
+    "time",
+    "initial time point",
+    "start time",
+    "stop time",
+    "time point",
+    "sampling time point",
+    "sampling time",
+    "time post infection",
+]
+
+# The fields of a harmonized sample other than its title, in the order
+# they're harmonized, and the metadata keys their values can come from.
+HARMONIZED_FIELDS = {
+    "sex": SEX_FIELDS,
+    "age": AGE_FIELDS,
+    "specimen_part": SPECIMEN_PART_FIELDS,
+    "genetic_information": GENETIC_INFORMATION_FIELDS,
+    "disease": DISEASE_FIELDS,
+    "disease_stage": DISEASE_STAGE_FIELDS,
+    "cell_line": CELL_LINE_FIELDS,
+    "treatment": TREATMENT_FIELDS,
+    "race": RACE_FIELDS,
+    "subject": SUBJECT_FIELDS,
+    "developmental_stage": DEVELOPMENTAL_STAGE_FIELDS,
+    "compound": COMPOUND_FIELDS,
+    "time": TIME_FIELDS,
+}
+
+# Every variant of the metadata keys for each harmonized field.
+HARMONIZED_FIELD_VARIANTS = {
+    field_name: frozenset(create_variants(fields))
+    for field_name, fields in HARMONIZED_FIELDS.items()
+}
+
+
+def index_fields_by_key(field_variants: Dict[str, frozenset]) -> Dict[str, tuple]:
+    """Maps each variant to the harmonized fields it's a key for, in
+    the order the fields are harmonized."""
+    fields_by_key = {}
+    for field_name, variants in field_variants.items():
+        for variant in variants:
+            fields_by_key.setdefault(variant, []).append(field_name)
+
+    return {key: tuple(field_names) for key, field_names in fields_by_key.items()}
+
+
+# Lets a sample be harmonized by looking up each of its keys once
+# instead of checking every key against every field's variants.
+HARMONIZED_FIELDS_BY_KEY = index_fields_by_key(HARMONIZED_FIELD_VARIANTS)
+
+
 class Harmonizer:
     def __init__(self):
-        sex_fields = [
-            "sex",
-            "gender",
-            "subject gender",
-            "subjext sex",
-            # This looks reduntant, but there are some samples which use
-            # Characteristic[Characteristic[sex]]
-            "characteristic [sex]",
-            "characteristics [sex]",
-        ]
-        self.sex_fields = create_variants(sex_fields)
-
-        age_fields = [
-            "age",
-            "patient age",
-            "age of patient",
-            "age (years)",
-            "age (yrs)",
-            "age (months)",
-            "age (days)",
-            "age (hours)",
-            "age at diagnosis",
-            "age at diagnosis years",
-            "age at diagnosis months",
-            "age at diagnosis days",
-            "age at diagnosis hours",
-            "characteristic [age]",
-            "characteristics [age]",
-        ]
-        self.age_fields = create_variants(age_fields)
-
-        specimen_part_fields = [
-            # AE
-            "organism part",
-            "cell type",
-            "tissue",
-            "tissue type",
-            "tissue source",
-            "tissue origin",
-            "source tissue",
-            "tissue subtype",
-            "tissue/cell type",
-            "tissue region",
-            "tissue compartment",
-            "tissues",
-            "tissue of origin",
-            "tissue-type",
-            "tissue harvested",
-            "cell/tissue type",
-            "tissue subregion",
-            "organ",
-            "characteristic [organism part]",
-            "characteristics [organism part]",
-            # SRA
-            "cell_type",
-            "organismpart",
-            # GEO
-            "isolation source",
-            "tissue sampled",
-            "cell description",
-        ]
-        self.specimen_part_fields = create_variants(specimen_part_fields)
-
-        genetic_information_fields = [
-            "strain/background",
-            "strain",
-            "strain or line",
-            "background strain",
-            "genotype",
-            "genetic background",
-            "genetic information",
-            "genotype/variation",
-            "ecotype",
-            "cultivar",
-            "strain/genotype",
-        ]
-        self.genetic_information_fields = create_variants(genetic_information_fields)
-
-        disease_fields = [
-            "disease",
-            "disease state",
-            "disease status",
-            "diagnosis",
-            "infection with",
-            "sample type",
-        ]
-        self.disease_fields = create_variants(disease_fields)
-
-        disease_stage_fields = [
-            "disease state",
-            "disease staging",
-            "disease stage",
-            "grade",
-            "tumor grade",
-            "who grade",
-            "histological grade",
-            "tumor grading",
-            "disease outcome",
-            "subject status",
-        ]
-        self.disease_stage_fields = create_variants(disease_stage_fields)
-
-        cell_line_fields = [
-            "cell line",
-            "sample strain",
-        ]
-        self.cell_line_fields = create_variants(cell_line_fields)
-
-        treatment_fields = [
-            "treatment",
-            "treatment group",
-            "treatment protocol",
-            "drug treatment",
-            "clinical treatment",
-        ]
-        self.treatment_fields = create_variants(treatment_fields)
-
-        race_fields = [
-            "race",
-            "ethnicity",
-            "race/ethnicity",
-        ]
-        self.race_fields = create_variants(race_fields)
-
-        subject_fields = [
-            # AE
-            "subject",
-            "subject id",
-            "subject/sample source id",
-            "subject identifier",
-            "human subject anonymized id",
-            "individual",
-            "individual identifier",
-            "individual id",
-            "patient",
-            "patient id",
-            "patient identifier",
-            "patient number",
-            "patient no",
-            "donor id",
-            "donor",
-            # SRA
-            "sample_source_name",
-        ]
-        self.subject_fields = create_variants(subject_fields)
-
-        developmental_stage_fields = [
-            "developmental stage",
-            "development stage",
-            "development stages",
-        ]
-        self.developmental_stage_fields = create_variants(developmental_stage_fields)
-
-        compound_fields = [
-            "compound",
-            "compound1",
-            "compound2",
-            "compound name",
-            "drug",
-            "drugs",
-            "immunosuppressive drugs",
-        ]
-        self.compound_fields = create_variants(compound_fields)
-
-        time_fields = [
-            "time",
-            "initial time point",
-            "start time",
-            "stop time",
-            "time point",
-            "sampling time point",
-            "sampling time",
-            "time post infection",
-        ]
-        self.time_fields = create_variants(time_fields)
+        # Experiments tend to have the same few values for each field.
+        self.harmonized_values = {}
 
     def harmonize_value(self, field_name: str, value):
         if field_name == "age":
@@ -585,40 +625,51 @@ class Harmonizer:
         else:
             return value.lower().strip()
 
+    def get_harmonized_value(self, field_name: str, value):
+        """Returns harmonize_value(field_name, value), remembering it if `value` is hashable."""
+        try:
+            return self.harmonized_values[(field_name, value)]
+        except KeyError:
+            harmonized_value = self.harmonize_value(field_name, value)
+            self.harmonized_values[(field_name, value)] = harmonized_value
+            return harmonized_value
+        except TypeError:
+            return self.harmonize_value(field_name, value)
+
     def harmonize_field(self, sample_metadata: Dict, harmonized_sample: Dict, field: str):
+        """Harmonizes a single field, such as "sex_fields", by checking every key of the sample.
+
+        harmonize_sample does the same thing for every field at once.
+        """
         field_name = field.split("_fields")[0]
 
         for key, value in sample_metadata.items():
             lower_key = key.lower().strip()
 
-            if lower_key in getattr(self, field):
-                harmonized_value = self.harmonize_value(field_name, value)
+            if lower_key in HARMONIZED_FIELD_VARIANTS[field_name]:
+                harmonized_value = self.get_harmonized_value(field_name, value)
 
                 if harmonized_value:
                     harmonized_sample[field_name] = harmonized_value
                     break
 
     def harmonize_sample(self, sample_metadata: Dict, title_field: str = None) -> Dict:
-        fields = [
-            "sex_fields",
-            "age_fields",
-            "specimen_part_fields",
-            "genetic_information_fields",
-            "disease_fields",
-            "disease_stage_fields",
-            "cell_line_fields",
-            "treatment_fields",
-            "race_fields",
-            "subject_fields",
-            "developmental_stage_fields",
-            "compound_fields",
-            "time_fields",
-        ]
+        # Each field gets the value of the first key for it that has a
+        # harmonized value, so keys are only looked at until then.
+        harmonized_values = {}
+        for key, value in sample_metadata.items():
+            for field_name in HARMONIZED_FIELDS_BY_KEY.get(key.lower().strip(), ()):
+                if field_name not in harmonized_values:
+                    harmonized_value = self.get_harmonized_value(field_name, value)
+
+                    if harmonized_value:
+                        harmonized_values[field_name] = harmonized_value
 
         harmonized_sample = {}
         harmonized_sample["title"] = extract_title(sample_metadata, title_field)
-        for field in fields:
-            self.harmonize_field(sample_metadata, harmonized_sample, field)
+        for field_name in HARMONIZED_FIELDS:
+            if field_name in harmonized_values:
+                harmonized_sample[field_name] = harmonized_values[field_name]
 
         return harmonized_sample
 
@@ -0,0 +1,91 @@
+"""Times sample harmonization on SDRF files and checks that it matches the field by field scan.
+
+Harmonizer.harmonize_sample looks each of a sample's keys up once in
+HARMONIZED_FIELDS_BY_KEY. Before that, each field was harmonized with
+Harmonizer.harmonize_field, which checks every key of the sample
+against the field's variants. This harmonizes the samples of each SDRF
+file both ways, makes sure the results are identical, and reports how
+long each took.
+
+SDRF files can be given as paths or URLs. Since large experiments are
+what this is meant to measure, --copies harmonizes each file's samples
+that many times over, with the same keys and values but distinct titles.
+"""
+
+import time
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand, CommandError
+
+from data_refinery_foreman.surveyor import harmony
+
+
+def harmonize_all_samples_by_field(sample_metadata: List[Dict], title_field: str = None) -> Dict:
+    """What harmonize_all_samples returned before harmonize_sample used the key index."""
+    harmonizer = harmony.Harmonizer()
+
+    harmonized_samples = {}
+    for sample in sample_metadata:
+        harmonized_sample = {"title": harmony.extract_title(sample, title_field)}
+        for field_name in harmony.HARMONIZED_FIELDS:
+            harmonizer.harmonize_field(sample, harmonized_sample, field_name + "_fields")
+
+        harmonized_samples[harmonized_sample["title"]] = harmonized_sample
+
+    return harmonized_samples
+
+
+def load_samples(sdrf: str, copies: int) -> List[Dict]:
+    if sdrf.startswith("http://") or sdrf.startswith("https://"):
+        samples = harmony.parse_sdrf(sdrf)
+    else:
+        with open(sdrf) as sdrf_file:
+            samples = harmony.parse_sdrf_text(sdrf_file.read())
+
+    copied_samples = []
+    for copy in range(copies):
+        for sample in samples:
+            copied_sample = dict(sample)
+            title = harmony.extract_title(sample)
+            for title_field in harmony.get_title_variants():
+                if title_field in copied_sample:
+                    copied_sample[title_field] = "{} {}".format(title, copy)
+            copied_samples.append(copied_sample)
+
+    return copied_samples
+
+
+def time_function(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("sdrf", nargs="+", help="Paths or URLs of SDRF files.")
+        parser.add_argument("--copies", type=int, default=1)
+
+    def handle(self, *args, **options):
+        print("sdrf, samples, keys_per_sample, by_field_seconds, by_key_seconds, speedup")
+        for sdrf in options["sdrf"]:
+            samples = load_samples(sdrf, options["copies"])
+            if not samples:
+                raise CommandError("No samples could be parsed from {}".format(sdrf))
+
+            expected, by_field_seconds = time_function(harmonize_all_samples_by_field, samples)
+            harmonized, by_key_seconds = time_function(harmony.harmonize_all_samples, samples)
+
+            if harmonized != expected:
+                raise CommandError("Harmonized samples from {} don't match.".format(sdrf))
+
+            print(
+                "{}, {}, {}, {:.3f}, {:.3f}, {:.1f}".format(
+                    sdrf,
+                    len(samples),
+                    len(samples[0]),
+                    by_field_seconds,
+                    by_key_seconds,
+                    by_field_seconds / by_key_seconds if by_key_seconds else 0,
+                )
+            )
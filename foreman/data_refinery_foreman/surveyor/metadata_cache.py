@@ -0,0 +1,173 @@
+"""A cache on disk for the metadata surveyors fetch over HTTP.
+
+Surveying a study asks ENA for the same study, submission and often
+experiment documents once per run, and resurveying it or refreshing its
+metadata asks for all of them again. Successful responses are stored
+under the SHA-256 of their URL in METADATA_CACHE_DIR and reused until
+they're older than METADATA_CACHE_TTL.
+
+The cache is off unless METADATA_CACHE_ENABLED is True, so that
+surveys and tests don't read responses another one left on disk.
+While it's off every request goes to the network, rate limited.
+
+When METADATA_CACHE_OFFLINE is True nothing is fetched: cached responses
+are used no matter how old they are, and anything that isn't cached
+raises a MetadataCacheMissError. This lets tests replay a survey from a
+cache that was filled by running it once.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from data_refinery_common.constants import LOCAL_ROOT_DIR
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.utils import get_env_variable
+from data_refinery_foreman.surveyor.utils import requests_retry_session
+
+logger = get_and_configure_logger(__name__)
+
+
+METADATA_CACHE_DIR = get_env_variable(
+    "METADATA_CACHE_DIR", os.path.join(LOCAL_ROOT_DIR, "metadata_cache")
+)
+METADATA_CACHE_TTL = datetime.timedelta(
+    hours=int(get_env_variable("METADATA_CACHE_TTL_HOURS", "168"))
+)
+METADATA_CACHE_ENABLED = get_env_variable("METADATA_CACHE_ENABLED", "False") == "True"
+METADATA_CACHE_OFFLINE = get_env_variable("METADATA_CACHE_OFFLINE", "False") == "True"
+METADATA_FETCH_MAX_THREADS = int(get_env_variable("METADATA_FETCH_MAX_THREADS", "8"))
+# ENA allows up to 50 requests a second, but we're not the only ones using it.
+METADATA_FETCH_MAX_REQUESTS_PER_SECOND = int(
+    get_env_variable("METADATA_FETCH_MAX_REQUESTS_PER_SECOND", "10")
+)
+
+
+class MetadataCacheMissError(Exception):
+    pass
+
+
+class CachedResponse:
+    """The parts of a requests.Response that surveyors use."""
+
+    def __init__(self, url: str, status_code: int, text: str):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RateLimiter:
+    """Spaces out calls to `wait` so there are no more than `max_per_second` a second,
+    across threads."""
+
+    def __init__(self, max_per_second: int):
+        self.interval = 1 / max_per_second
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+rate_limiter = RateLimiter(METADATA_FETCH_MAX_REQUESTS_PER_SECOND)
+
+
+def _get_cache_path(url: str) -> str:
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(METADATA_CACHE_DIR, key[:2], key + ".json")
+
+
+def get_cached_response(url: str) -> Optional[CachedResponse]:
+    """Returns the cached response for `url` if there is one that hasn't expired."""
+    if not METADATA_CACHE_ENABLED and not METADATA_CACHE_OFFLINE:
+        return None
+
+    try:
+        with open(_get_cache_path(url)) as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    age = datetime.timedelta(seconds=time.time() - cached["fetched_at"])
+    if not METADATA_CACHE_OFFLINE and age > METADATA_CACHE_TTL:
+        return None
+
+    return CachedResponse(url, cached["status_code"], cached["text"])
+
+
+def cache_response(url: str, status_code: int, text: str) -> None:
+    """Stores a response for `url`.
+
+    The cache is only an optimization, so this logs rather than raises
+    if it can't be written to.
+    """
+    cache_path = _get_cache_path(url)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write somewhere else first so other threads and processes
+        # never read half of a response.
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(cache_path), delete=False
+        ) as temp_file:
+            json.dump(
+                {"url": url, "status_code": status_code, "text": text, "fetched_at": time.time()},
+                temp_file,
+            )
+        os.replace(temp_file.name, cache_path)
+    except OSError:
+        logger.warning("Unable to cache metadata response.", url=url, cache_path=cache_path)
+
+
+def get(url: str, timeout: int = 60):
+    """Returns the response for `url`, from the cache if possible.
+
+    Only successful responses are cached, since errors may be temporary.
+    """
+    cached_response = get_cached_response(url)
+    if cached_response:
+        return cached_response
+
+    if METADATA_CACHE_OFFLINE:
+        raise MetadataCacheMissError("No cached response for {}".format(url))
+
+    rate_limiter.wait()
+    response = requests_retry_session().get(url, timeout=timeout)
+    if METADATA_CACHE_ENABLED and response.status_code == 200:
+        cache_response(url, response.status_code, response.text)
+
+    return response
+
+
+def get_all(urls: List[str]) -> Dict:
+    """Gets each of `urls` once, concurrently, and returns their responses by URL.
+
+    URLs that couldn't be gotten are logged and mapped to None, so
+    that whatever uses them can fail the way it would have without
+    them being fetched ahead of time.
+    """
+    unique_urls = list(dict.fromkeys(urls))
+
+    def get_or_log(url):
+        try:
+            return get(url)
+        except Exception:
+            logger.exception("Unable to fetch metadata.", url=url)
+            return None
+
+    with ThreadPoolExecutor(max_workers=METADATA_FETCH_MAX_THREADS) as executor:
+        return dict(zip(unique_urls, executor.map(get_or_log, unique_urls)))
@@ -20,7 +20,7 @@ from data_refinery_common.models import (
 )
 from data_refinery_common.rna_seq import _build_ena_file_url
 from data_refinery_common.utils import get_fasp_sra_download
-from data_refinery_foreman.surveyor import harmony, utils
+from data_refinery_foreman.surveyor import harmony, metadata_cache, utils
 from data_refinery_foreman.surveyor.external_source import ExternalSourceSurveyor
 
 logger = get_and_configure_logger(__name__)
@@ -68,7 +68,7 @@ class SraSurveyor(ExternalSourceSurveyor):
     def gather_submission_metadata(metadata: Dict) -> None:
 
         formatted_metadata_URL = ENA_METADATA_URL_TEMPLATE.format(metadata["submission_accession"])
-        response = utils.requests_retry_session().get(formatted_metadata_URL)
+        response = metadata_cache.get(formatted_metadata_URL)
         submission_xml = ET.fromstring(response.text)[0]
         submission_metadata = submission_xml.attrib
 
@@ -128,7 +128,7 @@ class SraSurveyor(ExternalSourceSurveyor):
     @staticmethod
     def gather_experiment_metadata(metadata: Dict) -> None:
         formatted_metadata_URL = ENA_METADATA_URL_TEMPLATE.format(metadata["experiment_accession"])
-        response = utils.requests_retry_session().get(formatted_metadata_URL)
+        response = metadata_cache.get(formatted_metadata_URL)
         experiment_xml = ET.fromstring(response.text)
 
         experiment = experiment_xml[0]
@@ -191,9 +191,7 @@ class SraSurveyor(ExternalSourceSurveyor):
         This endpoint returns a weird format, so some custom parsing is required:
         run_accession	fastq_ftp	fastq_bytes	fastq_md5	submitted_ftp	submitted_bytes	submitted_md5	sra_ftp	sra_bytes	sra_md5
         SRR7353755	ftp.sra.ebi.ac.uk/vol1/fastq/SRR735/005/SRR7353755/SRR7353755.fastq.gz;ftp.sra.ebi.ac.uk/vol1/fastq/SRR735/005/SRR7353755/SRR7353755_1.fastq.gz;ftp.sra.ebi.ac.uk/vol1/fastq/SRR735/005/SRR7353755/SRR7353755_2.fastq.gz	25176;2856704;3140575	7ef1ba010dcb679217112efa380798b2;6bc5651b7103306d4d65018180ab8d0d;3856c14164612d9879d576a046a9879f	"""
-        response = utils.requests_retry_session().get(
-            ENA_FILE_REPORT_URL_TEMPLATE.format(accession=run_accession)
-        )
+        response = metadata_cache.get(ENA_FILE_REPORT_URL_TEMPLATE.format(accession=run_accession))
 
         lines = response.text.split("\n")
         split_lines = [line.split("\t") for line in lines]
@@ -214,12 +212,15 @@ class SraSurveyor(ExternalSourceSurveyor):
     @staticmethod
     def gather_run_metadata(run_accession: str) -> Dict:
         """A run refers to a specific read in an experiment."""
+        response = metadata_cache.get(ENA_METADATA_URL_TEMPLATE.format(run_accession))
+        return SraSurveyor.parse_run_metadata(run_accession, response)
+
+    @staticmethod
+    def parse_run_metadata(run_accession: str, response) -> Dict:
+        """Parses the metadata out of the response to a request for a run's XML."""
 
         discoverable_accessions = ["study_accession", "sample_accession", "submission_accession"]
 
-        response = utils.requests_retry_session().get(
-            ENA_METADATA_URL_TEMPLATE.format(run_accession)
-        )
         try:
             run_xml = ET.fromstring(response.text)
         except Exception:
@@ -258,7 +259,7 @@ class SraSurveyor(ExternalSourceSurveyor):
     @staticmethod
     def gather_sample_metadata(metadata: Dict) -> None:
         formatted_metadata_URL = ENA_METADATA_URL_TEMPLATE.format(metadata["sample_accession"])
-        response = utils.requests_retry_session().get(formatted_metadata_URL)
+        response = metadata_cache.get(formatted_metadata_URL)
         sample_xml = ET.fromstring(response.text)
 
         sample = sample_xml[0]
@@ -283,7 +284,7 @@ class SraSurveyor(ExternalSourceSurveyor):
     @staticmethod
     def gather_study_metadata(metadata: Dict) -> None:
         formatted_metadata_URL = ENA_METADATA_URL_TEMPLATE.format(metadata["study_accession"])
-        response = utils.requests_retry_session().get(formatted_metadata_URL)
+        response = metadata_cache.get(formatted_metadata_URL)
         study_xml = ET.fromstring(response.text)
 
         study = study_xml[0]
@@ -335,6 +336,58 @@ class SraSurveyor(ExternalSourceSurveyor):
 
         return metadata
 
+    @staticmethod
+    def prefetch_metadata(run_accessions: List[str]) -> None:
+        """Fetches the metadata for `run_accessions` into the cache concurrently.
+
+        Runs in the same study share their study and submission, and
+        often their experiment, so those are only fetched once. Calling
+        gather_all_metadata for the runs afterwards reads everything
+        from the cache instead of making five requests in a row per run.
+
+        This does nothing unless the cache is enabled, since nothing it
+        fetched would be kept.
+        """
+        if not metadata_cache.METADATA_CACHE_ENABLED:
+            return
+
+        existing_samples = set(
+            Sample.objects.filter(accession_code__in=run_accessions).values_list(
+                "accession_code", flat=True
+            )
+        )
+        run_urls = [ENA_METADATA_URL_TEMPLATE.format(accession) for accession in run_accessions]
+        # The file report is only needed for runs that will become new samples.
+        file_report_urls = [
+            ENA_FILE_REPORT_URL_TEMPLATE.format(accession=accession)
+            for accession in run_accessions
+            if accession not in existing_samples
+        ]
+        responses = metadata_cache.get_all(run_urls + file_report_urls)
+
+        related_accessions = set()
+        for run_accession, run_url in zip(run_accessions, run_urls):
+            response = responses.get(run_url)
+            if not response or response.status_code != 200:
+                continue
+
+            metadata = SraSurveyor.parse_run_metadata(run_accession, response)
+            for key in [
+                "experiment_accession",
+                "sample_accession",
+                "study_accession",
+                "submission_accession",
+            ]:
+                if key in metadata:
+                    related_accessions.add(metadata[key])
+
+        metadata_cache.get_all(
+            [
+                ENA_METADATA_URL_TEMPLATE.format(accession)
+                for accession in sorted(related_accessions)
+            ]
+        )
+
     @staticmethod
     def _build_ncbi_file_url(run_accession: str):
         """Build the path to the hypothetical .sra file we want"""
@@ -615,9 +668,7 @@ class SraSurveyor(ExternalSourceSurveyor):
 
         # SRA Surveyor is mainly designed for SRRs, this handles SRPs
         if "SRP" in accession or "ERP" in accession or "DRP" in accession:
-            response = utils.requests_retry_session().get(
-                ENA_METADATA_URL_TEMPLATE.format(accession)
-            )
+            response = metadata_cache.get(ENA_METADATA_URL_TEMPLATE.format(accession))
 
             # If the status code is 404, then SRA doesn't know about this accession
             if response.status_code == 404:
@@ -648,6 +699,8 @@ class SraSurveyor(ExternalSourceSurveyor):
                             accessions_to_run.append(accession[0] + "RR" + run_id)
                     break
 
+            SraSurveyor.prefetch_metadata(accessions_to_run)
+
             experiment = None
             all_samples = []
             for run_id in accessions_to_run:
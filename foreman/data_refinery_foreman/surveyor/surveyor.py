@@ -4,6 +4,7 @@ import sys
 from django.utils import timezone
 
 from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.message_queue import record_job_finished, record_job_started
 from data_refinery_common.models import SurveyJob, SurveyJobKeyValue
 from data_refinery_foreman.surveyor.array_express import ArrayExpressSurveyor
 from data_refinery_foreman.surveyor.geo import GeoSurveyor
@@ -58,6 +59,7 @@ def _start_job(survey_job: SurveyJob) -> SurveyJob:
 
     survey_job.start_time = timezone.now()
     survey_job.save()
+    record_job_started(survey_job)
 
     global CURRENT_JOB
     CURRENT_JOB = survey_job
@@ -70,6 +72,7 @@ def _end_job(survey_job: SurveyJob, success=True) -> SurveyJob:
     survey_job.success = success
     survey_job.end_time = timezone.now()
     survey_job.save()
+    record_job_finished(survey_job)
 
     return survey_job
 
@@ -374,3 +374,43 @@ class HarmonyTestCase(TestCase):
         # So if this doesn't raise a KeyError, then we're good.
         for title in json_titles:
             sdrf_samples[title]
+
+    def test_harmonize_sample_matches_harmonize_field(self):
+        """Makes sure looking each key up once gives the same result as harmonizing field by field.
+        """
+        sample_metadata = {
+            "sample name": "sample 1",
+            "Characteristics [Age]": ".",
+            "characteristics[age]": "38 years",
+            " Disease State ": "Type 2 Diabetes",
+            "disease": "",
+            "Factor Value[sex]": "F",
+            "comment [tissue]": "Islet",
+            "unrelated": "value",
+        }
+
+        harmonized_sample = self._harmonizer.harmonize_sample(sample_metadata)
+
+        expected = {"title": "sample 1"}
+        for field in [
+            "sex_fields",
+            "age_fields",
+            "specimen_part_fields",
+            "genetic_information_fields",
+            "disease_fields",
+            "disease_stage_fields",
+            "cell_line_fields",
+            "treatment_fields",
+            "race_fields",
+            "subject_fields",
+            "developmental_stage_fields",
+            "compound_fields",
+            "time_fields",
+        ]:
+            self._harmonizer.harmonize_field(sample_metadata, expected, field)
+
+        self.assertEqual(list(harmonized_sample.items()), list(expected.items()))
+        self.assertEqual(harmonized_sample["age"], 38.0)
+        # "disease state" is a key for both fields.
+        self.assertEqual(harmonized_sample["disease"], "type 2 diabetes")
+        self.assertEqual(harmonized_sample["disease_stage"], "type 2 diabetes")
@@ -0,0 +1,144 @@
+import datetime
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+
+from django.test import TestCase
+
+from data_refinery_foreman.surveyor import metadata_cache
+from data_refinery_foreman.surveyor.sra import (
+    ENA_FILE_REPORT_URL_TEMPLATE,
+    ENA_METADATA_URL_TEMPLATE,
+    SraSurveyor,
+)
+
+RUN_XML_TEMPLATE = """<RUN_SET><RUN accession="{run}" center_name="GEO">
+<EXPERIMENT_REF accession="SRX0001"/>
+<RUN_LINKS>
+<RUN_LINK><XREF_LINK><DB>ENA-STUDY</DB><ID>SRP0001</ID></XREF_LINK></RUN_LINK>
+<RUN_LINK><XREF_LINK><DB>ENA-SAMPLE</DB><ID>{sample}</ID></XREF_LINK></RUN_LINK>
+<RUN_LINK><XREF_LINK><DB>ENA-SUBMISSION</DB><ID>SRA0001</ID></XREF_LINK></RUN_LINK>
+</RUN_LINKS>
+</RUN></RUN_SET>"""
+
+
+class FakeSession:
+    """Returns canned responses for URLs and counts how many times each was requested."""
+
+    def __init__(self, responses=None, status_code=200):
+        self.responses = responses or {}
+        self.status_code = status_code
+        self.requested_urls = []
+
+    def get(self, url, timeout=None):
+        self.requested_urls.append(url)
+        return Mock(status_code=self.status_code, text=self.responses.get(url, "<ROOT/>"))
+
+
+class MetadataCacheTestCase(TestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        for name, value in [("METADATA_CACHE_DIR", cache_dir), ("METADATA_CACHE_ENABLED", True)]:
+            patcher = patch.object(metadata_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def use_session(self, session):
+        patcher = patch.object(metadata_cache, "requests_retry_session", return_value=session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return session
+
+    def test_responses_are_cached(self):
+        session = self.use_session(FakeSession({"https://example.com/a": "<A/>"}))
+
+        self.assertEqual(metadata_cache.get("https://example.com/a").text, "<A/>")
+        self.assertEqual(metadata_cache.get("https://example.com/a").text, "<A/>")
+        self.assertEqual(session.requested_urls, ["https://example.com/a"])
+
+        # Expired responses are fetched again.
+        with patch.object(metadata_cache, "METADATA_CACHE_TTL", datetime.timedelta(0)):
+            metadata_cache.get("https://example.com/a")
+        self.assertEqual(len(session.requested_urls), 2)
+
+    def test_disabled_cache(self):
+        session = self.use_session(FakeSession({"https://example.com/a": "<A/>"}))
+
+        with patch.object(metadata_cache, "METADATA_CACHE_ENABLED", False):
+            metadata_cache.get("https://example.com/a")
+            self.assertEqual(metadata_cache.get("https://example.com/a").text, "<A/>")
+            # There's nothing to prefetch into.
+            SraSurveyor.prefetch_metadata(["SRR0001"])
+
+        self.assertEqual(len(session.requested_urls), 2)
+        self.assertIsNone(metadata_cache.get_cached_response("https://example.com/a"))
+
+    def test_errors_are_not_cached(self):
+        session = self.use_session(FakeSession(status_code=500))
+
+        metadata_cache.get("https://example.com/a")
+        metadata_cache.get("https://example.com/a")
+
+        self.assertEqual(len(session.requested_urls), 2)
+
+    def test_offline_replay(self):
+        self.use_session(FakeSession({"https://example.com/a": "<A/>"}))
+        metadata_cache.get("https://example.com/a")
+
+        session = self.use_session(FakeSession())
+        with patch.object(metadata_cache, "METADATA_CACHE_OFFLINE", True), patch.object(
+            metadata_cache, "METADATA_CACHE_TTL", datetime.timedelta(0)
+        ):
+            # Even expired responses are replayed.
+            self.assertEqual(metadata_cache.get("https://example.com/a").text, "<A/>")
+            with self.assertRaises(metadata_cache.MetadataCacheMissError):
+                metadata_cache.get("https://example.com/b")
+
+        self.assertEqual(session.requested_urls, [])
+
+    def test_get_all_fetches_each_url_once(self):
+        session = self.use_session(FakeSession())
+
+        responses = metadata_cache.get_all(
+            ["https://example.com/a", "https://example.com/b", "https://example.com/a"]
+        )
+
+        self.assertEqual(set(responses.keys()), {"https://example.com/a", "https://example.com/b"})
+        self.assertEqual(len(session.requested_urls), 2)
+
+    def test_prefetch_sra_metadata(self):
+        session = self.use_session(
+            FakeSession(
+                {
+                    ENA_METADATA_URL_TEMPLATE.format("SRR0001"): RUN_XML_TEMPLATE.format(
+                        run="SRR0001", sample="SRS0001"
+                    ),
+                    ENA_METADATA_URL_TEMPLATE.format("SRR0002"): RUN_XML_TEMPLATE.format(
+                        run="SRR0002", sample="SRS0002"
+                    ),
+                }
+            )
+        )
+
+        SraSurveyor.prefetch_metadata(["SRR0001", "SRR0002"])
+
+        # The experiment, study and submission the runs share are only fetched once.
+        expected_urls = [
+            ENA_METADATA_URL_TEMPLATE.format(accession)
+            for accession in [
+                "SRR0001",
+                "SRR0002",
+                "SRX0001",
+                "SRS0001",
+                "SRS0002",
+                "SRP0001",
+                "SRA0001",
+            ]
+        ] + [ENA_FILE_REPORT_URL_TEMPLATE.format(accession=run) for run in ["SRR0001", "SRR0002"]]
+        self.assertEqual(sorted(session.requested_urls), sorted(expected_urls))
+
+        # Gathering the metadata afterwards doesn't request anything.
+        metadata = SraSurveyor.gather_run_metadata("SRR0002")
+        self.assertEqual(metadata["sample_accession"], "SRS0002")
+        self.assertEqual(len(session.requested_urls), len(expected_urls))
@@ -206,6 +206,12 @@ variable "max_downloader_jobs_per_node" {
   default = 200
 }
 
+variable "max_ram_per_node" {
+  # In MB. The worker instances have at least 192GiB, but ECS keeps
+  # some for itself.
+  default = 184320
+}
+
 variable "elasticsearch_port" {
   default = "80"
 }
@@ -412,6 +418,10 @@ output "environment_variables" {
       name = "MAX_DOWNLOADER_JOBS_PER_NODE"
       value = var.max_downloader_jobs_per_node
     },
+    {
+      name = "MAX_RAM_PER_NODE"
+      value = var.max_ram_per_node
+    },
     {
       name = "ENGAGEMENTBOT_WEBHOOK"
       value = var.engagementbot_webhook
@@ -1,11 +1,10 @@
 import os
-import shutil
 import time
-import urllib.request
 import zipfile
-from typing import List
+from typing import Dict, List, Set
 
 from data_refinery_common import microarray
+from data_refinery_common.downloads import download_file
 from data_refinery_common.job_management import create_processor_jobs_for_original_files
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models import (
@@ -18,12 +17,10 @@ from data_refinery_common.utils import (
     get_readable_affymetrix_names,
     get_supported_microarray_platforms,
 )
-from data_refinery_workers.downloaders import utils
+from data_refinery_workers.downloaders import extraction, utils
 
 logger = get_and_configure_logger(__name__)
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
-# chunk_size is in bytes
-CHUNK_SIZE = 1024 * 256
 
 
 def _download_file(download_url: str, file_path: str, job: DownloaderJob) -> None:
@@ -33,19 +30,20 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob) -> Non
         logger.debug(
             "Downloading file from %s to %s.", download_url, file_path, downloader_job=job.id
         )
-        target_file = open(file_path, "wb")
-        with urllib.request.urlopen(download_url, timeout=60) as request:
-            shutil.copyfileobj(request, target_file, CHUNK_SIZE)
+        download_file(download_url, file_path)
     except Exception:
         logger.exception("Exception caught while downloading file.", downloader_job=job.id)
         job.failure_reason = "Exception caught while downloading file"
         raise
-    finally:
-        target_file.close()
 
 
-def _extract_files(file_path: str, accession_code: str, job: DownloaderJob) -> List[str]:
+def _extract_files(
+    file_path: str, accession_code: str, job: DownloaderJob, filenames: Set[str] = None
+) -> List[Dict]:
     """Extract zip and return a list of the raw files.
+
+    Each file is hashed as it's extracted. If `filenames` is given,
+    files in the zip that aren't in it are skipped.
     """
     logger.debug("Extracting %s!", file_path, file_path=file_path, downloader_job=job.id)
     abs_with_code_raw = LOCAL_ROOT_DIR + "/" + accession_code + "/raw/"
@@ -53,14 +51,31 @@ def _extract_files(file_path: str, accession_code: str, job: DownloaderJob) -> L
     try:
         # This is technically an unsafe operation.
         # However, we're trusting AE as a data source.
+        extracted_files = []
         with zipfile.ZipFile(file_path, "r") as zip_ref:
-            zip_ref.extractall(abs_with_code_raw)
             # Other zips for this same accession will go into this
             # directory too, so look at what's in the zip file rather than
             # what's in the directory it's being extracted to.
-            files_in_zip = zip_ref.namelist()
+            for member in zip_ref.infolist():
+                if member.is_dir() or (filenames is not None and member.filename not in filenames):
+                    continue
+
+                with zip_ref.open(member) as member_file:
+                    with extraction.read_in_background(member_file) as reader:
+                        extracted_file = extraction.write_stream(
+                            reader, abs_with_code_raw + member.filename
+                        )
+
+                extracted_files.append(
+                    {
+                        "absolute_path": extracted_file.absolute_path,
+                        "filename": member.filename,
+                        "sha1": extracted_file.sha1,
+                        "md5": extracted_file.md5,
+                    }
+                )
 
-        return [{"absolute_path": abs_with_code_raw + f, "filename": f} for f in files_in_zip]
+        return extracted_files
 
     except Exception as e:
         reason = "Exception %s caught while extracting %s", str(e), str(file_path)
@@ -103,7 +118,13 @@ def download_array_express(job_id: int) -> None:
     dl_file_path = LOCAL_ROOT_DIR + "/" + accession_code + "/" + filename + ".zip"
     _download_file(url, dl_file_path, job)
 
-    extracted_files = _extract_files(dl_file_path, accession_code, job)
+    # Only extract the files we have OriginalFiles for.
+    filenames = set(
+        OriginalFile.objects.filter(source_url=original_file.source_url).values_list(
+            "source_filename", flat=True
+        )
+    )
+    extracted_files = _extract_files(dl_file_path, accession_code, job, filenames)
     os.remove(dl_file_path)  # remove zip file
 
     for extracted_file in extracted_files:
@@ -118,7 +139,11 @@ def download_array_express(job_id: int) -> None:
             # haven't actually been processed before marking them as
             # downloaded and queuing processor jobs.
             if original_file.needs_processing():
-                original_file.set_downloaded(extracted_file["absolute_path"])
+                original_file.set_downloaded(
+                    extracted_file["absolute_path"],
+                    sha1=extracted_file["sha1"],
+                    md5=extracted_file["md5"],
+                )
                 unprocessed_original_files.append(original_file)
         except Exception:
             # The suspicion is that there are extra files related to
@@ -0,0 +1,160 @@
+"""Streaming extraction of the archives downloaders fetch.
+
+Archives are read front to back and each member is written straight to
+where it's extracted to, so nothing is decompressed to a temporary
+file first and the scratch space needed is about the size of what's
+extracted. Members are hashed as they're written so their OriginalFiles
+don't need to read them again.
+
+When DECOMPRESS_IN_THREAD is True decompression is done in a separate
+thread, which overlaps it with writing the extracted files to disk.
+"""
+
+import gzip
+import hashlib
+import os
+import queue
+import tarfile
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Tuple
+
+from data_refinery_common.utils import get_env_variable
+
+# chunk_size is in bytes
+CHUNK_SIZE = 1024 * 1024
+DECOMPRESS_IN_THREAD = get_env_variable("DECOMPRESS_IN_THREAD", "True") == "True"
+
+
+class ExtractedFile:
+    """A file that was written by `write_stream`, with its size and hashes."""
+
+    def __init__(self, absolute_path: str, size_in_bytes: int, sha1: str, md5: str):
+        self.absolute_path = absolute_path
+        self.size_in_bytes = size_in_bytes
+        self.sha1 = sha1
+        self.md5 = md5
+
+
+class BackgroundReader:
+    """Reads a file object in a separate thread.
+
+    Whatever work reading the file object does, such as decompressing,
+    happens in that thread while the caller is busy with the chunks it
+    has already read. At most `max_buffered_chunks` are kept in memory.
+    """
+
+    def __init__(self, fileobj, chunk_size: int = CHUNK_SIZE, max_buffered_chunks: int = 8):
+        self.chunks = queue.Queue(max_buffered_chunks)
+        self.chunk = b""
+        self.offset = 0
+        self.finished = False
+        self.stopped = False
+        self.error = None
+        self.thread = threading.Thread(target=self._read_all, args=(fileobj, chunk_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read_all(self, fileobj, chunk_size: int) -> None:
+        try:
+            for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+                if self.stopped:
+                    return
+                self.chunks.put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.chunks.put(None)
+
+    def read(self, size: int = -1) -> bytes:
+        pieces = []
+        while size != 0 and not self.finished:
+            if self.offset == len(self.chunk):
+                self.chunk = self.chunks.get()
+                self.offset = 0
+                if self.chunk is None:
+                    self.chunk = b""
+                    self.finished = True
+                    if self.error:
+                        raise self.error
+                    break
+
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + size)
+            pieces.append(self.chunk[self.offset : end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+
+        return b"".join(pieces)
+
+    def close(self) -> None:
+        """Stops the reading thread, which may be waiting for room in the queue."""
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextmanager
+def read_in_background(fileobj):
+    """Reads `fileobj` with a BackgroundReader if DECOMPRESS_IN_THREAD is True."""
+    if not DECOMPRESS_IN_THREAD:
+        yield fileobj
+        return
+
+    with BackgroundReader(fileobj) as reader:
+        yield reader
+
+
+def write_stream(stream, file_path: str) -> ExtractedFile:
+    """Writes everything read from `stream` to `file_path`, hashing it along the way."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    sha1 = hashlib.sha1()
+    md5 = hashlib.md5()
+    size_in_bytes = 0
+    with open(file_path, "wb") as target_file:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            sha1.update(chunk)
+            md5.update(chunk)
+            target_file.write(chunk)
+            size_in_bytes += len(chunk)
+
+    return ExtractedFile(file_path, size_in_bytes, sha1.hexdigest(), md5.hexdigest())
+
+
+def _iter_tar_stream(fileobj) -> Iterator[Tuple[str, object]]:
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member)
+
+
+def iter_tar_members(file_path: str, compressed: bool = False) -> Iterator[Tuple[str, object]]:
+    """Yields the name and a file object for each regular file in a tar archive.
+
+    The archive is read as a stream, gunzipping it along the way if
+    `compressed` is True, so each file object has to be read before
+    the next member is yielded.
+    """
+    if not compressed:
+        with open(file_path, "rb") as tar_file:
+            yield from _iter_tar_stream(tar_file)
+        return
+
+    with gzip.open(file_path, "rb") as gzip_file, read_in_background(gzip_file) as reader:
+        yield from _iter_tar_stream(reader)
+
+
+def extract_gz(file_path: str, target_file_path: str) -> ExtractedFile:
+    """Gunzips `file_path` to `target_file_path`."""
+    with gzip.open(file_path, "rb") as gzip_file, read_in_background(gzip_file) as reader:
+        return write_stream(reader, target_file_path)
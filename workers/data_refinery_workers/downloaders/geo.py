@@ -1,14 +1,11 @@
 import gzip
 import os
 import re
-import shutil
 import subprocess
-import tarfile
 import time
-import urllib.request
-from contextlib import closing
 from typing import List
 
+from data_refinery_common.downloads import download_file
 from data_refinery_common.job_management import create_processor_jobs_for_original_files
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models import (
@@ -18,12 +15,11 @@ from data_refinery_common.models import (
     Sample,
 )
 from data_refinery_common.utils import get_env_variable
-from data_refinery_workers.downloaders import utils
+from data_refinery_workers.downloaders import extraction, utils
+from data_refinery_workers.downloaders.extraction import ExtractedFile
 
 logger = get_and_configure_logger(__name__)
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
-# chunk_size is in bytes
-CHUNK_SIZE = 1024 * 256
 
 
 def _download_file(download_url: str, file_path: str, job: DownloaderJob, force_ftp=False) -> None:
@@ -43,20 +39,11 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob, force_
                 "Downloading file from %s to %s.", download_url, file_path, downloader_job=job.id
             )
 
-            # Ancient unresolved bug. WTF python: https://bugs.python.org/issue27973
-            urllib.request.urlcleanup()
-
-            target_file = open(file_path, "wb")
-            with closing(urllib.request.urlopen(download_url)) as request:
-                shutil.copyfileobj(request, target_file, CHUNK_SIZE)
-
-            urllib.request.urlcleanup()
+            download_file(download_url, file_path)
         except Exception:
             logger.exception("Exception caught while downloading file.", downloader_job=job.id)
             job.failure_reason = "Exception caught while downloading file"
             raise
-        finally:
-            target_file.close()
 
         return True
 
@@ -156,10 +143,15 @@ class FileExtractionError(Exception):
 class ArchivedFile:
     """ Contains utility functions to enumerate the files inside an archive that was downloaded from GEO. """
 
-    def __init__(self, downloaded_file_path, parent_archive=None):
+    def __init__(self, downloaded_file_path, parent_archive=None, extracted_file=None):
         self.file_path = downloaded_file_path
         self.parent_archive = parent_archive
 
+        # Files that were extracted from an archive were hashed along the way.
+        self.size_in_bytes = extracted_file.size_in_bytes if extracted_file else None
+        self.sha1 = extracted_file.sha1 if extracted_file else None
+        self.md5 = extracted_file.md5 if extracted_file else None
+
         # thanks to https://stackoverflow.com/a/541394/763705
         self.filename = os.path.basename(self.file_path)
         self.extension = os.path.splitext(self.file_path)[1]
@@ -202,24 +194,32 @@ class ArchivedFile:
     def is_archive(self):
         return self.extension.lower() in [".tar", ".tgz", ".gz"]
 
-    def get_files(self):
+    def get_files(self, processable_only=False):
+        """ Yields this file, or the files inside it if it's an archive.
+
+        If `processable_only` is True, files that aren't processable are
+        skipped without being extracted. Archives inside of archives are
+        removed once their files have been extracted. """
         if not self.is_archive():
             yield self
         else:
             # for archives extract them and enumerate all the files inside
-            for path in self._extract_files():
-                archived_file = ArchivedFile(path, self)
-                for file in archived_file.get_files():
+            for extracted_file in self._extract_files(processable_only):
+                archived_file = ArchivedFile(extracted_file.absolute_path, self, extracted_file)
+                for file in archived_file.get_files(processable_only):
                     yield file
 
-    def _extract_files(self):
+            if self.parent_archive:
+                os.remove(self.file_path)
+
+    def _extract_files(self, processable_only=False) -> List[ExtractedFile]:
         logger.debug("Extracting %s!", self.file_path, file_path=self.file_path)
 
         try:
             if ".tar" == self.extension:
-                return self._extract_tar()
+                return self._extract_tar(processable_only)
             elif ".tgz" == self.extension:
-                return self._extract_tgz()
+                return self._extract_tar(processable_only, compressed=True)
             elif ".gz" == self.extension:
                 return self._extract_gz()
         except Exception as e:
@@ -242,45 +242,34 @@ class ArchivedFile:
         else:
             return LOCAL_ROOT_DIR + "/" + self.filename + "/raw/"
 
-    def _extract_tar(self) -> List[str]:
-        """ Extract tar and return a list of the raw files. """
+    def _extract_tar(self, processable_only=False, compressed=False) -> List[ExtractedFile]:
+        """ Extract tar and return a list of the raw files.
+
+        The tar is read as a stream, so a .tgz is gunzipped as its files
+        are extracted rather than to a temporary .tar first. Gzipped files
+        inside of it are gunzipped as they're extracted too. """
         # This is technically an unsafe operation.
         # However, we're trusting GEO as a data source.
         abs_with_code_raw = self._get_absolute_path()
 
-        with tarfile.TarFile(self.file_path, "r") as zip_ref:
-            zip_ref.extractall(abs_with_code_raw)
-            extracted_files = (
-                zip_ref.getnames()
-            )  # https://docs.python.org/3/library/tarfile.html#tarfile.TarFile.getnames
+        extracted_files = []
+        for name, member_file in extraction.iter_tar_members(self.file_path, compressed):
+            member = ArchivedFile(abs_with_code_raw + name)
+            if ".gz" == member.extension:
+                member_file = gzip.GzipFile(fileobj=member_file)
+                member = ArchivedFile(member.file_path[: -len(".gz")])
 
-        return [(abs_with_code_raw + f) for f in extracted_files]
+            if processable_only and not member.is_archive() and not member.is_processable():
+                continue
 
-    def _extract_tgz(self) -> List[str]:
-        """Extract tgz and return a list of the raw files."""
-        abs_with_code_raw = self._get_absolute_path()
-
-        extracted_filepath = self.file_path.replace(".tgz", ".tar")
-
-        with gzip.open(self.file_path, "rb") as f_in:
-            with open(extracted_filepath, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            extracted_files.append(extraction.write_stream(member_file, member.file_path))
 
-        with tarfile.TarFile(extracted_filepath, "r") as zip_ref:
-            zip_ref.extractall(abs_with_code_raw)
-            extracted_files = (
-                zip_ref.getnames()
-            )  # https://docs.python.org/3/library/tarfile.html#tarfile.TarFile.getnames
+        return extracted_files
 
-        return [(abs_with_code_raw + f) for f in extracted_files]
-
-    def _extract_gz(self) -> List[str]:
+    def _extract_gz(self) -> List[ExtractedFile]:
         """Extract gz and return a list of the raw files."""
         extracted_filepath = self.file_path.replace(".gz", "")
-        with gzip.open(self.file_path, "rb") as f_in:
-            with open(extracted_filepath, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        return [extracted_filepath]
+        return [extraction.extract_gz(self.file_path, extracted_filepath)]
 
 
 def download_geo(job_id: int) -> None:
@@ -322,7 +311,7 @@ def download_geo(job_id: int) -> None:
 
     try:
         # enumerate all files inside the archive
-        archived_files = list(ArchivedFile(dl_file_path).get_files())
+        archived_files = list(ArchivedFile(dl_file_path).get_files(processable_only=True))
     except FileExtractionError as e:
         job.failure_reason = e
         logger.exception(
@@ -370,8 +359,13 @@ def download_geo(job_id: int) -> None:
         actual_file.is_archive = False
         actual_file.absolute_file_path = og_file.file_path
         actual_file.filename = og_file.filename
-        actual_file.calculate_size()
-        actual_file.calculate_sha1()
+        if og_file.sha1:
+            actual_file.size_in_bytes = og_file.size_in_bytes
+            actual_file.sha1 = og_file.sha1
+            actual_file.md5 = og_file.md5
+        else:
+            actual_file.calculate_size()
+            actual_file.calculate_sha1()
         actual_file.has_raw = True
         actual_file.source_url = original_file.source_url
         actual_file.source_filename = original_file.source_filename
@@ -7,6 +7,7 @@ from typing import List
 
 from django.utils import timezone
 
+from data_refinery_common.downloads import DownloadResult, download_file
 from data_refinery_common.job_management import create_processor_job_for_original_files
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models import (
@@ -17,7 +18,7 @@ from data_refinery_common.models import (
     Sample,
 )
 from data_refinery_common.rna_seq import _build_ena_file_url
-from data_refinery_common.utils import download_file, get_env_variable, get_https_sra_download
+from data_refinery_common.utils import get_env_variable, get_https_sra_download
 from data_refinery_workers.downloaders import utils
 
 logger = get_and_configure_logger(__name__)
@@ -52,6 +53,17 @@ def _download_file(
                     download_url = new_url
         except Exception:
             pass
+        # ENA's file-report endpoint only reports on .fastq files, so
+        # that's all the expected md5/size_in_bytes can be checked for.
+        if ".fastq" in original_file.source_filename:
+            return _download_file_http(
+                download_url,
+                downloader_job,
+                target_file_path,
+                expected_md5=original_file.expected_md5,
+                expected_size_in_bytes=original_file.expected_size_in_bytes,
+            )
+
         return _download_file_http(download_url, downloader_job, target_file_path)
     else:
         downloader_job.failure_reason = ("Unrecognized URL pattern: {}").format(download_url)
@@ -61,8 +73,13 @@ def _download_file(
 
 
 def _download_file_http(
-    download_url: str, downloader_job: DownloaderJob, target_file_path: str
-) -> bool:
+    download_url: str,
+    downloader_job: DownloaderJob,
+    target_file_path: str,
+    expected_md5: str = None,
+    expected_size_in_bytes: int = None,
+):
+    """Returns a DownloadResult, which has the file's SHA1 and MD5, or False if it failed."""
     try:
         logger.debug(
             "Downloading file from %s to %s using HTTP.",
@@ -71,7 +88,12 @@ def _download_file_http(
             downloader_job=downloader_job.id,
         )
         # This function will try to recover if the download fails
-        download_file(download_url, target_file_path)
+        download_result = download_file(
+            download_url,
+            target_file_path,
+            expected_md5=expected_md5,
+            expected_size_in_bytes=expected_size_in_bytes,
+        )
     except Exception as e:
         logger.exception(
             "Exception caught while downloading file.", downloader_job=downloader_job.id
@@ -81,7 +103,7 @@ def _download_file_http(
         ).replace("\n", "\\n")
         return False
 
-    return True
+    return download_result
 
 
 def _download_file_aspera(
@@ -284,10 +306,17 @@ def download_sra(job_id: int) -> None:
         os.makedirs(exp_path, exist_ok=True)
         os.makedirs(samp_path, exist_ok=True)
         dl_file_path = samp_path + "/" + original_file.source_filename
-        success = _download_file(original_file, job, dl_file_path)
+        download_result = _download_file(original_file, job, dl_file_path)
+        success = bool(download_result)
 
         if success:
-            original_file.set_downloaded(dl_file_path)
+            if isinstance(download_result, DownloadResult):
+                # It was hashed while it was downloaded.
+                original_file.set_downloaded(
+                    dl_file_path, sha1=download_result.sha1, md5=download_result.md5
+                )
+            else:
+                original_file.set_downloaded(dl_file_path)
 
             # ENA's file-report endpoint only reports on .fastq files,
             # so we can only check expected md5/size_in_bytes for
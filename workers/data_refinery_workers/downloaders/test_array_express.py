@@ -64,7 +64,7 @@ class DownloadArrayExpressTestCase(TestCase):
         self.survey_job = survey_job
 
     @tag("downloaders")
-    @patch("data_refinery_workers.downloaders.array_express.urllib.request.urlopen")
+    @patch("data_refinery_common.downloads.urllib.request.urlopen")
     def test_download_and_extract_file(self, mock_urlopen):
         mock_urlopen.side_effect = file_caching_urlopen
         dlj = DownloaderJob()
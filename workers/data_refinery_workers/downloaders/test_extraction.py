@@ -0,0 +1,89 @@
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from data_refinery_workers.downloaders import extraction, geo
+
+CEL_CONTENTS = os.urandom(3 * 1024 * 1024)
+TXT_CONTENTS = b"ID_REF\tVALUE\n" * 1000
+
+
+def add_to_tar(tar, name, contents):
+    info = tarfile.TarInfo(name)
+    info.size = len(contents)
+    tar.addfile(info, io.BytesIO(contents))
+
+
+class ExtractionTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+        # A tgz like GEO's supplementary archives, with gzipped sample files.
+        self.tgz_path = os.path.join(self.temp_dir, "GSE12345_RAW.tgz")
+        with tarfile.open(self.tgz_path, "w:gz") as tar:
+            add_to_tar(tar, "GSM123456.CEL.gz", gzip.compress(CEL_CONTENTS))
+            add_to_tar(tar, "GSM123457-tbl-1.txt", TXT_CONTENTS)
+            add_to_tar(tar, "GPL570-tbl-1.txt", TXT_CONTENTS)
+
+    def test_background_reader(self):
+        with extraction.BackgroundReader(io.BytesIO(CEL_CONTENTS), chunk_size=1000) as reader:
+            self.assertEqual(reader.read(10), CEL_CONTENTS[:10])
+            self.assertEqual(reader.read(2500), CEL_CONTENTS[10:2510])
+            self.assertEqual(reader.read(), CEL_CONTENTS[2510:])
+            self.assertEqual(reader.read(), b"")
+
+        # Closing it early doesn't leave the thread waiting to queue more chunks.
+        reader = extraction.BackgroundReader(io.BytesIO(CEL_CONTENTS), 1000, 2)
+        reader.read(10)
+        reader.close()
+        self.assertFalse(reader.thread.is_alive())
+
+    def test_extract_gz(self):
+        gz_path = os.path.join(self.temp_dir, "GSM123456.CEL.gz")
+        with open(gz_path, "wb") as gz_file:
+            gz_file.write(gzip.compress(CEL_CONTENTS))
+
+        for decompress_in_thread in [True, False]:
+            with patch.object(extraction, "DECOMPRESS_IN_THREAD", decompress_in_thread):
+                extracted_file = extraction.extract_gz(gz_path, gz_path[: -len(".gz")])
+
+            with open(extracted_file.absolute_path, "rb") as cel_file:
+                self.assertEqual(cel_file.read(), CEL_CONTENTS)
+            self.assertEqual(extracted_file.size_in_bytes, len(CEL_CONTENTS))
+            self.assertEqual(extracted_file.sha1, hashlib.sha1(CEL_CONTENTS).hexdigest())
+            self.assertEqual(extracted_file.md5, hashlib.md5(CEL_CONTENTS).hexdigest())
+
+    def test_iter_tar_members(self):
+        members = {
+            name: member_file.read()
+            for name, member_file in extraction.iter_tar_members(self.tgz_path, compressed=True)
+        }
+
+        self.assertEqual(
+            set(members.keys()), {"GSM123456.CEL.gz", "GSM123457-tbl-1.txt", "GPL570-tbl-1.txt"}
+        )
+        self.assertEqual(gzip.decompress(members["GSM123456.CEL.gz"]), CEL_CONTENTS)
+
+    def test_geo_archive_extraction(self):
+        with patch.object(geo, "LOCAL_ROOT_DIR", self.temp_dir):
+            files = list(geo.ArchivedFile(self.tgz_path).get_files(processable_only=True))
+
+        raw_dir = os.path.join(self.temp_dir, "GSE12345", "raw")
+        self.assertEqual(
+            sorted(file.file_path for file in files),
+            [raw_dir + "/GSM123456.CEL", raw_dir + "/GSM123457-tbl-1.txt"],
+        )
+        # Neither the gzipped sample file nor the platform file were written.
+        self.assertEqual(sorted(os.listdir(raw_dir)), ["GSM123456.CEL", "GSM123457-tbl-1.txt"])
+
+        cel_file = [file for file in files if file.filename == "GSM123456.CEL"][0]
+        self.assertEqual(cel_file.sha1, hashlib.sha1(CEL_CONTENTS).hexdigest())
+        self.assertEqual(cel_file.size_in_bytes, len(CEL_CONTENTS))
@@ -58,7 +58,8 @@ class DownloadGeoTestCase(TestCase):
         self.assertTrue(
             os.path.isfile("/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tgz")
         )
-        self.assertTrue(
+        # The .tgz is extracted as a stream, not gunzipped to a .tar first.
+        self.assertFalse(
             os.path.isfile("/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tar")
         )
 
@@ -1,8 +1,7 @@
 import os
 import shutil
-import urllib.request
-from contextlib import closing
 
+from data_refinery_common.downloads import download_file
 from data_refinery_common.enums import ProcessorPipeline
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.message_queue import send_job
@@ -18,7 +17,6 @@ from data_refinery_workers.downloaders import utils
 
 logger = get_and_configure_logger(__name__)
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
-CHUNK_SIZE = 1024 * 256  # chunk_size is in bytes
 
 
 def _download_file(download_url: str, file_path: str, job: DownloaderJob) -> DownloaderJob:
@@ -34,21 +32,13 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob) -> Dow
         logger.debug(
             "Downloading file from %s to %s.", download_url, file_path, downloader_job=job.id
         )
-        urllib.request.urlcleanup()
-        target_file = open(file_path, "wb")
-        with closing(urllib.request.urlopen(download_url)) as request:
-            shutil.copyfileobj(request, target_file, CHUNK_SIZE)
-
-        # Ancient unresolved bug. WTF python: https://bugs.python.org/issue27973
-        urllib.request.urlcleanup()
+        download_file(download_url, file_path)
     except Exception:
         failure_template = "Exception caught while downloading file from: %s"
         logger.exception(failure_template, download_url, downloader_job=job.id)
         job.failure_reason = failure_template % download_url
         job.success = False
         return job
-    finally:
-        target_file.close()
 
     job.success = True
     return job
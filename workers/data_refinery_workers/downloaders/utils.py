@@ -4,6 +4,7 @@ import sys
 from django.utils import timezone
 
 from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.message_queue import record_job_finished, record_job_started
 from data_refinery_common.models import DownloaderJob, DownloaderJobOriginalFileAssociation
 from data_refinery_common.utils import get_env_variable, get_instance_id
 
@@ -56,6 +57,7 @@ def start_job(job_id: int) -> DownloaderJob:
     job.worker_version = SYSTEM_VERSION
     job.start_time = timezone.now()
     job.save()
+    record_job_started(job)
 
     needs_downloading = any(
         original_file.needs_downloading() for original_file in job.original_files.all()
@@ -71,6 +73,7 @@ def start_job(job_id: int) -> DownloaderJob:
         job.no_retry = True
         job.end_time = timezone.now()
         job.save()
+        record_job_finished(job)
         sys.exit(0)
 
     global CURRENT_JOB
@@ -116,3 +119,4 @@ def end_downloader_job(job: DownloaderJob, success: bool):
     job.success = success
     job.end_time = timezone.now()
     job.save()
+    record_job_finished(job)
@@ -27,6 +27,7 @@ from data_refinery_common.models import (
 )
 from data_refinery_common.utils import get_env_variable
 from data_refinery_workers.processors import smashing_utils, utils
+from data_refinery_workers.processors.memmap_matrix import MemmapMatrix
 
 pd.set_option("mode.chained_assignment", None)
 
@@ -34,6 +35,12 @@ pd.set_option("mode.chained_assignment", None)
 S3_COMPENDIA_BUCKET_NAME = get_env_variable("S3_COMPENDIA_BUCKET_NAME", "data-refinery")
 BYTES_IN_GB = 1024 * 1024 * 1024
 SMASHING_DIR = "/home/user/data_store/smashed/"
+# If this is set, the intermediate matrices are kept on disk and
+# processed in blocks of columns which fit in this many MB of RAM.
+COMPENDIA_MEMORY_BUDGET_MB = int(get_env_variable("COMPENDIA_MEMORY_BUDGET_MB", "0"))
+BYTES_IN_MB = 1024 * 1024
+# IterativeSVD holds about this many float64 copies of the matrix it imputes.
+IMPUTATION_COPIES = 4
 logger = get_and_configure_logger(__name__)
 # DEBUG #
 logger.setLevel(logging.getLevelName("DEBUG"))
@@ -43,7 +50,13 @@ def log_state(message, job_id, start_time=False):
     if logger.isEnabledFor(logging.DEBUG):
         process = psutil.Process(os.getpid())
         ram_in_GB = process.memory_info().rss / BYTES_IN_GB
-        logger.debug(message, total_cpu=psutil.cpu_percent(), process_ram=ram_in_GB, job_id=job_id)
+        logger.debug(
+            message,
+            total_cpu=psutil.cpu_percent(),
+            process_ram=ram_in_GB,
+            peak_process_ram=utils.get_and_reset_peak_ram(),
+            job_id=job_id,
+        )
 
         if start_time:
             logger.debug("Duration: %s" % (time.time() - start_time), job_id=job_id)
@@ -73,6 +86,12 @@ def _prepare_input(job_context: Dict) -> Dict:
         if not os.path.exists(job_context["work_dir"]):
             os.makedirs(job_context["work_dir"])
 
+    if COMPENDIA_MEMORY_BUDGET_MB:
+        job_context["memory_budget"] = COMPENDIA_MEMORY_BUDGET_MB * BYTES_IN_MB
+        job_context["matrix_dir"] = job_context["work_dir"] + "matrices/"
+        shutil.rmtree(job_context["matrix_dir"], ignore_errors=True)
+        os.makedirs(job_context["matrix_dir"])
+
     job_context["organism_object"] = Organism.get_object_for_name(job_context["organism_name"])
     job_context["compendium_version"] = (
         CompendiumResult.objects.filter(
@@ -451,6 +470,305 @@ def _run_iterativesvd(job_context: Dict) -> Dict:
     return job_context
 
 
+def _filter_rnaseq_matrix_out_of_core(job_context: Dict) -> Dict:
+    """Does the same thing as `_filter_rnaseq_matrix`, but a block of columns at a time.
+
+    `rnaseq_matrix` needs to be a MemmapMatrix.
+    """
+    if job_context.get("rnaseq_matrix") is None:
+        log_state(
+            "no rnaseq samples found, skipping rnaseq matrix processing", job_context["job"].id
+        )
+        return job_context
+
+    rnaseq_row_sums_start = log_state("start rnaseq row sums", job_context["job"].id)
+
+    rnaseq_matrix = job_context.pop("rnaseq_matrix")
+    block_size = rnaseq_matrix.block_size(job_context["memory_budget"])
+
+    # Calculate the sum of the lengthScaledTPM values for each row
+    # (gene) and find the samples that are entirely NULL while we're at it.
+    rnaseq_row_sums = np.zeros(rnaseq_matrix.shape[0])
+    present_columns = np.zeros(rnaseq_matrix.shape[1], dtype=bool)
+    for start, end in rnaseq_matrix.column_blocks(block_size):
+        block = rnaseq_matrix.values[:, start:end]
+        rnaseq_row_sums += np.nansum(block, axis=1)
+        present_columns[start:end] = ~np.isnan(block).all(axis=0)
+
+    log_state("end rnaseq row sums", job_context["job"].id, rnaseq_row_sums_start)
+
+    # Drop all rows in rnaseq_matrix with a row sum < 10th
+    # percentile of rnaseq_row_sums; this is now
+    # filtered_rnaseq_matrix
+    drop_start = log_state("drop all rows", job_context["job"].id)
+
+    kept_rows = rnaseq_row_sums >= np.percentile(rnaseq_row_sums, 10)
+    kept_columns = np.flatnonzero(present_columns)
+
+    filtered_rnaseq_matrix = MemmapMatrix(
+        job_context["matrix_dir"] + "filtered_rnaseq_matrix.dat",
+        rnaseq_matrix.index[kept_rows],
+        rnaseq_matrix.columns[kept_columns],
+    )
+    for start, end in filtered_rnaseq_matrix.column_blocks(block_size):
+        block = rnaseq_matrix.values[:, kept_columns[start:end]]
+        filtered_rnaseq_matrix.values[:, start:end] = block[kept_rows]
+
+    rnaseq_matrix.delete()
+
+    log_state("end drop all rows", job_context["job"].id, drop_start)
+
+    job_context["filtered_rnaseq_matrix"] = filtered_rnaseq_matrix
+
+    return job_context
+
+
+def _log2_transform_matrix_out_of_core(job_context: Dict) -> Dict:
+    """Does the same thing as `_log2_transform_matrix`, but in place a
+    block of columns at a time."""
+
+    if job_context.get("filtered_rnaseq_matrix") is None:
+        # Then we don't have any RNA-SEQ samples, so just move on
+        return job_context
+
+    log2_rnaseq_matrix = job_context.pop("filtered_rnaseq_matrix")
+
+    log2_start = log_state("start log2", job_context["job"].id)
+
+    block_size = log2_rnaseq_matrix.block_size(job_context["memory_budget"])
+    for start, end in log2_rnaseq_matrix.column_blocks(block_size):
+        block = log2_rnaseq_matrix.values[:, start:end]
+        log2_rnaseq_matrix.values[:, start:end] = np.log2(block + 1)
+
+    log_state("end log2", job_context["job"].id, log2_start)
+
+    job_context["log2_rnaseq_matrix"] = log2_rnaseq_matrix
+
+    return job_context
+
+
+def _cached_remove_zeroes_out_of_core(job_context: Dict) -> Dict:
+    """Does the same thing as `_cached_remove_zeroes`, but in place a
+    block of columns at a time."""
+
+    if job_context.get("log2_rnaseq_matrix") is None:
+        job_context["cached_zeroes"] = {}
+        return job_context
+
+    cache_start = log_state("start caching zeroes", job_context["job"].id)
+
+    log2_rnaseq_matrix = job_context["log2_rnaseq_matrix"]
+    block_size = log2_rnaseq_matrix.block_size(job_context["memory_budget"])
+
+    cached_zeroes = {}
+    for start, end in log2_rnaseq_matrix.column_blocks(block_size):
+        block = np.array(log2_rnaseq_matrix.values[:, start:end])
+        zeroes = block == 0
+
+        for offset, column in enumerate(log2_rnaseq_matrix.columns[start:end]):
+            cached_zeroes[column] = log2_rnaseq_matrix.index[np.flatnonzero(zeroes[:, offset])]
+
+        block[zeroes] = np.nan
+        log2_rnaseq_matrix.values[:, start:end] = block
+
+    log_state("end caching zeroes", job_context["job"].id, cache_start)
+
+    job_context["cached_zeroes"] = cached_zeroes
+
+    return job_context
+
+
+def _full_outer_join_gene_matrices_out_of_core(job_context: Dict) -> Dict:
+    """Does the same thing as `_full_outer_join_gene_matrices`, but
+    copies the matrices into the combined matrix a block of columns at
+    a time."""
+
+    log2_rnaseq_matrix = job_context.pop("log2_rnaseq_matrix", None)
+
+    if log2_rnaseq_matrix is None:
+        logger.info("Building compendia with only microarray data.", job_id=job_context["job"].id)
+        job_context["combined_matrix"] = job_context.pop("microarray_matrix")
+        return job_context
+
+    outer_merge_start = log_state("start outer merge", job_context["job"].id)
+
+    microarray_matrix = job_context.pop("microarray_matrix")
+
+    # An outer merge sorts the union of the genes.
+    combined_index = microarray_matrix.index.union(log2_rnaseq_matrix.index)
+    combined_matrix = MemmapMatrix(
+        job_context["matrix_dir"] + "combined_matrix.dat",
+        combined_index,
+        microarray_matrix.columns.append(log2_rnaseq_matrix.columns),
+    )
+
+    column_offset = 0
+    for matrix in [microarray_matrix, log2_rnaseq_matrix]:
+        rows = combined_index.get_indexer(matrix.index)
+        block_size = matrix.block_size(job_context["memory_budget"])
+        for start, end in matrix.column_blocks(block_size):
+            combined_matrix.values[
+                rows, column_offset + start : column_offset + end
+            ] = matrix.values[:, start:end]
+
+        column_offset += matrix.shape[1]
+        matrix.delete()
+
+    log_state("end outer merge", job_context["job"].id, outer_merge_start)
+
+    job_context["combined_matrix"] = combined_matrix
+
+    return job_context
+
+
+def _filter_rows_and_columns_out_of_core(job_context: Dict) -> Dict:
+    """Does the same thing as `_filter_rows_and_columns`, but counts the
+    missing values a block of columns at a time.
+
+    `row_col_filtered_matrix` is left as a MemmapMatrix.
+    """
+
+    drop_na_genes_start = log_state("start drop NA genes", job_context["job"].id)
+
+    combined_matrix = job_context.pop("combined_matrix")
+    block_size = combined_matrix.block_size(job_context["memory_budget"])
+
+    # Remove genes (rows) with <=70% present values in combined_matrix
+    present_per_row = np.zeros(combined_matrix.shape[0], dtype=np.int64)
+    for start, end in combined_matrix.column_blocks(block_size):
+        present_per_row += (~np.isnan(combined_matrix.values[:, start:end])).sum(axis=1)
+
+    kept_rows = present_per_row >= combined_matrix.shape[1] * 0.7
+
+    log_state("end drop NA genes", job_context["job"].id, drop_na_genes_start)
+    drop_na_samples_start = log_state("start drop NA samples", job_context["job"].id)
+
+    # Remove samples (columns) with <50% present values in combined_matrix
+    present_per_column = np.zeros(combined_matrix.shape[1], dtype=np.int64)
+    for start, end in combined_matrix.column_blocks(block_size):
+        block = combined_matrix.values[:, start:end][kept_rows]
+        present_per_column[start:end] = (~np.isnan(block)).sum(axis=0)
+
+    col_thresh = kept_rows.sum() * 0.5
+    kept_columns = np.flatnonzero(present_per_column >= col_thresh)
+
+    for sample_accession_code in combined_matrix.columns[present_per_column < col_thresh]:
+        sample = Sample.objects.get(accession_code=sample_accession_code)
+        sample_metadata = sample.to_metadata_dict()
+        job_context["filtered_samples"][sample_accession_code] = {
+            **sample_metadata,
+            "reason": "Sample was dropped because it had less than 50% present values.",
+            "experiment_accession_code": smashing_utils.get_experiment_accession(
+                sample.accession_code, job_context["dataset"].data
+            ),
+        }
+
+    row_col_filtered_matrix = MemmapMatrix(
+        job_context["matrix_dir"] + "row_col_filtered_matrix.dat",
+        combined_matrix.index[kept_rows],
+        combined_matrix.columns[kept_columns],
+    )
+    for start, end in row_col_filtered_matrix.column_blocks(block_size):
+        block = combined_matrix.values[:, kept_columns[start:end]]
+        row_col_filtered_matrix.values[:, start:end] = block[kept_rows]
+
+    combined_matrix.delete()
+
+    log_state("end drop NA genes", job_context["job"].id, drop_na_samples_start)
+
+    job_context["row_col_filtered_matrix"] = row_col_filtered_matrix
+    job_context["row_col_filtered_matrix_index"] = row_col_filtered_matrix.index
+    job_context["row_col_filtered_matrix_columns"] = row_col_filtered_matrix.columns
+
+    return job_context
+
+
+def _reset_zero_values_out_of_core(job_context: Dict) -> Dict:
+    """Does the same thing as `_reset_zero_values`, but in place one column at a time."""
+
+    replace_zeroes_start = log_state("start replace zeroes", job_context["job"].id)
+
+    row_col_filtered_matrix = job_context.pop("row_col_filtered_matrix")
+    cached_zeroes = job_context.pop("cached_zeroes")
+
+    for column, zeroes in cached_zeroes.items():
+        # Skip purged columns
+        if column not in row_col_filtered_matrix.columns:
+            continue
+
+        position = row_col_filtered_matrix.columns.get_loc(column)
+        rows = row_col_filtered_matrix.index.get_indexer(zeroes)
+        row_col_filtered_matrix.values[rows[rows >= 0], position] = 0.0
+
+    log_state("end replace zeroes", job_context["job"].id, replace_zeroes_start)
+
+    job_context["combined_matrix_zero"] = row_col_filtered_matrix
+
+    return job_context
+
+
+def _run_iterativesvd_out_of_core(job_context: Dict) -> Dict:
+    """Does the same thing as `_run_iterativesvd`, but leaves `merged_no_qn`
+    as a MemmapMatrix.
+
+    IterativeSVD needs the whole matrix in memory, so this fails the
+    job if that wouldn't fit in the memory budget rather than going
+    over it.
+    """
+
+    transposed_zeroes_start = log_state("start replacing transposed zeroes", job_context["job"].id)
+
+    matrix = job_context.pop("combined_matrix_zero")
+    job_context.pop("row_col_filtered_matrix_index")
+    job_context.pop("row_col_filtered_matrix_columns")
+
+    # Remove -inf and inf and count the values that need to be imputed.
+    num_missing = 0
+    for start, end in matrix.column_blocks(matrix.block_size(job_context["memory_budget"])):
+        block = np.array(matrix.values[:, start:end])
+        block[np.isinf(block)] = np.nan
+        matrix.values[:, start:end] = block
+        num_missing += np.isnan(block).sum()
+
+    log_state("end replacing transposed zeroes", job_context["job"].id, transposed_zeroes_start)
+
+    total_percent_imputed = num_missing / (matrix.shape[0] * matrix.shape[1])
+    job_context["total_percent_imputed"] = total_percent_imputed
+    logger.info("Total percentage of data to impute!", total_percent_imputed=total_percent_imputed)
+
+    svd_algorithm = job_context["dataset"].svd_algorithm
+    if svd_algorithm != "NONE":
+        imputation_bytes = matrix.shape[0] * matrix.shape[1] * 8 * IMPUTATION_COPIES
+        if imputation_bytes > job_context["memory_budget"]:
+            raise utils.ProcessorJobError(
+                "The filtered matrix is too big to impute within COMPENDIA_MEMORY_BUDGET_MB.",
+                success=False,
+                no_retry=True,
+                matrix_shape=matrix.shape,
+                imputation_mb=imputation_bytes // BYTES_IN_MB,
+                memory_budget_mb=job_context["memory_budget"] // BYTES_IN_MB,
+            )
+
+        svd_start = log_state("start SVD", job_context["job"].id)
+
+        logger.info("IterativeSVD algorithm: %s" % svd_algorithm)
+        svd_algorithm = str.lower(svd_algorithm)
+        imputed_matrix = IterativeSVD(rank=10, svd_algorithm=svd_algorithm).fit_transform(
+            np.array(matrix.values.T)
+        )
+        # Untranspose imputed_matrix (genes are now rows, samples are now columns)
+        matrix.values[:, :] = imputed_matrix.T
+        del imputed_matrix
+
+        log_state("end SVD", job_context["job"].id, svd_start)
+    else:
+        logger.info("Skipping IterativeSVD")
+
+    job_context["merged_no_qn"] = matrix
+
+    return job_context
+
+
 def _perform_imputation(job_context: Dict) -> Dict:
     """
     Take the inputs and perform the primary imputation.
@@ -479,9 +797,20 @@ def _perform_imputation(job_context: Dict) -> Dict:
     imputation_start = log_state("start perform imputation", job_context["job"].id)
     job_context["time_start"] = timezone.now()
 
-    job_context = utils.run_pipeline(
-        job_context,
-        [
+    if job_context.get("memory_budget"):
+        # The matrices are on disk, so only hold a block of them in RAM at a time.
+        # IterativeSVD needs the whole filtered matrix, so it's only read in if it fits.
+        imputation_steps = [
+            _filter_rnaseq_matrix_out_of_core,
+            _log2_transform_matrix_out_of_core,
+            _cached_remove_zeroes_out_of_core,
+            _full_outer_join_gene_matrices_out_of_core,
+            _filter_rows_and_columns_out_of_core,
+            _reset_zero_values_out_of_core,
+            _run_iterativesvd_out_of_core,
+        ]
+    else:
+        imputation_steps = [
             _filter_rnaseq_matrix,
             _log2_transform_matrix,
             _cached_remove_zeroes,
@@ -489,8 +818,9 @@ def _perform_imputation(job_context: Dict) -> Dict:
             _filter_rows_and_columns,
             _reset_zero_values,
             _run_iterativesvd,
-        ],
-    )
+        ]
+
+    job_context = utils.run_pipeline(job_context, imputation_steps)
 
     job_context["time_end"] = timezone.now()
     job_context["formatted_command"] = ["create_compendia.py"]
@@ -536,8 +866,15 @@ def _create_result_objects(job_context: Dict) -> Dict:
     result.save()
 
     # Write the compendia dataframe to a file
-    job_context["csv_outfile"] = job_context["output_dir"] + job_context["organism_name"] + ".tsv"
-    job_context["merged_qn"].to_csv(job_context["csv_outfile"], sep="\t", encoding="utf-8")
+    job_context["csv_outfile"] = smashing_utils.write_expression_matrix(
+        job_context["merged_qn"],
+        job_context["output_dir"] + job_context["organism_name"],
+        job_context["dataset"].output_format,
+    )
+
+    # That was the last use of the matrix, which may be on disk.
+    if job_context.get("matrix_dir"):
+        shutil.rmtree(job_context["matrix_dir"], ignore_errors=True)
 
     organism_key = list(job_context["samples"].keys())[0]
     annotation = ComputationalResultAnnotation()
@@ -0,0 +1,246 @@
+"""A cache of computed files that have already been parsed into frames.
+
+The same computed files get smashed over and over by different datasets,
+so rather than downloading and sanitizing them every time the parsed
+frames are saved to `FRAME_CACHE_DIR` as .npz files. They are keyed by
+the sha1 of the computed file and the transform the smasher applied to
+it, so a cached frame can never be stale as long as FRAME_CACHE_VERSION
+is bumped whenever `_parse_frame` changes what it makes out of a file.
+When the cache grows past its quota the least recently used frames are
+evicted. If FRAME_CACHE_S3_BUCKET is set the cache is also backed by S3
+so nodes can share each other's frames.
+"""
+
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+import boto3
+import numpy as np
+import pandas as pd
+from botocore.client import Config
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.utils import get_env_variable, get_env_variable_gracefully
+
+logger = get_and_configure_logger(__name__)
+
+BYTES_IN_MB = 1024 * 1024
+LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+FRAME_CACHE_DIR = get_env_variable("SMASHER_FRAME_CACHE_DIR", LOCAL_ROOT_DIR + "/frame_cache")
+# The cache is disabled unless it's given a quota.
+FRAME_CACHE_QUOTA_MB = int(get_env_variable("SMASHER_FRAME_CACHE_QUOTA_MB", "0"))
+FRAME_CACHE_S3_BUCKET = get_env_variable_gracefully("SMASHER_FRAME_CACHE_S3_BUCKET", None)
+FRAME_CACHE_S3_PREFIX = "frame_cache/"
+FRAME_CACHE_EXTENSION = ".npz"
+# Part of every key, so that frames parsed by an older smasher are never used.
+FRAME_CACHE_VERSION = 1
+
+_frame_cache = None
+
+
+def get_cache_key(sha1: str, aggregate_by: str, has_been_log2scaled: bool) -> str:
+    """Returns the key of the frame `_parse_frame` makes out of a file.
+
+    The frame only depends on the contents of the file and which of
+    its transforms it applies, so equivalent frames from different
+    datasets share a key. Returns None if the file doesn't have a sha1
+    to identify it.
+    """
+    if not sha1:
+        return None
+
+    if not has_been_log2scaled:
+        # Non-log2 data is log2 transformed based on its values.
+        transform = "auto_log2"
+    elif aggregate_by == "SPECIES":
+        transform = "log2_plus_one"
+    else:
+        transform = "identity"
+
+    return "{}_{}_v{}".format(sha1, transform, FRAME_CACHE_VERSION)
+
+
+class FrameCache:
+    """A least-recently-used cache of parsed frames on local disk.
+
+    This is safe to use from multiple threads, and from multiple jobs
+    on the same node since entries are written atomically and a frame
+    being evicted by another job is just treated as a miss.
+    """
+
+    def __init__(self, cache_dir: str, quota_bytes: int, s3_bucket: str = None):
+        self.cache_dir = cache_dir
+        self.quota_bytes = quota_bytes
+        self.s3_bucket = s3_bucket
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size_in_bytes = sum(os.path.getsize(path) for path, _ in self._entries())
+
+        if self.s3_bucket:
+            self._s3 = boto3.client("s3", config=Config(signature_version="s3v4"))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + FRAME_CACHE_EXTENSION)
+
+    def _entries(self):
+        """Returns (path, stat) for each cached frame."""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(FRAME_CACHE_EXTENSION):
+                continue
+
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                entries.append((path, os.stat(path)))
+            except FileNotFoundError:
+                # Another job evicted it.
+                continue
+
+        return entries
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _load(self, path: str, sample_accession_code: str) -> pd.DataFrame:
+        with np.load(path, allow_pickle=False) as cached:
+            index = pd.Index(
+                cached["index"].astype(object), name=str(cached["index_name"][0]) or None
+            )
+            frame = pd.DataFrame(cached["values"], index=index, columns=[sample_accession_code])
+
+        # Mark this frame as recently used.
+        os.utime(path)
+        return frame
+
+    def _fetch_from_s3(self, key: str) -> bool:
+        if not (self.s3_bucket and settings.RUNNING_IN_CLOUD):
+            return False
+
+        path = self._path(key)
+        temp_fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(temp_fd)
+        try:
+            self._s3.download_file(
+                self.s3_bucket, FRAME_CACHE_S3_PREFIX + key + FRAME_CACHE_EXTENSION, temp_path
+            )
+            os.replace(temp_path, path)
+        except Exception:
+            # Usually it just isn't there.
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+
+        self._add_size(os.path.getsize(path))
+        return True
+
+    def get(self, key: str, sample_accession_code: str) -> pd.DataFrame:
+        """Returns the frame cached under `key` titled `sample_accession_code`,
+        or None if it isn't cached."""
+        path = self._path(key)
+        for attempt_s3 in [False, True]:
+            if attempt_s3 and not self._fetch_from_s3(key):
+                break
+
+            try:
+                frame = self._load(path, sample_accession_code)
+            except FileNotFoundError:
+                continue
+            except Exception:
+                logger.exception("Unable to load cached frame, discarding it.", path=path)
+                self._remove(path)
+                break
+
+            self._count(hit=True)
+            return frame
+
+        self._count(hit=False)
+        return None
+
+    def put(self, key: str, frame: pd.DataFrame):
+        """Caches the single column `frame` under `key`."""
+        path = self._path(key)
+        temp_fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(temp_fd, "wb") as temp_file:
+                np.savez(
+                    temp_file,
+                    index=np.array(frame.index, dtype=str),
+                    index_name=np.array([frame.index.name or ""], dtype=str),
+                    values=frame.values,
+                )
+            os.replace(temp_path, path)
+        except Exception:
+            logger.exception("Unable to cache frame.", path=path)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self._add_size(os.path.getsize(path))
+
+        if self.s3_bucket and settings.RUNNING_IN_CLOUD:
+            try:
+                self._s3.upload_file(
+                    path, self.s3_bucket, FRAME_CACHE_S3_PREFIX + key + FRAME_CACHE_EXTENSION
+                )
+            except Exception:
+                logger.exception("Unable to upload cached frame to S3.", path=path)
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            self._size_in_bytes -= size
+
+    def _add_size(self, size: int):
+        with self._lock:
+            self._size_in_bytes += size
+            if self._size_in_bytes <= self.quota_bytes:
+                return
+
+            # Other jobs on this node share the cache, so start from what's really on disk.
+            entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+            self._size_in_bytes = sum(stat.st_size for _, stat in entries)
+
+            for path, stat in entries:
+                if self._size_in_bytes <= self.quota_bytes:
+                    break
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._size_in_bytes -= stat.st_size
+
+
+def get_frame_cache() -> FrameCache:
+    """Returns the FrameCache configured from the environment, or None if
+    SMASHER_FRAME_CACHE_QUOTA_MB isn't set.
+
+    The cache is only created once per process, so its directory is
+    only scanned for its size the first time.
+    """
+    global _frame_cache
+
+    if FRAME_CACHE_QUOTA_MB <= 0:
+        return None
+
+    if _frame_cache is None:
+        _frame_cache = FrameCache(
+            FRAME_CACHE_DIR, FRAME_CACHE_QUOTA_MB * BYTES_IN_MB, FRAME_CACHE_S3_BUCKET
+        )
+
+    return _frame_cache
@@ -8,7 +8,6 @@ from typing import Dict
 
 from django.utils import timezone
 
-import numpy as np
 import pandas as pd
 
 from data_refinery_common.enums import PipelineEnum, ProcessorPipeline
@@ -16,17 +15,14 @@ from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.message_queue import send_job
 from data_refinery_common.models import (
     ComputationalResult,
-    ComputedFile,
     Pipeline,
     ProcessorJob,
     ProcessorJobOriginalFileAssociation,
     Sample,
     SampleAnnotation,
-    SampleComputedFileAssociation,
-    SampleResultAssociation,
 )
 from data_refinery_common.utils import get_env_variable
-from data_refinery_workers.processors import utils
+from data_refinery_workers.processors import platform_detection, utils
 
 S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
@@ -358,52 +354,12 @@ def _detect_platform(job_context: Dict) -> Dict:
     Related: https://github.com/AlexsLemonade/refinebio/issues/232
     """
 
-    all_databases = {
-        "HOMO_SAPIENS": [
-            "illuminaHumanv1",
-            "illuminaHumanv2",
-            "illuminaHumanv3",
-            "illuminaHumanv4",
-        ],
-        "MUS_MUSCULUS": ["illuminaMousev1", "illuminaMousev1p1", "illuminaMousev2",],
-        "RATTUS_NORVEGICUS": ["illuminaRatv1"],
-    }
-
-    sample0 = job_context["samples"][0]
-    databases = all_databases[sample0.organism.name]
-
-    # Loop over all of the possible platforms and find the one with the best match.
-    highest = 0.0
-    high_mapped_percent = 0.0
-    high_db = None
-    for platform in databases:
-        try:
-            result = subprocess.check_output(
-                [
-                    "/usr/bin/Rscript",
-                    "--vanilla",
-                    "/home/user/data_refinery_workers/processors/detect_database.R",
-                    "--platform",
-                    platform,
-                    "--inputFile",
-                    job_context["sanitized_file_path"],
-                    "--column",
-                    # R strips column names, so we have to too
-                    job_context["probeId"].strip(),
-                ]
-            )
-
-            results = result.decode().split("\n")
-            cleaned_result = float(results[0].strip())
-
-            if cleaned_result > highest:
-                highest = cleaned_result
-                high_db = platform
-                high_mapped_percent = float(results[1].strip())
-
-        except Exception as e:
-            logger.exception(e, processor_job_id=job_context["job"].id)
-            continue
+    high_db, highest, high_mapped_percent = platform_detection.detect_illumina_platform(
+        job_context["sanitized_file_path"],
+        # R strips column names, so we have to too
+        job_context["probeId"].strip(),
+        job_context["samples"][0].organism.name,
+    )
 
     # Record our sample detection outputs for every sample.
     for sample in job_context["samples"]:
@@ -562,21 +518,14 @@ def _create_result_objects(job_context: Dict) -> Dict:
     # Split the result into smashable subfiles
     big_tsv = job_context["output_file_path"]
     data = pd.read_csv(big_tsv, sep="\t", header=0, index_col=0)
-    individual_files = []
-    frames = np.split(data, len(data.columns), axis=1)
-    for frame in frames:
-        filename = (
-            frame.columns.values[0].replace("&", "").replace("*", "").replace(";", "") + ".tsv"
-        )
-        frame_path = job_context["work_dir"] + filename
-        frame.to_csv(frame_path, sep="\t", encoding="utf-8")
-
+    sample_file_paths = []
+    for column in data.columns:
         # This needs to be the same as the ones in the job context!
-        sample = _get_sample_for_column(frame.columns.values[0], job_context)
+        sample = _get_sample_for_column(column, job_context)
         if sample is None:
             job_context["job"].failure_reason = (
                 "Could not find sample for column "
-                + frame.columns.values[0]
+                + column
                 + " while splitting Illumina file "
                 + big_tsv
             )
@@ -584,25 +533,12 @@ def _create_result_objects(job_context: Dict) -> Dict:
             job_context["job"].no_retry = True
             return job_context
 
-        computed_file = ComputedFile()
-        computed_file.absolute_file_path = frame_path
-        computed_file.filename = frame_path.split("/")[-1]
-        computed_file.result = result
-        computed_file.is_smashable = True
-        computed_file.is_qc = False
-        computed_file.is_public = True
-        computed_file.calculate_sha1()
-        computed_file.calculate_size()
-        computed_file.save()
-        job_context["computed_files"].append(computed_file)
-
-        SampleResultAssociation.objects.get_or_create(sample=sample, result=result)
-
-        SampleComputedFileAssociation.objects.get_or_create(
-            sample=sample, computed_file=computed_file
-        )
+        filename = column.replace("&", "").replace("*", "").replace(";", "") + ".tsv"
+        sample_file_paths.append((sample, job_context["work_dir"] + filename))
 
-        individual_files.append(computed_file)
+    utils.write_sample_frames(data, [frame_path for _, frame_path in sample_file_paths])
+    individual_files = utils.register_sample_files(result, sample_file_paths)
+    job_context["computed_files"].extend(individual_files)
 
     logger.debug("Created %s", result)
     job_context["success"] = True
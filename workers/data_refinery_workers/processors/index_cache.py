@@ -0,0 +1,239 @@
+"""A cache of extracted transcriptome indexes shared by every job on a node.
+
+Each OrganismIndex is downloaded and extracted once into
+INDEX_CACHE_DIR/indexes and then used by every Salmon job that needs it.
+Every index has two lock files in INDEX_CACHE_DIR/locks which
+coordinate the jobs using it:
+
+  * The job that installs an index holds an exclusive lock on its
+    install lock while it does, so any other jobs that need it wait for
+    it to finish instead of downloading it too.
+  * Jobs using an installed index hold a shared lock on its usage lock
+    until they release it. These locks are the index's reference count,
+    and since the kernel drops them when a process exits they can't
+    leak when a job dies.
+  * Indexes are only evicted if an exclusive lock can be taken on their
+    usage lock, so an index that's in use is never removed.
+
+When the indexes take up more than INDEX_CACHE_QUOTA_GB, the least
+recently used ones that aren't in use are evicted. That happens after
+each install and whenever the Janitor runs.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import tarfile
+from typing import List
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.utils import get_env_variable
+
+logger = get_and_configure_logger(__name__)
+
+LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+INDEX_CACHE_DIR = get_env_variable("INDEX_CACHE_DIR", os.path.join(LOCAL_ROOT_DIR, "index_cache"))
+INDEX_CACHE_QUOTA_GB = int(get_env_variable("INDEX_CACHE_QUOTA_GB", "100"))
+BYTES_IN_GB = 1024 * 1024 * 1024
+
+# Written into an index's directory once it's completely installed.
+INSTALLED_MARKER = ".installed.json"
+# An index can be evicted between being installed and being locked for
+# use, so try installing it again if that happens.
+MAX_INSTALL_ATTEMPTS = 2
+
+
+class IndexCacheError(Exception):
+    pass
+
+
+class CachedIndex:
+    """A reference to an installed index, which can't be evicted until it's released."""
+
+    def __init__(self, directory: str, lock_file):
+        self.directory = directory
+        self.lock_file = lock_file
+
+    def release(self) -> None:
+        if not self.lock_file.closed:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+
+
+def _get_indexes_dir() -> str:
+    return os.path.join(INDEX_CACHE_DIR, "indexes")
+
+
+def _get_lock_path(name: str) -> str:
+    return os.path.join(INDEX_CACHE_DIR, "locks", name + ".lock")
+
+
+def _get_install_lock_path(name: str) -> str:
+    return os.path.join(INDEX_CACHE_DIR, "locks", name + ".install.lock")
+
+
+def _get_installing_dir(name: str) -> str:
+    return os.path.join(INDEX_CACHE_DIR, "installing", name)
+
+
+def _open_lock_file(lock_path: str):
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    # Lock files are never removed, otherwise two jobs could end up
+    # holding locks on different files for the same index.
+    return open(lock_path, "a")
+
+
+def _get_index_name(organism_index) -> str:
+    return "{}_{}_{}".format(
+        organism_index.organism.name, organism_index.index_type, organism_index.id
+    )
+
+
+def _get_directory_size(directory: str) -> int:
+    size_in_bytes = 0
+    for path, _, filenames in os.walk(directory):
+        for filename in filenames:
+            size_in_bytes += os.path.getsize(os.path.join(path, filename))
+
+    return size_in_bytes
+
+
+def _install(organism_index, index_dir: str) -> None:
+    """Downloads and extracts `organism_index` to `index_dir`.
+
+    It's extracted somewhere else first and then moved into place, so
+    that an index is either completely installed or not there at all.
+    """
+    installing_dir = _get_installing_dir(os.path.basename(index_dir))
+    # Whatever is there was left by a job that died while installing it.
+    shutil.rmtree(installing_dir, ignore_errors=True)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.makedirs(installing_dir)
+
+    index_file = organism_index.get_computed_file()
+    index_tarball = index_file.sync_from_s3(path=os.path.join(installing_dir, index_file.filename))
+    if not index_tarball:
+        raise IndexCacheError("Unable to download {}".format(index_file.filename))
+
+    with tarfile.open(index_tarball, "r:gz") as index_archive:
+        index_archive.extractall(installing_dir)
+    os.remove(index_tarball)
+
+    with open(os.path.join(installing_dir, INSTALLED_MARKER), "w") as marker_file:
+        json.dump(
+            {
+                "organism_index_id": organism_index.id,
+                "size_in_bytes": _get_directory_size(installing_dir),
+            },
+            marker_file,
+        )
+
+    os.makedirs(os.path.dirname(index_dir), exist_ok=True)
+    os.rename(installing_dir, index_dir)
+
+
+def acquire(organism_index) -> CachedIndex:
+    """Returns a reference to `organism_index`, installing it first if it isn't already.
+
+    The index won't be evicted until the returned CachedIndex is
+    released or this process exits.
+    """
+    name = _get_index_name(organism_index)
+    index_dir = os.path.join(_get_indexes_dir(), name)
+    marker_path = os.path.join(index_dir, INSTALLED_MARKER)
+
+    lock_file = _open_lock_file(_get_lock_path(name))
+    try:
+        num_installs = 0
+        while True:
+            if os.path.exists(marker_path):
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                # It could have been evicted before the lock was taken.
+                if os.path.exists(marker_path):
+                    # Mark it as recently used.
+                    os.utime(marker_path)
+                    if num_installs:
+                        # Now that it can't be evicted itself, make room for it.
+                        evict()
+
+                    return CachedIndex(index_dir, lock_file)
+
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+            if num_installs == MAX_INSTALL_ATTEMPTS:
+                raise IndexCacheError("{} kept being evicted before it was used.".format(name))
+
+            # Only one job installs the index, any others wait here
+            # until it's done and then use it.
+            with _open_lock_file(_get_install_lock_path(name)) as install_lock_file:
+                fcntl.flock(install_lock_file, fcntl.LOCK_EX)
+                if not os.path.exists(marker_path):
+                    logger.info("Installing transcriptome index.", index=name)
+                    _install(organism_index, index_dir)
+                    num_installs += 1
+    except Exception:
+        lock_file.close()
+        raise
+
+
+def _try_remove(lock_path: str, directory: str) -> bool:
+    """Removes `directory` if nothing holds the lock at `lock_path`."""
+    with _open_lock_file(lock_path) as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        # Remove the marker first so a partly removed index never looks installed.
+        marker_path = os.path.join(directory, INSTALLED_MARKER)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+        shutil.rmtree(directory, ignore_errors=True)
+        return True
+
+
+def evict(quota_in_bytes: int = None) -> List[str]:
+    """Removes the least recently used indexes that aren't in use until the rest fit in
+    `quota_in_bytes`, which defaults to INDEX_CACHE_QUOTA_GB.
+
+    Also removes whatever jobs that died while installing indexes left
+    behind. Returns the paths that were removed.
+    """
+    if quota_in_bytes is None:
+        quota_in_bytes = INDEX_CACHE_QUOTA_GB * BYTES_IN_GB
+
+    removed = []
+
+    installing_root = os.path.join(INDEX_CACHE_DIR, "installing")
+    if os.path.isdir(installing_root):
+        for name in os.listdir(installing_root):
+            if _try_remove(_get_install_lock_path(name), os.path.join(installing_root, name)):
+                removed.append(os.path.join(installing_root, name))
+
+    indexes = []
+    if os.path.isdir(_get_indexes_dir()):
+        for name in os.listdir(_get_indexes_dir()):
+            marker_path = os.path.join(_get_indexes_dir(), name, INSTALLED_MARKER)
+            try:
+                last_used = os.path.getmtime(marker_path)
+                with open(marker_path) as marker_file:
+                    size_in_bytes = json.load(marker_file)["size_in_bytes"]
+            except (OSError, ValueError, KeyError):
+                # It's being installed or removed.
+                continue
+
+            indexes.append((last_used, size_in_bytes, name))
+
+    total_size = sum(size_in_bytes for _, size_in_bytes, _ in indexes)
+    for _, size_in_bytes, name in sorted(indexes):
+        if total_size <= quota_in_bytes:
+            break
+
+        index_dir = os.path.join(_get_indexes_dir(), name)
+        if _try_remove(_get_lock_path(name), index_dir):
+            logger.info("Evicted transcriptome index.", index=name, size_in_bytes=size_in_bytes)
+            total_size -= size_in_bytes
+            removed.append(index_dir)
+
+    return removed
@@ -7,7 +7,7 @@ from data_refinery_common.enums import PipelineEnum
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models import Pipeline, ProcessorJob, Sample
 from data_refinery_common.utils import get_env_variable
-from data_refinery_workers.processors import utils
+from data_refinery_workers.processors import index_cache, native_tximport, utils
 
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
 logger = get_and_configure_logger(__name__)
@@ -31,6 +31,14 @@ def _find_and_remove_expired_jobs(job_context):
     jobs_to_check = []
     for item in os.listdir(LOCAL_ROOT_DIR):
 
+        # The index cache removes the indexes that aren't in use itself, below.
+        if os.path.join(LOCAL_ROOT_DIR, item) == index_cache.INDEX_CACHE_DIR:
+            continue
+
+        # So does the tximport state, below.
+        if os.path.join(LOCAL_ROOT_DIR, item) == native_tximport.TXIMPORT_STATE_DIR:
+            continue
+
         # There may be successful processors
         if "SRP" in item or "ERP" in item or "DRP" in item:
             sub_path = os.path.join(LOCAL_ROOT_DIR, item)
@@ -104,6 +112,14 @@ def _find_and_remove_expired_jobs(job_context):
         shutil.rmtree(to_delete, ignore_errors=True)
         job_context["deleted_items"].append(to_delete)
 
+    # Evict the least recently used transcriptome indexes that no job
+    # is using if the cache has outgrown its quota.
+    job_context["deleted_items"].extend(index_cache.evict())
+
+    # Remove the tximport states of experiments that haven't had
+    # tximport run on them on this node in a while.
+    job_context["deleted_items"].extend(native_tximport.evict_states())
+
     job_context["success"] = True
     return job_context
 
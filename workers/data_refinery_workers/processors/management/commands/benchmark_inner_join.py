@@ -0,0 +1,118 @@
+"""Compares smasher._inner_join against the pairwise merge loop it replaced.
+
+Every frame is a single sample column over a shared set of genes with a
+few genes randomly missing, which is what the smasher usually sees.
+"""
+
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+import pandas as pd
+
+from data_refinery_workers.processors import smasher
+
+
+def _pairwise_inner_join(job_context):
+    """The merge loop `smasher._inner_join` used to run, without the logging."""
+    merged = job_context["all_frames"][0]
+    merged_backup = merged
+
+    for frame in job_context["all_frames"][1:]:
+        if any(column in merged.columns for column in frame.columns):
+            continue
+
+        merged = merged.merge(frame, how="inner", left_index=True, right_index=True)
+
+        if len(merged) == 0:
+            merged = merged_backup
+            job_context["unsmashable_files"].append(frame.columns[0])
+
+        merged_backup = merged
+
+    return merged
+
+
+def _build_frames(num_frames, num_genes, missing_genes, seed):
+    random_state = np.random.RandomState(seed)
+    gene_ids = np.array(["ENSG{:011d}".format(i) for i in range(num_genes)])
+
+    frames = []
+    for i in range(num_frames):
+        present = np.ones(num_genes, dtype=bool)
+        present[random_state.choice(num_genes, missing_genes, replace=False)] = False
+        frames.append(
+            pd.DataFrame(
+                random_state.rand(present.sum()).astype(np.float32),
+                index=gene_ids[present],
+                columns=["SAMPLE{}".format(i)],
+            )
+        )
+
+    return frames
+
+
+def _time_join(join_function, frames):
+    job_context = {
+        "all_frames": frames,
+        "unsmashable_files": [],
+        "job": SimpleNamespace(id=None),
+        "dataset": SimpleNamespace(id=None),
+    }
+
+    start = time.time()
+    merged = join_function(job_context)
+    return time.time() - start, merged
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--frame-counts",
+            type=str,
+            default="100,1000,10000",
+            help="Comma separated numbers of frames to join.",
+        )
+        parser.add_argument(
+            "--num-genes", type=int, default=20000, help="Number of genes in each frame."
+        )
+        parser.add_argument(
+            "--missing-genes",
+            type=int,
+            default=10,
+            help="Number of genes randomly left out of each frame.",
+        )
+        parser.add_argument(
+            "--skip-pairwise-above",
+            type=int,
+            default=None,
+            help="Don't time the pairwise loop for more frames than this, it's quadratic.",
+        )
+
+    def handle(self, *args, **options):
+        for num_frames in [int(count) for count in options["frame_counts"].split(",")]:
+            frames = _build_frames(num_frames, options["num_genes"], options["missing_genes"], 0)
+
+            seconds, merged = _time_join(smasher._inner_join, frames)
+            print(
+                "{} frames: _inner_join took {:.2f}s for a {} x {} matrix.".format(
+                    num_frames, seconds, *merged.shape
+                )
+            )
+
+            if options["skip_pairwise_above"] and num_frames > options["skip_pairwise_above"]:
+                continue
+
+            pairwise_seconds, pairwise_merged = _time_join(_pairwise_inner_join, frames)
+            print(
+                "{} frames: pairwise merge took {:.2f}s ({:.1f}x slower).".format(
+                    num_frames, pairwise_seconds, pairwise_seconds / max(seconds, 1e-9)
+                )
+            )
+
+            if not merged.index.equals(pairwise_merged.index) or not np.allclose(
+                merged.values, pairwise_merged.values
+            ):
+                print("{} frames: the joined matrices are different!".format(num_frames))
@@ -0,0 +1,68 @@
+"""Compares the numpy and preprocessCore quantile normalization engines.
+
+By default this normalizes a random 20,000 gene by 10,000 sample
+float32 matrix, which is about the size of a small species compendium.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+import pandas as pd
+from rpy2.robjects import pandas2ri
+
+from data_refinery_workers.processors import smashing_utils
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--num-genes", type=int, default=20000)
+        parser.add_argument("--num-samples", type=int, default=10000)
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=smashing_utils.MULTIPROCESSING_MAX_THREAD_COUNT,
+            help="Number of processes the numpy engine can use.",
+        )
+        parser.add_argument(
+            "--skip-preprocesscore", action="store_true", help="Only time the numpy engine.",
+        )
+
+    def handle(self, *args, **options):
+        random_state = np.random.RandomState(0)
+        matrix = pd.DataFrame(
+            random_state.lognormal(size=(options["num_genes"], options["num_samples"])).astype(
+                np.float32
+            )
+        )
+        target = pd.Series(np.sort(random_state.lognormal(size=options["num_genes"])))
+
+        start = time.time()
+        numpy_qn = smashing_utils._quantile_normalize_matrix_numpy(
+            target, matrix.copy(), processes=options["processes"]
+        )
+        numpy_seconds = time.time() - start
+        print(
+            "numpy QN of a {} x {} matrix with {} processes took {:.2f}s.".format(
+                *matrix.shape, options["processes"], numpy_seconds
+            )
+        )
+
+        if options["skip_preprocesscore"]:
+            return
+
+        pandas2ri.activate()
+        start = time.time()
+        preprocesscore_qn = smashing_utils._quantile_normalize_matrix(target, matrix.copy())
+        preprocesscore_seconds = time.time() - start
+        print(
+            "preprocessCore QN took {:.2f}s ({:.1f}x slower).".format(
+                preprocesscore_seconds, preprocesscore_seconds / max(numpy_seconds, 1e-9)
+            )
+        )
+
+        max_difference = np.nanmax(
+            np.abs(numpy_qn.values - preprocesscore_qn.values.astype(np.float32))
+        )
+        print("Largest difference between the engines: {}".format(max_difference))
@@ -0,0 +1,103 @@
+"""Compares the ways of measuring read lengths on synthetic gzipped FASTQ files.
+
+For each size this writes a FASTQ with reads of random lengths around
+--mean-length and times the line by line loop
+`salmon._determine_index_length` used to run, measuring every read in
+large blocks, and the sampled estimate it uses now.
+"""
+
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+
+from data_refinery_workers.processors import read_length
+
+
+def _line_by_line(file_path):
+    """The loop `salmon._determine_index_length` used to run over each file."""
+    total_base_pairs = 0
+    number_of_reads = 0
+    counter = 1
+    with subprocess.Popen(
+        ["zcat", file_path], stdout=subprocess.PIPE, universal_newlines=True
+    ) as process:
+        for line in process.stdout:
+            if counter % 4 == 2:
+                total_base_pairs += len(line.replace("\n", ""))
+                number_of_reads += 1
+            counter += 1
+
+    return total_base_pairs / number_of_reads
+
+
+def _write_fastq(file_path, num_reads, mean_length, seed):
+    random_state = np.random.RandomState(seed)
+    lengths = random_state.randint(mean_length - 10, mean_length + 11, num_reads)
+    bases = "ACGT" * ((mean_length + 10) // 4 + 1)
+
+    # Quick compression, since this is about reading the files, not writing them.
+    with gzip.open(file_path, "wt", compresslevel=1) as fastq_file:
+        for i, length in enumerate(lengths):
+            fastq_file.write("@READ{}\n{}\n+\n{}\n".format(i, bases[:length], "I" * length))
+
+
+def _time(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--read-counts",
+            type=str,
+            default="100000,1000000,10000000",
+            help="Comma separated numbers of reads in each FASTQ.",
+        )
+        parser.add_argument("--mean-length", type=int, default=100)
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            print(
+                "reads, gz_mb, line_by_line_seconds, exact_seconds, sampled_seconds, "
+                "exact_length, sampled_length"
+            )
+            for num_reads in [int(count) for count in options["read_counts"].split(",")]:
+                file_path = os.path.join(temp_dir, "reads_{}.fastq.gz".format(num_reads))
+                _write_fastq(file_path, num_reads, options["mean_length"], options["seed"])
+
+                line_seconds, line_length = _time(_line_by_line, file_path)
+                exact_seconds, exact = _time(read_length.measure_read_lengths, [file_path])
+                sampled_seconds, sampled = _time(read_length.estimate_read_length, [file_path])
+
+                if exact.mean != line_length:
+                    self.stderr.write(
+                        "Lengths differ for {} reads: {} line by line, {} exact".format(
+                            num_reads, line_length, exact.mean
+                        )
+                    )
+
+                print(
+                    "{}, {:.1f}, {:.2f}, {:.2f}, {:.3f}, {:.2f}, {:.2f}".format(
+                        num_reads,
+                        os.path.getsize(file_path) / 1024 / 1024,
+                        line_seconds,
+                        exact_seconds,
+                        sampled_seconds,
+                        exact.mean,
+                        sampled.mean,
+                    )
+                )
+                os.remove(file_path)
+        finally:
+            shutil.rmtree(temp_dir)
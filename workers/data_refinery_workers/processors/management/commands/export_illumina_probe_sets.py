@@ -0,0 +1,61 @@
+"""Exports the probe IDs of the Illumina annotation packages for platform detection.
+
+platform_detection reads these instead of loading the packages each
+time it detects a platform, so this needs to be run again whenever the
+packages change. The images export them when they're built.
+"""
+
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+from data_refinery_workers.processors import platform_detection
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            type=str,
+            default=platform_detection.ILLUMINA_PROBE_SETS_PATH,
+            help="Where to write the probe IDs.",
+        )
+
+    def handle(self, *args, **options):
+        platforms = [
+            platform
+            for organism_platforms in platform_detection.ILLUMINA_DATABASES.values()
+            for platform in organism_platforms
+        ]
+
+        # Export somewhere else first so jobs never read a partly written file.
+        temp_path = options["output"] + ".tmp.gz"
+        subprocess.check_call(
+            [
+                "/usr/bin/Rscript",
+                "--vanilla",
+                "/home/user/data_refinery_workers/processors/export_illumina_probes.R",
+                "--platforms",
+                ",".join(platforms),
+                "--outputFile",
+                temp_path,
+            ]
+        )
+
+        index = platform_detection.ProbeSetIndex.read(temp_path)
+        failed = False
+        for platform in platforms:
+            if platform not in index.platforms:
+                self.stderr.write("No probes were exported for " + platform)
+                failed = True
+            else:
+                num_probes = index.num_probes[index.platforms.index(platform)]
+                print("{}, {}".format(platform, num_probes))
+
+        if failed:
+            os.remove(temp_path)
+            sys.exit(1)
+
+        os.replace(temp_path, options["output"])
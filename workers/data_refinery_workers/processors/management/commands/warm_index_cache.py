@@ -0,0 +1,78 @@
+"""Installs the transcriptome indexes of the most common organisms into this node's index cache.
+
+Salmon jobs on a fresh node otherwise all wait for the first of them
+to download and extract the index they need. Organisms can be named
+with --organisms, otherwise the --top organisms with the most RNA-Seq
+samples are used.
+"""
+
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.models import Organism, OrganismIndex, Sample
+from data_refinery_workers.processors import index_cache
+
+logger = get_and_configure_logger(__name__)
+
+INDEX_TYPES = ["TRANSCRIPTOME_LONG", "TRANSCRIPTOME_SHORT"]
+
+
+def get_most_common_organisms(top: int):
+    organism_counts = (
+        Sample.objects.filter(technology="RNA-SEQ", organism__isnull=False)
+        .values("organism")
+        .annotate(num_samples=Count("id"))
+        .order_by("-num_samples")[:top]
+    )
+    organisms = Organism.objects.in_bulk([count["organism"] for count in organism_counts])
+    return [organisms[count["organism"]] for count in organism_counts]
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--organisms",
+            type=str,
+            help="Comma separated names of the organisms whose indexes should be installed.",
+        )
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=5,
+            help="How many of the organisms with the most RNA-Seq samples to install indexes for.",
+        )
+
+    def handle(self, *args, **options):
+        if options["organisms"]:
+            names = [name.strip().upper() for name in options["organisms"].split(",")]
+            organisms = list(Organism.objects.filter(name__in=names))
+        else:
+            organisms = get_most_common_organisms(options["top"])
+
+        failed = False
+        for organism in organisms:
+            for index_type in INDEX_TYPES:
+                organism_index = (
+                    OrganismIndex.objects.filter(organism=organism, index_type=index_type)
+                    .order_by("-created_at")
+                    .first()
+                )
+                if not organism_index:
+                    logger.info(
+                        "No index to install.", organism=organism.name, index_type=index_type
+                    )
+                    continue
+
+                try:
+                    index_cache.acquire(organism_index).release()
+                    logger.info("Installed index.", organism=organism.name, index_type=index_type)
+                except Exception:
+                    logger.exception(
+                        "Failed to install index.", organism=organism.name, index_type=index_type
+                    )
+                    failed = True
+
+        sys.exit(1 if failed else 0)
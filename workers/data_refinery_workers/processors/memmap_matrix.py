@@ -0,0 +1,83 @@
+"""Matrices stored in np.memmap files rather than in memory.
+
+These are used to build compendia that are too big to hold all of
+their intermediate matrices in RAM at once.
+"""
+
+import os
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+BYTES_PER_VALUE = np.dtype(np.float32).itemsize
+FILL_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+class MemmapMatrix:
+    """A float32 matrix with labelled rows and columns backed by a file.
+
+    Genes are rows and samples are columns, just like the DataFrames
+    the compendia pipeline holds in memory otherwise. Columns can be
+    assigned to by label the same way they can on a DataFrame, and
+    `column_blocks` can be used to process the matrix a few columns
+    at a time.
+    """
+
+    def __init__(self, path: str, index: List[str], columns: List[str], fill_value=np.nan):
+        self.path = path
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shape = (len(self.index), len(self.columns))
+        if shape[0] == 0 or shape[1] == 0:
+            # Empty files can't be memory-mapped, but there's nothing to store anyway.
+            self.values = np.empty(shape, dtype=np.float32)
+        else:
+            # Column-major so that blocks of columns are contiguous on disk.
+            self.values = np.memmap(path, dtype=np.float32, mode="w+", shape=shape, order="F")
+
+        for start, end in self.column_blocks(self.block_size(FILL_BLOCK_BYTES, copies=1)):
+            self.values[:, start:end] = fill_value
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.values.shape
+
+    def __setitem__(self, column: str, column_values):
+        """Sets every column labelled `column` to `column_values`."""
+        positions = np.flatnonzero(self.columns == column)
+        if len(positions) == 0:
+            raise KeyError(column)
+
+        for position in positions:
+            self.values[:, position] = np.reshape(column_values, -1)
+
+    def column_blocks(self, block_size: int) -> Iterator[Tuple[int, int]]:
+        """Yields the (start, end) column slices of blocks of `block_size` columns."""
+        for start in range(0, self.shape[1], block_size):
+            yield start, min(start + block_size, self.shape[1])
+
+    def block_size(self, memory_budget: int, copies: int = 4) -> int:
+        """How many columns can be processed at once without going over `memory_budget` bytes.
+
+        `copies` is how many temporary arrays the size of a block the
+        processing step needs."""
+        column_bytes = max(1, self.shape[0]) * BYTES_PER_VALUE * copies
+        return max(1, memory_budget // column_bytes)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Wraps the matrix in a DataFrame without reading it into memory."""
+        return pd.DataFrame(self.values, index=self.index, columns=self.columns, copy=False)
+
+    def delete(self):
+        """Removes the file backing this matrix."""
+        if isinstance(self.values, np.memmap):
+            self.values.flush()
+        self.values = None
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
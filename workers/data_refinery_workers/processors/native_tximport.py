@@ -0,0 +1,377 @@
+"""Summarizes Salmon's quant.sf files to genes the way tximport.R does, without R.
+
+This follows tximport 1.6.0's `summarizeToGene` with
+countsFromAbundance="lengthScaledTPM". For each gene and sample:
+
+  * the abundance is the sum of the TPMs of the gene's transcripts,
+  * the length is the average of their effective lengths weighted by
+    their TPMs,
+  * and the count is the sum of their NumReads.
+
+Genes whose length is missing from a sample because none of their
+transcripts were expressed get the geometric mean of their lengths in
+the other samples. Genes that aren't expressed in any sample get the
+average effective length of their transcripts instead. Each gene's
+abundance is then multiplied by its average length over all samples,
+and each sample is scaled so its total matches its total count.
+
+Everything but the last step can be accumulated one sample at a time.
+That means an experiment's ExperimentState can be saved and samples
+added to it later, without reading the quant.sf files of the samples
+that are already in it again. Each sample's gene abundances are saved
+in their own file, so only one sample's are in memory at a time.
+Transcripts are summed into genes by multiplying by a sparse
+genes-by-transcripts matrix.
+
+States are kept on the node's local disk under TXIMPORT_STATE_DIR, so
+they are only reused when an experiment's tximport jobs run on the same
+node. The Janitor removes the ones that haven't been used for
+TXIMPORT_STATE_MAX_AGE_DAYS.
+"""
+
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.utils import get_env_variable
+
+logger = get_and_configure_logger(__name__)
+
+LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+TXIMPORT_STATE_DIR = get_env_variable(
+    "TXIMPORT_STATE_DIR", os.path.join(LOCAL_ROOT_DIR, "tximport_state")
+)
+TXIMPORT_STATE_MAX_AGE_DAYS = int(get_env_variable("TXIMPORT_STATE_MAX_AGE_DAYS", "7"))
+SECONDS_IN_DAY = 24 * 60 * 60
+
+SUMMARY_FILENAME = "summary.npz"
+ABUNDANCES_DIR = "abundances"
+LOCKS_DIR = "locks"
+
+
+def read_gene2txmap(gene2txmap_path: str) -> pd.Series:
+    """Reads a genes_to_transcripts.txt file into a Series mapping transcripts to genes."""
+    gene2tx = pd.read_csv(
+        gene2txmap_path, sep="\t", header=None, names=["gene_id", "tx_name"], dtype=str
+    )
+    tx2gene = pd.Series(gene2tx["gene_id"].values, index=gene2tx["tx_name"].values)
+    # tximport uses the first gene listed for a transcript.
+    return tx2gene[~tx2gene.index.duplicated()]
+
+
+def read_quant_file(quant_file_path: str) -> pd.DataFrame:
+    return pd.read_csv(
+        quant_file_path,
+        sep="\t",
+        usecols=["Name", "EffectiveLength", "TPM", "NumReads"],
+        dtype={"Name": str},
+    )
+
+
+class ExperimentState:
+    """Running sums over the quant.sf files of one experiment's samples.
+
+    The transcripts and genes are set by the first sample added, and
+    every other sample has to have been quantified against the same
+    transcripts.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # The transcripts in the quant.sf files and the index in
+        # gene_ids of each of their genes, or -1 for the ones that
+        # aren't in genes_to_transcripts.txt.
+        self.transcript_ids = None
+        self.transcript_genes = None
+        self.gene_ids = None
+        self.sample_names = []
+        # Whatever identifies the version of the quant.sf file each sample was added from.
+        self.sample_keys = []
+        # The sum of the counts of each sample's genes.
+        self.counts_sums = []
+        # For each gene, the sum of its lengths in the samples it was
+        # expressed in, the sum of their logs and how many there were.
+        self.length_sums = None
+        self.log_length_sums = None
+        self.num_lengths = None
+        # The sum of each transcript's effective length over every sample.
+        self.transcript_length_sums = None
+
+        self._aggregation_matrix = None
+
+    @property
+    def num_samples(self) -> int:
+        return len(self.sample_names)
+
+    def _get_abundances_path(self, sample_name: str) -> str:
+        return os.path.join(self.directory, ABUNDANCES_DIR, sample_name + ".npy")
+
+    def _get_aggregation_matrix(self) -> sparse.csr_matrix:
+        """Returns the genes by transcripts matrix that sums transcripts into genes."""
+        if self._aggregation_matrix is None:
+            in_gene = self.transcript_genes >= 0
+            self._aggregation_matrix = sparse.csr_matrix(
+                (
+                    np.ones(in_gene.sum()),
+                    (self.transcript_genes[in_gene], np.flatnonzero(in_gene)),
+                ),
+                shape=(len(self.gene_ids), len(self.transcript_ids)),
+            )
+
+        return self._aggregation_matrix
+
+    def _set_transcripts(self, transcript_ids: np.ndarray, tx2gene: pd.Series) -> None:
+        genes = tx2gene.reindex(transcript_ids).values
+        in_gene = pd.notnull(genes)
+        if not in_gene.any():
+            raise ValueError("None of the transcripts in the quant.sf file are in tx2gene.")
+
+        # Genes are in sorted order, as they are in tximport's output.
+        self.gene_ids, gene_indices = np.unique(genes[in_gene].astype(str), return_inverse=True)
+        self.transcript_ids = transcript_ids
+        self.transcript_genes = np.full(len(transcript_ids), -1)
+        self.transcript_genes[in_gene] = gene_indices
+
+        self.length_sums = np.zeros(len(self.gene_ids))
+        self.log_length_sums = np.zeros(len(self.gene_ids))
+        self.num_lengths = np.zeros(len(self.gene_ids), dtype=int)
+        self.transcript_length_sums = np.zeros(len(transcript_ids))
+
+    def add_sample(
+        self, sample_name: str, quant_file_path: str, tx2gene: pd.Series, sample_key: str = ""
+    ) -> None:
+        """Adds the quant.sf file at `quant_file_path` to the state as `sample_name`."""
+        if sample_name in self.sample_names:
+            raise ValueError("{} has already been added.".format(sample_name))
+
+        quant = read_quant_file(quant_file_path)
+        transcript_ids = quant["Name"].values
+        if self.transcript_ids is None:
+            self._set_transcripts(transcript_ids, tx2gene)
+        elif not np.array_equal(transcript_ids, self.transcript_ids):
+            # The same index lists its transcripts in the same order,
+            # so this only needs to reorder them if it didn't.
+            order = pd.Index(transcript_ids).get_indexer(self.transcript_ids)
+            if len(transcript_ids) != len(self.transcript_ids) or (order < 0).any():
+                raise ValueError(
+                    "{} wasn't quantified against the same transcripts.".format(quant_file_path)
+                )
+            quant = quant.iloc[order]
+
+        lengths = quant["EffectiveLength"].values.astype(float)
+        tpms = quant["TPM"].values.astype(float)
+
+        aggregation_matrix = self._get_aggregation_matrix()
+        abundances, counts, weighted_lengths = (
+            aggregation_matrix @ np.column_stack([tpms, quant["NumReads"].values, tpms * lengths])
+        ).T
+
+        # A gene's length is missing when it isn't expressed.
+        expressed = abundances > 0
+        gene_lengths = weighted_lengths[expressed] / abundances[expressed]
+        self.length_sums[expressed] += gene_lengths
+        with np.errstate(divide="ignore"):
+            self.log_length_sums[expressed] += np.log(gene_lengths)
+        self.num_lengths[expressed] += 1
+        self.transcript_length_sums += lengths
+
+        os.makedirs(os.path.join(self.directory, ABUNDANCES_DIR), exist_ok=True)
+        np.save(self._get_abundances_path(sample_name), abundances)
+        self.sample_names.append(sample_name)
+        self.sample_keys.append(sample_key)
+        self.counts_sums.append(counts.sum())
+
+    def get_mean_lengths(self) -> np.ndarray:
+        """Returns each gene's length averaged over every sample, with the missing ones
+        filled in."""
+        aggregation_matrix = self._get_aggregation_matrix()
+        average_transcript_lengths = self.transcript_length_sums / self.num_samples
+        # The mean of the average lengths of each gene's transcripts.
+        average_gene_lengths = (aggregation_matrix @ average_transcript_lengths) / (
+            aggregation_matrix @ np.ones(len(self.transcript_ids))
+        )
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            geometric_means = np.exp(self.log_length_sums / self.num_lengths)
+        missing_length = np.where(self.num_lengths > 0, geometric_means, average_gene_lengths)
+
+        num_missing = self.num_samples - self.num_lengths
+        return (self.length_sums + num_missing * missing_length) / self.num_samples
+
+    def iter_length_scaled_tpm(self) -> Iterator[Tuple[str, pd.Series]]:
+        """Yields each sample's name and its lengthScaledTPM counts, indexed by gene."""
+        mean_lengths = self.get_mean_lengths()
+        for sample_name, counts_sum in zip(self.sample_names, self.counts_sums):
+            new_counts = np.load(self._get_abundances_path(sample_name)) * mean_lengths
+            new_counts *= counts_sum / new_counts.sum()
+            yield sample_name, pd.Series(
+                new_counts, index=pd.Index(self.gene_ids, name="Gene"), name=sample_name
+            )
+
+    def get_length_scaled_tpm(self) -> pd.DataFrame:
+        """Returns the lengthScaledTPM counts of every sample, the same table that tximport.R
+        writes to its --tpm_file."""
+        return pd.concat([counts for _, counts in self.iter_length_scaled_tpm()], axis=1)
+
+    def save(self) -> None:
+        summary_path = os.path.join(self.directory, SUMMARY_FILENAME)
+        # np.savez adds .npz to names that don't end with it.
+        temp_path = summary_path + ".tmp.npz"
+        np.savez(
+            temp_path,
+            transcript_ids=self.transcript_ids.astype(str),
+            transcript_genes=self.transcript_genes,
+            gene_ids=self.gene_ids,
+            sample_names=np.array(self.sample_names, dtype=str),
+            sample_keys=np.array(self.sample_keys, dtype=str),
+            counts_sums=np.array(self.counts_sums),
+            length_sums=self.length_sums,
+            log_length_sums=self.log_length_sums,
+            num_lengths=self.num_lengths,
+            transcript_length_sums=self.transcript_length_sums,
+        )
+        # Replace the old summary all at once so it's never half written.
+        os.replace(temp_path, summary_path)
+
+    @classmethod
+    def load(cls, directory: str) -> "ExperimentState":
+        """Loads the state saved in `directory`, or returns an empty one if nothing is."""
+        state = cls(directory)
+        summary_path = os.path.join(directory, SUMMARY_FILENAME)
+        if not os.path.exists(summary_path):
+            return state
+
+        with np.load(summary_path, allow_pickle=False) as summary:
+            state.transcript_ids = summary["transcript_ids"].astype(object)
+            state.transcript_genes = summary["transcript_genes"]
+            state.gene_ids = summary["gene_ids"]
+            state.sample_names = summary["sample_names"].tolist()
+            state.sample_keys = summary["sample_keys"].tolist()
+            state.counts_sums = summary["counts_sums"].tolist()
+            state.length_sums = summary["length_sums"]
+            state.log_length_sums = summary["log_length_sums"]
+            state.num_lengths = summary["num_lengths"]
+            state.transcript_length_sums = summary["transcript_length_sums"]
+
+        return state
+
+
+def _get_lock_path(directory: str) -> str:
+    # Lock files are kept outside the states and never removed,
+    # otherwise a job waiting on a state the Janitor removes could end
+    # up holding a lock on a different file than the next job.
+    parent, name = os.path.split(os.path.normpath(directory))
+    return os.path.join(parent, LOCKS_DIR, name + ".lock")
+
+
+def _open_lock_file(directory: str):
+    lock_path = _get_lock_path(directory)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    return open(lock_path, "a")
+
+
+@contextmanager
+def lock_state(directory: str):
+    """Keeps any other job from updating or removing the state in `directory` until this
+    exits."""
+    with _open_lock_file(directory) as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # The lock file's modification time is when the state was last used.
+        os.utime(lock_file.fileno())
+        os.makedirs(directory, exist_ok=True)
+        yield
+
+
+def evict_states(max_age_in_seconds: int = None) -> List[str]:
+    """Removes the states in TXIMPORT_STATE_DIR that haven't been used for
+    `max_age_in_seconds`, which defaults to TXIMPORT_STATE_MAX_AGE_DAYS.
+
+    States that a job is using are left alone. Returns the paths that
+    were removed.
+    """
+    if max_age_in_seconds is None:
+        max_age_in_seconds = TXIMPORT_STATE_MAX_AGE_DAYS * SECONDS_IN_DAY
+
+    if not os.path.isdir(TXIMPORT_STATE_DIR):
+        return []
+
+    removed = []
+    oldest_last_used = time.time() - max_age_in_seconds
+    for name in os.listdir(TXIMPORT_STATE_DIR):
+        directory = os.path.join(TXIMPORT_STATE_DIR, name)
+        if name == LOCKS_DIR or not os.path.isdir(directory):
+            continue
+
+        with _open_lock_file(directory) as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+
+            if os.fstat(lock_file.fileno()).st_mtime < oldest_last_used:
+                shutil.rmtree(directory, ignore_errors=True)
+                logger.info("Evicted tximport state.", directory=directory)
+                removed.append(directory)
+
+    return removed
+
+
+def update_state(
+    directory: str, gene2txmap_path: str, quant_files: Dict[str, Tuple[str, Callable[[], str]]]
+) -> ExperimentState:
+    """Brings the state saved in `directory` up to date with `quant_files` and saves it.
+
+    `quant_files` maps each sample's name to a key identifying the
+    version of its quant.sf file and a function returning the path to
+    that file. Only the samples that aren't already in the state are
+    read. If a sample was removed from the experiment or its quant.sf
+    file changed, the state is started over.
+
+    This should be called while holding `lock_state(directory)`.
+    """
+    state = ExperimentState.load(directory)
+
+    current_keys = {name: key for name, (key, _) in quant_files.items()}
+    saved_keys = dict(zip(state.sample_names, state.sample_keys))
+    if any(current_keys.get(name) != key for name, key in saved_keys.items()):
+        logger.info(
+            "Samples changed since tximport state was saved, starting it over.",
+            directory=directory,
+        )
+        shutil.rmtree(os.path.join(directory, ABUNDANCES_DIR), ignore_errors=True)
+        state = ExperimentState(directory)
+
+    samples_to_add = [name for name in quant_files if name not in state.sample_names]
+    if samples_to_add:
+        tx2gene = read_gene2txmap(gene2txmap_path)
+        for name in samples_to_add:
+            key, get_path = quant_files[name]
+            state.add_sample(name, get_path(), tx2gene, key)
+
+        state.save()
+
+    return state
+
+
+def summarize_to_gene(quant_file_paths: List[str], gene2txmap_path: str) -> pd.DataFrame:
+    """Computes the lengthScaledTPM table for `quant_file_paths` from scratch.
+
+    Like tximport.R, each sample is named after the directory its quant.sf file is in.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        tx2gene = read_gene2txmap(gene2txmap_path)
+        state = ExperimentState(directory)
+        for quant_file_path in quant_file_paths:
+            sample_name = os.path.basename(os.path.dirname(quant_file_path))
+            state.add_sample(sample_name, quant_file_path, tx2gene)
+
+        return state.get_length_scaled_tpm()
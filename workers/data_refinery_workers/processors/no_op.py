@@ -14,7 +14,7 @@ from data_refinery_common.models import (
     SampleResultAssociation,
 )
 from data_refinery_common.utils import get_env_variable, get_internal_microarray_accession
-from data_refinery_workers.processors import utils
+from data_refinery_workers.processors import platform_detection, utils
 
 logger = get_and_configure_logger(__name__)
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
@@ -260,53 +260,11 @@ def _convert_affy_genes(job_context: Dict) -> Dict:
 def _convert_illumina_genes(job_context: Dict) -> Dict:
     """ Convert to Ensembl genes if we can"""
 
-    all_databases = {
-        "HOMO_SAPIENS": [
-            "illuminaHumanv1",
-            "illuminaHumanv2",
-            "illuminaHumanv3",
-            "illuminaHumanv4",
-        ],
-        "MUS_MUSCULUS": ["illuminaMousev1", "illuminaMousev1p1", "illuminaMousev2",],
-        "RATTUS_NORVEGICUS": ["illuminaRatv1"],
-    }
-
-    sample0 = job_context["samples"][0]
-    databases = all_databases[sample0.organism.name]
-
-    # Loop over all of the possible platforms and find the one with the best match.
-    highest = 0.0
-    high_mapped_percent = 0.0
-    high_db = None
-    for platform in databases:
-        try:
-            result = subprocess.check_output(
-                [
-                    "/usr/bin/Rscript",
-                    "--vanilla",
-                    "/home/user/data_refinery_workers/processors/detect_database.R",
-                    "--platform",
-                    platform,
-                    "--inputFile",
-                    job_context["input_file_path"],
-                    "--column",
-                    job_context.get("column_name", "Reporter Identifier"),
-                ]
-            )
-
-            results = result.decode().split("\n")
-            cleaned_result = float(results[0].strip())
-
-            if cleaned_result > highest:
-                highest = cleaned_result
-                high_db = platform
-                high_mapped_percent = float(results[1].strip())
-
-        except Exception:
-            logger.exception(
-                "Could not detect database for file!", platform=platform, job_context=job_context
-            )
-            continue
+    high_db, highest, high_mapped_percent = platform_detection.detect_illumina_platform(
+        job_context["input_file_path"],
+        job_context.get("column_name", "Reporter Identifier"),
+        job_context["samples"][0].organism.name,
+    )
 
     # Record our sample detection outputs for every sample.
     for sample in job_context["samples"]:
@@ -0,0 +1,206 @@
+"""Detects which Illumina platform a file's probe IDs come from.
+
+detect_database.R loads a platform's Bioconductor annotation package
+to compare its probe IDs with a file's, so it takes one R process per
+candidate platform. Instead, export_illumina_probes.R exports the probe
+IDs of every platform's package once, when the image is built, to
+ILLUMINA_PROBE_SETS_PATH. They're loaded into one sorted array of every
+probe ID and a matrix of which platforms each of them belongs to, so
+every candidate platform is scored with a single lookup of the file's
+probe IDs.
+
+The scores are the same ones detect_database.R computes: the
+percentage of the platform's probes that are in the file, and the
+percentage of the file's probes that are in the platform. If the probe
+IDs haven't been exported, detect_database.R is run instead.
+"""
+
+import csv
+import gzip
+import os
+import subprocess
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.utils import get_env_variable
+
+logger = get_and_configure_logger(__name__)
+
+ILLUMINA_DATABASES = {
+    "HOMO_SAPIENS": ["illuminaHumanv1", "illuminaHumanv2", "illuminaHumanv3", "illuminaHumanv4"],
+    "MUS_MUSCULUS": ["illuminaMousev1", "illuminaMousev1p1", "illuminaMousev2"],
+    "RATTUS_NORVEGICUS": ["illuminaRatv1"],
+}
+ILLUMINA_PROBE_SETS_PATH = get_env_variable(
+    "ILLUMINA_PROBE_SETS_PATH", "/home/user/illumina_probe_sets.tsv.gz"
+)
+
+
+def _round_like_r(percentage: float) -> float:
+    """detect_database.R prints its percentages with R's default of 7 significant digits."""
+    return float("{:.7g}".format(percentage))
+
+
+class ProbeSetIndex:
+    """The probe IDs of each Illumina platform."""
+
+    def __init__(self, platforms: List[str], probe_ids: np.ndarray, membership: np.ndarray):
+        self.platforms = platforms
+        # Every platform's probe IDs, sorted.
+        self.probe_ids = probe_ids
+        # Whether each probe ID is one of each platform's.
+        self.membership = membership
+        self.num_probes = membership.sum(axis=0)
+
+    @classmethod
+    def read(cls, path: str) -> "ProbeSetIndex":
+        """Reads the platform and probe_id TSV written by export_illumina_probes.R."""
+        probe_sets = pd.read_csv(path, sep="\t", dtype=str, keep_default_na=False)
+        platforms = list(pd.unique(probe_sets["platform"]))
+        probe_ids = np.unique(probe_sets["probe_id"].values.astype(str))
+
+        membership = np.zeros((len(probe_ids), len(platforms)), dtype=bool)
+        platform_indices = pd.Index(platforms).get_indexer(probe_sets["platform"])
+        probe_indices = np.searchsorted(probe_ids, probe_sets["probe_id"].values.astype(str))
+        membership[probe_indices, platform_indices] = True
+
+        return cls(platforms, probe_ids, membership)
+
+    def score(
+        self, file_probe_ids: List[Optional[str]], platforms: List[str]
+    ) -> Dict[str, Tuple[float, float]]:
+        """Returns the detection and mapped percentages of `file_probe_ids` for each of
+        `platforms`.
+
+        Missing probe IDs are None. They're counted as probes of the
+        file but never match.
+        """
+        unique_probe_ids = np.unique(
+            np.array([probe_id for probe_id in file_probe_ids if probe_id is not None], dtype=str)
+        )
+        positions = np.searchsorted(self.probe_ids, unique_probe_ids)
+        positions[positions == len(self.probe_ids)] = 0
+        found = self.probe_ids[positions] == unique_probe_ids
+        num_common = self.membership[positions[found]].sum(axis=0)
+
+        scores = {}
+        for platform in platforms:
+            platform_index = self.platforms.index(platform)
+            scores[platform] = (
+                _round_like_r(num_common[platform_index] / self.num_probes[platform_index] * 100.0),
+                _round_like_r(num_common[platform_index] / len(file_probe_ids) * 100.0),
+            )
+
+        return scores
+
+
+@lru_cache(maxsize=None)
+def get_probe_set_index(path: str) -> Optional[ProbeSetIndex]:
+    """Returns the index exported to `path`, or None if there isn't one."""
+    if not os.path.exists(path):
+        return None
+
+    return ProbeSetIndex.read(path)
+
+
+def read_probe_ids(file_path: str, column: str) -> List[Optional[str]]:
+    """Reads the values of `column` in the TSV at `file_path`, the way detect_database.R does.
+
+    Like R's fread, whitespace around the column names and values is
+    ignored and empty values are missing, which are returned as None.
+    """
+    opener = gzip.open if file_path.endswith(".gz") else open
+    with opener(file_path, "rt", encoding="utf-8", errors="replace", newline="") as tsv_file:
+        reader = csv.reader(tsv_file, delimiter="\t")
+        header = [name.strip() for name in next(reader)]
+        try:
+            column_index = header.index(column.strip())
+        except ValueError:
+            raise ValueError("{} has no column named {}".format(file_path, column))
+
+        probe_ids = []
+        for row in reader:
+            if not row:
+                continue
+
+            probe_id = row[column_index].strip() if column_index < len(row) else ""
+            probe_ids.append(probe_id or None)
+
+    return probe_ids
+
+
+def _score_platforms_with_r(
+    file_path: str, column: str, platforms: List[str]
+) -> Dict[str, Tuple[float, float]]:
+    """Runs detect_database.R for each of `platforms`, leaving out the ones it fails on."""
+    scores = {}
+    for platform in platforms:
+        try:
+            result = subprocess.check_output(
+                [
+                    "/usr/bin/Rscript",
+                    "--vanilla",
+                    "/home/user/data_refinery_workers/processors/detect_database.R",
+                    "--platform",
+                    platform,
+                    "--inputFile",
+                    file_path,
+                    "--column",
+                    column,
+                ]
+            )
+
+            results = result.decode().split("\n")
+            scores[platform] = (float(results[0].strip()), float(results[1].strip()))
+        except Exception:
+            logger.exception(
+                "Could not detect database for file!", platform=platform, file_path=file_path
+            )
+
+    return scores
+
+
+def detect_illumina_platform(
+    file_path: str, column: str, organism_name: str
+) -> Tuple[Optional[str], float, float]:
+    """Finds which of `organism_name`'s Illumina platforms the probe IDs in `column` best match.
+
+    Returns the platform, the percentage of its probes that are in the
+    file and the percentage of the file's probes that are its. The
+    platform is None if no probes matched any of them.
+    """
+    platforms = ILLUMINA_DATABASES[organism_name]
+
+    index = get_probe_set_index(ILLUMINA_PROBE_SETS_PATH)
+    if index and all(platform in index.platforms for platform in platforms):
+        try:
+            scores = index.score(read_probe_ids(file_path, column), platforms)
+        except Exception:
+            logger.exception("Could not detect database for file!", file_path=file_path)
+            scores = {}
+    else:
+        logger.info(
+            "Illumina probe IDs haven't been exported, running detect_database.R.",
+            probe_sets_path=ILLUMINA_PROBE_SETS_PATH,
+        )
+        scores = _score_platforms_with_r(file_path, column, platforms)
+
+    # Find the platform with the best match.
+    highest = 0.0
+    high_mapped_percent = 0.0
+    high_db = None
+    for platform in platforms:
+        if platform not in scores:
+            continue
+
+        detection_percent, mapped_percent = scores[platform]
+        if detection_percent > highest:
+            highest = detection_percent
+            high_db = platform
+            high_mapped_percent = mapped_percent
+
+    return high_db, highest, high_mapped_percent
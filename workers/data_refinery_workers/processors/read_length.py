@@ -0,0 +1,159 @@
+"""Estimates the average read length of FASTQ files.
+
+Salmon only needs to know whether reads are longer than
+INDEX_LENGTH_THRESHOLD to choose between the long and short index, so
+reading every line of a large FASTQ is usually wasted work. In sampled
+mode only the first READ_LENGTH_SAMPLE_SIZE reads of each file are
+measured. If their average is too close to the threshold to be sure
+which side of it the whole file is on, the files are measured exactly.
+
+Either way the files are decompressed by `zcat` in its own process and
+read back in large blocks. The lines in each block are found by
+looking for newlines with numpy rather than by reading one line at a
+time.
+"""
+
+import math
+import subprocess
+from typing import List
+
+import numpy as np
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.utils import get_env_variable
+
+logger = get_and_configure_logger(__name__)
+
+# Reads longer than this on average use the long index.
+INDEX_LENGTH_THRESHOLD = 75
+# Set to 0 to always measure every read.
+READ_LENGTH_SAMPLE_SIZE = int(get_env_variable("READ_LENGTH_SAMPLE_SIZE", "100000"))
+# How many standard errors the sampled average needs to be from the
+# threshold to trust it.
+CONFIDENCE_Z_SCORE = 4
+BLOCK_SIZE = 4 * 1024 * 1024
+NEWLINE = ord("\n")
+CARRIAGE_RETURN = ord("\r")
+
+
+class ReadLengths:
+    """The number of reads and bases seen, and the sum of squared read lengths."""
+
+    def __init__(self):
+        self.number_of_reads = 0
+        self.total_base_pairs = 0
+        self.total_squared = 0
+        # Whether the reads seen were all of the reads in the files.
+        self.is_exact = True
+
+    def add(self, lengths: np.ndarray, track_variance: bool) -> None:
+        self.number_of_reads += len(lengths)
+        self.total_base_pairs += int(lengths.sum())
+        if track_variance:
+            self.total_squared += int(np.dot(lengths, lengths))
+
+    @property
+    def mean(self) -> float:
+        return self.total_base_pairs / self.number_of_reads
+
+    @property
+    def standard_error(self) -> float:
+        variance = max(self.total_squared / self.number_of_reads - self.mean ** 2, 0)
+        return math.sqrt(variance / self.number_of_reads)
+
+    def is_confident(self) -> bool:
+        """Whether the sampled reads are clearly on one side of the threshold."""
+        if self.is_exact:
+            return True
+
+        margin = CONFIDENCE_Z_SCORE * self.standard_error
+        return abs(self.mean - INDEX_LENGTH_THRESHOLD) > margin
+
+
+def _measure_file(file_path: str, read_lengths: ReadLengths, max_reads: int = None) -> None:
+    """Adds the lengths of the reads in `file_path`, or of its first `max_reads`, to
+    `read_lengths`."""
+    # zcat unzips the file provided and dumps the output to STDOUT.
+    # It is installed by default in Debian so it should be included
+    # in every docker image already.
+    cat = "zcat" if ".gz" == file_path[-3:] else "cat"
+    with subprocess.Popen([cat, file_path], stdout=subprocess.PIPE) as process:
+        remainder = b""
+        # How many lines have been passed so far.
+        line_number = 0
+        reads_left = max_reads
+        for block in iter(lambda: process.stdout.read(BLOCK_SIZE), b""):
+            data = remainder + block
+            characters = np.frombuffer(data, dtype=np.uint8)
+            line_ends = np.flatnonzero(characters == NEWLINE)
+            if len(line_ends) == 0:
+                remainder = data
+                continue
+
+            remainder = data[line_ends[-1] + 1 :]
+            line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+
+            # In the FASTQ file format, there are 4 lines for each
+            # read. Three of these contain metadata about the
+            # read. The string representing the read itself is found
+            # on the second line of each quartet.
+            first_sequence_line = (1 - line_number) % 4
+            sequence_starts = line_starts[first_sequence_line::4]
+            sequence_ends = line_ends[first_sequence_line::4]
+            line_number += len(line_ends)
+
+            lengths = sequence_ends - sequence_starts
+            # Don't count the \r of files with Windows line endings.
+            lengths -= (lengths > 0) & (characters[sequence_ends - 1] == CARRIAGE_RETURN)
+
+            if reads_left is not None and len(lengths) >= reads_left:
+                read_lengths.add(lengths[:reads_left], max_reads is not None)
+                read_lengths.is_exact = False
+                # Stop zcat instead of waiting for it to finish.
+                process.kill()
+                return
+
+            read_lengths.add(lengths, max_reads is not None)
+            if reads_left is not None:
+                reads_left -= len(lengths)
+
+        # The last line won't have a newline if the file doesn't end with one.
+        if remainder and line_number % 4 == 1:
+            length = len(remainder) - remainder.endswith(b"\r")
+            read_lengths.add(np.array([length]), max_reads is not None)
+
+
+def measure_read_lengths(file_paths: List[str], sample_size: int = None) -> ReadLengths:
+    """Measures the reads in each of `file_paths`.
+
+    If `sample_size` is given only that many reads are measured from
+    the start of each file.
+    """
+    read_lengths = ReadLengths()
+    for file_path in file_paths:
+        _measure_file(file_path, read_lengths, sample_size)
+
+    return read_lengths
+
+
+def estimate_read_length(
+    file_paths: List[str], sample_size: int = READ_LENGTH_SAMPLE_SIZE
+) -> ReadLengths:
+    """Measures the reads in `file_paths`, sampling them if `sample_size` is given.
+
+    The sampled reads are used unless their average is within
+    CONFIDENCE_Z_SCORE standard errors of INDEX_LENGTH_THRESHOLD, in
+    which case every read is measured.
+    """
+    if sample_size:
+        read_lengths = measure_read_lengths(file_paths, sample_size)
+        if read_lengths.number_of_reads > 0 and read_lengths.is_confident():
+            return read_lengths
+
+        logger.debug(
+            "Sampled reads were too close to the index length threshold, measuring all of them.",
+            file_paths=file_paths,
+            number_of_reads=read_lengths.number_of_reads,
+        )
+
+    return measure_read_lengths(file_paths)
@@ -4,14 +4,14 @@ import re
 import shutil
 import subprocess
 import tarfile
-from typing import Dict, List
+from functools import partial
+from typing import Dict, List, Tuple
 
 from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 
 import boto3
-import numpy as np
 import pandas as pd
 import untangle
 from botocore.client import Config
@@ -31,7 +31,12 @@ from data_refinery_common.models import (
 )
 from data_refinery_common.rna_seq import get_tximport_inputs_if_eligible
 from data_refinery_common.utils import get_env_variable
-from data_refinery_workers.processors import utils
+from data_refinery_workers.processors import (
+    index_cache,
+    native_tximport,
+    read_length,
+    utils,
+)
 
 # We have to set the signature_version to v4 since us-east-1 buckets require
 # v4 authentication.
@@ -40,6 +45,12 @@ logger = get_and_configure_logger(__name__)
 JOB_DIR_PREFIX = "processor_job_"
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
 S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
+# "R" runs tximport.R, "NATIVE" runs native_tximport instead, which
+# only reads the quant files of samples it hasn't seen but can't write
+# the RDS file.
+TXIMPORT_ENGINE = get_env_variable("TXIMPORT_ENGINE", "R")
+RDS_FILENAME = "txi_out.RDS"
+TPM_FILENAME = "gene_lengthScaledTPM.tsv"
 
 
 def _set_job_prefix(job_context: Dict) -> Dict:
@@ -267,43 +278,13 @@ def _determine_index_length(job_context: Dict) -> Dict:
         return _determine_index_length_sra(job_context)
 
     logger.debug("Determining index length..")
-    total_base_pairs = 0
-    number_of_reads = 0
-    counter = 1
-
-    if ".gz" == job_context["input_file_path"][-3:]:
-        cat = "zcat"
-    else:
-        cat = "cat"
-    # zcat unzips the file provided and dumps the output to STDOUT.
-    # It is installed by default in Debian so it should be included
-    # in every docker image already.
-    with subprocess.Popen(
-        [cat, job_context["input_file_path"]], stdout=subprocess.PIPE, universal_newlines=True
-    ) as process:
-        for line in process.stdout:
-            # In the FASTQ file format, there are 4 lines for each
-            # read. Three of these contain metadata about the
-            # read. The string representing the read itself is found
-            # on the second line of each quartet.
-            if counter % 4 == 2:
-                total_base_pairs += len(line.replace("\n", ""))
-                number_of_reads += 1
-            counter += 1
-
+    file_paths = [job_context["input_file_path"]]
     if "input_file_path_2" in job_context:
-        if ".gz" == job_context["input_file_path_2"][-3:]:
-            cat = "zcat"
-        else:
-            cat = "cat"
-        with subprocess.Popen(
-            [cat, job_context["input_file_path_2"]], stdout=subprocess.PIPE, universal_newlines=True
-        ) as process:
-            for line in process.stdout:
-                if counter % 4 == 2:
-                    total_base_pairs += len(line.replace("\n", ""))
-                    number_of_reads += 1
-                counter += 1
+        file_paths.append(job_context["input_file_path_2"])
+
+    read_lengths = read_length.estimate_read_length(file_paths)
+    total_base_pairs = read_lengths.total_base_pairs
+    number_of_reads = read_lengths.number_of_reads
 
     if number_of_reads == 0:
         logger.error(
@@ -368,84 +349,28 @@ def _find_or_download_index(job_context: Dict) -> Dict:
 
     job_context["index_directory"] = index_object.absolute_directory_path
 
-    try:
-        # The organism index only needs to be downloaded from S3 once per
-        # organism per index length per EBS volume. We don't know if
-        # another job has started downloading it yet, started extracting
-        # it yet, or already finished and been symlinked to a common
-        # location. Therefore check to see if it's happened before we
-        # complete each step.
-        version_info_path = job_context["index_directory"] + "/versionInfo.json"
-
-        # Something very bad happened and now there are corrupt indexes installed. Nuke 'em.
-        if os.path.exists(version_info_path) and (os.path.getsize(version_info_path) == 0):
-            logger.error("We have to nuke a zero-valued index directory: " + version_info_path)
-            shutil.rmtree(job_context["index_directory"], ignore_errors=True)
-            os.makedirs(job_context["index_directory"], exist_ok=True)
-
-        index_tarball = None
-        if not os.path.exists(version_info_path):
-            # Index is not installed yet, so download it.
-            index_file = ComputedFile.objects.filter(result=index_object.result)[0]
-            index_tarball = index_file.sync_from_s3(
-                path=job_context["work_dir"] + index_file.filename
+    # Indexes that were installed before there was an index cache are
+    # still used where they are.
+    version_info_path = job_context["index_directory"] + "/versionInfo.json"
+    if not os.path.exists(version_info_path) or os.path.getsize(version_info_path) == 0:
+        # The index only needs to be downloaded from S3 once per node.
+        # If another job is already downloading it, this waits for that
+        # job to finish rather than downloading it again.
+        try:
+            cached_index = index_cache.acquire(index_object)
+        except Exception as e:
+            error_template = (
+                "Failed to download or extract transcriptome index for organism {0}: {1}"
             )
+            error_message = error_template.format(str(job_context["organism"]), str(e))
+            logger.exception(error_message, processor_job=job_context["job_id"])
+            job_context["job"].failure_reason = error_message
+            job_context["success"] = False
+            return job_context
 
-        index_hard_dir = None
-        if not os.path.exists(version_info_path):
-            # Index is still not installed yet, so extract it.
-
-            # Create a temporary location to download the index to, which
-            # can be symlinked to once extraction is complete.
-            index_hard_dir = os.path.join(LOCAL_ROOT_DIR, job_context["job_dir_prefix"]) + "_index/"
-            os.makedirs(index_hard_dir)
-            with tarfile.open(index_tarball, "r:gz") as index_archive:
-                index_archive.extractall(index_hard_dir)
-
-        if not os.path.exists(version_info_path):
-            # Index is still not installed yet, so symlink the files we
-            # have to where they are expected to reside.
-            os.makedirs(job_context["index_directory"], exist_ok=True)
-
-            index_files = [
-                "versionInfo.json",
-                "duplicate_clusters.tsv",
-                "hash.bin",
-                "indexing.log",
-                "refInfo.json",
-                "sa.bin",
-                "genes_to_transcripts.txt",
-                "header.json",
-                "quasi_index.log",
-                "rsd.bin",
-                "txpInfo.bin",
-            ]
-
-            for subfile in index_files:
-                # Remove any broken links before symlinking.
-                # If a link is broken, os.path.exists returns false because the
-                # file pointed to by the link does not exist but
-                # os.symlink throws an error because the broken link itself exists.
-                # os.path.lexists, however, returns true if a broken link exists
-                target_file = job_context["index_directory"] + "/" + subfile
-                if os.path.lexists(target_file):
-                    os.unlink(target_file)
-
-                os.symlink(index_hard_dir + subfile, target_file)
-        elif index_hard_dir:
-            # We have failed the race.
-            logger.error("We have failed the index extraction race! Removing dead trees.")
-            shutil.rmtree(index_hard_dir, ignore_errors=True)
-    except Exception as e:
-        error_template = "Failed to download or extract transcriptome index for organism {0}: {1}"
-        error_message = error_template.format(str(job_context["organism"]), str(e))
-        logger.exception(error_message, processor_job=job_context["job_id"])
-        job_context["job"].failure_reason = error_message
-        job_context["success"] = False
-
-        # Make sure we don't leave an empty index directory lying around.
-        shutil.rmtree(index_hard_dir, ignore_errors=True)
-        return job_context
+        # utils.end_job releases this so the index can be evicted once nothing's using it.
+        job_context["cached_index"] = cached_index
+        job_context["index_directory"] = cached_index.directory
 
     # The index tarball contains a directory named index, so add that
     # to the path where we should put it.
@@ -458,10 +383,35 @@ def _find_or_download_index(job_context: Dict) -> Dict:
     return job_context
 
 
-def _run_tximport_for_experiment(
+def _get_tximport_sample_name(quant_file: ComputedFile) -> str:
+    """Returns the name tximport gives the column for `quant_file`'s sample.
+
+    tximport names each column after the directory its quant.sf file
+    is in. ex., a file with absolute_file_path:
+    /processor_job_1/SRR123_output/quant.sf has the column
+    "SRR123_output", which we can associate with sample SRR123.
+    """
+    return str(quant_file.absolute_file_path.split("/")[-2])
+
+
+def _sync_quant_file(job_context: Dict, quant_file: ComputedFile) -> str:
+    # We create a directory in the work directory for each (quant.sf)
+    # file so that its synced copy is in a directory with the same
+    # name as the original.
+    sample_output = job_context["work_dir"] + _get_tximport_sample_name(quant_file) + "/"
+    os.makedirs(sample_output, exist_ok=True)
+    quant_work_path = sample_output + quant_file.filename
+    return quant_file.get_synced_file_path(path=quant_work_path)
+
+
+def _run_tximport_r(
     job_context: Dict, experiment: Experiment, quant_files: List[ComputedFile]
-) -> Dict:
+) -> Tuple[List[str], str, pd.DataFrame]:
+    """Runs tximport.R on every quant file of `experiment`.
 
+    Returns the command that was run, the path to the RDS file it
+    wrote and its lengthScaledTPM table.
+    """
     # Download all the quant.sf fles for this experiment. Write all
     # their paths to a file so we can pass a path to that to
     # tximport.R rather than having to pass in one argument per
@@ -470,27 +420,12 @@ def _run_tximport_for_experiment(
     quant_file_paths = {}
     with open(tximport_path_list_file, "w") as input_list:
         for quant_file in quant_files:
-            # We create a directory in the work directory for each (quant.sf) file, as
-            # tximport assigns column names based on the parent directory name,
-            # and we need those names so that we can reassociate withe samples later.
-            # ex., a file with absolute_file_path: /processor_job_1/SRR123_output/quant.sf
-            # downloads to: /processor_job_2/SRR123_output/quant.sf
-            # So the result file has frame "SRR123_output",
-            # which we can associate with sample SRR123
-            sample_output = (
-                job_context["work_dir"] + str(quant_file.absolute_file_path.split("/")[-2]) + "/"
-            )
-            os.makedirs(sample_output, exist_ok=True)
-            quant_work_path = sample_output + quant_file.filename
-            quant_file_path = quant_file.get_synced_file_path(path=quant_work_path)
+            quant_file_path = _sync_quant_file(job_context, quant_file)
             input_list.write(quant_file_path + "\n")
             quant_file_paths[quant_file_path] = os.stat(quant_file_path).st_size
 
-    rds_filename = "txi_out.RDS"
-    rds_file_path = job_context["work_dir"] + rds_filename
-    tpm_filename = "gene_lengthScaledTPM.tsv"
-    tpm_file_path = job_context["work_dir"] + tpm_filename
-    result = ComputationalResult()
+    rds_file_path = job_context["work_dir"] + RDS_FILENAME
+    tpm_file_path = job_context["work_dir"] + TPM_FILENAME
     cmd_tokens = [
         "/usr/bin/Rscript",
         "--vanilla",
@@ -504,7 +439,6 @@ def _run_tximport_for_experiment(
         "--tpm_file",
         tpm_file_path,
     ]
-    result.time_start = timezone.now()
 
     logger.debug(
         "Running tximport with: %s",
@@ -534,6 +468,75 @@ def _run_tximport_for_experiment(
             quant_file_paths=quant_file_paths,
         )
 
+    data = pd.read_csv(tpm_file_path, sep="\t", header=0, index_col=0)
+    return cmd_tokens, rds_file_path, data
+
+
+def _run_native_tximport(
+    job_context: Dict, experiment: Experiment, quant_files: List[ComputedFile]
+) -> Tuple[List[str], pd.DataFrame]:
+    """Computes the same lengthScaledTPM table as tximport.R, but in numpy.
+
+    The experiment's running sums are kept in TXIMPORT_STATE_DIR, so
+    only the quant files of samples that were added since the last
+    time tximport ran on it are downloaded and read. They're on this
+    node's disk, so they're only reused when the experiment's next
+    tximport runs on the same node.
+    """
+    state_directory = os.path.join(
+        native_tximport.TXIMPORT_STATE_DIR,
+        "{}_{}".format(experiment.accession_code, job_context["organism_index"].id),
+    )
+    quant_file_inputs = {
+        _get_tximport_sample_name(quant_file): (
+            str(quant_file.id) + "_" + str(quant_file.sha1),
+            partial(_sync_quant_file, job_context, quant_file),
+        )
+        for quant_file in quant_files
+    }
+
+    logger.debug(
+        "Running native tximport.",
+        processor_job=job_context["job_id"],
+        experiment=experiment.id,
+        state_directory=state_directory,
+    )
+
+    try:
+        with native_tximport.lock_state(state_directory):
+            state = native_tximport.update_state(
+                state_directory, job_context["genes_to_transcripts_path"], quant_file_inputs
+            )
+            data = state.get_length_scaled_tpm()
+    except Exception as e:
+        raise utils.ProcessorJobError(
+            "Encountered error while running native tximport: {}".format(str(e)),
+            success=False,
+            experiment=experiment.id,
+        )
+
+    cmd_tokens = [
+        "native_tximport.update_state",
+        state_directory,
+        job_context["genes_to_transcripts_path"],
+    ]
+    # Keep the columns in the same order tximport.R would have.
+    return cmd_tokens, data[list(quant_file_inputs.keys())]
+
+
+def _run_tximport_for_experiment(
+    job_context: Dict, experiment: Experiment, quant_files: List[ComputedFile]
+) -> Dict:
+    result = ComputationalResult()
+    result.time_start = timezone.now()
+
+    if TXIMPORT_ENGINE == "NATIVE":
+        cmd_tokens, data = _run_native_tximport(job_context, experiment, quant_files)
+        # The RDS file is an R object, so only tximport.R can write it.
+        rds_file_path = None
+    else:
+        cmd_tokens, rds_file_path, data = _run_tximport_r(job_context, experiment, quant_files)
+
     result.time_end = timezone.now()
     result.commands.append(" ".join(cmd_tokens))
     result.is_ccdl = True
@@ -548,57 +551,50 @@ def _run_tximport_for_experiment(
     result.save()
     job_context["pipeline"].steps.append(result.id)
 
-    rds_file = ComputedFile()
-    rds_file.absolute_file_path = rds_file_path
-    rds_file.filename = rds_filename
-    rds_file.result = result
-    rds_file.is_smashable = False
-    rds_file.is_qc = False
-    rds_file.is_public = True
-    rds_file.calculate_sha1()
-    rds_file.calculate_size()
-    rds_file.save()
-    job_context["computed_files"].append(rds_file)
-
-    # Split the tximport result into smashable subfiles
-    data = pd.read_csv(tpm_file_path, sep="\t", header=0, index_col=0)
-    individual_files = []
-    frames = np.split(data, len(data.columns), axis=1)
-    for frame in frames:
-        # Create sample-specific TPM file.
-        sample_file_name = frame.columns.values[0] + "_" + tpm_filename
-        frame_path = os.path.join(job_context["work_dir"], sample_file_name)
-        frame.to_csv(frame_path, sep="\t", encoding="utf-8")
-
-        # The frame column header is based off of the path, which includes _output.
-        sample_accession_code = frame.columns.values[0].replace("_output", "")
-        sample = Sample.objects.get(accession_code=sample_accession_code)
-
-        computed_file = ComputedFile()
-        computed_file.absolute_file_path = frame_path
-        computed_file.filename = sample_file_name
-        computed_file.result = result
-        computed_file.is_smashable = True
-        computed_file.is_qc = False
-        computed_file.is_public = True
-        computed_file.calculate_sha1()
-        computed_file.calculate_size()
-        computed_file.save()
-        job_context["computed_files"].append(computed_file)
-        job_context["smashable_files"].append(computed_file)
-
-        SampleResultAssociation.objects.get_or_create(sample=sample, result=result)
+    rds_file = None
+    if rds_file_path:
+        rds_file = ComputedFile()
+        rds_file.absolute_file_path = rds_file_path
+        rds_file.filename = RDS_FILENAME
+        rds_file.result = result
+        rds_file.is_smashable = False
+        rds_file.is_qc = False
+        rds_file.is_public = True
+        rds_file.calculate_sha1()
+        rds_file.calculate_size()
+        rds_file.save()
+        job_context["computed_files"].append(rds_file)
+
+    # Split the tximport result into smashable subfiles, one per sample.
+    # The column headers are based off of the paths, which include _output.
+    sample_accession_codes = [column.replace("_output", "") for column in data.columns]
+    samples = Sample.objects.in_bulk(sample_accession_codes, field_name="accession_code")
+    missing_accession_codes = set(sample_accession_codes) - set(samples)
+    if missing_accession_codes:
+        raise utils.ProcessorJobError(
+            "Could not find the samples tximport produced columns for.",
+            success=False,
+            experiment=experiment.id,
+            missing_accession_codes=sorted(missing_accession_codes),
+        )
 
-        # Create association with the RDS file.
-        SampleComputedFileAssociation.objects.get_or_create(sample=sample, computed_file=rds_file)
+    frame_paths = [
+        os.path.join(job_context["work_dir"], column + "_" + TPM_FILENAME)
+        for column in data.columns
+    ]
+    utils.write_sample_frames(data, frame_paths)
 
-        # Create association with TPM file.
-        SampleComputedFileAssociation.objects.get_or_create(
-            sample=sample, computed_file=computed_file
-        )
+    sample_file_paths = [
+        (samples[accession_code], frame_path)
+        for accession_code, frame_path in zip(sample_accession_codes, frame_paths)
+    ]
+    individual_files = utils.register_sample_files(
+        result, sample_file_paths, shared_files=[rds_file] if rds_file else []
+    )
 
-        individual_files.append(computed_file)
-        job_context["samples"].append(sample)
+    job_context["computed_files"].extend(individual_files)
+    job_context["smashable_files"].extend(individual_files)
+    job_context["samples"].extend(sample for sample, _ in sample_file_paths)
 
     # Salmon-processed samples aren't marked as is_processed
     # until they are fully tximported, this value sets that
@@ -2,7 +2,6 @@
 
 import logging
 import os
-import shutil
 import time
 from datetime import timedelta
 from pathlib import Path
@@ -13,6 +12,7 @@ from django.conf import settings
 from django.utils import timezone
 
 import boto3
+import numpy as np
 import pandas as pd
 import psutil
 import requests
@@ -22,8 +22,12 @@ from sklearn import preprocessing
 from data_refinery_common.enums import PipelineEnum
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models import ComputedFile, Pipeline
-from data_refinery_common.utils import calculate_file_size, calculate_sha1, get_env_variable
+from data_refinery_common.utils import get_env_variable
 from data_refinery_workers.processors import smashing_utils, utils
+from data_refinery_workers.processors.streaming_archive import (
+    S3MultipartWriter,
+    StreamingZipArchive,
+)
 
 RESULTS_BUCKET = get_env_variable("S3_RESULTS_BUCKET_NAME", "refinebio-results-bucket")
 S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
@@ -69,45 +73,48 @@ def _inner_join(job_context: Dict) -> pd.DataFrame:
 
     Returns a dataframe, not the job_context.
 
+    Rather than merging the frames one at a time, this works out which
+    frames make it into the join and which genes they all share, then
+    copies every frame into a single preallocated float32 block. The
+    rows are kept in the order of the first frame, just like repeated
+    inner merges would have left them.
+
     TODO: This function should be mostly unnecessary now because we
     pretty much do this in the smashing utils but I don't want to rip
     it out right now .
     """
-    # Merge all of the frames we've gathered into a single big frame, skipping duplicates.
-    # TODO: If the very first frame is the wrong platform, are we boned?
-    merged = job_context["all_frames"][0]
-    i = 1
+    all_frames = job_context["all_frames"]
 
-    old_len_merged = len(merged)
-    merged_backup = merged
+    # TODO: If the very first frame is the wrong platform, are we boned?
+    first_frame = all_frames[0]
+    joined_frames = [first_frame]
+    joined_columns = set(first_frame.columns)
 
-    while i < len(job_context["all_frames"]):
-        frame = job_context["all_frames"][i]
-        i = i + 1
+    # Which genes of the first frame are shared by every frame so far.
+    shared_genes = np.ones(len(first_frame.index), dtype=bool)
+    old_len_merged = len(first_frame)
 
+    # `i` is the 1-based position of `frame` in all_frames.
+    for i, frame in enumerate(all_frames[1:], start=2):
         if i % 1000 == 0:
             logger.info("Smashing keyframe", i=i, job_id=job_context["job"].id)
 
         # I'm not sure where these are sneaking in from, but we don't want them.
         # Related: https://github.com/AlexsLemonade/refinebio/issues/390
-        breaker = False
-        for column in frame.columns:
-            if column in merged.columns:
-                breaker = True
-
-        if breaker:
+        repeated_columns = [column for column in frame.columns if column in joined_columns]
+        if repeated_columns:
             logger.warning(
                 "Column repeated for smash job!",
                 dataset_id=job_context["dataset"].id,
                 job_id=job_context["job"].id,
-                column=column,
+                column=repeated_columns[-1],
             )
             continue
 
         # This is the inner join, the main "Smash" operation
-        merged = merged.merge(frame, how="inner", left_index=True, right_index=True)
+        new_shared_genes = shared_genes & first_frame.index.isin(frame.index)
 
-        new_len_merged = len(merged)
+        new_len_merged = int(new_shared_genes.sum())
         if new_len_merged < old_len_merged:
             logger.warning(
                 "Dropped rows while smashing!",
@@ -124,18 +131,30 @@ def _inner_join(job_context: Dict) -> pd.DataFrame:
                 new_len_merged=new_len_merged,
                 bad_frame_number=i,
             )
-            merged = merged_backup
-            new_len_merged = len(merged)
             try:
                 job_context["unsmashable_files"].append(frame.columns[0])
             except Exception:
                 # Something is really, really wrong with this frame.
                 pass
+            continue
 
-        old_len_merged = len(merged)
-        merged_backup = merged
+        shared_genes = new_shared_genes
+        old_len_merged = new_len_merged
+        joined_frames.append(frame)
+        joined_columns.update(frame.columns)
 
-    return merged
+    merged_index = first_frame.index[shared_genes]
+    merged_columns = [column for frame in joined_frames for column in frame.columns]
+
+    # Preallocate the result so every frame only gets copied once.
+    merged_values = np.empty((len(merged_index), len(merged_columns)), dtype=np.float32)
+    column = 0
+    for frame in joined_frames:
+        frame_width = len(frame.columns)
+        merged_values[:, column : column + frame_width] = frame.reindex(merged_index).values
+        column += frame_width
+
+    return pd.DataFrame(merged_values, index=merged_index, columns=merged_columns, copy=False)
 
 
 def process_frames_for_key(key: str, input_files: List[ComputedFile], job_context: Dict) -> Dict:
@@ -155,14 +174,13 @@ def process_frames_for_key(key: str, input_files: List[ComputedFile], job_contex
     )
 
     job_context["all_frames"] = []
-    for (computed_file, sample) in input_files:
-        frame_data = smashing_utils.process_frame(
-            job_context["work_dir"],
-            computed_file,
-            sample.accession_code,
-            job_context["dataset"].aggregate_by,
-        )
-
+    frames = smashing_utils.iterate_frames(
+        job_context["work_dir"],
+        input_files,
+        job_context["dataset"].aggregate_by,
+        job_context["job"].id,
+    )
+    for (computed_file, sample, frame_data) in frames:
         if frame_data is not None:
             job_context["all_frames"].append(frame_data)
         else:
@@ -260,17 +278,49 @@ def _smash_key(job_context: Dict, key: str, input_files: List[ComputedFile]) ->
 
     outfile_dir = job_context["output_dir"] + key + "/"
     os.makedirs(outfile_dir, exist_ok=True)
-    outfile = outfile_dir + key + ".tsv"
-    job_context["smash_outfile"] = outfile
-    untransposed.to_csv(outfile, sep="\t", encoding="utf-8")
+    job_context["smash_outfile"] = smashing_utils.write_expression_matrix(
+        untransposed, outfile_dir + key, job_context["dataset"].output_format
+    )
 
     log_state("end _smash_key for {}".format(key), job_context["job"].id, start_smash)
 
     return job_context
 
 
+def _open_archive(job_context: Dict) -> StreamingZipArchive:
+    """Opens the archive the smashed files are compressed into as they're written.
+
+    If the result is going to be uploaded the archive is streamed
+    straight to S3, otherwise it's written to `output_file`.
+    """
+    job_context["output_file"] = (
+        "/home/user/data_store/smashed/" + str(job_context["dataset"].pk) + ".zip"
+    )
+
+    try:
+        if job_context.get("upload", True) and settings.RUNNING_IN_CLOUD:
+            # Note that file expiry is handled by the S3 object lifecycle,
+            # managed by terraform.
+            sink = S3MultipartWriter(
+                boto3.client("s3"), RESULTS_BUCKET, job_context["output_file"].split("/")[-1]
+            )
+        else:
+            os.makedirs(os.path.dirname(job_context["output_file"]), exist_ok=True)
+            sink = open(job_context["output_file"], "wb")
+    except Exception:
+        raise utils.ProcessorJobError(
+            "Smash Error while generating zip file", success=False, exc_info=1
+        )
+
+    return StreamingZipArchive(sink)
+
+
 def _smash_all(job_context: Dict) -> Dict:
-    """Perform smashing on all species/experiments in the dataset."""
+    """Perform smashing on all species/experiments in the dataset.
+
+    The output of each key is compressed into the archive as soon as
+    it's smashed, so the archive is done shortly after the last key is.
+    """
     start_smash = log_state("start smash", job_context["job"].id)
 
     job_context["unsmashable_files"] = []
@@ -283,11 +333,18 @@ def _smash_all(job_context: Dict) -> Dict:
         job_id=job_context["job"].id,
     )
 
+    archive = _open_archive(job_context)
+    # When the archive is streamed to S3 nothing needs the smashed files
+    # afterwards, so they can be deleted as soon as they're compressed.
+    delete_archived_files = job_context.get("upload", True) and settings.RUNNING_IN_CLOUD
+
     try:
         # Once again, `key` is either a species name or an experiment accession
         for key, input_files in job_context.pop("input_files").items():
             job_context = _smash_key(job_context, key, input_files)
+            archive.add_tree(job_context["output_dir"], delete_files=delete_archived_files)
     except Exception as e:
+        archive.abort()
         raise utils.ProcessorJobError(
             "Could not smash dataset: " + str(e),
             success=False,
@@ -295,16 +352,27 @@ def _smash_all(job_context: Dict) -> Dict:
             num_input_files=job_context["num_input_files"],
         )
 
-    smashing_utils.write_non_data_files(job_context)
+    try:
+        smashing_utils.write_non_data_files(job_context)
+    except Exception:
+        archive.abort()
+        raise
 
-    # Finally, compress all files into a zip
-    final_zip_base = "/home/user/data_store/smashed/" + str(job_context["dataset"].pk)
+    # Finally, compress everything that's left into the zip
     try:
-        shutil.make_archive(final_zip_base, "zip", job_context["output_dir"])
-    except OSError:
-        raise utils.ProcessorJobError("Smash Error while generating zip file", success=False)
+        archive.add_tree(job_context["output_dir"], delete_files=delete_archived_files)
+        archive.close()
+    except Exception:
+        archive.abort()
+        raise utils.ProcessorJobError(
+            "Smash Error while generating zip file",
+            success=False,
+            exc_info=1,
+            file=job_context["output_file"],
+        )
 
-    job_context["output_file"] = final_zip_base + ".zip"
+    job_context["output_size_in_bytes"] = archive.size_in_bytes
+    job_context["output_sha1"] = archive.sha1
 
     job_context["dataset"].success = True
     job_context["dataset"].save()
@@ -316,24 +384,14 @@ def _smash_all(job_context: Dict) -> Dict:
 
 
 def _upload(job_context: Dict) -> Dict:
-    """Uploads the result file to S3 and notifies user."""
+    """Records where the result file was uploaded to.
+
+    The file itself is streamed to S3 by `_smash_all` while it's being
+    compressed."""
     if not job_context.get("upload", True) or not settings.RUNNING_IN_CLOUD:
         return job_context
 
-    s3_client = boto3.client("s3")
     output_filename = job_context["output_file"].split("/")[-1]
-
-    try:
-        # Note that file expiry is handled by the S3 object lifecycle,
-        # managed by terraform.
-        s3_client.upload_file(
-            job_context["output_file"], RESULTS_BUCKET, output_filename,
-        )
-    except Exception:
-        raise utils.ProcessorJobError(
-            "Failed to upload smash result file.", success=False, file=job_context["output_file"]
-        )
-
     result_url = "https://s3.amazonaws.com/" + RESULTS_BUCKET + "/" + output_filename
 
     job_context["result_url"] = result_url
@@ -502,21 +560,14 @@ def _update_result_objects(job_context: Dict) -> Dict:
 
     dataset.s3_bucket = RESULTS_BUCKET
     dataset.s3_key = job_context["output_file"].split("/")[-1]
-    dataset.size_in_bytes = calculate_file_size(job_context["output_file"])
-    dataset.sha1 = calculate_sha1(job_context["output_file"])
+    dataset.size_in_bytes = job_context["output_size_in_bytes"]
+    dataset.sha1 = job_context["output_sha1"]
     dataset.is_processing = False
     dataset.is_processed = True
     dataset.is_available = True
     dataset.expires_on = timezone.now() + timedelta(days=7)
     dataset.save()
 
-    if settings.RUNNING_IN_CLOUD and job_context.get("upload", True):
-        # File is uploaded and the metadata is updated, can delete the local.
-        try:
-            os.remove(job_context["output_file"])
-        except OSError:
-            pass
-
     job_context["success"] = True
 
     return job_context
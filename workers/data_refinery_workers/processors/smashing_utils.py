@@ -8,11 +8,17 @@ import multiprocessing
 import os
 import random
 import shutil
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 
+import django
+from django.conf import settings
+from django.db.models import F
 from django.utils import timezone
 
 import numpy as np
@@ -25,9 +31,10 @@ from rpy2.robjects import pandas2ri, r as rlang
 from rpy2.robjects.packages import importr
 
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.models import ComputedFile, Sample
+from data_refinery_common.models import ComputedFile, Sample, SampleAttribute
 from data_refinery_common.utils import get_env_variable, queryset_page_iterator
-from data_refinery_workers.processors import utils
+from data_refinery_workers.processors import frame_cache, utils
+from data_refinery_workers.processors.memmap_matrix import MemmapMatrix
 
 MULTIPROCESSING_MAX_THREAD_COUNT = max(1, math.floor(multiprocessing.cpu_count() / 2) - 1)
 RESULTS_BUCKET = get_env_variable("S3_RESULTS_BUCKET_NAME", "refinebio-results-bucket")
@@ -41,7 +48,15 @@ BODY_ERROR_HTML = (
     .replace("\n", "")
 )
 BYTES_IN_GB = 1024 * 1024 * 1024
+BYTES_IN_MB = 1024 * 1024
 QN_CHUNK_SIZE = 10000
+# Downloads are I/O-bound so there can be more of them than there are cores.
+FRAME_PIPELINE_THREAD_COUNT = max(1, multiprocessing.cpu_count() * 2)
+FRAME_PIPELINE_MEMORY_BUDGET = (
+    int(get_env_variable("SMASHER_FRAME_MEMORY_BUDGET_MB", "1024")) * BYTES_IN_MB
+)
+# Used for computed files that don't know their own size.
+DEFAULT_FRAME_SIZE_IN_BYTES = 10 * BYTES_IN_MB
 PAGE_SIZE = 2000
 logger = get_and_configure_logger(__name__)
 ### DEBUG ###
@@ -52,7 +67,13 @@ def log_state(message, job_id, start_time=False):
     if logger.isEnabledFor(logging.DEBUG):
         process = psutil.Process(os.getpid())
         ram_in_GB = process.memory_info().rss / BYTES_IN_GB
-        logger.debug(message, total_cpu=psutil.cpu_percent(), process_ram=ram_in_GB, job_id=job_id)
+        logger.debug(
+            message,
+            total_cpu=psutil.cpu_percent(),
+            process_ram=ram_in_GB,
+            peak_process_ram=utils.get_and_reset_peak_ram(),
+            job_id=job_id,
+        )
 
         if start_time:
             logger.debug("Duration: %s" % (time.time() - start_time), job_id=job_id)
@@ -166,26 +187,36 @@ def _load_and_sanitize_file(computed_file_path) -> pd.DataFrame:
     return data
 
 
-def process_frame(work_dir, computed_file, sample_accession_code, aggregate_by) -> pd.DataFrame:
-    """Downloads the computed file from S3 and tries to see if it's smashable.
-    Returns a data frame if the file can be processed or False otherwise."""
+def _sync_frame_file(work_dir, computed_file) -> str:
+    """Downloads the computed file from S3 into work_dir.
 
-    try:
-        # Download the file to a job-specific location so it
-        # won't disappear while we're using it.
-        computed_file_path = computed_file.get_synced_file_path(
-            path="%s%s" % (work_dir, computed_file.filename)
+    Returns the path to the file, or None if it couldn't be found."""
+    # Download the file to a job-specific location so it
+    # won't disappear while we're using it.
+    computed_file_path = computed_file.get_synced_file_path(
+        path="%s%s" % (work_dir, computed_file.filename)
+    )
+
+    # Bail appropriately if this isn't a real file.
+    if not computed_file_path or not os.path.exists(computed_file_path):
+        logger.warning(
+            "Smasher received non-existent file path.",
+            computed_file_path=computed_file_path,
+            computed_file_id=computed_file.id,
         )
+        return None
 
-        # Bail appropriately if this isn't a real file.
-        if not computed_file_path or not os.path.exists(computed_file_path):
-            logger.warning(
-                "Smasher received non-existent file path.",
-                computed_file_path=computed_file_path,
-                computed_file_id=computed_file.id,
-            )
-            return None
+    return computed_file_path
 
+
+def _parse_frame(
+    computed_file_path, computed_file_id, has_been_log2scaled, sample_accession_code, aggregate_by,
+) -> pd.DataFrame:
+    """Reads a downloaded computed file and tries to see if it's smashable.
+    Returns a data frame if the file can be processed or None otherwise.
+
+    This doesn't touch the database so that it can run in another process."""
+    try:
         data = _load_and_sanitize_file(computed_file_path)
 
         if len(data.columns) > 2:
@@ -195,20 +226,20 @@ def process_frame(work_dir, computed_file, sample_accession_code, aggregate_by)
             logger.info(
                 "Found a frame with more than 2 columns - this shouldn't happen!",
                 computed_file_path=computed_file_path,
-                computed_file_id=computed_file.id,
+                computed_file_id=computed_file_id,
             )
             return None
 
         # via https://github.com/AlexsLemonade/refinebio/issues/330:
         #   aggregating by experiment -> return untransformed output from tximport
         #   aggregating by species -> log2(x + 1) tximport output
-        if aggregate_by == "SPECIES" and computed_file.has_been_log2scaled():
+        if aggregate_by == "SPECIES" and has_been_log2scaled:
             data = data + 1
             data = np.log2(data)
 
         # Ideally done in the NO-OPPER, but sanity check here.
-        if (not computed_file.has_been_log2scaled()) and (data.max() > 100).any():
-            logger.info("Detected non-log2 microarray data.", computed_file_id=computed_file.id)
+        if (not has_been_log2scaled) and (data.max() > 100).any():
+            logger.info("Detected non-log2 microarray data.", computed_file_id=computed_file_id)
             data = np.log2(data)
 
         # Explicitly title this dataframe
@@ -236,15 +267,193 @@ def process_frame(work_dir, computed_file, sample_accession_code, aggregate_by)
     except Exception:
         logger.exception("Unable to smash file", file=computed_file_path)
         return None
-    # TEMPORARY for iterating on compendia more quickly.
-    # finally:
-    #     # Delete before archiving the work dir
-    #     if computed_file_path and os.path.exists(computed_file_path):
-    #         os.remove(computed_file_path)
 
     return data
 
 
+def process_frame(work_dir, computed_file, sample_accession_code, aggregate_by) -> pd.DataFrame:
+    """Downloads the computed file from S3 and tries to see if it's smashable.
+    Returns a data frame if the file can be processed or None otherwise."""
+    try:
+        computed_file_path = _sync_frame_file(work_dir, computed_file)
+    except Exception:
+        logger.exception("Unable to smash file", computed_file_id=computed_file.id)
+        return None
+
+    if computed_file_path is None:
+        return None
+
+    return _parse_frame(
+        computed_file_path,
+        computed_file.id,
+        computed_file.has_been_log2scaled(),
+        sample_accession_code,
+        aggregate_by,
+    )
+
+
+def _fetch_and_parse_frame(
+    parse_pool, work_dir, computed_file, sample_accession_code, aggregate_by, cache=None
+) -> pd.DataFrame:
+    """Does the same thing as `process_frame`, but parses the file in `parse_pool`.
+
+    This runs in a thread so the download happens concurrently with
+    the downloads and parses of other files. If `cache` is a
+    FrameCache, frames are loaded from it instead of being downloaded
+    and parsed when they can be, and are added to it when they can't.
+    """
+    cache_key = None
+    try:
+        has_been_log2scaled = computed_file.has_been_log2scaled()
+
+        if cache:
+            cache_key = frame_cache.get_cache_key(
+                computed_file.sha1, aggregate_by, has_been_log2scaled
+            )
+        if cache_key:
+            frame_data = cache.get(cache_key, sample_accession_code)
+            if frame_data is not None:
+                return frame_data
+
+        computed_file_path = _sync_frame_file(work_dir, computed_file)
+    except Exception:
+        logger.exception("Unable to smash file", computed_file_id=computed_file.id)
+        return None
+
+    if computed_file_path is None:
+        return None
+
+    try:
+        frame_data = parse_pool.parse(
+            computed_file_path,
+            computed_file.id,
+            has_been_log2scaled,
+            sample_accession_code,
+            aggregate_by,
+        )
+    except Exception:
+        logger.exception("Unable to smash file", file=computed_file_path)
+        return None
+
+    if cache_key and frame_data is not None:
+        cache.put(cache_key, frame_data)
+
+    return frame_data
+
+
+class _ParsePool:
+    """The pool of processes that `iterate_frames` parses frames in.
+
+    The processes are spawned rather than forked: a process forked
+    while one of the downloading threads holds a lock (logging's, say)
+    would start with that lock held forever. If one of them dies,
+    probably because it ran out of memory, every frame still in the
+    pool fails with BrokenProcessPool, so the pool is replaced and each
+    of them is retried once in the new one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = self._create_executor()
+
+    @staticmethod
+    def _create_executor() -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=MULTIPROCESSING_MAX_THREAD_COUNT,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        )
+
+    def parse(self, *args) -> pd.DataFrame:
+        """Runs `_parse_frame(*args)` in one of the pool's processes."""
+        for attempt in range(2):
+            with self._lock:
+                executor = self._executor
+
+            try:
+                return executor.submit(_parse_frame, *args).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    # Another thread may have already replaced it.
+                    if self._executor is executor:
+                        logger.warning("A frame parsing process died, replacing the pool.")
+                        executor.shutdown(wait=False)
+                        self._executor = self._create_executor()
+
+                if attempt > 0:
+                    raise
+
+    def shutdown(self):
+        with self._lock:
+            self._executor.shutdown()
+
+
+def iterate_frames(
+    work_dir: str,
+    input_files: List[Tuple[ComputedFile, Sample]],
+    aggregate_by: str,
+    job_id: int = None,
+) -> Iterator[Tuple[ComputedFile, Sample, pd.DataFrame]]:
+    """Yields `(computed_file, sample, frame_data)` for each of `input_files`, in order.
+
+    `frame_data` is what `process_frame` would have returned for that
+    file. The files are downloaded in a pool of threads and parsed in
+    a pool of processes while earlier frames are being consumed. To
+    bound how much memory the frames waiting to be consumed can take
+    up, no more than FRAME_PIPELINE_MEMORY_BUDGET bytes worth of
+    computed files are in flight at once.
+
+    Frames that are in the frame cache aren't downloaded or parsed at
+    all. How many were is logged once all the frames have been yielded.
+    """
+    cache = frame_cache.get_frame_cache()
+    # The cache is shared by every job this process runs.
+    if cache:
+        hits_before, misses_before = cache.hits, cache.misses
+
+    # The parsing processes are only kept for as long as the frames are being iterated.
+    parse_pool = _ParsePool()
+    try:
+        with ThreadPoolExecutor(max_workers=FRAME_PIPELINE_THREAD_COUNT) as fetch_pool:
+            in_flight = deque()
+            in_flight_bytes = 0
+
+            for computed_file, sample in input_files:
+                frame_bytes = computed_file.size_in_bytes or DEFAULT_FRAME_SIZE_IN_BYTES
+
+                # There always needs to be at least one frame in flight.
+                while in_flight and in_flight_bytes + frame_bytes > FRAME_PIPELINE_MEMORY_BUDGET:
+                    done_file, done_sample, done_bytes, done_future = in_flight.popleft()
+                    in_flight_bytes -= done_bytes
+                    yield done_file, done_sample, done_future.result()
+
+                future = fetch_pool.submit(
+                    _fetch_and_parse_frame,
+                    parse_pool,
+                    work_dir,
+                    computed_file,
+                    sample.accession_code,
+                    aggregate_by,
+                    cache,
+                )
+                in_flight.append((computed_file, sample, frame_bytes, future))
+                in_flight_bytes += frame_bytes
+
+            while in_flight:
+                done_file, done_sample, _, done_future = in_flight.popleft()
+                yield done_file, done_sample, done_future.result()
+    finally:
+        parse_pool.shutdown()
+
+    if cache:
+        logger.info(
+            "Finished loading frames.",
+            job_id=job_id,
+            frame_cache_hits=cache.hits - hits_before,
+            frame_cache_misses=cache.misses - misses_before,
+        )
+
+
 def load_first_pass_data_if_cached(work_dir: str):
     path = os.path.join(work_dir, "first_pass.csv")
     try:
@@ -287,6 +496,35 @@ def cache_first_pass(
         )
 
 
+def _spill_frame(spill_dir: str, index: int, gene_codes: np.ndarray, values: np.ndarray):
+    """Writes a parsed frame to `spill_dir` as a vector of gene identifier
+    codes and a float32 vector of values."""
+    np.save(os.path.join(spill_dir, "{}_genes.npy".format(index)), gene_codes)
+    np.save(os.path.join(spill_dir, "{}_values.npy".format(index)), values.astype(np.float32))
+
+
+def _load_spilled_frame(
+    spill_dir: str, index: int, gene_code_rows: np.ndarray, num_rows: int
+) -> np.ndarray:
+    """Reads a frame written by `_spill_frame` back as a column of the matrix.
+
+    `gene_code_rows` maps each gene identifier code to its row in the
+    matrix, or -1 if that gene identifier isn't in the matrix. Rows
+    the frame didn't have a value for are NaN, just like `reindex`
+    would have left them.
+    """
+    gene_codes = np.load(os.path.join(spill_dir, "{}_genes.npy".format(index)))
+    values = np.load(os.path.join(spill_dir, "{}_values.npy".format(index)))
+
+    rows = gene_code_rows[gene_codes]
+    kept = rows >= 0
+
+    column_data = np.full(num_rows, np.nan, dtype=np.float32)
+    column_data[rows[kept]] = values[kept]
+
+    return column_data
+
+
 def process_frames_for_key(
     key: str, input_files: List[Tuple[ComputedFile, Sample]], job_context: Dict
 ) -> Dict:
@@ -296,8 +534,15 @@ def process_frames_for_key(
 
     Will add to job_context the keys 'microarray_matrix' and
     'rnaseq_matrix' with pandas dataframes containing all of the
-    samples' data. Also adds the key 'unsmashable_files' containing a
-    list of paths that were determined to be unsmashable.
+    samples' data. If job_context has a 'memory_budget', these will be
+    MemmapMatrix objects stored in job_context['matrix_dir'] instead.
+    Also adds the key 'unsmashable_files' containing a list of paths
+    that were determined to be unsmashable.
+
+    Each file is only downloaded and parsed once: the first pass
+    spills every frame to `work_dir` so the second pass can fill the
+    matrices from there. If the first pass was cached by a previous
+    job, the files are parsed during the second pass instead.
     """
 
     start_gene_ids = log_state(
@@ -311,6 +556,13 @@ def process_frames_for_key(
     cached_data = load_first_pass_data_if_cached(job_context["work_dir"])
     first_pass_was_cached = False
 
+    spill_dir = os.path.join(job_context["work_dir"], "frame_spill", key)
+    # Maps each gene identifier we've seen to the integer code used
+    # for it in the spilled frames.
+    gene_identifier_codes = {}
+    # The indexes into `input_files` of the frames we spilled.
+    spilled_frames = set()
+
     if cached_data:
         logger.info(
             (
@@ -327,14 +579,21 @@ def process_frames_for_key(
         gene_identifier_counts = {}
         microarray_columns = []
         rnaseq_columns = []
-        for index, (computed_file, sample) in enumerate(input_files):
+
+        # Every parsed frame gets spilled to disk so that the matrices
+        # can be built without downloading and parsing each file a
+        # second time.
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        os.makedirs(spill_dir)
+
+        frames = iterate_frames(
+            job_context["work_dir"],
+            input_files,
+            job_context["dataset"].aggregate_by,
+            job_context["job"].id,
+        )
+        for index, (computed_file, sample, frame_data) in enumerate(frames):
             log_state("1st processing frame {}".format(index), job_context["job"].id)
-            frame_data = process_frame(
-                job_context["work_dir"],
-                computed_file,
-                sample.accession_code,
-                job_context["dataset"].aggregate_by,
-            )
 
             if frame_data is None:
                 # we were unable to process this sample, so we drop
@@ -358,11 +617,18 @@ def process_frames_for_key(
 
             # Count how many frames are in each tech so we can preallocate
             # the matrices in both directions.
-            for gene_id in frame_data.index:
+            gene_codes = np.empty(len(frame_data.index), dtype=np.int32)
+            for position, gene_id in enumerate(frame_data.index):
                 if gene_id in gene_identifier_counts:
                     gene_identifier_counts[gene_id] += 1
                 else:
                     gene_identifier_counts[gene_id] = 1
+                    gene_identifier_codes[gene_id] = len(gene_identifier_codes)
+
+                gene_codes[position] = gene_identifier_codes[gene_id]
+
+            _spill_frame(spill_dir, index, gene_codes, frame_data.values[:, 0])
+            spilled_frames.add(index)
 
             # Each dataframe should only have 1 column, but it's
             # returned as a list so use extend.
@@ -412,23 +678,58 @@ def process_frames_for_key(
     # Preallocate the matrices to be the exact size we will need. This
     # should prevent any operations from happening while we build it
     # up, so the only RAM used will be needed.
-    job_context["microarray_matrix"] = pd.DataFrame(
-        data=None, index=all_gene_identifiers, columns=microarray_columns, dtype=np.float32
-    )
-    job_context["rnaseq_matrix"] = pd.DataFrame(
-        data=None, index=all_gene_identifiers, columns=rnaseq_columns, dtype=np.float32
-    )
+    if job_context.get("memory_budget"):
+        # We're not going to hold the matrices in RAM at all.
+        job_context["microarray_matrix"] = MemmapMatrix(
+            os.path.join(job_context["matrix_dir"], key + "_microarray_matrix.dat"),
+            all_gene_identifiers,
+            microarray_columns,
+        )
+        job_context["rnaseq_matrix"] = MemmapMatrix(
+            os.path.join(job_context["matrix_dir"], key + "_rnaseq_matrix.dat"),
+            all_gene_identifiers,
+            rnaseq_columns,
+        )
+    else:
+        job_context["microarray_matrix"] = pd.DataFrame(
+            data=None, index=all_gene_identifiers, columns=microarray_columns, dtype=np.float32
+        )
+        job_context["rnaseq_matrix"] = pd.DataFrame(
+            data=None, index=all_gene_identifiers, columns=rnaseq_columns, dtype=np.float32
+        )
 
-    for index, (computed_file, sample) in enumerate(input_files):
-        log_state("2nd processing frame {}".format(index), job_context["job"].id)
-        frame_data = process_frame(
+    # Maps the code of every gene identifier we kept to its row in
+    # the matrices, or -1 if it was dropped.
+    gene_code_rows = np.full(len(gene_identifier_codes), -1, dtype=np.int64)
+    for row, gene_id in enumerate(all_gene_identifiers):
+        if gene_id in gene_identifier_codes:
+            gene_code_rows[gene_identifier_codes[gene_id]] = row
+
+    if first_pass_was_cached:
+        # We didn't parse anything in this job, so we have to do it now.
+        frames = iterate_frames(
             job_context["work_dir"],
-            computed_file,
-            sample.accession_code,
+            input_files,
             job_context["dataset"].aggregate_by,
+            job_context["job"].id,
         )
+    else:
+        frames = ((computed_file, sample, None) for (computed_file, sample) in input_files)
+
+    for index, (computed_file, sample, frame_data) in enumerate(frames):
+        log_state("2nd processing frame {}".format(index), job_context["job"].id)
+        if index in spilled_frames:
+            column_data = _load_spilled_frame(
+                spill_dir, index, gene_code_rows, len(all_gene_identifiers)
+            )
+        elif frame_data is not None:
+            column_data = frame_data.reindex(all_gene_identifiers).values
+        else:
+            # Either this frame already failed during the first pass,
+            # so there was no point in trying again, or it just failed.
+            column_data = None
 
-        if frame_data is None:
+        if column_data is None:
             job_context["unsmashable_files"].append(computed_file.filename)
             sample_metadata = sample.to_metadata_dict()
             job_context["filtered_samples"][sample.accession_code] = {
@@ -441,15 +742,15 @@ def process_frames_for_key(
             }
             continue
 
-        frame_data = frame_data.reindex(all_gene_identifiers)
-
-        # The dataframe for each sample will only have one column
-        # whose header will be the accession code.
-        column = frame_data.columns[0]
+        # The dataframe for each sample only had one column whose
+        # header was the accession code.
+        column = sample.accession_code
         if sample.technology == "MICROARRAY":
-            job_context["microarray_matrix"][column] = frame_data.values
+            job_context["microarray_matrix"][column] = column_data
         elif sample.technology == "RNA-SEQ":
-            job_context["rnaseq_matrix"][column] = frame_data.values
+            job_context["rnaseq_matrix"][column] = column_data
+
+    shutil.rmtree(spill_dir, ignore_errors=True)
 
     job_context["num_samples"] = 0
     if job_context["microarray_matrix"] is not None:
@@ -507,6 +808,126 @@ def _quantile_normalize_matrix(target_vector, original_matrix):
     return new_merged
 
 
+def _quantile_normalize_column(column: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """Quantile normalizes a single column to `target`, which must be
+    sorted and free of NaNs.
+
+    This follows what preprocessCore's normalize_quantiles_use_target
+    does: tied values get the average of their ranks, NaNs are left
+    alone, and if the column doesn't have exactly one non-NaN value
+    for each value of the target then the target is linearly
+    interpolated at the column's percentiles.
+    """
+    present = ~np.isnan(column)
+    values = column[present].astype(np.float64)
+    num_present = values.shape[0]
+    num_targets = target.shape[0]
+
+    normalized = np.full(column.shape, np.nan)
+    if num_present == 0:
+        return normalized
+
+    order = np.argsort(values, kind="mergesort")
+    sorted_values = values[order]
+
+    # Tied values share the average of their (1-based) ranks.
+    group_starts = np.concatenate(([True], sorted_values[1:] != sorted_values[:-1]))
+    start_positions = np.flatnonzero(group_starts)
+    end_positions = np.append(start_positions[1:], num_present)
+    group_ranks = (start_positions + end_positions + 1) / 2.0
+    ranks = group_ranks[np.cumsum(group_starts) - 1]
+
+    if num_present == column.shape[0] == num_targets:
+        floor_ranks = np.floor(ranks).astype(np.int64)
+        lower = target[floor_ranks - 1]
+        upper = target[np.minimum(floor_ranks, num_targets - 1)]
+        sorted_normalized = np.where(ranks - floor_ranks > 0.4, 0.5 * (lower + upper), lower)
+    elif num_present == 1:
+        sorted_normalized = target[:1]
+    else:
+        sample_percentiles = (ranks - 1) / (num_present - 1)
+        target_indexes = 1.0 + (num_targets - 1.0) * sample_percentiles
+        floor_indexes = np.floor(target_indexes + 4 * np.finfo(np.float64).eps)
+        deltas = target_indexes - floor_indexes
+        deltas[np.abs(deltas) <= 4 * np.finfo(np.float64).eps] = 0.0
+
+        lower = target[np.clip(floor_indexes.astype(np.int64) - 1, 0, num_targets - 1)]
+        upper = target[np.clip(floor_indexes.astype(np.int64), 0, num_targets - 1)]
+        sorted_normalized = np.where(deltas == 0.0, lower, (1.0 - deltas) * lower + deltas * upper)
+        sorted_normalized[floor_indexes >= num_targets] = target[-1]
+        sorted_normalized[floor_indexes < 1] = target[0]
+
+    present_normalized = np.empty(num_present)
+    present_normalized[order] = sorted_normalized
+    normalized[present] = present_normalized
+
+    return normalized
+
+
+def _quantile_normalize_columns(matrix: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """Quantile normalizes every column of `matrix` to `target` in place."""
+    for i in range(matrix.shape[1]):
+        matrix[:, i] = _quantile_normalize_column(matrix[:, i], target)
+
+    return matrix
+
+
+def _quantile_normalize_matrix_numpy(target_vector, original_matrix, processes=1):
+    """Quantile normalizes `original_matrix` to `target_vector` without going through R.
+
+    This gives the same results as `_quantile_normalize_matrix`, but
+    writes them straight into the matrix's float32 values instead of
+    copying every chunk into and out of R. If `processes` is more than
+    one, the columns are split up between that many processes.
+    """
+    target = np.sort(np.asarray(target_vector, dtype=np.float64))
+    target = target[~np.isnan(target)]
+
+    values = original_matrix.values
+    if values.dtype != np.float32 or not values.flags.writeable:
+        values = values.astype(np.float32)
+
+    num_columns = values.shape[1]
+    if processes <= 1 or num_columns <= 1:
+        _quantile_normalize_columns(values, target)
+    else:
+        chunk_size = math.ceil(num_columns / processes)
+        starts = range(0, num_columns, chunk_size)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunks = executor.map(
+                _quantile_normalize_columns,
+                [values[:, start : start + chunk_size] for start in starts],
+                itertools.repeat(target),
+            )
+            for start, chunk in zip(starts, chunks):
+                values[:, start : start + chunk_size] = chunk
+
+    return pd.DataFrame(
+        values, columns=original_matrix.columns, index=original_matrix.index, copy=False
+    )
+
+
+def _quantile_normalize_memmap_matrix(
+    target_vector, original_matrix: MemmapMatrix, memory_budget: int
+) -> pd.DataFrame:
+    """Quantile normalizes `original_matrix` to `target_vector` in place, a
+    block of columns at a time.
+
+    Each column is normalized to the target on its own, so this gives
+    the same results as `_quantile_normalize_matrix_numpy` while only
+    holding `memory_budget` bytes worth of columns in memory.
+    """
+    target = np.sort(np.asarray(target_vector, dtype=np.float64))
+    target = target[~np.isnan(target)]
+
+    block_size = original_matrix.block_size(memory_budget, copies=2)
+    for start, end in original_matrix.column_blocks(block_size):
+        block = np.array(original_matrix.values[:, start:end])
+        original_matrix.values[:, start:end] = _quantile_normalize_columns(block, target)
+
+    return original_matrix.to_dataframe()
+
+
 def _test_qn(merged_matrix):
     """Selects a list of 100 random pairs of columns and performs the KS Test on them.
     Returns a list of tuples with the results of the KN test (statistic, pvalue)"""
@@ -528,28 +949,31 @@ def _test_qn(merged_matrix):
         np.random.shuffle(indexes)
         combos = np.array([*zip(indexes[0:100], indexes[100:200])])
 
+    combos = combos[:100]
+
+    # RNA-seq has a lot of zeroes in it, which
+    # breaks the ks_test. Therefore we want to
+    # filter them out. To do this we drop the
+    # lowest half of the values. If there's
+    # still zeroes in there, then that's
+    # probably too many zeroes so it's okay to
+    # fail. The medians of all of the selected
+    # columns are computed at once.
+    selected_columns = np.unique(combos)
+    selected_values = merged_matrix.iloc[:, selected_columns].values
+    above_median = selected_values > np.median(selected_values, axis=0)
+    positions = {column: position for position, column in enumerate(selected_columns)}
+
     result = []
     # adapted from
     # https://stackoverflow.com/questions/9661469/r-t-test-over-all-columns
     # apply KS test to randomly selected pairs of columns (samples)
-    for i in range(min(combos.shape[0], 100)):
-        column_a_index = combos[i][0]
-        column_b_index = combos[i][1]
-
-        column_a = merged_matrix.iloc[:, column_a_index]
-        column_b = merged_matrix.iloc[:, column_b_index]
-
-        # RNA-seq has a lot of zeroes in it, which
-        # breaks the ks_test. Therefore we want to
-        # filter them out. To do this we drop the
-        # lowest half of the values. If there's
-        # still zeroes in there, then that's
-        # probably too many zeroes so it's okay to
-        # fail.
-        median_a = np.median(column_a)
-        median_b = np.median(column_b)
-        test_a = [column_a[i] for i in range(len(column_a)) if column_a[i] > median_a]
-        test_b = [column_b[i] for i in range(len(column_b)) if column_b[i] > median_b]
+    for column_a_index, column_b_index in combos:
+        position_a = positions[column_a_index]
+        position_b = positions[column_b_index]
+
+        test_a = selected_values[above_median[:, position_a], position_a]
+        test_b = selected_values[above_median[:, position_b], position_b]
 
         ks_res = scipy.stats.kstest(test_a, test_b)
         statistic = ks_res.statistic
@@ -580,15 +1004,25 @@ def quantile_normalize(job_context: Dict, ks_stat=0.001) -> Dict:
         qn_target_path, sep="\t", header=None, index_col=None, error_bad_lines=False
     )
 
-    # Prepare our RPy2 bridge
-    pandas2ri.activate()
-
     # Remove un-quantiled normalized matrix from job_context
     # because we no longer need it.
     merged_no_qn = job_context.pop("merged_no_qn")
 
     # Perform the Actual QN
-    new_merged = _quantile_normalize_matrix(qn_target_frame[0], merged_no_qn)
+    if isinstance(merged_no_qn, MemmapMatrix):
+        # It's too big to hold in memory, let alone copy into R.
+        new_merged = _quantile_normalize_memmap_matrix(
+            qn_target_frame[0], merged_no_qn, job_context["memory_budget"]
+        )
+    elif job_context["dataset"].qn_engine == "NUMPY":
+        new_merged = _quantile_normalize_matrix_numpy(
+            qn_target_frame[0], merged_no_qn, processes=MULTIPROCESSING_MAX_THREAD_COUNT
+        )
+    else:
+        # Prepare our RPy2 bridge
+        pandas2ri.activate()
+
+        new_merged = _quantile_normalize_matrix(qn_target_frame[0], merged_no_qn)
 
     # And add the quantile normalized matrix to job_context.
     job_context["merged_qn"] = new_merged
@@ -618,6 +1052,89 @@ def quantile_normalize(job_context: Dict, ks_stat=0.001) -> Dict:
     return job_context
 
 
+def write_expression_matrix(matrix: pd.DataFrame, output_path_base: str, output_format: str) -> str:
+    """Writes `matrix`, which has genes as rows and samples as columns, to disk.
+
+    For the TSV format this writes `<output_path_base>.tsv`. For the
+    NPY format this writes the values as a float32 array to
+    `<output_path_base>.npy`, which can be read back memory-mapped with
+    `np.load(path, mmap_mode="r")`, along with the gene and sample
+    labels to `<output_path_base>_genes.txt` and
+    `<output_path_base>_samples.txt`, one per line.
+
+    Returns the path to the file containing the values.
+    """
+    if output_format == "NPY":
+        outfile = output_path_base + ".npy"
+        np.save(outfile, matrix.values.astype(np.float32, copy=False))
+
+        with open(output_path_base + "_genes.txt", "w", encoding="utf-8") as genes_file:
+            genes_file.writelines(str(gene) + "\n" for gene in matrix.index)
+        with open(output_path_base + "_samples.txt", "w", encoding="utf-8") as samples_file:
+            samples_file.writelines(str(sample) + "\n" for sample in matrix.columns)
+    else:
+        outfile = output_path_base + ".tsv"
+        matrix.to_csv(outfile, sep="\t", encoding="utf-8")
+
+    return outfile
+
+
+def _get_most_recent_result_files(sample_ids: List[int], quant_sf_only: bool) -> Dict:
+    """Finds the file `compile_metadata` describes for each of `sample_ids` at once.
+
+    This is the same file that `Sample.get_most_recent_quant_sf_file`
+    or `Sample.get_most_recent_smashable_result_file` would return,
+    keyed by sample id.
+    """
+    if quant_sf_only:
+        computed_files = ComputedFile.objects.filter(
+            result__samples__id__in=sample_ids,
+            filename="quant.sf",
+            s3_key__isnull=False,
+            s3_bucket__isnull=False,
+        ).annotate(metadata_sample_id=F("result__samples__id"))
+    else:
+        computed_files = ComputedFile.objects.filter(
+            samples__id__in=sample_ids, is_public=True, is_smashable=True
+        )
+        if settings.RUNNING_IN_CLOUD:
+            computed_files = computed_files.filter(s3_bucket__isnull=False, s3_key__isnull=False)
+        computed_files = computed_files.annotate(metadata_sample_id=F("samples__id"))
+
+    most_recent_files = {}
+    for computed_file in computed_files.select_related("result__processor").order_by("created_at"):
+        # Ordered oldest first, so the latest file for each sample wins.
+        most_recent_files[computed_file.metadata_sample_id] = computed_file
+
+    return most_recent_files
+
+
+def get_sample_attributes(sample_accession_codes: List[str]) -> Dict[str, List[SampleAttribute]]:
+    """Loads the contributed attributes of all of `sample_accession_codes`.
+
+    Returns a dict mapping each accession code to its list of
+    attributes, with everything their keys and values are rendered from
+    already loaded.
+    """
+    sample_accession_codes = list(sample_accession_codes)
+    sample_attributes = {accession_code: [] for accession_code in sample_accession_codes}
+
+    for page in range(0, len(sample_accession_codes), PAGE_SIZE):
+        attribute_page = list(
+            SampleAttribute.objects.filter(
+                sample__accession_code__in=sample_accession_codes[page : page + PAGE_SIZE]
+            )
+            .select_related("sample", "source", "name", "unit")
+            .order_by("id")
+        )
+        SampleAttribute.prefetch_values(attribute_page)
+
+        for attribute in attribute_page:
+            sample_attributes[attribute.sample.accession_code].append(attribute)
+
+    return sample_attributes
+
+
 def compile_metadata(job_context: Dict) -> Dict:
     """Compiles metadata about the job.
 
@@ -627,6 +1144,7 @@ def compile_metadata(job_context: Dict) -> Dict:
 
     metadata["num_experiments"] = job_context["experiments"].count()
     metadata["quant_sf_only"] = job_context["dataset"].quant_sf_only
+    metadata["output_format"] = job_context["dataset"].output_format
 
     if "compendium_version" in job_context:
         metadata["compendium_version"] = job_context["compendium_version"]
@@ -653,25 +1171,29 @@ def compile_metadata(job_context: Dict) -> Dict:
 
     samples = {}
     for page in range(0, len(all_sample_accessions), PAGE_SIZE):
-        sample_page = Sample.objects.filter(
-            accession_code__in=all_sample_accessions[page : page + PAGE_SIZE]
+        sample_page = (
+            Sample.objects.filter(accession_code__in=all_sample_accessions[page : page + PAGE_SIZE])
+            .select_related("organism")
+            .prefetch_related("sampleannotation_set")
+        )
+        # skip the samples that were filtered
+        sample_page = [
+            sample for sample in sample_page if sample.accession_code not in filtered_samples
+        ]
+
+        computed_files = _get_most_recent_result_files(
+            [sample.id for sample in sample_page], quant_sf_only
         )
         for sample in sample_page:
-            if sample.accession_code in filtered_samples:
-                # skip the samples that were filtered
-                continue
-            computed_file = None
-            if quant_sf_only:
-                computed_file = sample.get_most_recent_quant_sf_file()
-            else:
-                computed_file = sample.get_most_recent_smashable_result_file()
-            samples[sample.accession_code] = sample.to_metadata_dict(computed_file)
+            samples[sample.accession_code] = sample.to_metadata_dict(computed_files.get(sample.id))
 
     metadata["samples"] = samples
     metadata["num_samples"] = len(metadata["samples"])
 
     experiments = {}
-    for experiment in job_context["dataset"].get_experiments():
+    for experiment in (
+        job_context["dataset"].get_experiments().prefetch_related("organisms", "samples")
+    ):
         experiment_metadata = experiment.to_metadata_dict()
         # exclude filtered samples from experiment metadata
         all_samples = experiment_metadata["sample_accession_codes"]
@@ -716,7 +1238,11 @@ def write_non_data_files(job_context: Dict) -> Dict:
             with open(filtered_samples_path, "w", encoding="utf-8") as metadata_file:
                 json.dump(job_context["filtered_samples"], metadata_file, indent=4, sort_keys=True)
 
-            columns = get_tsv_columns(job_context["filtered_samples"])
+            filtered_sample_attributes = get_sample_attributes(
+                job_context["filtered_samples"].keys()
+            )
+            experiment_accessions = get_experiment_accessions(job_context["dataset"].data)
+            columns = get_tsv_columns(job_context["filtered_samples"], filtered_sample_attributes)
             filtered_samples_tsv_path = os.path.join(
                 job_context["output_dir"], "filtered_samples_metadata.tsv"
             )
@@ -724,7 +1250,14 @@ def write_non_data_files(job_context: Dict) -> Dict:
                 dw = csv.DictWriter(tsv_file, columns, delimiter="\t", extrasaction="ignore")
                 dw.writeheader()
                 for sample_metadata in job_context["filtered_samples"].values():
-                    dw.writerow(get_tsv_row_data(sample_metadata, job_context["dataset"].data))
+                    dw.writerow(
+                        get_tsv_row_data(
+                            sample_metadata,
+                            job_context["dataset"].data,
+                            filtered_sample_attributes,
+                            experiment_accessions,
+                        )
+                    )
     except Exception:
         raise utils.ProcessorJobError("Failed to write metadata TSV!", success=False)
 
@@ -738,6 +1271,18 @@ def get_experiment_accession(sample_accession_code, dataset_data):
     return ""  # Should never happen, because the sample is by definition in the dataset
 
 
+def get_experiment_accessions(dataset_data) -> Dict[str, str]:
+    """Builds a map from each sample accession code in `dataset_data` to
+    what `get_experiment_accession` would return for it, so each sample
+    doesn't need to scan every experiment."""
+    experiment_accessions = {}
+    for experiment_accession, samples in dataset_data.items():
+        for sample_accession_code in samples:
+            experiment_accessions.setdefault(sample_accession_code, experiment_accession)
+
+    return experiment_accessions
+
+
 def _add_annotation_column(annotation_columns, column_name):
     """Add annotation column names in place.
     Any column_name that starts with "refinebio_" will be skipped.
@@ -773,11 +1318,18 @@ def _add_annotation_value(row_data, col_name, col_value, sample_accession_code):
         )
 
 
-def get_tsv_row_data(sample_metadata, dataset_data):
+def get_tsv_row_data(
+    sample_metadata, dataset_data, sample_attributes=None, experiment_accessions=None
+):
     """Returns field values based on input sample_metadata.
 
     Some annotation fields are treated specially because they are more
     important.  See `get_tsv_columns` function above for details.
+
+    `sample_attributes` and `experiment_accessions` should come from
+    `get_sample_attributes` and `get_experiment_accessions` when
+    writing more than one row, otherwise they're looked up for just
+    this sample.
     """
 
     sample_accession_code = sample_metadata.get("refinebio_accession_code", "")
@@ -859,7 +1411,10 @@ def get_tsv_row_data(sample_metadata, dataset_data):
                         row_data, annotation_key, annotation_value, sample_accession_code
                     )
 
-        for attribute in Sample.objects.get(accession_code=sample_accession_code).attributes.all():
+        if sample_attributes is None:
+            sample_attributes = get_sample_attributes([sample_accession_code])
+
+        for attribute in sample_attributes.get(sample_accession_code, []):
             attribute_key = f"{attribute.source.source_name}_{attribute.name.human_readable_name}"
             attribute_value = attribute.get_value()
             _add_annotation_value(row_data, attribute_key, attribute_value, sample_accession_code)
@@ -882,18 +1437,32 @@ def get_tsv_row_data(sample_metadata, dataset_data):
                     row_data, attribute_key, attribute_value, sample_accession_code
                 )
 
-    row_data["experiment_accession"] = get_experiment_accession(sample_accession_code, dataset_data)
+    if experiment_accessions is None:
+        row_data["experiment_accession"] = get_experiment_accession(
+            sample_accession_code, dataset_data
+        )
+    else:
+        row_data["experiment_accession"] = experiment_accessions.get(sample_accession_code, "")
 
     return row_data
 
 
-def get_tsv_columns(samples_metadata):
+def get_tsv_columns(samples_metadata, sample_attributes=None):
     """Returns an array of strings that will be written as a TSV file's
     header. The columns are based on fields found in samples_metadata.
 
     Some nested annotation fields are taken out as separate columns
     because they are more important than the others.
+
+    `sample_attributes` is loaded with `get_sample_attributes` if it
+    isn't provided.
     """
+    if sample_attributes is None:
+        sample_attributes = get_sample_attributes(
+            sample_metadata["refinebio_accession_code"]
+            for sample_metadata in samples_metadata.values()
+        )
+
     refinebio_columns = set()
     annotation_columns = set()
     for sample_metadata in samples_metadata.values():
@@ -949,9 +1518,7 @@ def get_tsv_columns(samples_metadata):
                     else:
                         _add_annotation_column(annotation_columns, annotation_key)
 
-        for attribute in Sample.objects.get(
-            accession_code=sample_metadata["refinebio_accession_code"]
-        ).attributes.all():
+        for attribute in sample_attributes.get(sample_metadata["refinebio_accession_code"], []):
             _add_annotation_column(
                 annotation_columns,
                 f"{attribute.source.source_name}_{attribute.name.human_readable_name}",
@@ -986,8 +1553,15 @@ def write_tsv_json(job_context):
     # Avoid pulling this out of job_context repeatedly.
     metadata = job_context["metadata"]
 
+    # Load everything the rows need up front rather than once per row.
+    sample_attributes = get_sample_attributes(
+        sample_metadata["refinebio_accession_code"]
+        for sample_metadata in metadata["samples"].values()
+    )
+    experiment_accessions = get_experiment_accessions(job_context["dataset"].data)
+
     # Uniform TSV header per dataset
-    columns = get_tsv_columns(metadata["samples"])
+    columns = get_tsv_columns(metadata["samples"], sample_attributes)
 
     # Per-Experiment Metadata
     if job_context["dataset"].aggregate_by == "EXPERIMENT":
@@ -1002,9 +1576,15 @@ def write_tsv_json(job_context):
             with open(tsv_path, "w", encoding="utf-8") as tsv_file:
                 dw = csv.DictWriter(tsv_file, columns, delimiter="\t", extrasaction="ignore")
                 dw.writeheader()
+                experiment_samples = set(experiment_data["sample_accession_codes"])
                 for sample_accession_code, sample_metadata in metadata["samples"].items():
-                    if sample_accession_code in experiment_data["sample_accession_codes"]:
-                        row_data = get_tsv_row_data(sample_metadata, job_context["dataset"].data)
+                    if sample_accession_code in experiment_samples:
+                        row_data = get_tsv_row_data(
+                            sample_metadata,
+                            job_context["dataset"].data,
+                            sample_attributes,
+                            experiment_accessions,
+                        )
                         dw.writerow(row_data)
         return tsv_paths
     # Per-Species Metadata
@@ -1024,13 +1604,18 @@ def write_tsv_json(job_context):
                 i = 0
                 for sample_metadata in metadata["samples"].values():
                     if sample_metadata.get("refinebio_organism", "") == species:
-                        row_data = get_tsv_row_data(sample_metadata, job_context["dataset"].data)
+                        row_data = get_tsv_row_data(
+                            sample_metadata,
+                            job_context["dataset"].data,
+                            sample_attributes,
+                            experiment_accessions,
+                        )
                         dw.writerow(row_data)
 
                         contributions = set()
-                        for attribute in Sample.objects.get(
-                            accession_code=sample_metadata["refinebio_accession_code"]
-                        ).attributes.all():
+                        for attribute in sample_attributes.get(
+                            sample_metadata["refinebio_accession_code"], []
+                        ):
                             sample_metadata[
                                 f"{attribute.source.source_name}_{attribute.name.human_readable_name}"
                             ] = attribute.to_dict()
@@ -1072,7 +1657,12 @@ def write_tsv_json(job_context):
             dw = csv.DictWriter(tsv_file, columns, delimiter="\t", extrasaction="ignore")
             dw.writeheader()
             for sample_metadata in metadata["samples"].values():
-                row_data = get_tsv_row_data(sample_metadata, job_context["dataset"].data)
+                row_data = get_tsv_row_data(
+                    sample_metadata,
+                    job_context["dataset"].data,
+                    sample_attributes,
+                    experiment_accessions,
+                )
                 dw.writerow(row_data)
         return [tsv_path]
 
@@ -0,0 +1,322 @@
+"""Zip archives that are compressed and uploaded while they're being written.
+
+`shutil.make_archive` needs the whole output directory on disk before
+it starts, and then the finished zip has to be uploaded on its own. A
+StreamingZipArchive instead compresses each file as soon as it's
+added, deflating large files in parallel, and writes the zip to any
+file-like sink. When that sink is an S3MultipartWriter the zip is
+uploaded a part at a time while the rest of it is still being built.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import shutil
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from data_refinery_common.logging import get_and_configure_logger
+
+logger = get_and_configure_logger(__name__)
+
+BYTES_IN_MB = 1024 * 1024
+# Files bigger than this are split into chunks that are deflated in parallel.
+PARALLEL_DEFLATE_MIN_BYTES = 16 * BYTES_IN_MB
+PARALLEL_DEFLATE_CHUNK_BYTES = 4 * BYTES_IN_MB
+PARALLEL_DEFLATE_THREADS = max(1, multiprocessing.cpu_count() - 1)
+# How much of the previous chunk deflate can refer back to.
+DEFLATE_WINDOW_BYTES = 32 * 1024
+COPY_BUFFER_BYTES = 1 * BYTES_IN_MB
+# S3 requires every part except the last to be at least 5MB, and
+# allows at most 10,000 parts, so this allows for archives up to ~320GB.
+MULTIPART_PART_BYTES = 32 * BYTES_IN_MB
+MULTIPART_CONCURRENCY = 4
+
+
+def _deflate_chunk(chunk: bytes, zdict: bytes, level: int, final: bool) -> bytes:
+    """Deflates `chunk` so that it can be concatenated onto the chunk before it.
+
+    Every chunk but the last ends with a sync flush so it ends on a
+    byte boundary without ending the deflate stream. Priming the
+    compressor with the end of the previous chunk lets it find matches
+    across the boundary, which keeps the ratio close to deflating the
+    whole file at once.
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return compressor.compress(chunk) + compressor.flush(
+        zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH
+    )
+
+
+class _ParallelDeflater:
+    """A stand-in for the zlib compressobj zipfile uses that deflates
+    chunks of its input in a pool of threads.
+
+    zlib releases the GIL while it compresses so the threads really do
+    run in parallel.
+    """
+
+    def __init__(self, pool: ThreadPoolExecutor, level: int, chunk_size: int, max_pending: int):
+        self._pool = pool
+        self._level = level
+        self._chunk_size = chunk_size
+        self._max_pending = max_pending
+        self._buffer = bytearray()
+        self._previous_chunk = b""
+        self._pending = deque()
+
+    def _submit(self, chunk: bytes, final: bool):
+        zdict = self._previous_chunk[-DEFLATE_WINDOW_BYTES:]
+        self._previous_chunk = chunk
+        self._pending.append(self._pool.submit(_deflate_chunk, chunk, zdict, self._level, final))
+
+    def _collect(self, max_pending: int) -> bytes:
+        """Returns the deflated chunks that are ready, in order, waiting
+        for the oldest ones until no more than `max_pending` are left."""
+        deflated = []
+        while self._pending and (len(self._pending) > max_pending or self._pending[0].done()):
+            deflated.append(self._pending.popleft().result())
+
+        return b"".join(deflated)
+
+    def compress(self, data: bytes) -> bytes:
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self._submit(bytes(self._buffer[: self._chunk_size]), final=False)
+            del self._buffer[: self._chunk_size]
+
+        return self._collect(self._max_pending)
+
+    def flush(self) -> bytes:
+        self._submit(bytes(self._buffer), final=True)
+        self._buffer = bytearray()
+        return self._collect(0)
+
+
+class _HashingWriter:
+    """Passes writes through to `sink` while keeping track of the sha1
+    and size of everything written.
+
+    It can `tell` but not `seek`, so zipfile writes the archive as a
+    stream."""
+
+    def __init__(self, sink):
+        self._sink = sink
+        self._sha1 = hashlib.sha1()
+        self.size_in_bytes = 0
+
+    def write(self, data) -> int:
+        self._sha1.update(data)
+        self.size_in_bytes += len(data)
+        self._sink.write(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.size_in_bytes
+
+    def flush(self):
+        if hasattr(self._sink, "flush"):
+            self._sink.flush()
+
+    @property
+    def sha1(self) -> str:
+        return self._sha1.hexdigest()
+
+
+class S3MultipartWriter:
+    """A write-only file object that uploads what's written to it to S3
+    as a multipart upload.
+
+    Parts are uploaded in the background as soon as they're full, and
+    the upload is completed when the writer is closed.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        key: str,
+        part_size: int = MULTIPART_PART_BYTES,
+        max_concurrency: int = MULTIPART_CONCURRENCY,
+    ):
+        self._s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self._part_size = part_size
+        self._max_concurrency = max_concurrency
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._parts = []
+        self._next_part_number = 1
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        self._upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def _upload_part(self, part_number: int, body: bytes) -> dict:
+        response = self._s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self._upload_id,
+            Body=body,
+        )
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    def _submit_part(self, body: bytes):
+        self._pending.append(self._pool.submit(self._upload_part, self._next_part_number, body))
+        self._next_part_number += 1
+
+        # Don't hold more parts in memory than can be uploaded at once.
+        while len(self._pending) > self._max_concurrency:
+            self._parts.append(self._pending.popleft().result())
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._part_size:
+            self._submit_part(bytes(self._buffer[: self._part_size]))
+            del self._buffer[: self._part_size]
+
+        return len(data)
+
+    def close(self):
+        """Uploads the last part and completes the upload."""
+        # Even an empty upload needs one part.
+        if self._buffer or self._next_part_number == 1:
+            self._submit_part(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        while self._pending:
+            self._parts.append(self._pending.popleft().result())
+        self._pool.shutdown()
+
+        self._s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+
+    def abort(self):
+        """Throws away everything that has been uploaded."""
+        self._pool.shutdown()
+        try:
+            self._s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+        except Exception:
+            logger.exception("Unable to abort multipart upload.", bucket=self.bucket, key=self.key)
+
+
+class StreamingZipArchive:
+    """A zip archive that's written to `sink` as files are added to it.
+
+    `sink` can be any object with a `write` method, such as a file
+    opened for writing or an S3MultipartWriter. It is closed when the
+    archive is. Once the archive is closed its `size_in_bytes` and
+    `sha1` are available without having to read it back.
+    """
+
+    def __init__(
+        self,
+        sink,
+        parallel_deflate_min_bytes: int = PARALLEL_DEFLATE_MIN_BYTES,
+        chunk_size: int = PARALLEL_DEFLATE_CHUNK_BYTES,
+        threads: int = PARALLEL_DEFLATE_THREADS,
+    ):
+        self._sink = sink
+        self._writer = _HashingWriter(sink)
+        self._zip = zipfile.ZipFile(self._writer, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        self._parallel_deflate_min_bytes = parallel_deflate_min_bytes
+        self._chunk_size = chunk_size
+        self._threads = threads
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self.archived = set()
+        self.size_in_bytes = None
+        self.sha1 = None
+
+    def add_file(self, path: str, arcname: str):
+        """Compresses the file at `path` into the archive as `arcname`."""
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+        if zinfo.is_dir():
+            self._zip.write(path, arcname)
+        else:
+            with open(path, "rb") as source, self._zip.open(zinfo, "w") as member:
+                if zinfo.file_size >= self._parallel_deflate_min_bytes:
+                    self._use_parallel_deflater(member, arcname)
+                shutil.copyfileobj(source, member, COPY_BUFFER_BYTES)
+
+        self.archived.add(zinfo.filename)
+
+    def _use_parallel_deflater(self, member, arcname: str):
+        """Swaps the compressor zipfile made for `member` for a _ParallelDeflater.
+
+        zipfile doesn't have a way to plug in a different compressor,
+        so this relies on how its member writer works. If that ever
+        changes the member is deflated serially by zipfile instead.
+        """
+        compressor = getattr(member, "_compressor", None)
+        if not (hasattr(compressor, "compress") and hasattr(compressor, "flush")):
+            logger.warning(
+                "Unable to deflate in parallel, falling back to zipfile's compressor.",
+                arcname=arcname,
+            )
+            return
+
+        member._compressor = _ParallelDeflater(
+            self._pool, zlib.Z_DEFAULT_COMPRESSION, self._chunk_size, max_pending=2 * self._threads,
+        )
+
+    def add_tree(self, root_dir: str, delete_files: bool = False):
+        """Adds everything under `root_dir` that isn't in the archive yet.
+
+        Paths in the archive are relative to `root_dir`, the same as
+        with `shutil.make_archive`. If `delete_files` is set, files are
+        deleted once they're in the archive so that the disk never has
+        to hold both copies.
+        """
+        for dirpath, dirnames, filenames in os.walk(root_dir):
+            dirnames.sort()
+            relative_dir = os.path.relpath(dirpath, root_dir)
+
+            for name in dirnames + sorted(filenames):
+                path = os.path.join(dirpath, name)
+                arcname = os.path.normpath(os.path.join(relative_dir, name))
+                if os.path.isdir(path):
+                    arcname += "/"
+
+                if arcname in self.archived:
+                    continue
+
+                self.add_file(path, arcname)
+                if delete_files and not os.path.isdir(path):
+                    os.remove(path)
+
+    def close(self):
+        """Finishes the archive and closes `sink`."""
+        self._zip.close()
+        self._pool.shutdown()
+        self._sink.close()
+
+        self.size_in_bytes = self._writer.size_in_bytes
+        self.sha1 = self._writer.sha1
+
+    def abort(self):
+        """Gives up on the archive, aborting the upload if `sink` is an S3MultipartWriter."""
+        try:
+            # Otherwise the ZipFile would try to finish itself when it's garbage collected.
+            self._zip.close()
+        except Exception:
+            pass
+        self._pool.shutdown()
+        if hasattr(self._sink, "abort"):
+            self._sink.abort()
+        else:
+            self._sink.close()
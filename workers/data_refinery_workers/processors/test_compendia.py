@@ -4,6 +4,7 @@ import json
 import math
 import os
 import random
+import shutil
 import zipfile
 from typing import Dict
 
@@ -28,7 +29,8 @@ from data_refinery_common.models import (
     SampleComputedFileAssociation,
     SampleResultAssociation,
 )
-from data_refinery_workers.processors import create_compendia, utils
+from data_refinery_workers.processors import create_compendia, smashing_utils, utils
+from data_refinery_workers.processors.memmap_matrix import MemmapMatrix
 from data_refinery_workers.processors.testing_utils import ProcessorJobTestCaseMixin
 
 
@@ -527,6 +529,225 @@ class CompendiaTestCase(TransactionTestCase, ProcessorJobTestCaseMixin):
         for v in final_job_context["filtered_samples"].values():
             self.assertIn("less than 50% present", v["reason"])
 
+    @tag("compendia")
+    def test_out_of_core_matches_in_memory(self):
+        """Make sure the memmap backend filters the same genes and samples"""
+        job = ProcessorJob()
+        job.pipeline_applied = ProcessorPipeline.CREATE_COMPENDIA.value
+        job.save()
+
+        danio_rerio = Organism(name="DANIO_RERIO", taxonomy_id=1)
+        danio_rerio.save()
+
+        experiment = Experiment()
+        experiment.accession_code = "GSE1234"
+        experiment.save()
+
+        microarray_samples = ["MA" + str(i) for i in range(0, 10)]
+        rnaseq_samples = ["RS" + str(i) for i in range(0, 10)]
+        for i in microarray_samples + rnaseq_samples:
+            create_sample_for_experiment(
+                {"organism": danio_rerio, "accession_code": i, "technology": "MICROARRAY"},
+                experiment,
+            )
+
+        dset = Dataset()
+        dset.data = {"GSE1234": "ALL"}
+        dset.scale_by = "NONE"
+        dset.aggregate_by = "SPECIES"
+        dset.svd_algorithm = "ARPACK"
+        dset.quantile_normalize = True
+        dset.save()
+
+        random_state = np.random.RandomState(0)
+        microarray_matrix = pd.DataFrame(
+            random_state.rand(100, 10).astype(np.float32),
+            index=[str(i) for i in range(0, 100)],
+            columns=microarray_samples,
+        )
+        microarray_matrix.values[random_state.rand(100, 10) < 0.2] = np.nan
+        microarray_matrix.iloc[:, 0] = np.nan
+
+        rnaseq_matrix = pd.DataFrame(
+            random_state.randint(0, 5, (100, 10)).astype(np.float32),
+            index=[str(i) for i in range(50, 150)],
+            columns=rnaseq_samples,
+        )
+        rnaseq_matrix.iloc[:, 1] = np.nan
+
+        work_dir = "/home/user/data_store/out_of_core_test/"
+        os.makedirs(work_dir, exist_ok=True)
+
+        out_of_core_context = {
+            "job": job,
+            "dataset": dset,
+            "filtered_samples": {},
+            # Small enough that every step has to go a few columns at a time.
+            "memory_budget": 100 * 4 * 4 * 3,
+            "matrix_dir": work_dir + "matrices/",
+        }
+        for key, matrix in [("microarray", microarray_matrix), ("rnaseq", rnaseq_matrix)]:
+            memmap_matrix = MemmapMatrix(
+                out_of_core_context["matrix_dir"] + key + "_matrix.dat",
+                matrix.index,
+                matrix.columns,
+            )
+            for column in matrix.columns:
+                memmap_matrix[column] = matrix[column].values
+            out_of_core_context[key + "_matrix"] = memmap_matrix
+
+        in_memory_context = {
+            "job": job,
+            "dataset": dset,
+            "filtered_samples": {},
+            "microarray_matrix": microarray_matrix.copy(),
+            "rnaseq_matrix": rnaseq_matrix.copy(),
+        }
+
+        in_memory_context = utils.run_pipeline(
+            in_memory_context,
+            [
+                create_compendia._filter_rnaseq_matrix,
+                create_compendia._log2_transform_matrix,
+                create_compendia._cached_remove_zeroes,
+                create_compendia._full_outer_join_gene_matrices,
+                create_compendia._filter_rows_and_columns,
+            ],
+        )
+        out_of_core_context = utils.run_pipeline(
+            out_of_core_context,
+            [
+                create_compendia._filter_rnaseq_matrix_out_of_core,
+                create_compendia._log2_transform_matrix_out_of_core,
+                create_compendia._cached_remove_zeroes_out_of_core,
+                create_compendia._full_outer_join_gene_matrices_out_of_core,
+                create_compendia._filter_rows_and_columns_out_of_core,
+            ],
+        )
+
+        expected = in_memory_context["row_col_filtered_matrix"]
+        actual = out_of_core_context["row_col_filtered_matrix"]
+        self.assertEqual(list(actual.index), list(expected.index))
+        self.assertEqual(list(actual.columns), list(expected.columns))
+        self.assertTrue(np.allclose(actual.values, expected.values, equal_nan=True))
+        self.assertEqual(
+            set(out_of_core_context["filtered_samples"].keys()),
+            set(in_memory_context["filtered_samples"].keys()),
+        )
+        for sample, zeroes in in_memory_context["cached_zeroes"].items():
+            self.assertEqual(list(out_of_core_context["cached_zeroes"][sample]), list(zeroes))
+
+        # Only the filtered matrix is left, everything before it was cleaned up.
+        self.assertEqual(
+            os.listdir(out_of_core_context["matrix_dir"]), ["row_col_filtered_matrix.dat"]
+        )
+
+        # The rest of the steps work on that matrix in place.
+        dset.svd_algorithm = "NONE"
+        in_memory_context = utils.run_pipeline(
+            in_memory_context,
+            [create_compendia._reset_zero_values, create_compendia._run_iterativesvd],
+        )
+        out_of_core_context = utils.run_pipeline(
+            out_of_core_context,
+            [
+                create_compendia._reset_zero_values_out_of_core,
+                create_compendia._run_iterativesvd_out_of_core,
+            ],
+        )
+
+        expected = in_memory_context["merged_no_qn"]
+        actual = out_of_core_context["merged_no_qn"]
+        self.assertIsInstance(actual, MemmapMatrix)
+        self.assertTrue(np.allclose(actual.values, expected.values, equal_nan=True))
+        self.assertAlmostEqual(
+            out_of_core_context["total_percent_imputed"],
+            in_memory_context["total_percent_imputed"],
+        )
+
+        target = np.sort(random_state.rand(len(expected.index)))
+        expected = smashing_utils._quantile_normalize_matrix_numpy(target, expected)
+        actual = smashing_utils._quantile_normalize_memmap_matrix(
+            target, actual, out_of_core_context["memory_budget"]
+        )
+        self.assertEqual(list(actual.columns), list(expected.columns))
+        self.assertTrue(np.allclose(actual.values, expected.values, equal_nan=True))
+
+    @tag("compendia")
+    def test_out_of_core_peak_ram(self):
+        """Make sure zeroes are reset, values imputed and the matrix quantile
+        normalized without reading it into memory"""
+        job = ProcessorJob()
+        job.pipeline_applied = ProcessorPipeline.CREATE_COMPENDIA.value
+        job.save()
+
+        dset = Dataset()
+        dset.data = {}
+        dset.svd_algorithm = "NONE"
+        dset.save()
+
+        matrix_dir = "/home/user/data_store/out_of_core_peak_ram_test/matrices/"
+        self.addCleanup(shutil.rmtree, os.path.dirname(matrix_dir[:-1]), ignore_errors=True)
+
+        # 80 MB of float32s, with a budget of 4 MB.
+        num_genes, num_samples = 40000, 500
+        memory_budget = 4 * 1024 * 1024
+        genes = ["G" + str(i) for i in range(num_genes)]
+        samples = ["S" + str(i) for i in range(num_samples)]
+        matrix = MemmapMatrix(matrix_dir + "row_col_filtered_matrix.dat", genes, samples)
+
+        random_state = np.random.RandomState(0)
+        for start, end in matrix.column_blocks(matrix.block_size(memory_budget)):
+            block = random_state.rand(num_genes, end - start).astype(np.float32)
+            block[block < 0.1] = np.nan
+            matrix.values[:, start:end] = block
+
+        job_context = {
+            "job": job,
+            "dataset": dset,
+            "memory_budget": memory_budget,
+            "matrix_dir": matrix_dir,
+            "row_col_filtered_matrix": matrix,
+            "row_col_filtered_matrix_index": matrix.index,
+            "row_col_filtered_matrix_columns": matrix.columns,
+            "cached_zeroes": {sample: matrix.index[:100] for sample in samples},
+        }
+        target = np.sort(random_state.rand(num_genes))
+
+        # Reset the peak so it only covers these steps.
+        if utils.get_and_reset_peak_ram() is None:
+            self.skipTest("This OS doesn't report the peak RSS.")
+        with open("/proc/self/status") as status_file:
+            start_ram = [int(line.split()[1]) for line in status_file if line.startswith("VmRSS:")]
+
+        job_context = utils.run_pipeline(
+            job_context,
+            [
+                create_compendia._reset_zero_values_out_of_core,
+                create_compendia._run_iterativesvd_out_of_core,
+            ],
+        )
+        merged_qn = smashing_utils._quantile_normalize_memmap_matrix(
+            target, job_context["merged_no_qn"], memory_budget
+        )
+
+        peak_process_ram = utils.get_and_reset_peak_ram() * 1024 * 1024
+        # Reading the matrix into memory would have taken 80 MB,
+        # and a float64 copy of it twice that.
+        self.assertLess(peak_process_ram - start_ram[0], 40 * 1024)
+
+        self.assertEqual(merged_qn.shape, (num_genes, num_samples))
+        self.assertLessEqual(np.nanmax(merged_qn.values), np.float32(target[-1]))
+        self.assertAlmostEqual(job_context["total_percent_imputed"], 0.1, places=2)
+
+        # IterativeSVD would need the whole matrix in memory.
+        dset.svd_algorithm = "ARPACK"
+        job_context["combined_matrix_zero"] = job_context.pop("merged_no_qn")
+        job_context["row_col_filtered_matrix_index"] = matrix.index
+        job_context["row_col_filtered_matrix_columns"] = matrix.columns
+        with self.assertRaises(utils.ProcessorJobError):
+            create_compendia._run_iterativesvd_out_of_core(job_context)
+
     @tag("compendia")
     def test_imputation(self):
         job = ProcessorJob()
@@ -0,0 +1,122 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from data_refinery_workers.processors import index_cache
+
+INDEX_FILE_CONTENTS = b"\0" * 1024
+
+
+class FakeIndexFile:
+    """Stands in for the ComputedFile of an index, and counts how many times it's synced."""
+
+    filename = "index.tar.gz"
+
+    def __init__(self):
+        self.num_syncs = 0
+
+    def sync_from_s3(self, path=None):
+        self.num_syncs += 1
+        # Give other jobs a chance to try installing it at the same time.
+        time.sleep(0.2)
+        with tarfile.open(path, "w:gz") as tar:
+            for filename in ["versionInfo.json", "hash.bin"]:
+                info = tarfile.TarInfo(filename)
+                info.size = len(INDEX_FILE_CONTENTS)
+                tar.addfile(info, io.BytesIO(INDEX_FILE_CONTENTS))
+
+        return path
+
+
+def make_organism_index(index_id, index_type="TRANSCRIPTOME_LONG"):
+    index_file = FakeIndexFile()
+    return SimpleNamespace(
+        id=index_id,
+        organism=SimpleNamespace(name="HOMO_SAPIENS"),
+        index_type=index_type,
+        get_computed_file=lambda: index_file,
+        index_file=index_file,
+    )
+
+
+class IndexCacheTestCase(TestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        patcher = patch.object(index_cache, "INDEX_CACHE_DIR", cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_jobs_install_once(self):
+        organism_index = make_organism_index(1)
+        cached_indexes = []
+
+        def acquire():
+            cached_indexes.append(index_cache.acquire(organism_index))
+
+        threads = [threading.Thread(target=acquire) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(organism_index.index_file.num_syncs, 1)
+        self.assertEqual(len({cached_index.directory for cached_index in cached_indexes}), 1)
+        self.assertTrue(
+            os.path.exists(os.path.join(cached_indexes[0].directory, "versionInfo.json"))
+        )
+        # The tarball isn't kept around.
+        self.assertEqual(
+            sorted(os.listdir(cached_indexes[0].directory)),
+            [index_cache.INSTALLED_MARKER, "hash.bin", "versionInfo.json"],
+        )
+
+        for cached_index in cached_indexes:
+            cached_index.release()
+
+    def test_least_recently_used_indexes_not_in_use_are_evicted(self):
+        cached_indexes = [index_cache.acquire(make_organism_index(i)) for i in range(3)]
+        for i, cached_index in enumerate(cached_indexes):
+            marker_path = os.path.join(cached_index.directory, index_cache.INSTALLED_MARKER)
+            os.utime(marker_path, (i, i))
+
+        # The least recently used index is still in use, so the next one is evicted instead.
+        cached_indexes[1].release()
+        cached_indexes[2].release()
+        removed = index_cache.evict(quota_in_bytes=2 * 2 * len(INDEX_FILE_CONTENTS))
+
+        self.assertEqual(removed, [cached_indexes[1].directory])
+        self.assertTrue(os.path.exists(cached_indexes[0].directory))
+        self.assertFalse(os.path.exists(cached_indexes[1].directory))
+        self.assertTrue(os.path.exists(cached_indexes[2].directory))
+
+        # Once it's released it can be evicted too.
+        cached_indexes[0].release()
+        removed = index_cache.evict(quota_in_bytes=0)
+        self.assertEqual(removed, [cached_indexes[0].directory, cached_indexes[2].directory])
+
+    def test_interrupted_install(self):
+        organism_index = make_organism_index(1)
+        installing_dir = index_cache._get_installing_dir(
+            index_cache._get_index_name(organism_index)
+        )
+        os.makedirs(installing_dir)
+
+        self.assertEqual(index_cache.evict(), [installing_dir])
+
+        # An index whose files are there without the marker is installed again.
+        cached_index = index_cache.acquire(organism_index)
+        cached_index.release()
+        os.remove(os.path.join(cached_index.directory, index_cache.INSTALLED_MARKER))
+
+        cached_index = index_cache.acquire(organism_index)
+        cached_index.release()
+        self.assertEqual(organism_index.index_file.num_syncs, 2)
@@ -0,0 +1,226 @@
+import glob
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from unittest.mock import patch
+
+from django.test import TestCase, tag
+
+import numpy as np
+import pandas as pd
+
+from data_refinery_workers.processors import native_tximport
+
+GENE2TXMAP = [("G1", "T1"), ("G1", "T2"), ("G2", "T3"), ("G3", "T4"), ("G3", "T5")]
+
+# Name: (EffectiveLength, TPM, NumReads) for each sample. T6 isn't in
+# GENE2TXMAP, G2 isn't expressed in sample A and G3 isn't expressed at all.
+QUANTS = {
+    "A_output": {
+        "T1": (100, 10, 5),
+        "T2": (200, 30, 20),
+        "T3": (50, 0, 0),
+        "T4": (300, 0, 0),
+        "T5": (100, 0, 0),
+        "T6": (10, 60, 3),
+    },
+    "B_output": {
+        "T1": (120, 0, 0),
+        "T2": (180, 20, 10),
+        "T3": (60, 40, 8),
+        "T4": (280, 0, 0),
+        "T5": (120, 0, 0),
+        "T6": (10, 40, 1),
+    },
+    "C_output": {
+        "T1": (100, 10, 1),
+        "T2": (210, 0, 0),
+        "T3": (90, 10, 2),
+        "T4": (290, 0, 0),
+        "T5": (110, 0, 0),
+        "T6": (10, 80, 4),
+    },
+}
+
+
+def expected_length_scaled_tpm():
+    """The lengthScaledTPM counts of QUANTS, worked out gene by gene."""
+    mean_lengths = {
+        "G1": (175 + 180 + 100) / 3,
+        # A's length is the geometric mean of B's and C's.
+        "G2": (60 + 90 + math.sqrt(60 * 90)) / 3,
+        # The mean of T4's and T5's average lengths.
+        "G3": ((300 + 280 + 290) / 3 + (100 + 120 + 110) / 3) / 2,
+    }
+    abundances = {"A_output": [40, 0, 0], "B_output": [20, 40, 0], "C_output": [10, 10, 0]}
+    counts_sums = {"A_output": 25, "B_output": 18, "C_output": 3}
+
+    expected = {}
+    for sample_name, sample_abundances in abundances.items():
+        new_counts = np.array(sample_abundances) * [mean_lengths[g] for g in ["G1", "G2", "G3"]]
+        expected[sample_name] = new_counts * counts_sums[sample_name] / new_counts.sum()
+
+    return expected
+
+
+class NativeTximportTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.gene2txmap_path = os.path.join(self.directory, "genes_to_transcripts.txt")
+        with open(self.gene2txmap_path, "w") as gene2txmap_file:
+            for gene_id, tx_name in GENE2TXMAP:
+                gene2txmap_file.write("{}\t{}\n".format(gene_id, tx_name))
+
+        self.quant_file_paths = {}
+        for sample_name, quant in QUANTS.items():
+            self.quant_file_paths[sample_name] = self.write_quant_file(sample_name, quant)
+
+        self.state_directory = os.path.join(self.directory, "state")
+
+    def write_quant_file(self, sample_name, quant, transcripts=None):
+        sample_directory = os.path.join(self.directory, sample_name)
+        os.makedirs(sample_directory, exist_ok=True)
+        quant_file_path = os.path.join(sample_directory, "quant.sf")
+        with open(quant_file_path, "w") as quant_file:
+            quant_file.write("Name\tLength\tEffectiveLength\tTPM\tNumReads\n")
+            for name in transcripts or sorted(quant):
+                length, tpm, num_reads = quant[name]
+                quant_file.write(
+                    "{}\t{}\t{}\t{}\t{}\n".format(name, length, length, tpm, num_reads)
+                )
+
+        return quant_file_path
+
+    def get_inputs(self, sample_names, key="1"):
+        return {name: (key, lambda name=name: self.quant_file_paths[name]) for name in sample_names}
+
+    def test_summarize_to_gene(self):
+        data = native_tximport.summarize_to_gene(
+            list(self.quant_file_paths.values()), self.gene2txmap_path
+        )
+
+        self.assertEqual(list(data.index), ["G1", "G2", "G3"])
+        self.assertEqual(data.index.name, "Gene")
+        self.assertEqual(list(data.columns), list(QUANTS))
+        for sample_name, expected in expected_length_scaled_tpm().items():
+            np.testing.assert_allclose(data[sample_name].values, expected, rtol=1e-12)
+
+    def test_transcripts_in_another_order(self):
+        self.quant_file_paths["C_output"] = self.write_quant_file(
+            "C_output", QUANTS["C_output"], transcripts=["T6", "T5", "T4", "T3", "T2", "T1"]
+        )
+
+        data = native_tximport.summarize_to_gene(
+            list(self.quant_file_paths.values()), self.gene2txmap_path
+        )
+
+        expected = expected_length_scaled_tpm()["C_output"]
+        np.testing.assert_allclose(data["C_output"].values, expected, rtol=1e-12)
+
+    def test_incremental_updates(self):
+        with native_tximport.lock_state(self.state_directory):
+            native_tximport.update_state(
+                self.state_directory, self.gene2txmap_path, self.get_inputs(["A_output"])
+            )
+
+        # Only the new samples are read.
+        os.remove(self.quant_file_paths["A_output"])
+        with native_tximport.lock_state(self.state_directory):
+            state = native_tximport.update_state(
+                self.state_directory, self.gene2txmap_path, self.get_inputs(QUANTS)
+            )
+
+        self.assertEqual(state.sample_names, list(QUANTS))
+        data = state.get_length_scaled_tpm()
+        for sample_name, expected in expected_length_scaled_tpm().items():
+            np.testing.assert_allclose(data[sample_name].values, expected, rtol=1e-12)
+
+        # When a sample's quant file changes the state is started over.
+        self.quant_file_paths["A_output"] = self.write_quant_file("A_output", QUANTS["A_output"])
+        inputs = self.get_inputs(["A_output", "B_output"], key="2")
+        with native_tximport.lock_state(self.state_directory):
+            state = native_tximport.update_state(self.state_directory, self.gene2txmap_path, inputs)
+
+        self.assertEqual(state.sample_names, ["A_output", "B_output"])
+        self.assertEqual(state.sample_keys, ["2", "2"])
+
+    def test_evict_states(self):
+        old_directory = os.path.join(self.state_directory, "SRP1_1")
+        in_use_directory = os.path.join(self.state_directory, "SRP2_1")
+        recent_directory = os.path.join(self.state_directory, "SRP3_1")
+        for directory in [old_directory, in_use_directory, recent_directory]:
+            with native_tximport.lock_state(directory):
+                native_tximport.update_state(
+                    directory, self.gene2txmap_path, self.get_inputs(["A_output"])
+                )
+
+        two_weeks_ago = time.time() - 14 * native_tximport.SECONDS_IN_DAY
+        for directory in [old_directory, in_use_directory]:
+            lock_path = native_tximport._get_lock_path(directory)
+            os.utime(lock_path, (two_weeks_ago, two_weeks_ago))
+
+        with patch.object(native_tximport, "TXIMPORT_STATE_DIR", self.state_directory):
+            with native_tximport.lock_state(in_use_directory):
+                os.utime(
+                    native_tximport._get_lock_path(in_use_directory), (two_weeks_ago, two_weeks_ago)
+                )
+                removed = native_tximport.evict_states()
+
+        self.assertEqual(removed, [old_directory])
+        self.assertFalse(os.path.exists(old_directory))
+        self.assertTrue(os.path.exists(in_use_directory))
+        self.assertTrue(os.path.exists(recent_directory))
+
+        # Using a state again starts it over.
+        with native_tximport.lock_state(old_directory):
+            state = native_tximport.update_state(
+                old_directory, self.gene2txmap_path, self.get_inputs(["B_output"])
+            )
+        self.assertEqual(state.sample_names, ["B_output"])
+
+
+class TximportEquivalenceTestCase(TestCase):
+    @tag("salmon")
+    def test_matches_tximport_r(self):
+        """Tests that the native engine computes the same table as tximport.R on our fixtures."""
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+
+        quant_file_paths = sorted(
+            glob.glob("/home/user/data_store/SRP095529/quant_files/*_output/quant.sf")
+        )
+        gene2txmap_path = "/home/user/data_store/ZEBRAFISH_INDEX/SHORT/genes_to_transcripts.txt"
+
+        file_list_path = os.path.join(work_dir, "tximport_inputs.txt")
+        with open(file_list_path, "w") as file_list:
+            file_list.write("\n".join(quant_file_paths) + "\n")
+
+        tpm_file_path = os.path.join(work_dir, "gene_lengthScaledTPM.tsv")
+        subprocess.run(
+            [
+                "/usr/bin/Rscript",
+                "--vanilla",
+                "/home/user/data_refinery_workers/processors/tximport.R",
+                "--file_list",
+                file_list_path,
+                "--gene2txmap",
+                gene2txmap_path,
+                "--rds_file",
+                os.path.join(work_dir, "txi_out.RDS"),
+                "--tpm_file",
+                tpm_file_path,
+            ],
+            check=True,
+        )
+        r_data = pd.read_csv(tpm_file_path, sep="\t", header=0, index_col=0)
+
+        native_data = native_tximport.summarize_to_gene(quant_file_paths, gene2txmap_path)
+
+        self.assertEqual(list(native_data.index), list(r_data.index))
+        self.assertEqual(list(native_data.columns), list(r_data.columns))
+        np.testing.assert_allclose(native_data.values, r_data.values, rtol=1e-9, atol=1e-9)
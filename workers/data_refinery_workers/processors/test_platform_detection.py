@@ -0,0 +1,95 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from data_refinery_workers.processors import platform_detection
+
+PROBE_SETS = {
+    "illuminaHumanv1": ["GI_1-S", "GI_2-S", "GI_3-S"],
+    "illuminaHumanv2": ["GI_1-S", "GI_2-S", "GI_3-S", "GI_4-S", "ILMN_1"],
+    "illuminaHumanv3": ["ILMN_1", "ILMN_2", "ILMN_3"],
+    "illuminaHumanv4": ["ILMN_1", "ILMN_2", "ILMN_3", "ILMN_4", "ILMN_5", "ILMN_6"],
+}
+
+
+class PlatformDetectionTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.probe_sets_path = os.path.join(self.directory, "illumina_probe_sets.tsv.gz")
+        with gzip.open(self.probe_sets_path, "wt") as probe_sets_file:
+            probe_sets_file.write("platform\tprobe_id\n")
+            for platform, probe_ids in PROBE_SETS.items():
+                for probe_id in probe_ids:
+                    probe_sets_file.write("{}\t{}\n".format(platform, probe_id))
+
+        patcher = patch.object(platform_detection, "ILLUMINA_PROBE_SETS_PATH", self.probe_sets_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_input_file(self, probe_ids):
+        input_path = os.path.join(self.directory, "input.tsv")
+        with open(input_path, "w") as input_file:
+            input_file.write(" ID_REF \tSample 1\n")
+            for probe_id in probe_ids:
+                input_file.write("{}\t1.0\n".format(probe_id))
+
+        return input_path
+
+    def test_detect_illumina_platform(self):
+        # ILMN_1 is there twice, one value is missing and one isn't a probe.
+        input_path = self.write_input_file(
+            [" ILMN_1 ", "ILMN_1", "ILMN_2", "ILMN_3", "ILMN_4", "", "NOT_A_PROBE"]
+        )
+
+        probe_ids = platform_detection.read_probe_ids(input_path, "ID_REF")
+        self.assertEqual(
+            probe_ids, ["ILMN_1", "ILMN_1", "ILMN_2", "ILMN_3", "ILMN_4", None, "NOT_A_PROBE"]
+        )
+
+        index = platform_detection.ProbeSetIndex.read(self.probe_sets_path)
+        scores = index.score(probe_ids, list(PROBE_SETS))
+        self.assertEqual(scores["illuminaHumanv1"], (0.0, 0.0))
+        # Scores are rounded to 7 significant digits like detect_database.R's.
+        self.assertEqual(scores["illuminaHumanv2"], (20.0, 14.28571))
+        self.assertEqual(scores["illuminaHumanv3"], (100.0, 42.85714))
+        self.assertEqual(scores["illuminaHumanv4"], (66.66667, 57.14286))
+
+        # The first platform with the highest detection percentage wins.
+        self.assertEqual(
+            platform_detection.detect_illumina_platform(input_path, "ID_REF", "HOMO_SAPIENS"),
+            ("illuminaHumanv3", 100.0, 42.85714),
+        )
+
+    def test_no_matches(self):
+        input_path = self.write_input_file(["NOT_A_PROBE"])
+
+        self.assertEqual(
+            platform_detection.detect_illumina_platform(input_path, "ID_REF", "HOMO_SAPIENS"),
+            (None, 0.0, 0.0),
+        )
+        # A column that isn't there doesn't match either.
+        self.assertEqual(
+            platform_detection.detect_illumina_platform(input_path, "Probe", "HOMO_SAPIENS"),
+            (None, 0.0, 0.0),
+        )
+
+    @patch("data_refinery_workers.processors.platform_detection.subprocess.check_output")
+    def test_falls_back_to_r(self, mock_check_output):
+        input_path = self.write_input_file(["ILMN_1"])
+        mock_check_output.side_effect = [b"10\n50\n", b"30\n60\n", b"30\n70\n", Exception()]
+
+        with patch.object(
+            platform_detection, "ILLUMINA_PROBE_SETS_PATH", os.path.join(self.directory, "missing")
+        ):
+            result = platform_detection.detect_illumina_platform(
+                input_path, "ID_REF", "HOMO_SAPIENS"
+            )
+
+        self.assertEqual(result, ("illuminaHumanv2", 30.0, 60.0))
+        self.assertEqual(mock_check_output.call_count, 4)
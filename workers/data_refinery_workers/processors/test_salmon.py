@@ -1,9 +1,12 @@
+import gzip
 import hashlib
 import os
 import random
 import shutil
 import subprocess
+import tempfile
 from typing import Dict, List
+from unittest.mock import patch
 
 from django.test import TestCase, tag
 
@@ -31,7 +34,13 @@ from data_refinery_common.models import (
     SurveyJob,
 )
 from data_refinery_common.utils import get_env_variable
-from data_refinery_workers.processors import salmon, tximport, utils
+from data_refinery_workers.processors import (
+    native_tximport,
+    read_length,
+    salmon,
+    tximport,
+    utils,
+)
 
 
 def prepare_organism_indices():
@@ -687,6 +696,70 @@ class DetermineIndexLengthTestCase(TestCase):
         self.assertEqual(results["index_length"], "short")
 
 
+def write_fastq(file_path: str, read_lengths: List[int], line_ending: str = "\n") -> None:
+    """Writes a FASTQ with reads of the given lengths, gzipped if `file_path` ends with .gz."""
+    opener = gzip.open if file_path.endswith(".gz") else open
+    with opener(file_path, "wt", newline="") as fastq_file:
+        for i, length in enumerate(read_lengths):
+            lines = ["@READ{}".format(i), "A" * length, "+", "I" * length]
+            fastq_file.write(line_ending.join(lines) + line_ending)
+
+
+class ReadLengthTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def test_exact_matches_line_by_line(self):
+        """Reads of varying lengths, Windows line endings and files without a trailing newline
+        are measured the way the old line by line loop measured them."""
+        lengths = [random.randint(20, 150) for _ in range(5000)]
+        gz_path = os.path.join(self.temp_dir, "reads_1.fastq.gz")
+        write_fastq(gz_path, lengths)
+        crlf_path = os.path.join(self.temp_dir, "reads_2.fastq")
+        write_fastq(crlf_path, lengths[:100], "\r\n")
+        truncated_path = os.path.join(self.temp_dir, "reads_3.fastq")
+        write_fastq(truncated_path, [30, 40])
+        with open(truncated_path, "rb+") as truncated_file:
+            # Cut off everything after the last read's sequence.
+            truncated_file.truncate(
+                os.path.getsize(truncated_path) - len("\n+\n" + "I" * 40 + "\n")
+            )
+
+        with patch.object(read_length, "BLOCK_SIZE", 1000):
+            read_lengths = read_length.measure_read_lengths([gz_path, crlf_path, truncated_path])
+
+        self.assertEqual(read_lengths.number_of_reads, 5102)
+        self.assertEqual(read_lengths.total_base_pairs, sum(lengths) + sum(lengths[:100]) + 70)
+        self.assertTrue(read_lengths.is_exact)
+
+    def test_sampled_reads(self):
+        fastq_path = os.path.join(self.temp_dir, "reads.fastq.gz")
+        write_fastq(fastq_path, [100] * 1000 + [50] * 1000)
+
+        read_lengths = read_length.estimate_read_length([fastq_path], sample_size=500)
+
+        self.assertEqual(read_lengths.number_of_reads, 500)
+        self.assertEqual(read_lengths.mean, 100)
+        self.assertFalse(read_lengths.is_exact)
+
+        # Files with fewer reads than the sample size are measured exactly.
+        read_lengths = read_length.estimate_read_length([fastq_path], sample_size=5000)
+        self.assertEqual(read_lengths.mean, 75)
+        self.assertTrue(read_lengths.is_exact)
+
+    def test_sampled_reads_near_threshold(self):
+        """Every read is measured when the sample's average is too close to the threshold."""
+        fastq_path = os.path.join(self.temp_dir, "reads.fastq.gz")
+        write_fastq(fastq_path, [30, 121] * 500 + [100] * 1000)
+
+        read_lengths = read_length.estimate_read_length([fastq_path], sample_size=500)
+
+        self.assertEqual(read_lengths.number_of_reads, 2000)
+        self.assertEqual(read_lengths.mean, 87.75)
+        self.assertTrue(read_lengths.is_exact)
+
+
 class RuntimeProcessorTest(TestCase):
     """Test the four processors hosted inside "Salmon" docker container."""
 
@@ -1068,6 +1141,29 @@ class EarlyTximportTestCase(TestCase):
             sample = Sample.objects.get(accession_code=accession_code)
             self.assertEqual(sample.computed_files.count(), 0)
 
+    @tag("salmon")
+    def test_native_tximport(self):
+        """Tests that the native engine makes the same files as tximport.R except the RDS file."""
+        complete_accessions = ["SRR51256" + str(i) for i in range(21, 41)]
+
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        with patch.object(salmon, "TXIMPORT_ENGINE", "NATIVE"), patch.object(
+            native_tximport, "TXIMPORT_STATE_DIR", state_dir
+        ):
+            job_context = run_tximport_at_progress_point(complete_accessions, [])
+
+        self.assertTrue("tximported" in job_context)
+        self.assertFalse(ComputedFile.objects.filter(filename="txi_out.RDS").exists())
+
+        for accession_code in complete_accessions:
+            tpm_file = ComputedFile.objects.get(
+                filename=accession_code + "_output_gene_lengthScaledTPM.tsv"
+            )
+            sample = tpm_file.samples.first()
+            self.assertEqual(sample.accession_code, accession_code)
+            self.assertTrue(sample.is_processed)
+
     @tag("salmon")
     def test_version_filter(self):
         """Tests that we don't run tximport on old salmon versions.
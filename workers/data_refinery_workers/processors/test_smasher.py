@@ -3,16 +3,21 @@
 import csv
 import json
 import os
+import shutil
 import sys
 import zipfile
+import zlib
+from concurrent.futures.process import BrokenProcessPool
 from io import StringIO
 from unittest.mock import MagicMock, patch
 
 from django.core.management import call_command
 from django.test import TransactionTestCase, tag
 
+import numpy as np
 import pandas as pd
 import vcr
+from rpy2.robjects import pandas2ri
 
 from data_refinery_common.models import (
     ComputationalResult,
@@ -35,8 +40,22 @@ from data_refinery_common.models import (
     SampleResultAssociation,
     SurveyJob,
 )
-from data_refinery_workers.processors import smasher, smashing_utils
-from data_refinery_workers.processors.testing_utils import ProcessorJobTestCaseMixin
+from data_refinery_common.utils import calculate_sha1
+from data_refinery_workers.processors import (
+    frame_cache,
+    smasher,
+    smashing_utils,
+    streaming_archive,
+)
+from data_refinery_workers.processors.streaming_archive import (
+    PARALLEL_DEFLATE_MIN_BYTES,
+    S3MultipartWriter,
+    StreamingZipArchive,
+)
+from data_refinery_workers.processors.testing_utils import (
+    LocalS3Client,
+    ProcessorJobTestCaseMixin,
+)
 
 
 def prepare_job():
@@ -316,6 +335,39 @@ class SmasherTestCase(TransactionTestCase, ProcessorJobTestCaseMixin):
 
         self._test_all_scale_types("EXPERIMENT", experiment_tests)
 
+    @tag("smasher")
+    def test_smasher_npy_output_format(self):
+        job = prepare_job()
+        relations = ProcessorJobDatasetAssociation.objects.filter(processor_job=job)
+        dataset = Dataset.objects.filter(id__in=relations.values("dataset_id")).first()
+        dataset.aggregate_by = "EXPERIMENT"
+        dataset.output_format = "NPY"
+        dataset.save()
+
+        final_context = smasher.smash(job.pk, upload=False)
+        self.assertEqual(final_context["dataset"].is_processed, True)
+
+        zf = zipfile.ZipFile(final_context["output_file"])
+        namelist = zf.namelist()
+        self.assertNotIn("GSE51081/GSE51081.tsv", namelist)
+        self.assertIn("GSE51081/GSE51081.npy", namelist)
+
+        zf.extractall("/home/user/data_store/smasher_npy_output/")
+        npy_base = "/home/user/data_store/smasher_npy_output/GSE51081/GSE51081"
+        matrix = np.load(npy_base + ".npy", mmap_mode="r")
+        with open(npy_base + "_genes.txt") as genes_file:
+            genes = genes_file.read().splitlines()
+        with open(npy_base + "_samples.txt") as samples_file:
+            samples = samples_file.read().splitlines()
+
+        self.assertEqual(matrix.dtype, np.float32)
+        self.assertEqual(matrix.shape, (len(genes), len(samples)))
+        self.assertEqual(samples, ["GSM1237810", "GSM1237812"])
+        np.testing.assert_allclose(matrix, final_context["final_frame"].values, rtol=1e-6)
+
+        with zf.open("aggregated_metadata.json") as metadata_file:
+            self.assertEqual(json.load(metadata_file)["output_format"], "NPY")
+
     @tag("smasher")
     def test_get_samples_by_experiment(self):
         job = prepare_job()
@@ -1250,6 +1302,37 @@ class SmasherTestCase(TransactionTestCase, ProcessorJobTestCaseMixin):
         import sklearn  # noqa
         import sympy  # noqa
 
+    @tag("smasher")
+    def test_numpy_qn_matches_preprocesscore(self):
+        """The numpy QN engine should agree with preprocessCore, ties and NaNs included."""
+        random_state = np.random.RandomState(123)
+        matrix = pd.DataFrame(
+            random_state.lognormal(size=(500, 20)).astype(np.float32),
+            index=["GENE{}".format(i) for i in range(500)],
+            columns=["SAMPLE{}".format(i) for i in range(20)],
+        )
+        # Ties
+        matrix.iloc[0:10, 0] = 1.0
+        matrix.iloc[20:23, 1] = matrix.iloc[30, 1]
+        # Missing values
+        matrix.iloc[5:50, 2] = np.nan
+        matrix.iloc[7, 3] = np.nan
+
+        pandas2ri.activate()
+        for target_length in [500, 321]:
+            target = pd.Series(np.sort(random_state.lognormal(size=target_length)))
+
+            preprocesscore_qn = smashing_utils._quantile_normalize_matrix(target, matrix.copy())
+            numpy_qn = smashing_utils._quantile_normalize_matrix_numpy(
+                target, matrix.copy(), processes=2
+            )
+
+            self.assertEqual(list(numpy_qn.columns), list(matrix.columns))
+            self.assertEqual(list(numpy_qn.index), list(matrix.index))
+            np.testing.assert_allclose(
+                numpy_qn.values, preprocesscore_qn.values.astype(np.float32), rtol=1e-5
+            )
+
     @tag("smasher")
     @vcr.use_cassette("/home/user/data_store/cassettes/smasher.get_synced_files.yaml")
     def test_get_synced_files(self):
@@ -1508,6 +1591,36 @@ class AggregationTestCase(TransactionTestCase):
         self.assertTrue("characteristics_ch1_serum" in columns)
         self.assertTrue("MetaSRA_age" in columns)
 
+    @tag("smasher")
+    def test_prefetched_tsv_rows(self):
+        """Check that rows built from prefetched metadata match the ones built per sample."""
+        dataset_data = {
+            "GSE56409": ["GSM1361050"],
+            "E-GEOD-44719": ["E-GEOD-44719-GSM1089311", "GSM1361050"],
+        }
+        samples_metadata = self.metadata["samples"].values()
+
+        with self.assertNumQueries(1):
+            sample_attributes = smashing_utils.get_sample_attributes(
+                metadata["refinebio_accession_code"] for metadata in samples_metadata
+            )
+        experiment_accessions = smashing_utils.get_experiment_accessions(dataset_data)
+        self.assertEqual(experiment_accessions["GSM1361050"], "GSE56409")
+
+        with self.assertNumQueries(0):
+            prefetched_rows = [
+                smashing_utils.get_tsv_row_data(
+                    metadata, dataset_data, sample_attributes, experiment_accessions
+                )
+                for metadata in samples_metadata
+            ]
+
+        rows = [
+            smashing_utils.get_tsv_row_data(metadata, dataset_data) for metadata in samples_metadata
+        ]
+        self.assertEqual(prefetched_rows, rows)
+        self.assertEqual(prefetched_rows[0]["MetaSRA_age"], 3.0)
+
     @tag("smasher")
     def test_all_samples(self):
         """Check tsv file that includes all sample metadata."""
@@ -1919,3 +2032,273 @@ class AggregationTestCase(TransactionTestCase):
         ds = Dataset.objects.get(id=ds.id)
 
         self.assertEqual(len(final_context["final_frame"]), 4)
+
+
+class ParsePoolTestCase(TransactionTestCase):
+    @tag("smasher")
+    def test_broken_pool_is_replaced(self):
+        broken_executor = MagicMock()
+        broken_executor.submit.side_effect = BrokenProcessPool()
+        executor = MagicMock()
+        executor.submit.return_value.result.return_value = "frame"
+
+        with patch.object(
+            smashing_utils._ParsePool,
+            "_create_executor",
+            side_effect=[broken_executor, executor, broken_executor, broken_executor, executor],
+        ):
+            parse_pool = smashing_utils._ParsePool()
+            self.assertEqual(parse_pool.parse("GSM1.PCL"), "frame")
+            broken_executor.shutdown.assert_called_once_with(wait=False)
+
+            # A frame that breaks the new pool too isn't retried again,
+            # but the pool is still replaced for the frames after it.
+            parse_pool = smashing_utils._ParsePool()
+            with self.assertRaises(BrokenProcessPool):
+                parse_pool.parse("GSM1.PCL")
+
+        self.assertEqual(broken_executor.shutdown.call_count, 3)
+        parse_pool.shutdown()
+        executor.shutdown.assert_called_once_with()
+
+
+class FrameSpillTestCase(TransactionTestCase):
+    def setUp(self):
+        self.work_dir = "/home/user/data_store/frame_spill_test/"
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(self.work_dir)
+
+        self.frames = {
+            "GSM1": pd.DataFrame({"GSM1": [1.0, 2.0, 3.0]}, index=["G1", "G2", "G3"]),
+            # In another order, and with a gene only it has.
+            "GSM2": pd.DataFrame({"GSM2": [6.0, 5.0, 4.0]}, index=["G4", "G2", "G1"]),
+            "GSM3": None,
+            "GSM4": pd.DataFrame({"GSM4": [7.0, 8.0]}, index=["G1", "G3"]),
+        }
+        self.input_files = []
+        for accession_code in self.frames:
+            sample = MagicMock(accession_code=accession_code, technology="MICROARRAY")
+            sample.to_metadata_dict.return_value = {"refinebio_accession_code": accession_code}
+            computed_file = MagicMock(id=len(self.input_files), filename=accession_code + ".PCL")
+            self.input_files.append((computed_file, sample))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def iterate_frames(self, work_dir, input_files, aggregate_by, job_id=None):
+        for computed_file, sample in input_files:
+            yield computed_file, sample, self.frames[sample.accession_code]
+
+    def process_frames(self):
+        job_context = {
+            "work_dir": self.work_dir,
+            "job": MagicMock(id=1),
+            "dataset": MagicMock(aggregate_by="SPECIES", data={"GSE1": list(self.frames)}),
+            "filtered_samples": {},
+            "unsmashable_files": [],
+        }
+        return smashing_utils.process_frames_for_key("MUS_MUSCULUS", self.input_files, job_context)
+
+    @tag("smasher")
+    def test_spilled_frames_match_parsed_frames(self):
+        with patch.object(
+            smashing_utils, "iterate_frames", side_effect=self.iterate_frames
+        ), patch.object(
+            smashing_utils, "_spill_frame", wraps=smashing_utils._spill_frame
+        ) as mock_spill_frame:
+            spilled_context = self.process_frames()
+
+            # The first pass of mouse compendia is cached, so this time
+            # the frames are parsed in the second pass instead of spilled.
+            parsed_context = self.process_frames()
+
+        self.assertEqual(mock_spill_frame.call_count, 3)
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir, "frame_spill", "MUS_MUSCULUS")))
+
+        spilled_matrix = spilled_context["microarray_matrix"]
+        parsed_matrix = parsed_context["microarray_matrix"]
+        self.assertEqual(list(spilled_matrix.index), ["G1", "G2", "G3"])
+        self.assertEqual(list(spilled_matrix.columns), ["GSM1", "GSM2", "GSM4"])
+        # Spilled values are stored as float32, like the matrices.
+        pd.testing.assert_frame_equal(spilled_matrix, parsed_matrix, check_dtype=False)
+        np.testing.assert_array_equal(spilled_matrix["GSM2"].values, [4.0, 5.0, np.nan])
+
+        self.assertEqual(spilled_context["filtered_samples"], parsed_context["filtered_samples"])
+        self.assertEqual(list(spilled_context["filtered_samples"]), ["GSM3"])
+        self.assertEqual(spilled_context["unsmashable_files"], ["GSM3.PCL"])
+        self.assertEqual(spilled_context["num_samples"], parsed_context["num_samples"])
+
+
+class FrameCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        self.cache_dir = "/home/user/data_store/frame_cache_test/"
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    @tag("smasher")
+    def test_cached_frames_match_parsed_frames(self):
+        parsed_frame = smashing_utils._parse_frame(
+            "/home/user/data_store/PCL/GSM1487313_liver.PCL", 1, True, "GSM1487313", "SPECIES"
+        )
+
+        cache = frame_cache.FrameCache(self.cache_dir, 1024 * 1024 * 1024)
+        key = frame_cache.get_cache_key("abc123", "SPECIES", True)
+        self.assertIsNone(cache.get(key, "GSM1487313"))
+
+        cache.put(key, parsed_frame)
+        cached_frame = cache.get(key, "GSM1487313")
+        self.assertTrue(cached_frame.equals(parsed_frame))
+        self.assertEqual(cached_frame.index.name, parsed_frame.index.name)
+
+        # The same file is titled with whichever sample it's smashed for.
+        self.assertEqual(list(cache.get(key, "GSM1487314").columns), ["GSM1487314"])
+
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+        # The transform is part of the key, so the untransformed frame is a miss.
+        self.assertIsNone(cache.get(frame_cache.get_cache_key("abc123", "ALL", True), "GSM1"))
+        self.assertIsNone(frame_cache.get_cache_key("", "ALL", True))
+
+        # Frames parsed by another version of the smasher are misses too.
+        with patch.object(frame_cache, "FRAME_CACHE_VERSION", frame_cache.FRAME_CACHE_VERSION + 1):
+            self.assertIsNone(
+                cache.get(frame_cache.get_cache_key("abc123", "SPECIES", True), "GSM1487313")
+            )
+
+    @tag("smasher")
+    def test_frame_cache_is_only_created_once(self):
+        with patch.object(frame_cache, "FRAME_CACHE_DIR", self.cache_dir), patch.object(
+            frame_cache, "FRAME_CACHE_QUOTA_MB", 1
+        ), patch.object(frame_cache, "_frame_cache", None), patch.object(
+            frame_cache.FrameCache, "_entries", wraps=frame_cache.FrameCache._entries, autospec=True
+        ) as mock_entries:
+            cache = frame_cache.get_frame_cache()
+            self.assertIs(frame_cache.get_frame_cache(), cache)
+
+        self.assertEqual(mock_entries.call_count, 1)
+
+    @tag("smasher")
+    def test_least_recently_used_frames_are_evicted(self):
+        frames = [
+            pd.DataFrame(np.random.rand(1000, 1), index=[str(i) for i in range(1000)])
+            for _ in range(3)
+        ]
+
+        cache = frame_cache.FrameCache(self.cache_dir, 1024 * 1024)
+        cache.put("first", frames[0])
+        cache.put("second", frames[1])
+        entry_size = os.path.getsize(os.path.join(self.cache_dir, "first.npz"))
+
+        # Only room for two frames, and "second" is now the least recently used.
+        cache.quota_bytes = entry_size * 2
+        os.utime(os.path.join(self.cache_dir, "second.npz"), (0, 0))
+        self.assertIsNotNone(cache.get("first", "S"))
+        cache.put("third", frames[2])
+
+        self.assertIsNone(cache.get("second", "S"))
+        self.assertIsNotNone(cache.get("first", "S"))
+        self.assertIsNotNone(cache.get("third", "S"))
+
+
+class StreamingArchiveTestCase(TransactionTestCase):
+    def setUp(self):
+        self.work_dir = "/home/user/data_store/streaming_archive_test/"
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        self.output_dir = self.work_dir + "output/"
+        os.makedirs(self.output_dir + "GSE51081/")
+
+        random_state = np.random.RandomState(0)
+        # Big enough to be deflated in parallel and uploaded in a few parts.
+        self.matrix_bytes = "\n".join(
+            "\t".join(str(value) for value in row) for row in random_state.rand(150000, 8)
+        ).encode()
+        with open(self.output_dir + "GSE51081/GSE51081.tsv", "wb") as matrix_file:
+            matrix_file.write(self.matrix_bytes)
+        with open(self.output_dir + "README.md", "w") as readme_file:
+            readme_file.write("Hello!")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    @tag("smasher")
+    def test_streamed_to_s3(self):
+        s3_client = LocalS3Client(self.work_dir + "s3/")
+        sink = S3MultipartWriter(s3_client, "results", "1.zip", part_size=5 * 1024 * 1024)
+        archive = StreamingZipArchive(sink, parallel_deflate_min_bytes=1024 * 1024, threads=3)
+
+        archive.add_tree(self.output_dir, delete_files=True)
+        archive.close()
+
+        # The files are deleted once they're in the archive, but the directories stay.
+        self.assertEqual(os.listdir(self.output_dir + "GSE51081/"), [])
+
+        zip_path = self.work_dir + "1.zip"
+        s3_client.download_file("results", "1.zip", zip_path)
+        self.assertEqual(archive.size_in_bytes, os.path.getsize(zip_path))
+        self.assertEqual(archive.sha1, calculate_sha1(zip_path))
+
+        with zipfile.ZipFile(zip_path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(
+                set(zf.namelist()), {"GSE51081/", "GSE51081/GSE51081.tsv", "README.md"}
+            )
+            self.assertEqual(zf.read("GSE51081/GSE51081.tsv"), self.matrix_bytes)
+            self.assertEqual(zf.read("README.md"), b"Hello!")
+
+            # Deflating in chunks shouldn't cost much compression.
+            matrix_info = zf.getinfo("GSE51081/GSE51081.tsv")
+            self.assertLess(matrix_info.compress_size, len(zlib.compress(self.matrix_bytes)) * 1.01)
+
+    @tag("smasher")
+    def test_large_member_crc(self):
+        """A file over the parallel deflate threshold unzips with the right CRC."""
+        repeats = PARALLEL_DEFLATE_MIN_BYTES // len(self.matrix_bytes) + 1
+        large_bytes = self.matrix_bytes * repeats
+        self.assertGreater(len(large_bytes), PARALLEL_DEFLATE_MIN_BYTES)
+        with open(self.output_dir + "large.tsv", "wb") as large_file:
+            large_file.write(large_bytes)
+
+        zip_path = self.work_dir + "large.zip"
+        archive = StreamingZipArchive(open(zip_path, "wb"))
+        with patch.object(
+            streaming_archive, "_deflate_chunk", wraps=streaming_archive._deflate_chunk
+        ) as deflate_chunk:
+            archive.add_file(self.output_dir + "large.tsv", "large.tsv")
+            archive.close()
+
+        # It really was deflated in parallel chunks.
+        self.assertGreater(deflate_chunk.call_count, 1)
+
+        with zipfile.ZipFile(zip_path) as zf:
+            self.assertIsNone(zf.testzip())
+            large_info = zf.getinfo("large.tsv")
+            self.assertEqual(large_info.file_size, len(large_bytes))
+            self.assertEqual(large_info.CRC, zlib.crc32(large_bytes))
+            self.assertEqual(zf.read("large.tsv"), large_bytes)
+
+    @tag("smasher")
+    def test_parallel_deflate_fallback(self):
+        """Members zipfile made without a compressor we know are left alone."""
+        archive = StreamingZipArchive(open(self.work_dir + "fallback.zip", "wb"))
+        member = MagicMock(spec=[])
+
+        archive._use_parallel_deflater(member, "large.tsv")
+
+        self.assertFalse(hasattr(member, "_compressor"))
+        archive.close()
+
+    @tag("smasher")
+    def test_aborted_upload(self):
+        s3_client = LocalS3Client(self.work_dir + "s3/")
+        sink = S3MultipartWriter(s3_client, "results", "1.zip", part_size=5 * 1024 * 1024)
+        archive = StreamingZipArchive(sink)
+
+        archive.add_file(self.output_dir + "README.md", "README.md")
+        archive.abort()
+
+        self.assertEqual(len(s3_client.aborted_uploads), 1)
+        self.assertFalse(os.path.exists(self.work_dir + "s3/results/1.zip"))
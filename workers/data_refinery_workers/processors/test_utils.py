@@ -1,16 +1,26 @@
 import copy
+import os
+import shutil
+import tempfile
 from unittest.mock import MagicMock
 
 from django.test import TestCase
 from django.utils import timezone
 
+import numpy as np
+import pandas as pd
+
 from data_refinery_common.models import (
+    ComputationalResult,
+    ComputedFile,
     Organism,
     OriginalFile,
     OriginalFileSampleAssociation,
     ProcessorJob,
     ProcessorJobOriginalFileAssociation,
     Sample,
+    SampleComputedFileAssociation,
+    SampleResultAssociation,
     SurveyJob,
 )
 from data_refinery_workers.processors import utils
@@ -113,3 +123,63 @@ class RunPipelineTestCase(TestCase):
         processor_job.refresh_from_db()
         self.assertFalse(processor_job.success)
         self.assertIsNotNone(processor_job.end_time)
+
+
+class PeakRamTestCase(TestCase):
+    def test_reset_does_not_lower_peak_ram_amount(self):
+        # Use up about 200MB so the peak is well above where the process is now.
+        data = np.ones(200 * 1024 * 1024 // 8)
+        del data
+
+        peak_ram_in_GB = utils.get_and_reset_peak_ram()
+        if peak_ram_in_GB is None:
+            self.skipTest("This OS doesn't report the peak RSS of a process.")
+
+        # The second call only sees the RAM used since the reset.
+        self.assertLess(utils.get_and_reset_peak_ram(), peak_ram_in_GB)
+        self.assertGreaterEqual(utils.get_peak_ram_amount(), int(peak_ram_in_GB * 1024))
+
+
+class RegisterSampleFilesTestCase(TestCase):
+    def test_register_sample_files(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+
+        samples = [Sample.objects.create(accession_code="SRR" + str(i)) for i in range(3)]
+        data = pd.DataFrame(
+            np.arange(12, dtype=float).reshape(4, 3),
+            index=pd.Index(["G1", "G2", "G3", "G4"], name="Gene"),
+            columns=[sample.accession_code for sample in samples],
+        )
+        file_paths = [os.path.join(work_dir, sample.accession_code + ".tsv") for sample in samples]
+        utils.write_sample_frames(data, file_paths)
+
+        for column, file_path in zip(data.columns, file_paths):
+            pd.testing.assert_frame_equal(
+                pd.read_csv(file_path, sep="\t", index_col=0), data[[column]]
+            )
+
+        result = ComputationalResult.objects.create()
+        shared_file = ComputedFile.objects.create(filename="shared.RDS", result=result)
+        # Associations that already exist are left alone.
+        SampleResultAssociation.objects.create(sample=samples[0], result=result)
+
+        computed_files = utils.register_sample_files(
+            result, list(zip(samples, file_paths)), shared_files=[shared_file]
+        )
+
+        self.assertEqual(len(computed_files), 3)
+        for sample, computed_file, file_path in zip(samples, computed_files, file_paths):
+            computed_file.refresh_from_db()
+            self.assertEqual(computed_file.filename, os.path.basename(file_path))
+            self.assertEqual(computed_file.size_in_bytes, os.path.getsize(file_path))
+            self.assertEqual(computed_file.sha1, computed_file.calculate_sha1())
+            self.assertTrue(computed_file.is_smashable)
+            self.assertEqual(
+                set(sample.computed_files.all()), {computed_file, shared_file},
+            )
+
+        self.assertEqual(SampleResultAssociation.objects.filter(result=result).count(), 3)
+        self.assertEqual(
+            SampleComputedFileAssociation.objects.filter(computed_file=shared_file).count(), 3
+        )
@@ -1,3 +1,7 @@
+import hashlib
+import os
+import uuid
+
 from django.test import TestCase
 
 import pandas as pd
@@ -73,3 +77,64 @@ class ProcessorJobTestCaseMixin:
             msg = f"Processor job failed without a given reason"
 
         raise self.failureException(msg)
+
+
+class LocalS3Client:
+    """Stands in for a boto3 S3 client's multipart upload methods by
+    storing objects under `root_dir`, so uploads can be tested offline.
+
+    It enforces S3's rule that every part except the last has to be at
+    least `min_part_size` bytes."""
+
+    def __init__(self, root_dir: str, min_part_size: int = 5 * 1024 * 1024):
+        self.root_dir = root_dir
+        self.min_part_size = min_part_size
+        self.uploads = {}
+        self.aborted_uploads = set()
+
+    def _object_path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root_dir, bucket, key)
+
+    def create_multipart_upload(self, Bucket: str, Key: str) -> dict:
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {"bucket": Bucket, "key": Key, "parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body) -> dict:
+        etag = hashlib.md5(Body).hexdigest()
+        self.uploads[UploadId]["parts"][PartNumber] = (etag, Body)
+        return {"ETag": etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self.uploads.pop(UploadId)
+        parts = MultipartUpload["Parts"]
+
+        part_numbers = [part["PartNumber"] for part in parts]
+        if part_numbers != sorted(part_numbers):
+            raise ValueError("Parts must be listed in ascending order.")
+
+        bodies = []
+        for part in parts:
+            etag, body = upload["parts"][part["PartNumber"]]
+            if etag != part["ETag"]:
+                raise ValueError("Part {} has the wrong ETag.".format(part["PartNumber"]))
+            bodies.append(body)
+
+        if any(len(body) < self.min_part_size for body in bodies[:-1]):
+            raise ValueError("Your proposed upload is smaller than the minimum allowed size.")
+
+        path = self._object_path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as object_file:
+            for body in bodies:
+                object_file.write(body)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted_uploads.add(UploadId)
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(self._object_path(Bucket, Key), "rb") as object_file, open(
+            Filename, "wb"
+        ) as local_file:
+            local_file.write(object_file.read())
@@ -2,14 +2,17 @@ import json
 import os
 import pickle
 import random
+import resource
 import shutil
 import signal
 import string
 import subprocess
 import sys
-from typing import Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
 import pandas as pd
@@ -18,7 +21,16 @@ import yaml
 from data_refinery_common.enums import SMASHER_JOB_TYPES, ProcessorEnum, ProcessorPipeline
 from data_refinery_common.job_management import create_downloader_job
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.models import Processor, ProcessorJob, Sample
+from data_refinery_common.message_queue import record_job_finished, record_job_started
+from data_refinery_common.models import (
+    ComputationalResult,
+    ComputedFile,
+    Processor,
+    ProcessorJob,
+    Sample,
+    SampleComputedFileAssociation,
+    SampleResultAssociation,
+)
 from data_refinery_common.utils import get_env_variable, get_instance_id
 
 logger = get_and_configure_logger(__name__)
@@ -27,7 +39,12 @@ SYSTEM_VERSION = get_env_variable("SYSTEM_VERSION")
 S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
 S3_QN_TARGET_BUCKET_NAME = get_env_variable("S3_QN_TARGET_BUCKET_NAME", "data-refinery")
 DIRNAME = os.path.dirname(os.path.abspath(__file__))
+# How many per-sample files are written or hashed at once.
+SAMPLE_FILE_THREADS = int(get_env_variable("SAMPLE_FILE_THREADS", "8"))
+BYTES_IN_GB = 1024 * 1024 * 1024
 CURRENT_JOB = None
+# The highest peak RSS in kB that get_and_reset_peak_ram has reset.
+HIGHEST_RESET_PEAK_RAM = 0
 
 
 def signal_handler(sig, frame):
@@ -180,6 +197,7 @@ def start_job(job_context: Dict):
     job.worker_version = SYSTEM_VERSION
     job.start_time = timezone.now()
     job.save()
+    record_job_started(job)
 
     global CURRENT_JOB
     CURRENT_JOB = job
@@ -210,6 +228,46 @@ def start_job(job_context: Dict):
     return job_context
 
 
+def get_and_reset_peak_ram() -> Optional[float]:
+    """Returns the peak RSS of this process in GB since the last time
+    this was called, or None if the OS doesn't let us find that out.
+
+    Resetting the peak RSS also resets ru_maxrss, so the highest peak
+    is kept for get_peak_ram_amount.
+    """
+    global HIGHEST_RESET_PEAK_RAM
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    peak_ram_in_kB = int(line.split()[1])
+                    break
+            else:
+                return None
+
+        HIGHEST_RESET_PEAK_RAM = max(HIGHEST_RESET_PEAK_RAM, peak_ram_in_kB)
+
+        # Writing 5 to clear_refs resets the peak RSS (VmHWM) of this process.
+        with open("/proc/self/clear_refs", "w") as clear_refs_file:
+            clear_refs_file.write("5")
+    except (OSError, ValueError):
+        return None
+
+    return peak_ram_in_kB * 1024 / BYTES_IN_GB
+
+
+def get_peak_ram_amount() -> int:
+    """Returns the most RAM in MB this process or any of its finished
+    subprocesses (salmon, R scripts, etc.) has used so far."""
+    # ru_maxrss is in kilobytes on Linux.
+    peak_kilobytes = max(
+        HIGHEST_RESET_PEAK_RAM,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return int(peak_kilobytes / 1024) + 1
+
+
 def end_job(job_context: Dict, abort=False):
     """A processor function to end jobs.
 
@@ -326,6 +384,10 @@ def end_job(job_context: Dict, abort=False):
         if len(pipeline.steps):
             pipeline.save()
 
+    # Let the index cache evict the transcriptome index this job used.
+    if "cached_index" in job_context:
+        job_context["cached_index"].release()
+
     if (
         "work_dir" in job_context
         and job_context["job"].pipeline_applied != ProcessorPipeline.CREATE_COMPENDIA.value
@@ -336,7 +398,9 @@ def end_job(job_context: Dict, abort=False):
     job.abort = abort
     job.success = success
     job.end_time = timezone.now()
+    job.peak_ram_amount = get_peak_ram_amount()
     job.save()
+    record_job_finished(job)
 
     if success:
         logger.debug(
@@ -766,3 +830,73 @@ def squish_duplicates(data: pd.DataFrame) -> pd.DataFrame:
     Discussion here: https://github.com/AlexsLemonade/refinebio/issues/186#issuecomment-395516419
     """
     return data.groupby(data.index, sort=False).mean()
+
+
+def write_sample_frames(data: pd.DataFrame, file_paths: List[str]) -> None:
+    """Writes each column of `data` with its index as a TSV to the path in the same position
+    in `file_paths`."""
+
+    def write_frame(column_index: int) -> None:
+        frame = data.iloc[:, [column_index]]
+        frame.to_csv(file_paths[column_index], sep="\t", encoding="utf-8")
+
+    with ThreadPoolExecutor(SAMPLE_FILE_THREADS) as executor:
+        # list() so any exceptions are raised here.
+        list(executor.map(write_frame, range(len(file_paths))))
+
+
+def register_sample_files(
+    result: ComputationalResult,
+    sample_file_paths: List[Tuple[Sample, str]],
+    shared_files: List[ComputedFile] = None,
+    is_smashable: bool = True,
+) -> List[ComputedFile]:
+    """Creates a ComputedFile of `result` for each sample's file in `sample_file_paths`.
+
+    The files are hashed in parallel and then they, their samples'
+    associations with them and with `result` are all created in one
+    transaction. Each sample is also associated with every file in
+    `shared_files`. Returns the new ComputedFiles in the same order.
+    """
+    computed_files = []
+    for _, file_path in sample_file_paths:
+        computed_file = ComputedFile()
+        computed_file.absolute_file_path = file_path
+        computed_file.filename = os.path.basename(file_path)
+        computed_file.result = result
+        computed_file.is_smashable = is_smashable
+        computed_file.is_qc = False
+        computed_file.is_public = True
+        computed_files.append(computed_file)
+
+    def calculate_sha1_and_size(computed_file: ComputedFile) -> None:
+        computed_file.calculate_sha1()
+        computed_file.calculate_size()
+
+    with ThreadPoolExecutor(SAMPLE_FILE_THREADS) as executor:
+        list(executor.map(calculate_sha1_and_size, computed_files))
+
+    samples = [sample for sample, _ in sample_file_paths]
+    with transaction.atomic():
+        computed_files = ComputedFile.objects.bulk_create(computed_files)
+
+        # Samples can already be associated with the result or shared files.
+        SampleResultAssociation.objects.bulk_create(
+            [
+                SampleResultAssociation(sample=sample, result=result)
+                for sample in {sample.id: sample for sample in samples}.values()
+            ],
+            ignore_conflicts=True,
+        )
+        file_associations = [
+            SampleComputedFileAssociation(sample=sample, computed_file=computed_file)
+            for sample, computed_file in zip(samples, computed_files)
+        ]
+        for shared_file in shared_files or []:
+            file_associations.extend(
+                SampleComputedFileAssociation(sample=sample, computed_file=shared_file)
+                for sample in samples
+            )
+        SampleComputedFileAssociation.objects.bulk_create(file_associations, ignore_conflicts=True)
+
+    return computed_files
@@ -160,6 +160,10 @@ if ENGAGEMENTBOT_WEBHOOK == "DEFAULT":
     ENGAGEMENTBOT_WEBHOOK = None
 
 MAX_JOBS_PER_NODE = int(get_env_variable("MAX_JOBS_PER_NODE"))
+# How much RAM in MB the jobs in each worker queue can be given in
+# total. The worker instances have 192GB or more, but ECS keeps some
+# of that for itself.
+MAX_RAM_PER_NODE = int(get_env_variable("MAX_RAM_PER_NODE", "184320"))
 MAX_DOWNLOADER_JOBS_PER_NODE = int(get_env_variable("MAX_DOWNLOADER_JOBS_PER_NODE"))
 
 # For testing purposes, sometimes we do not want to dispatch jobs unless specifically told to